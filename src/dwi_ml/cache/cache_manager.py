@@ -25,13 +25,21 @@ class CacheManager(object):
 
 
 class SingleThreadCacheManager(CacheManager):
-    """A single-thread FIFO dictionary cache"""
+    """A single-thread LRU dictionary cache: the least recently used item
+    is removed first."""
 
     def __init__(self, cache_size: int):
         super(SingleThreadCacheManager, self).__init__(cache_size)
         self._cache = dict()
         self._queue = deque()
 
+    def __getitem__(self, item):
+        value = self._cache[item]
+        # Most recently used: moving to the end of the queue.
+        self._queue.remove(item)
+        self._queue.append(item)
+        return value
+
     def __setitem__(self, key, value):
         if len(self._queue) >= self._cache_size:
             to_delete = self._queue.popleft()
@@ -23,6 +23,7 @@ from dwi_ml.experiment_utils.timer import Timer
 from dwi_ml.io_utils import add_memory_args
 from dwi_ml.models.projects.ae_models import ModelAE
 from dwi_ml.training.trainers import DWIMLAbstractTrainer
+from dwi_ml.training.utils.batch_size_tuner import tune_batch_size
 from dwi_ml.training.utils.batch_samplers import (add_args_batch_sampler,
                                                   prepare_batch_sampler)
 from dwi_ml.training.utils.batch_loaders import (add_args_batch_loader)
@@ -42,7 +43,8 @@ def prepare_arg_parser():
     add_training_args(p)
     p.add_argument('streamline_group_name',
                    help="Name of the group in hdf5")
-    add_memory_args(p, add_lazy_options=True, add_rng=True)
+    add_memory_args(p, add_lazy_options=True, add_rng=True,
+                    add_dataloader_options=True)
     add_verbose_arg(p)
 
     return p
@@ -101,8 +103,13 @@ def init_from_args(args, sub_loggers_level):
             max_batches_per_epoch_validation=args.max_batches_per_epoch_validation,
             patience=args.patience, patience_delta=args.patience_delta,
             from_checkpoint=False, clip_grad=args.clip_grad,
+            precision=args.precision,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            activation_checkpointing=args.activation_checkpointing,
             # MEMORY
             nb_cpu_processes=args.nbr_processes, use_gpu=args.use_gpu,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
             log_level=sub_loggers_level)
         logging.info("Trainer params : " +
                      format_dict_to_str(trainer.params_for_checkpoint))
@@ -133,6 +140,10 @@ def main():
 
     trainer = init_from_args(args, sub_loggers_level)
 
+    if args.auto_batch_size:
+        with Timer("\n\nTuning the batch size", newline=True, color='red'):
+            tune_batch_size(trainer, args.auto_batch_size)
+
     run_experiment(trainer)
 
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares a tractogram to a reference tractogram tracked from the same seeds,
+for instance to verify that tracking with a quantized model (option
+--quantize of the tracking scripts) gives the same results as in float32.
+
+Both tractograms must be .trk files saved with --save_seeds, and tracked with
+the same --rng_seed. Preferably, use --compress_th 0 (no compression), as
+directions are compared step by step.
+
+Prints:
+    - The number of streamlines (matched by seed) found in both tractograms.
+    - The mean angular error (degrees) between matched streamlines, step by
+      step from the seed.
+    - The fraction of matched streamlines connecting the same blocs.
+    - The difference between the connectivity matrices (from blocs), as a
+      fraction of the total number of streamlines.
+"""
+import argparse
+import json
+import logging
+
+from dipy.io.streamline import load_tractogram
+import numpy as np
+
+from scilpy.io.utils import (add_overwrite_arg, add_verbose_arg,
+                             assert_inputs_exist, assert_outputs_exist)
+
+from dwi_ml.data.hdf5.utils import format_nb_blocs_connectivity
+from dwi_ml.tracking.utils import compare_tractograms
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument('ref_tractogram',
+                   help="Reference tractogram (.trk, with seeds). Ex: "
+                        "tracked in float32.")
+    p.add_argument('in_tractogram',
+                   help="Tractogram being compared (.trk, with seeds).")
+    p.add_argument(
+        '--connectivity_nb_blocs', metavar='m', type=int, nargs='+',
+        help="Number of 3D blocks (m x m x m) for the connectivity matrix. \n"
+             "If more than one values are provided, expected to be one per "
+             "dimension. \nDefault: 20x20x20.")
+    p.add_argument('--out_json', metavar='file',
+                   help="If set, also saves the results in a json file.")
+    add_overwrite_arg(p)
+    add_verbose_arg(p)
+
+    return p
+
+
+def _load_lines_and_seeds(p, filename):
+    sft = load_tractogram(filename, 'same')
+    if 'seeds' not in sft.data_per_streamline:
+        p.error("No seeds in {}. Track with --save_seeds.".format(filename))
+    sft.to_vox()
+    sft.to_corner()
+    # Seeds are saved in voxel space, center origin.
+    seeds = np.asarray(sft.data_per_streamline['seeds']) + 0.5
+    return sft, list(sft.streamlines), seeds
+
+
+def main():
+    p = _build_arg_parser()
+    args = p.parse_args()
+    logging.getLogger().setLevel(logging.getLevelName(args.verbose))
+
+    assert_inputs_exist(p, [args.ref_tractogram, args.in_tractogram])
+    assert_outputs_exist(p, args, [], args.out_json)
+    nb_blocs = format_nb_blocs_connectivity(args.connectivity_nb_blocs)
+
+    ref_sft, ref_lines, ref_seeds = _load_lines_and_seeds(
+        p, args.ref_tractogram)
+    _, lines, seeds = _load_lines_and_seeds(p, args.in_tractogram)
+
+    results = compare_tractograms(ref_lines, ref_seeds, lines, seeds,
+                                  ref_sft.dimensions, nb_blocs)
+    print("Matched streamlines: {} (out of {} in the reference, {} in the "
+          "compared tractogram)".format(results['nb_matched'],
+                                        len(ref_lines), len(lines)))
+    print("Mean angular error: {:.3f} degrees"
+          .format(results['angular_error']))
+    print("Same connection: {:.2%}".format(results['same_connection']))
+    print("Connectivity difference: {:.2%}"
+          .format(results['connectivity_difference']))
+
+    if args.out_json:
+        with open(args.out_json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
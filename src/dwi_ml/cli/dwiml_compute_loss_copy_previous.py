@@ -22,7 +22,6 @@ from dwi_ml.models.utils.direction_getters import add_direction_getter_args, \
     check_args_direction_getter
 from dwi_ml.testing.testers import TesterWithDirectionGetter
 from dwi_ml.testing.utils import add_args_testing_subj_hdf5
-from dwi_ml.testing.visu_loss import run_all_visu_loss
 from dwi_ml.testing.visu_loss_utils import prepare_args_visu_loss, visu_checks
 
 CHOICES = ['cosine-regression', 'l2-regression', 'sphere-classification',
@@ -70,6 +69,8 @@ def main():
     tester = TesterWithDirectionGetter(model, args.subj_id, args.hdf5_file,
                                        args.subset, args.batch_size, device)
 
+    # Imported here: matplotlib is slow to import.
+    from dwi_ml.testing.visu_loss import run_all_visu_loss
     run_all_visu_loss(tester, model, args, names)
 
 
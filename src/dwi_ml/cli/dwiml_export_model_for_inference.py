@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Exports a trained model as a self-contained file for inference: model type,
+parameters and weights (on CPU), in one file. When loading, weights are
+memory-mapped rather than read and copied.
+
+By default, the file is written as model_for_inference.pt in the experiment's
+model directories (best_model and checkpoint/model). Tracking and testing
+scripts then use it automatically. With --out_file, a single file is written
+(from the best model, or from the latest epoch with --use_latest_epoch); load
+it with your model class' load_model_from_inference_artifact.
+"""
+import argparse
+import logging
+import os
+
+from scilpy.io.utils import (add_overwrite_arg, add_verbose_arg,
+                             assert_outputs_exist)
+
+from dwi_ml.experiment_utils.timer import Timer
+from dwi_ml.io_utils import add_arg_existing_experiment_path
+from dwi_ml.models.main_models import (INFERENCE_ARTIFACT_NAME,
+                                       export_inference_artifact)
+
+
+def _prepare_argparser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    add_arg_existing_experiment_path(p)
+    p.add_argument('--out_file', metavar='file',
+                   help="Output file. Default: saved in the model "
+                        "directories.")
+    add_overwrite_arg(p)
+    add_verbose_arg(p)
+    return p
+
+
+def main():
+    p = _prepare_argparser()
+    args = p.parse_args()
+    logging.getLogger().setLevel(logging.getLevelName(args.verbose))
+
+    if args.out_file:
+        sub_dir = 'checkpoint/model' if args.use_latest_epoch \
+            else 'best_model'
+        model_dirs = [os.path.join(args.experiment_path, sub_dir)]
+        out_files = [args.out_file]
+    else:
+        model_dirs = [os.path.join(args.experiment_path, sub_dir)
+                      for sub_dir in ['best_model', 'checkpoint/model']]
+        model_dirs = [d for d in model_dirs if os.path.isdir(d)]
+        out_files = [os.path.join(d, INFERENCE_ARTIFACT_NAME)
+                     for d in model_dirs]
+    for model_dir in model_dirs:
+        if not os.path.isdir(model_dir):
+            p.error("Model directory {} not found.".format(model_dir))
+    if len(model_dirs) == 0:
+        p.error("No model found in {}.".format(args.experiment_path))
+    assert_outputs_exist(p, args, out_files)
+
+    for model_dir, out_file in zip(model_dirs, out_files):
+        with Timer("Exporting {} to {}".format(model_dir, out_file)):
+            export_inference_artifact(model_dir, out_file)
+
+
+if __name__ == '__main__':
+    main()
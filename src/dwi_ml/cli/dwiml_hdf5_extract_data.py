@@ -14,6 +14,8 @@ from scilpy.io.utils import assert_inputs_exist, assert_outputs_exist, \
 
 from dwi_ml.data.dataset.streamline_containers import \
     load_all_streamlines_from_hdf, load_streamlines_attributes_from_hdf
+from dwi_ml.data.processing.volume.compact_dtypes import \
+    load_volume_as_float32
 from dwi_ml.data.processing.streamlines.post_processing import \
     prepare_figure_connectivity
 
@@ -42,7 +44,7 @@ def _prepare_argparser():
 def extract_volume(group, outname):
     if not outname.endswith('.nii.gz'):
         raise ValueError("outname must end with '.nii.gz' to save a volume.")
-    data = np.asarray(group['data'])
+    data = load_volume_as_float32(group)
     affine = np.asarray(group.attrs['affine'])
     img = nib.Nifti1Image(data, affine)
     logging.info("Saving volume as {}".format(outname))
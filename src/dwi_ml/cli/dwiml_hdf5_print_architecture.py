@@ -4,6 +4,8 @@ import argparse
 import h5py
 from scilpy.io.utils import assert_inputs_exist
 
+from dwi_ml.data.hdf5.utils import INDEX_GROUP, get_subjects_in_hdf
+
 
 def _prepare_argparser():
     p = argparse.ArgumentParser(description=__doc__,
@@ -38,8 +40,11 @@ def main():
             print("- List of testing subjects: {}\n"
                   .format(hdf_handle.attrs['testing_subjs']))
 
+        print("- Dataset index (fast loading): {}\n"
+              .format(INDEX_GROUP in hdf_handle))
+
         print("- For each subject, caracteristics are:")
-        first_subj = list(hdf_handle.keys())[0]
+        first_subj = get_subjects_in_hdf(hdf_handle)[0]
         for key, val in hdf_handle[first_subj].items():
             print("   - {}\n"
                   "       type: {}\n"
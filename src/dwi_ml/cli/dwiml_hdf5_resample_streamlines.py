@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Adds a resampled copy of a streamline group to an existing hdf5 file, for
+all subjects.
+
+If your model's step_size differs from the step size used when creating the
+hdf5, the batch loader resamples the streamlines at every batch of every
+epoch. Instead, you may add a resampled group once with this script, and train
+your model using this new streamline group (--streamline_group_name). The
+batch loader will see that the group's step_size is the same as the model's
+and will not resample again.
+
+The hdf5 is modified in place. Lengths and euclidean lengths of the new group
+are updated, so that the batch sampler's heaviness stays correct. The dataset
+index is rewritten to include the new group.
+"""
+import argparse
+import logging
+
+import h5py
+from scilpy.io.utils import add_verbose_arg, assert_inputs_exist
+
+from dwi_ml.data.hdf5.utils import add_resampled_streamline_group, \
+    get_subjects_in_hdf, write_dataset_index
+
+
+def _prepare_argparser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument('hdf5_file',
+                   help="Path to the hdf5 file. Will be modified.")
+    p.add_argument('streamline_group',
+                   help="Name of the streamline group to resample.")
+    p.add_argument('step_size', type=float,
+                   help="The new step size, in mm.")
+    p.add_argument('--new_group_name',
+                   help="Name of the new streamline group. Default: "
+                        "{streamline_group}_step{step_size}mm.")
+    add_verbose_arg(p)
+    return p
+
+
+def main():
+    p = _prepare_argparser()
+    args = p.parse_args()
+    logging.getLogger().setLevel(logging.getLevelName(args.verbose))
+
+    assert_inputs_exist(p, args.hdf5_file)
+    if args.step_size <= 0:
+        p.error("The step size must be positive.")
+
+    new_group = args.new_group_name or "{}_step{}mm".format(
+        args.streamline_group, args.step_size)
+
+    with h5py.File(args.hdf5_file, 'a') as hdf_handle:
+        subjs = [s for s in get_subjects_in_hdf(hdf_handle)
+                 if args.streamline_group in hdf_handle[s]]
+        if len(subjs) == 0:
+            p.error("Streamline group {} not found in the hdf5."
+                    .format(args.streamline_group))
+
+        for subj in subjs:
+            logging.info("Resampling group {} for subject {}."
+                         .format(args.streamline_group, subj))
+            add_resampled_streamline_group(
+                hdf_handle[subj], args.streamline_group, new_group,
+                args.step_size)
+
+        write_dataset_index(hdf_handle)
+
+    logging.info("Added streamline group {} for {} subjects."
+                 .format(new_group, len(subjs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Adds (or rewrites) the dataset index to an existing hdf5 file.
+
+The index summarizes, for each set, the list of subjects, and for each
+streamline group, the number of streamlines per subject and their lengths. It
+allows the MultiSubjectDataset to load the dataset without walking through
+all subjects. It is written by dwiml_create_hdf5_dataset; use this script on
+hdf5 files created with older versions of dwi_ml.
+
+The hdf5 is modified in place.
+"""
+import argparse
+import logging
+
+import h5py
+from scilpy.io.utils import add_verbose_arg, assert_inputs_exist
+
+from dwi_ml.data.hdf5.utils import write_dataset_index
+
+
+def _prepare_argparser():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument('hdf5_file',
+                   help="Path to the hdf5 file. Will be modified.")
+    add_verbose_arg(p)
+    return p
+
+
+def main():
+    p = _prepare_argparser()
+    args = p.parse_args()
+    logging.getLogger().setLevel(logging.getLevelName(args.verbose))
+
+    assert_inputs_exist(p, args.hdf5_file)
+
+    with h5py.File(args.hdf5_file, 'a') as hdf_handle:
+        write_dataset_index(hdf_handle)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This script allows tracking many subjects from a trained Learn2track or
+Transformer model. The model is loaded once. One tractogram per subject is
+saved in out_dir.
+
+Data is always loaded lazily: while subjects are tracked, the next subjects'
+seeding mask, tracking mask and input volume are loaded in the background.
+
+With --subjects_together n, lines of n subjects are propagated together (by
+batches of --simultaneous_tracking lines). Subjects must then have the same
+resolution, and the tracking mask must use nearest interpolation.
+"""
+import argparse
+import logging
+import os
+
+import dipy.core.geometry as gm
+from dipy.io.utils import is_header_compatible
+import h5py
+
+from scilpy.io.utils import (add_sphere_arg, add_verbose_arg,
+                             assert_inputs_exist, assert_outputs_exist,
+                             verify_compression_th)
+from scilpy.tracking.utils import (add_seeding_options,
+                                   verify_streamline_length_options,
+                                   verify_seed_options, add_out_options)
+
+from dwi_ml.data.dataset.mri_data_containers import MRIData
+from dwi_ml.data.dataset.multi_subject_containers import MultiSubjectDataset
+from dwi_ml.experiment_utils.prints import format_dict_to_str
+from dwi_ml.experiment_utils.timer import Timer
+from dwi_ml.io_utils import verify_which_model_in_path
+from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
+from dwi_ml.models.projects.transformer_models import find_transformer_class
+from dwi_ml.testing.utils import find_hdf5_associated_to_experiment
+from dwi_ml.tracking.io_utils import (add_tracking_options,
+                                      prepare_seed_generator,
+                                      prepare_tracking_mask,
+                                      save_tractogram_and_seeds)
+from dwi_ml.tracking.multi_subject_tracking import (SubjectTrackingData,
+                                                    track_multiple_subjects)
+from dwi_ml.tracking.projects.learn2track_tracker import RecurrentTracker
+from dwi_ml.tracking.projects.transformer_tracker import TransformerTracker
+from dwi_ml.tracking.tracking_mask import TrackingMask
+
+# Also, after upgrading torch, I now have a lot of warnings:
+# FutureWarning: `torch.distributed.reduce_op` is deprecated, please use
+# `torch.distributed.ReduceOp` instead
+# But I don't use torch.distributed anywhere. Comes from inside torch.
+# Hiding warnings for now.
+import warnings
+warnings.filterwarnings("ignore",
+                        message="`torch.distributed.reduce_op` is deprecated")
+
+
+def build_argparser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=__doc__)
+
+    track_g = add_tracking_options(p, multiple_subjects=True)
+    # Sphere used if the direction_getter key is the sphere-classification.
+    add_sphere_arg(track_g, symmetric_only=False)
+    track_g.add_argument(
+        '--subjects_together', type=int, default=1, metavar='n',
+        help="Number of subjects whose lines are propagated together. "
+             "Requires \n--simultaneous_tracking. [%(default)s]")
+
+    # As in scilpy:
+    add_seeding_options(p)
+    add_out_options(p)
+
+    add_verbose_arg(p)
+
+    return p
+
+
+def load_model(args, sub_loggers_level):
+    if args.use_latest_epoch:
+        model_dir = os.path.join(args.experiment_path, 'best_model')
+    else:
+        model_dir = os.path.join(args.experiment_path, 'checkpoint/model')
+    model_type = verify_which_model_in_path(model_dir)
+    print("Model's class: {}".format(model_type))
+    if model_type == Learn2TrackModel.__name__:
+        cls, tracker_cls = Learn2TrackModel, RecurrentTracker
+    else:
+        cls, tracker_cls = find_transformer_class(model_type), \
+            TransformerTracker
+    model = cls.load_model_from_params_and_state(model_dir,
+                                                 sub_loggers_level)
+    logging.info("* Formatted model: " +
+                 format_dict_to_str(model.params_for_checkpoint))
+    if args.cnn_volume_features:
+        model.cnn_volume_features = True
+        model.set_cnn_features_cache_size(args.subjects_together)
+
+    return model, tracker_cls
+
+
+def prepare_subject_loader(parser, args, hdf5_file):
+    """
+    Returns the function loading a subject's data. It is called from the
+    background thread, which uses its own hdf handle.
+    """
+    hdf_handle = h5py.File(hdf5_file, 'r')
+
+    def load_subject(subj_id):
+        seed_generator, nbr_seeds, seeding_mask_header, ref = \
+            prepare_seed_generator(parser, args, hdf_handle, subj_id)
+
+        if args.tracking_mask_group is not None:
+            tracking_mask, ref2 = prepare_tracking_mask(
+                hdf_handle, args.tracking_mask_group, subj_id,
+                args.mask_interp)
+            is_header_compatible(ref2, seeding_mask_header)
+        else:
+            tracking_mask = TrackingMask(ref.shape)
+
+        volume = MRIData.init_mri_data_from_hdf_info(
+            hdf_handle[subj_id][args.input_group])
+        return SubjectTrackingData(subj_id, seed_generator, nbr_seeds,
+                                   tracking_mask, ref,
+                                   {args.input_group: volume})
+
+    return load_subject, hdf_handle
+
+
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
+
+    # Setting root logger to high level to max info, not debug, prints way too
+    # much stuff. (but we can set our tracker's logger to debug)
+    root_level = args.verbose
+    if root_level == 'DEBUG':
+        root_level = 'INFO'
+    logging.getLogger().setLevel(level=root_level)
+    sub_loggers_level = root_level
+
+    # ----- Checks
+    if args.subjects_together > 1:
+        if args.simultaneous_tracking < 2:
+            parser.error("--subjects_together requires "
+                         "--simultaneous_tracking.")
+        if args.tracking_mask_group is not None and \
+                args.mask_interp != 'nearest':
+            parser.error("--subjects_together requires nearest "
+                         "interpolation of the tracking mask.")
+    if args.save_seeds and args.out_format != 'trk':
+        parser.error("Cannot save seeds! (data per streamline not saved "
+                     "with format {}). Please use --out_format trk."
+                     .format(args.out_format))
+
+    assert_inputs_exist(parser, [], args.hdf5_file)
+    verify_streamline_length_options(parser, args)
+    verify_compression_th(args.compress_th)
+    verify_seed_options(parser, args)
+
+    hdf5_file = args.hdf5_file or find_hdf5_associated_to_experiment(
+        args.experiment_path)
+
+    with Timer("\nLoading data and preparing tracker...",
+               newline=True, color='green'):
+        logging.info("Loading subjects' (lazy) data.")
+        # Current subjects + the ones added to the cache before tracking.
+        cache_size = max(args.cache_size, args.subjects_together)
+        dataset = MultiSubjectDataset(hdf5_file, lazy=True,
+                                      cache_size=cache_size,
+                                      log_level=sub_loggers_level)
+        dataset.load_data(
+            load_training=args.subset == 'training',
+            load_validation=args.subset == 'validation',
+            load_testing=args.subset == 'testing',
+            volume_groups=[args.input_group], streamline_groups=[])
+        subset = getattr(dataset, args.subset + '_set')
+
+        subj_ids = args.subj_ids or subset.subjs_data_list.subject_ids
+        unknown = set(subj_ids) - set(subset.subjs_data_list.subject_ids)
+        if len(unknown) > 0:
+            parser.error("Subjects {} not found in the {} set."
+                         .format(sorted(unknown), args.subset))
+
+        os.makedirs(args.out_dir, exist_ok=True)
+        out_files = [os.path.join(args.out_dir, '{}.{}'.format(
+            subj_id, args.out_format)) for subj_id in subj_ids]
+        assert_outputs_exist(parser, args, out_files)
+
+        logging.info("Loading model.")
+        model, tracker_cls = load_model(args, sub_loggers_level)
+
+        # The tracker is created with the first subject, then bound to each
+        # group of subjects.
+        load_subject, hdf_handle = prepare_subject_loader(parser, args,
+                                                          hdf5_file)
+        first_subj = load_subject(subj_ids[0])
+
+        logging.debug("Instantiating tracker.")
+        tracker = tracker_cls(
+            input_volume_group=args.input_group,
+            dataset=subset,
+            subj_idx=subset.subjs_data_list.subject_ids.index(subj_ids[0]),
+            model=model, mask=first_subj.mask,
+            seed_generator=first_subj.seed_generator,
+            nbr_seeds=first_subj.nbr_seeds,
+            min_len_mm=args.min_length, max_len_mm=args.max_length,
+            compression_th=args.compress_th, nbr_processes=args.nbr_processes,
+            save_seeds=args.save_seeds, rng_seed=args.rng_seed,
+            track_forward_only=args.track_forward_only,
+            step_size_mm=args.step_size, algo=args.algo,
+            theta=gm.math.radians(args.theta),
+            use_gpu=args.use_gpu, precision=args.precision,
+            quantization=args.quantize,
+            samples_per_seed=args.samples_per_seed,
+            spatial_sorting=args.spatial_sorting,
+            eos_stopping_thresh=args.eos_stop,
+            simultaneous_tracking=args.simultaneous_tracking,
+            append_last_point=not args.discard_last_point,
+            log_level=args.verbose)
+
+    # ----- Track
+    with Timer("\nTracking {} subjects...".format(len(subj_ids)),
+               newline=True, color='blue'):
+        for subj_data, lines, seeds in track_multiple_subjects(
+                tracker, subj_ids, load_subject, args.subjects_together,
+                first_subj_data=first_subj):
+            logging.info("Subject {}: tracked {} streamlines (out of {} "
+                         "seeds).".format(subj_data.subj_id, len(lines),
+                                          subj_data.nbr_seeds))
+            save_tractogram_and_seeds(
+                lines, seeds, subj_data.ref,
+                out_files[subj_ids.index(subj_data.subj_id)],
+                args.save_seeds)
+
+    hdf_handle.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -35,6 +35,7 @@ from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
 from dwi_ml.models.projects.learn2track_utils import add_model_args
 from dwi_ml.models.utils.direction_getters import check_args_direction_getter
 from dwi_ml.training.projects.learn2track_trainer import Learn2TrackTrainer
+from dwi_ml.training.utils.batch_size_tuner import tune_batch_size
 from dwi_ml.training.utils.batch_samplers import (add_args_batch_sampler,
                                                   prepare_batch_sampler)
 from dwi_ml.training.utils.batch_loaders import (add_args_batch_loader,
@@ -51,8 +52,10 @@ def prepare_arg_parser():
     add_mandatory_args_experiment_and_hdf5_path(p)
     add_args_batch_sampler(p)
     add_args_batch_loader(p)
-    add_training_args(p, add_a_tracking_validation_phase=True)
-    add_memory_args(p, add_lazy_options=True, add_rng=True)
+    add_training_args(p, add_a_tracking_validation_phase=True,
+                      add_validation_cache=True)
+    add_memory_args(p, add_lazy_options=True, add_rng=True,
+                    add_dataloader_options=True)
     add_verbose_arg(p)
     add_model_args(p)
 
@@ -129,13 +132,22 @@ def init_from_args(args, sub_loggers_level):
             max_batches_per_epoch_validation=args.max_batches_per_epoch_validation,
             patience=args.patience, patience_delta=args.patience_delta,
             from_checkpoint=False, clip_grad=args.clip_grad,
+            precision=args.precision,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            activation_checkpointing=args.activation_checkpointing,
             # (generation validation:)
             add_a_tracking_validation_phase=args.add_a_tracking_validation_phase,
             tracking_phase_frequency=args.tracking_phase_frequency,
             tracking_phase_nb_segments_init=args.tracking_phase_nb_segments_init,
             tracking_phase_mask_group=args.tracking_mask,
+            tracking_phase_cache_size=args.tracking_phase_cache_size,
             # MEMORY
+            validation_cache_size=args.validation_cache_size,
+            validation_cache_dir=args.validation_cache_dir,
+            cnn_volume_features=args.cnn_volume_features,
             nb_cpu_processes=args.nbr_processes, use_gpu=args.use_gpu,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
             log_level=args.verbose)
         logging.info("Trainer params : " +
                      format_dict_to_str(trainer.params_for_checkpoint))
@@ -166,6 +178,10 @@ def main():
 
     trainer = init_from_args(args, sub_loggers_level)
 
+    if args.auto_batch_size:
+        with Timer("\n\nTuning the batch size", newline=True, color='red'):
+            tune_batch_size(trainer, args.auto_batch_size)
+
     run_experiment(trainer)
 
 
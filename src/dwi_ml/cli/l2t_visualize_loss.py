@@ -20,7 +20,6 @@ from dwi_ml.io_utils import add_arg_existing_experiment_path
 from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
 from dwi_ml.testing.testers import TesterOneInput
 from dwi_ml.testing.utils import add_args_testing_subj_hdf5
-from dwi_ml.testing.visu_loss import run_all_visu_loss
 from dwi_ml.testing.visu_loss_utils import prepare_args_visu_loss, visu_checks
 
 
@@ -68,8 +67,11 @@ def main():
     tester = TesterOneInput(
         model=model, batch_size=args.batch_size, device=device,
         subj_id=args.subj_id, hdf5_file=args.hdf5_file,
-        subset_name=args.subset, volume_group=args.input_group)
+        subset_name=args.subset, volume_group=args.input_group,
+        precision=args.precision)
 
+    # Imported here: matplotlib is slow to import.
+    from dwi_ml.testing.visu_loss import run_all_visu_loss
     run_all_visu_loss(tester, model, args, names)
 
 
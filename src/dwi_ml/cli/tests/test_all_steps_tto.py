@@ -29,6 +29,15 @@ def test_help_option(script_runner):
     ret = script_runner.run('tt_track_from_model', '--help')
     assert ret.success
 
+    ret = script_runner.run('dwiml_track_multiple_subjects', '--help')
+    assert ret.success
+
+    ret = script_runner.run('dwiml_export_model_for_inference', '--help')
+    assert ret.success
+
+    ret = script_runner.run('dwiml_compare_tractograms', '--help')
+    assert ret.success
+
     ret = script_runner.run('tt_visualize_loss', '--help')
     assert ret.success
 
@@ -110,6 +119,61 @@ def test_execution(script_runner, experiments_path):
 
     assert ret.success
 
+    logging.info("************ TESTING MANY SAMPLES PER SEED ************")
+    out_tractogram = os.path.join(tmp_dir.name, 'test_tractogram_prob.trk')
+    ret = script_runner.run(
+        'tt_track_from_model', whole_experiment_path, subj_id,
+        input_group, out_tractogram, seeding_mask_group,
+        '--hdf5_file', hdf5_file,
+        '--algo', 'prob', '--samples_per_seed', '3', '--nt', '2',
+        '--rng_seed', '0', '--min_length', '0', '--subset', 'training',
+        '--max_length', str(MAX_LEN * 0.5), '--step', '0.5',
+        '--simultaneous_tracking', '6',
+        '--tracking_mask_group', tracking_mask_group)
+    assert ret.success
+
+    logging.info("************ TESTING QUANTIZED TRACKING ************")
+    # Compared to float32, from the same seeds.
+    tractograms = {}
+    for quantize in [[], ['--quantize', 'dynamic']]:
+        name = 'int8' if quantize else 'float32'
+        tractograms[name] = os.path.join(tmp_dir.name, name + '.trk')
+        ret = script_runner.run(
+            'tt_track_from_model', whole_experiment_path, subj_id,
+            input_group, tractograms[name], seeding_mask_group,
+            '--hdf5_file', hdf5_file,
+            '--algo', 'det', '--nt', '2', '--rng_seed', '0',
+            '--min_length', '0', '--subset', 'training', '--save_seeds',
+            '--max_length', str(MAX_LEN * 0.5), '--step', '0.5',
+            '--compress_th', '0', '--tracking_mask_group',
+            tracking_mask_group, *quantize)
+        assert ret.success
+
+    ret = script_runner.run('dwiml_compare_tractograms',
+                            tractograms['float32'], tractograms['int8'],
+                            '--connectivity_nb_blocs', '5')
+    assert ret.success
+
+    logging.info("************ TESTING EXPORT FOR INFERENCE ************")
+    ret = script_runner.run('dwiml_export_model_for_inference',
+                            whole_experiment_path)
+    assert ret.success
+
+    # Now tracking with the exported model.
+    logging.info("************ TESTING TRACKING MANY SUBJECTS ************")
+    out_dir = os.path.join(tmp_dir.name, 'tractograms')
+    ret = script_runner.run(
+        'dwiml_track_multiple_subjects', whole_experiment_path,
+        input_group, out_dir, seeding_mask_group, '--hdf5_file', hdf5_file,
+        '--algo', 'det', '--nt', '2', '--rng_seed', '0',
+        '--min_length', '0', '--subset', 'training',
+        '--max_length', str(MAX_LEN * 0.5), '--step', '0.5',
+        '--tracking_mask_group', tracking_mask_group,
+        '--simultaneous_tracking', '2', '--subjects_together', '2',
+        '--spatial_sorting', '2')
+    assert ret.success
+    assert os.path.isfile(os.path.join(out_dir, subj_id + '.trk'))
+
     # Test visu loss
     prefix = 'fornix_'
     ret = script_runner.run('tt_visualize_loss', whole_experiment_path,
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from dwi_ml.unit_tests.utils.data_and_models_for_tests import \
+    fetch_testing_data
+
+data_dir = fetch_testing_data()
+tmp_dir = tempfile.TemporaryDirectory()
+
+
+def test_help_option(script_runner):
+    ret = script_runner.run('dwiml_hdf5_write_index', '--help')
+    assert ret.success
+
+
+def test_execution(script_runner):
+    os.chdir(os.path.expanduser(tmp_dir.name))
+    hdf5_file = os.path.join(data_dir, 'hdf5_file.hdf5')
+    shutil.copy(hdf5_file, 'hdf5_file.hdf5')
+    ret = script_runner.run('dwiml_hdf5_write_index', 'hdf5_file.hdf5')
+    assert ret.success
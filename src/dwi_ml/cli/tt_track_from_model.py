@@ -106,6 +106,8 @@ def prepare_tracker(parser, args):
                                                      sub_loggers_level)
         logging.info("* Formatted model: " +
                      format_dict_to_str(model.params_for_checkpoint))
+        if args.cnn_volume_features:
+            model.cnn_volume_features = True
 
         theta = gm.math.radians(args.theta)
         logging.debug("Instantiating tracker.")
@@ -119,7 +121,11 @@ def prepare_tracker(parser, args):
             save_seeds=args.save_seeds, rng_seed=args.rng_seed,
             track_forward_only=args.track_forward_only,
             step_size_mm=args.step_size, algo=args.algo, theta=theta,
-            use_gpu=args.use_gpu, eos_stopping_thresh=args.eos_stop,
+            use_gpu=args.use_gpu, precision=args.precision,
+            quantization=args.quantize,
+            samples_per_seed=args.samples_per_seed,
+            spatial_sorting=args.spatial_sorting,
+            eos_stopping_thresh=args.eos_stop,
             simultaneous_tracking=args.simultaneous_tracking,
             append_last_point=append_last_point,
             log_level=args.verbose)
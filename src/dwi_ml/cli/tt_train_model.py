@@ -38,6 +38,7 @@ from dwi_ml.models.projects.transformers_utils import (
     add_transformers_model_args)
 from dwi_ml.models.utils.direction_getters import check_args_direction_getter
 from dwi_ml.training.projects.transformer_trainer import TransformerTrainer
+from dwi_ml.training.utils.batch_size_tuner import tune_batch_size
 from dwi_ml.training.utils.batch_samplers import (add_args_batch_sampler,
                                                   prepare_batch_sampler)
 from dwi_ml.training.utils.batch_loaders import (add_args_batch_loader,
@@ -55,12 +56,14 @@ def prepare_arg_parser():
     add_verbose_arg(p)
     add_args_batch_sampler(p)
     add_args_batch_loader(p)
-    add_training_args(p, add_a_tracking_validation_phase=True)
+    add_training_args(p, add_a_tracking_validation_phase=True,
+                      add_validation_cache=True)
 
     # Specific to Transformers:
     add_transformers_model_args(p)
 
-    add_memory_args(p, add_lazy_options=True, add_rng=True)
+    add_memory_args(p, add_lazy_options=True, add_rng=True,
+                    add_dataloader_options=True)
 
     return p
 
@@ -117,6 +120,7 @@ def init_from_args(args, sub_loggers_level):
             # Concerning inputs:
             max_len=args.max_len, nb_features=args.nb_features,
             positional_encoding_key=args.position_encoding,
+            attention_window=args.attention_window,
             input_embedding_key=args.input_embedding_key,
             input_embedded_size=args.input_embedded_size,
             nb_cnn_filters=args.nb_cnn_filters, kernel_size=args.kernel_size,
@@ -156,13 +160,22 @@ def init_from_args(args, sub_loggers_level):
             max_batches_per_epoch_validation=args.max_batches_per_epoch_validation,
             patience=args.patience, patience_delta=args.patience_delta,
             from_checkpoint=False, clip_grad=args.clip_grad,
+            precision=args.precision,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            activation_checkpointing=args.activation_checkpointing,
             # (generation validation:)
             add_a_tracking_validation_phase=args.add_a_tracking_validation_phase,
             tracking_phase_frequency=args.tracking_phase_frequency,
             tracking_phase_nb_segments_init=args.tracking_phase_nb_segments_init,
             tracking_phase_mask_group=args.tracking_mask,
+            tracking_phase_cache_size=args.tracking_phase_cache_size,
             # MEMORY
+            validation_cache_size=args.validation_cache_size,
+            validation_cache_dir=args.validation_cache_dir,
+            cnn_volume_features=args.cnn_volume_features,
             nb_cpu_processes=args.nbr_processes, use_gpu=args.use_gpu,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
             log_level=args.verbose)
         logging.info("Trainer params : " +
                      format_dict_to_str(trainer.params_for_checkpoint))
@@ -191,6 +204,10 @@ def main():
 
     trainer = init_from_args(args, sub_loggers_level)
 
+    if args.auto_batch_size:
+        with Timer("\n\nTuning the batch size", newline=True, color='red'):
+            tune_batch_size(trainer, args.auto_batch_size)
+
     run_experiment(trainer)
 
 
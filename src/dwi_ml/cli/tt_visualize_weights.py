@@ -9,7 +9,6 @@ from scilpy.io.utils import assert_outputs_exist
 
 from dwi_ml.testing.projects.tt_visu_argparser import \
     build_argparser_transformer_visu
-from dwi_ml.testing.projects.tt_visu_main import tt_visualize_weights_main
 from dwi_ml.testing.projects.tt_visu_utils import get_out_dir_and_create, \
     get_config_filename
 
@@ -51,6 +50,9 @@ def main():
 
     # Running.
     if run_locally:
+        # Imported here: matplotlib and bertviz are slow to import.
+        from dwi_ml.testing.projects.tt_visu_main import \
+            tt_visualize_weights_main
         tt_visualize_weights_main(args, parser)
     else:
         # PREPARING TO RUN THROUGH JUPYTER
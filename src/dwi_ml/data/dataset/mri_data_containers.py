@@ -8,6 +8,9 @@ import torch
 
 from torch import Tensor
 
+from dwi_ml.data.processing.volume.compact_dtypes import \
+    load_compact_volume_as_tensor
+
 logger = logging.getLogger('dataset_logger')
 
 
@@ -22,7 +25,7 @@ class MRIDataAbstract(object):
     could contain data from many "real" MRI volumes concatenated together.
     """
     def __init__(self, data: Union[torch.Tensor, h5py.Group],
-                 voxres: np.ndarray, affine: np.ndarray):
+                 voxres: np.ndarray, affine: np.ndarray, scaling=None):
         """
         Parameters
         ----------
@@ -34,10 +37,14 @@ class MRIDataAbstract(object):
             The pixel resolution, ex, using img.header.get_zooms()[:3].
         affine: np.array
             The affine.
+        scaling: Tuple[Tensor, Tensor] or None
+            For data saved as int16 in the hdf5: the (scale, offset) per
+            feature, to apply after interpolation. See compact_dtypes.py.
         """
         # Data management depends on lazy or not
         self.voxres = voxres
         self.affine = affine
+        self.scaling = scaling
 
         # _data: in lazy, it is a hdf5 group. In non-lazy, it is the already
         # loaded data.
@@ -53,7 +60,9 @@ class MRIDataAbstract(object):
         raise NotImplementedError
 
     def get_data_as_tensor(self, device) -> Tensor:
-        """Returns the _data in the tensor format."""
+        """Returns the _data in the tensor format. Data is kept in the dtype
+        used in the hdf5 (float32, float16, bfloat16 or int16). Use
+        self.scaling to dequantize int16 data after interpolation."""
         raise NotImplementedError
 
     @property
@@ -70,20 +79,20 @@ class MRIData(MRIDataAbstract):
     In this child class, the data is a np.array containing the loaded data.
     """
     def __init__(self, data: torch.Tensor, voxres: np.ndarray,
-                 affine: np.ndarray):
-        super().__init__(data, voxres, affine)
+                 affine: np.ndarray, scaling=None):
+        super().__init__(data, voxres, affine, scaling)
 
     @classmethod
     def init_mri_data_from_hdf_info(cls, hdf_group: h5py.Group):
         """
         Creating class instance from the hdf in cases where data is not
-        loaded yet. Non-lazy = loading the data here.
+        loaded yet. Non-lazy = loading the data here, in its compact dtype.
         """
-        data = torch.as_tensor(np.array(hdf_group['data'], dtype=np.float32))
+        data, scaling = load_compact_volume_as_tensor(hdf_group)
         voxres = np.array(hdf_group.attrs['voxres'], dtype=np.float32)
         affine = np.array(hdf_group.attrs['affine'], dtype=np.float32)
 
-        return cls(data, voxres, affine)
+        return cls(data, voxres, affine, scaling)
 
     def get_data_as_tensor(self, device):
         # Data is already a np.array
@@ -102,7 +111,7 @@ class LazyMRIData(MRIDataAbstract):
     """
 
     def __init__(self, data: Union[h5py.Group, None], voxres: np.ndarray,
-                 affine: np.ndarray):
+                 affine: np.ndarray, scaling=None):
         """
         Here the data is a hdf5 group. Accessing it will load it.
 
@@ -116,7 +125,7 @@ class LazyMRIData(MRIDataAbstract):
         This lazy version is still useful for a big database: We can they clear
         the volume in memory before accessing another subject's.
         """
-        super().__init__(data, voxres, affine)
+        super().__init__(data, voxres, affine, scaling)
 
     @classmethod
     def init_mri_data_from_hdf_info(cls, hdf_group: h5py.Group):
@@ -124,22 +133,27 @@ class LazyMRIData(MRIDataAbstract):
         Creating class instance from the hdf in cases where data is not
         loaded yet. Not loading the data, but loading the voxres.
         """
-        data = hdf_group['data']
+        data = hdf_group
         voxres = np.array(hdf_group.attrs['voxres'], dtype=np.float32)
         affine = np.array(hdf_group.attrs['affine'], dtype=np.float32)
 
+        # Scaling is loaded with the data.
         return cls(data, voxres, affine)
 
+    @property
+    def shape(self):
+        return np.array(self._data['data'].shape)
+
     # All three methods below load the data.
     # Data is not loaded yet, but sending it to a np.array will load it.
 
     def get_data_as_tensor(self, device):
         logger.debug("Loading from hdf5 now: {}".format(self._data))
-        return torch.as_tensor(np.array(self._data, dtype=np.float32),
-                               dtype=torch.float, device=device)
+        data, self.scaling = load_compact_volume_as_tensor(self._data, device)
+        return data
 
     @property
     def as_non_lazy(self):
         logger.debug("Loading from hdf5 now: {}".format(self._data))
-        return MRIData(torch.as_tensor(np.array(self._data, dtype=np.float32)),
-                       self.voxres, self.affine)
+        data, self.scaling = load_compact_volume_as_tensor(self._data)
+        return MRIData(data, self.voxres, self.affine, self.scaling)
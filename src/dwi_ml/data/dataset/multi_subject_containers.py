@@ -18,6 +18,7 @@ from dwi_ml.data.dataset.subjectdata_list_containers import (
     LazySubjectsDataList, SubjectsDataList)
 from dwi_ml.data.dataset.single_subject_containers import (LazySubjectData,
                                                            SubjectData)
+from dwi_ml.data.hdf5.utils import INDEX_GROUP
 
 logger = logging.getLogger('dataset_logger')
 
@@ -73,31 +74,72 @@ class MultisubjectSubset(Dataset):
         # Preprocessing information will be found in the hdf5 later.
         self.step_size = None
         self.compress = None
+        self.nb_points = None
+        # One value per streamline group. Groups added with
+        # dwiml_hdf5_resample_streamlines have their own step size.
+        self.streamline_step_sizes = []  # type: List[float]
 
         self.is_lazy = lazy
 
         # This is only used in the lazy case.
         self.cache_size = cache_size
         self.volume_cache_manager = None  # type: SingleThreadCacheManager
+        # Cache statistics (reset by the trainer at each epoch).
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Volumes saved as int16 in the hdf5 must be dequantized after
+        # interpolation. Remembering their (scale, offset) here, with the same
+        # keys as the cache. Small; never emptied.
+        self.volume_scalings = {}  # type: Dict[str, Tuple]
 
     def close_all_handles(self):
         if self.subjs_data_list.hdf_handle:
             self.subjs_data_list.hdf_handle.close()
             self.subjs_data_list.hdf_handle = None
-        for i in range(self.nb_subjects):
-            s = self.subjs_data_list[i]
+        for s in self.subjs_data_list.created_subjects():
             if s.hdf_handle:
                 s.hdf_handle.close()
                 s.hdf_handle = None
 
+    def open_worker_handle(self):
+        """
+        To be called at the start of a DataLoader worker process. With fork,
+        the worker inherits the parent's hdf handles, which h5py does not
+        support using in a child process: they are forgotten (without closing
+        them, the parent may still be using them) and the worker opens its
+        own handle, kept for the worker's lifetime. With spawn, handles were
+        not pickled (see __getstate__).
+        """
+        if not self.is_lazy or self.subjs_data_list is None:
+            return
+        self.subjs_data_list.hdf_handle = None
+        for s in self.subjs_data_list.created_subjects():
+            s.hdf_handle = None
+        self.subjs_data_list.hdf_handle = h5py.File(self.hdf5_file, 'r')
+        logger.debug("PROCESS ID {}: Worker opened its handle for the {} set."
+                     .format(os.getpid(), self.set_name))
+
+    def __getstate__(self):
+        # Pickled to be sent to DataLoader workers (spawn start method):
+        # the volume cache is not copied. Each worker builds its own.
+        state = self.__dict__.copy()
+        state['volume_cache_manager'] = None
+        return state
+
     def set_subset_info(self, volume_groups, nb_features, streamline_groups,
-                        contains_connectivity, step_size, compress):
+                        contains_connectivity, step_size, compress,
+                        streamline_step_sizes=None, nb_points=None):
         self.volume_groups = volume_groups
         self.nb_features = nb_features
         self.streamline_groups = streamline_groups
         self.contains_connectivity = contains_connectivity
         self.step_size = step_size
         self.compress = compress
+        self.nb_points = nb_points
+        if streamline_step_sizes is None:
+            streamline_step_sizes = [step_size] * len(streamline_groups)
+        self.streamline_step_sizes = streamline_step_sizes
 
     @property
     def params(self) -> Dict[str, Any]:
@@ -155,6 +197,8 @@ class MultisubjectSubset(Dataset):
         Returns
         -------
         mri_data: Union[Tensor, DatasetVolume]
+            The volume, in the compact dtype used in the hdf5 (float32,
+            float16, bfloat16 or int16). See get_volume_scaling.
         """
         # Note. Developer's choice:
         # There will be one cache manager per subset. This could be moved to
@@ -181,9 +225,12 @@ class MultisubjectSubset(Dataset):
             if cache_key in self.volume_cache_manager:
                 mri_data_tensor = self.volume_cache_manager[cache_key]
                 was_cached = True
+                self.cache_hits += 1
 
                 # User should not change device between calls but just checking
                 mri_data_tensor = mri_data_tensor.to(device)
+            else:
+                self.cache_misses += 1
 
         if not was_cached:
             # Either non-lazy or if lazy, data was not cached.
@@ -191,6 +238,7 @@ class MultisubjectSubset(Dataset):
             logger.debug("Getting a new volume from the dataset.")
             mri_data = self.get_mri_data(subj_idx, group_idx)
             mri_data_tensor = mri_data.get_data_as_tensor(device)
+            self.volume_scalings[cache_key] = mri_data.scaling
 
             # Add to cache the tensor (on correct device)
             if self.cache_size:
@@ -201,6 +249,45 @@ class MultisubjectSubset(Dataset):
 
         return mri_data_tensor
 
+    def add_volume_to_cache(self, subj_idx: int, group_idx: int,
+                            mri_data: MRIDataAbstract,
+                            device: torch.device = torch.device('cpu')):
+        """
+        Adds an already loaded volume to the cache, ex when it was prefetched
+        in another thread. Does nothing if there is no cache.
+        """
+        if not self.cache_size:
+            return
+        if self.volume_cache_manager is None:
+            self.volume_cache_manager = \
+                SingleThreadCacheManager(self.cache_size)
+        cache_key = str(subj_idx) + '.' + str(group_idx)
+        self.volume_scalings[cache_key] = mri_data.scaling
+        self.volume_cache_manager[cache_key] = \
+            mri_data.get_data_as_tensor(device)
+
+    def get_volume_scaling(self, subj_idx: int, group_idx: int):
+        """
+        Returns the (scale, offset) to apply to the interpolated data of a
+        volume saved as int16 in the hdf5, or None. The volume must have been
+        accessed first through get_volume_verify_cache.
+        """
+        cache_key = str(subj_idx) + '.' + str(group_idx)
+        return self.volume_scalings.get(cache_key, None)
+
+    def reset_cache_stats(self):
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def cache_hit_rate(self):
+        """Ratio of volume accesses found in the cache, or None if the cache
+        was not used since the last reset."""
+        nb_accesses = self.cache_hits + self.cache_misses
+        if nb_accesses == 0:
+            return None
+        return self.cache_hits / nb_accesses
+
     def empty_cache_now(self):
         if self.volume_cache_manager is not None:
             self.volume_cache_manager.empty_cache()
@@ -239,6 +326,11 @@ class MultisubjectSubset(Dataset):
         """
         Load all subjects for this subjset (either training, validation or
         testing).
+
+        If the hdf5 contains a dataset index (see
+        dwi_ml.data.hdf5.utils.write_dataset_index), streamlines' lengths are
+        read from it instead of from each subject. With lazy data, subjects'
+        containers are then only created on first access.
         """
         # Checking if there are any subjects to load
         subject_keys = sorted(hdf_handle.attrs[self.set_name + '_subjs'])
@@ -265,18 +357,113 @@ class MultisubjectSubset(Dataset):
         self.streamline_ids_per_subj = \
             [defaultdict(slice) for _ in self.streamline_groups]
         self.total_nb_streamlines = [0 for _ in self.streamline_groups]
-        self.total_nb_points = [0 for _ in self.streamline_groups]
 
+        ref_group_info = (self.volume_groups, self.nb_features,
+                          self.streamline_groups, self.contains_connectivity)
+
+        set_index = self._get_set_index(hdf_handle)
+        if set_index is None:
+            lengths, lengths_mm = self._load_subjects_and_lengths(
+                hdf_handle, subject_keys, ref_group_info)
+        else:
+            lengths, lengths_mm = self._load_lengths_from_index(
+                set_index, subject_keys)
+            if self.is_lazy:
+                # Subjects' containers will be created on first access.
+                self.subjs_data_list.group_info = ref_group_info
+                for subj_id in subject_keys:
+                    self.subjs_data_list.add_subject_id(subj_id)
+            else:
+                self._load_subjects_and_lengths(hdf_handle, subject_keys,
+                                                ref_group_info,
+                                                keep_lengths=False)
+
+        # Arrange final data properties: Concatenate all subjects
+        logging.debug("All subjects added. Final verifications.")
+        self.streamline_lengths_mm = \
+            [np.concatenate(lengths_mm[group], axis=0)
+             for group in range(len(self.streamline_groups))]
+        self.streamline_lengths = \
+            [np.concatenate(lengths[i], axis=0)
+             for i in range(len(self.streamline_groups))]
+        self.total_nb_points = \
+            [sum(self.streamline_lengths[group])
+             for group in range(len(self.streamline_groups))]
+
+    def _get_set_index(self, hdf_handle: h5py.File):
+        """
+        Returns this set's part of the dataset index, or None if the hdf5
+        has no index, or if it does not fit the current hdf5 (ex, a streamline
+        group was added after the index was written).
+        """
+        if INDEX_GROUP not in hdf_handle:
+            logger.info("No dataset index in the hdf5: reading all subjects. "
+                        "You may add one with dwiml_hdf5_write_index.")
+            return None
+
+        set_index = hdf_handle[INDEX_GROUP][self.set_name]
+        indexed_subjs = list(set_index.attrs['subjs'])
+        all_subjs = sorted(hdf_handle.attrs[self.set_name + '_subjs'])
+        missing_groups = [g for g in self.streamline_groups
+                          if g not in set_index]
+        if indexed_subjs != all_subjs or len(missing_groups) > 0:
+            logger.warning("The hdf5's dataset index is outdated: reading all "
+                           "subjects. Please rewrite it with "
+                           "dwiml_hdf5_write_index.")
+            return None
+        return set_index
+
+    def _load_lengths_from_index(self, set_index: h5py.Group,
+                                 subject_keys: List[str]):
+        """
+        Reads the streamlines' ids and lengths from the index. Returns the
+        lengths and lengths_mm: one list of np arrays per group.
+        """
+        indexed_subjs = list(set_index.attrs['subjs'])
+        lengths = []
+        lengths_mm = []
+        for group_idx, group in enumerate(self.streamline_groups):
+            nb_streamlines = np.asarray(set_index[group]['nb_streamlines'])
+            group_lengths = np.asarray(set_index[group]['lengths'])
+            group_lengths_mm = np.asarray(set_index[group]['lengths_mm'])
+
+            if len(subject_keys) < len(indexed_subjs):
+                # Only some subjects (ex, subj_id was given).
+                starts = np.concatenate(([0], np.cumsum(nb_streamlines)))
+                idx = [indexed_subjs.index(s) for s in subject_keys]
+                nb_streamlines = nb_streamlines[idx]
+                group_lengths = [group_lengths[starts[i]:starts[i + 1]]
+                                 for i in idx]
+                group_lengths_mm = [group_lengths_mm[starts[i]:starts[i + 1]]
+                                    for i in idx]
+            else:
+                group_lengths = [group_lengths]
+                group_lengths_mm = [group_lengths_mm]
+
+            for subj_idx, n_streamlines in enumerate(nb_streamlines):
+                self._add_streamlines_ids(int(n_streamlines), subj_idx,
+                                          group_idx)
+            lengths.append(group_lengths)
+            lengths_mm.append(group_lengths_mm)
+
+        return lengths, lengths_mm
+
+    def _load_subjects_and_lengths(self, hdf_handle: h5py.File,
+                                   subject_keys: List[str], ref_group_info,
+                                   keep_lengths=True):
+        """
+        Creates all subjects' containers and, if keep_lengths, arranges their
+        streamlines' ids and lengths. Returns the lengths and lengths_mm: one
+        list of np arrays per group.
+        """
         # Remembering heaviness. One np array per subj per group.
         lengths = [[] for _ in self.streamline_groups]
         lengths_mm = [[] for _ in self.streamline_groups]
 
-        ref_group_info = (self.volume_groups, self.nb_features,
-                          self.streamline_groups, self.contains_connectivity)
-
         # Using tqdm progress bar, load all subjects from hdf_file
         with logging_redirect_tqdm(loggers=[logging.root], tqdm_class=tqdm):
-            for subj_id in tqdm(subject_keys, ncols=100, total=self.nb_subjects):
+            for subj_id in tqdm(subject_keys, ncols=100,
+                                total=len(subject_keys)):
                 # Create subject's container
                 # Uses SubjectData or LazySubjectData based on the class
                 # calling this method.
@@ -286,6 +473,8 @@ class MultisubjectSubset(Dataset):
 
                 # Add subject to the list
                 subj_idx = self.subjs_data_list.add_subject(subj_data)
+                if not keep_lengths:
+                    continue
 
                 # Arrange streamlines
                 # In the lazy case, we need to allow loading the data, passing
@@ -300,20 +489,10 @@ class MultisubjectSubset(Dataset):
                     lengths[group].append(subj_sft_data.lengths)
                     lengths_mm[group].append(subj_sft_data.lengths_mm)
 
-                    # Remove hdf handle
+                # Remove hdf handle
                 subj_data.hdf_handle = None
 
-            # Arrange final data properties: Concatenate all subjects
-            logging.debug("All subjects added. Final verifications.")
-            self.streamline_lengths_mm = \
-                [np.concatenate(lengths_mm[group], axis=0)
-                 for group in range(len(self.streamline_groups))]
-            self.streamline_lengths = \
-                [np.concatenate(lengths[i], axis=0)
-                 for i in range(len(self.streamline_groups))]
-            self.total_nb_points = \
-                [sum(self.streamline_lengths[group])
-                 for group in range(len(self.streamline_groups))]
+        return lengths, lengths_mm
 
     def _add_streamlines_ids(self, n_streamlines: int, subj_idx: int,
                              group_idx: int):
@@ -441,19 +620,44 @@ class MultiSubjectDataset:
             # the collate_fn must open its own hdf_file
             step_size = hdf_handle.attrs['step_size']
             compress = hdf_handle.attrs['compress']
+            # (Not saved in older hdf5 files)
+            nb_points = hdf_handle.attrs.get('nb_points',
+                                             'Not defined by user')
 
             # Can't save None in hdf5, saved a string instead. Converting.
             if step_size == 'Not defined by user':
                 step_size = None
             if compress == 'Not defined by user':
                 compress = None
-
-            # Loading the first training subject's group information.
-            # Others should fit.
-            one_subj = hdf_handle.attrs['training_subjs'][0]
-            (poss_volume_groups, nb_features, poss_strea_groups,
-             contains_connectivity) = prepare_groups_info(
-                one_subj, hdf_handle, ref_group_info=None)
+            if nb_points == 'Not defined by user':
+                nb_points = None
+
+            if INDEX_GROUP in hdf_handle:
+                # Group information saved in the dataset index.
+                index = hdf_handle[INDEX_GROUP]
+                poss_volume_groups = [str(g) for g in
+                                      index.attrs['volume_groups']]
+                nb_features = [int(n) for n in index.attrs['nb_features']]
+                poss_strea_groups = [str(g) for g in
+                                     index.attrs['streamline_groups']]
+                contains_connectivity = np.asarray(
+                    index.attrs['contains_connectivity'], dtype=bool)
+                poss_step_sizes = [None if np.isnan(s) else float(s)
+                                   for s in index.attrs['step_sizes']]
+            else:
+                # Loading the first training subject's group information.
+                # Others should fit.
+                one_subj = hdf_handle.attrs['training_subjs'][0]
+                (poss_volume_groups, nb_features, poss_strea_groups,
+                 contains_connectivity) = prepare_groups_info(
+                    one_subj, hdf_handle, ref_group_info=None)
+
+                # Streamline groups resampled after the hdf5 creation have
+                # their own step size.
+                poss_step_sizes = [
+                    hdf_handle[one_subj][group].attrs.get('step_size',
+                                                          step_size)
+                    for group in poss_strea_groups]
             logger.debug("Possible volume groups are: {}"
                          .format(poss_volume_groups))
             logger.debug("Number of features in each of these groups: {}"
@@ -498,12 +702,18 @@ class MultiSubjectDataset:
                 self.streamlines_contain_connectivity = contains_connectivity
 
             self.streamline_groups = list(self.streamline_groups)
+
+            streamline_step_sizes = [
+                poss_step_sizes[poss_strea_groups.index(group)]
+                for group in self.streamline_groups]
+
             group_info = (self.volume_groups, self.nb_features,
                           self.streamline_groups,
                           self.streamlines_contain_connectivity)
-            self.training_set.set_subset_info(*group_info, step_size, compress)
-            self.validation_set.set_subset_info(*group_info, step_size, compress)
-            self.testing_set.set_subset_info(*group_info, step_size, compress)
+            for subset in [self.training_set, self.validation_set,
+                           self.testing_set]:
+                subset.set_subset_info(*group_info, step_size, compress,
+                                       streamline_step_sizes, nb_points)
 
             # LOADING
             if load_training:
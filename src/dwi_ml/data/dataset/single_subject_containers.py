@@ -219,6 +219,12 @@ class LazySubjectData(SubjectDataAbstract):
         #    self.hdf_handle.close()
         self.hdf_handle = hdf_handle
 
+    def __getstate__(self):
+        # hdf handles can't be pickled. See LazySubjectsDataList.
+        state = self.__dict__.copy()
+        state['hdf_handle'] = None
+        return state
+
     def __del__(self):
         if self.hdf_handle is not None:
             self.hdf_handle.close()
@@ -86,6 +86,17 @@ def load_all_streamlines_from_hdf(hdf_group: h5py.Group):
     return streamlines, dps_dict
 
 
+def _get_flat_indices(offsets: np.ndarray, lengths: np.ndarray):
+    """
+    Returns the indices, in the flat data array (ArraySequence._data), of
+    all points of the streamlines with given offsets and lengths, in order.
+    """
+    # For the kth streamline, the point at position p in the output comes from
+    # offsets[k] + p - (sum of previous lengths).
+    starts = offsets - np.cumsum(lengths) + lengths
+    return np.repeat(starts, lengths) + np.arange(np.sum(lengths))
+
+
 def _load_connectivity_info(hdf_group: h5py.Group):
     connectivity_nb_blocs = None
     connectivity_labels = None
@@ -199,6 +210,20 @@ class _LazyStreamlinesGetter(object):
         self._assert_dps(data_per_streamline, len(streamlines))
         return streamlines, data_per_streamline
 
+    def get_flat_data(self, ids: np.ndarray):
+        """
+        Returns the concatenated points of chosen streamlines, without
+        building an ArraySequence, together with their lengths.
+        """
+        lengths = np.zeros(len(ids), dtype=int)
+        data = []
+        for i, idx in enumerate(ids):
+            data.append(self._get_one_streamline(idx))
+            lengths[i] = len(data[-1])
+        if len(data) == 0:
+            return np.zeros((0, 3), dtype=np.float32), lengths
+        return np.concatenate(data, axis=0), lengths
+
     @property
     def lengths(self):
         """
@@ -331,6 +356,45 @@ class SFTDataAbstract(object):
         the hdf5."""
         raise NotImplementedError
 
+    @property
+    def is_vox_corner(self):
+        """New method compared to SFTs: True if streamlines are stored in
+        voxel space, corner origin, i.e. the space used by our interpolation.
+        This is how dwiml_create_hdf5_dataset saves them."""
+        return self.space == Space.VOX and self.origin == Origin.TRACKVIS
+
+    def _format_ids(self, streamline_ids) -> np.ndarray:
+        if streamline_ids is None:
+            return np.arange(len(self))
+        elif isinstance(streamline_ids, slice):
+            return np.arange(len(self))[streamline_ids]
+        return np.atleast_1d(np.asarray(streamline_ids, dtype=int))
+
+    def get_flat_streamlines(
+            self, streamline_ids: Union[List[int], int, slice, None] = None):
+        """
+        New method compared to SFTs: returns chosen streamlines as one flat
+        float32 array of points and their lengths, without creating a
+        StatefulTractogram or an ArraySequence. Streamlines are returned in the
+        space in which they are stored in the hdf5 (see is_vox_corner).
+
+        Params
+        ------
+        streamline_ids: Union[List[int], int, slice, None]
+            List of chosen ids. If None, use all streamlines.
+
+        Returns
+        -------
+        data: np.ndarray of shape (nb_points, 3)
+        lengths: np.ndarray of shape (nb_streamlines, )
+        """
+        data, lengths = self._get_flat_streamlines(
+            self._format_ids(streamline_ids))
+        return np.asarray(data, dtype=np.float32), lengths
+
+    def _get_flat_streamlines(self, streamline_ids: np.ndarray):
+        raise NotImplementedError
+
     def as_sft(self,
                streamline_ids: Union[List[int], int, slice, None] = None) \
             -> StatefulTractogram:
@@ -431,6 +495,13 @@ class SFTData(SFTDataAbstract):
         else:
             return self.streamlines, self.data_per_streamline
 
+    def _get_flat_streamlines(self, streamline_ids: np.ndarray):
+        # Accessing private ArraySequence info, ok.
+        lengths = self.streamlines._lengths[streamline_ids]
+        offsets = self.streamlines._offsets[streamline_ids]
+        data = self.streamlines._data[_get_flat_indices(offsets, lengths)]
+        return data, lengths
+
 
 class LazySFTData(SFTDataAbstract):
     def __init__(self, streamlines_getter: _LazyStreamlinesGetter, **kwargs):
@@ -450,7 +521,7 @@ class LazySFTData(SFTDataAbstract):
     @property
     def lengths(self):
         # Fetching from the lazy streamline getter
-        return np.array(self.streamlines_getter.lengths_mm)
+        return np.array(self.streamlines_getter.lengths)
 
     @property
     def lengths_mm(self):
@@ -482,3 +553,6 @@ class LazySFTData(SFTDataAbstract):
         streamlines, dps = self.streamlines_getter.get_array_sequence(
             streamline_ids)
         return streamlines, dps
+
+    def _get_flat_streamlines(self, streamline_ids: np.ndarray):
+        return self.streamlines_getter.get_flat_data(streamline_ids)
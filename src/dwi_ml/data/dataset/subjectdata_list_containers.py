@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+from typing import List
 
 import h5py
 from dwi_ml.data.dataset.single_subject_containers import (
@@ -36,6 +37,12 @@ class SubjectsDataListAbstract(object):
     def __len__(self):
         return len(self._subjects_data_list)
 
+    @property
+    def subject_ids(self) -> List[str]:
+        # Lazy subjects may not be created yet (see add_subject_id).
+        return [s if isinstance(s, str) else s.subject_id
+                for s in self._subjects_data_list]
+
     def __getitem__(self, subject_idx):
         """
         Get a specific SubjectData. In the lazy case, a handle must be
@@ -83,11 +90,43 @@ class LazySubjectsDataList(SubjectsDataListAbstract):
         self.is_lazy = True
         self.hdf_handle = None
 
+        # (volume_groups, nb_features, streamline_groups,
+        # contains_connectivity), used to create subjects added with
+        # add_subject_id.
+        self.group_info = None
+
+    def add_subject_id(self, subject_id: str):
+        """
+        Adds a subject without creating its LazySubjectData: it is created on
+        first access, with self.group_info. Returns subject index.
+        """
+        subject_idx = len(self._subjects_data_list)
+        self._subjects_data_list.append(subject_id)
+
+        return subject_idx
+
+    def created_subjects(self) -> List[LazySubjectData]:
+        """Subjects already created (i.e. accessed at least once)."""
+        return [s for s in self._subjects_data_list if not isinstance(s, str)]
+
+    def __getstate__(self):
+        # hdf handles can't be pickled (ex, when sent to DataLoader workers
+        # with the spawn start method). A new one is opened when needed.
+        state = self.__dict__.copy()
+        state['hdf_handle'] = None
+        return state
+
     def __getitem__(self, subject_item: int) -> LazySubjectData:
         """
         Returns the nth LazySubjectData.
         """
-        return self._subjects_data_list[subject_item]
+        subj_data = self._subjects_data_list[subject_item]
+        if isinstance(subj_data, str):
+            volume_groups, nb_features, streamline_groups, _ = self.group_info
+            subj_data = LazySubjectData(volume_groups, nb_features,
+                                        streamline_groups, subj_data)
+            self._subjects_data_list[subject_item] = subj_data
+        return subj_data
 
     def get_subj_with_handle(self, subject_idx) -> LazySubjectData:
         """
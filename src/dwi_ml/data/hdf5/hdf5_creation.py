@@ -13,9 +13,12 @@ from dipy.tracking.utils import length
 import h5py
 from scilpy.image.labels import get_data_as_labels
 
-from dwi_ml.data.hdf5.utils import format_nb_blocs_connectivity
+from dwi_ml.data.hdf5.utils import format_nb_blocs_connectivity, \
+    write_dataset_index
 from dwi_ml.data.processing.streamlines.data_augmentation import \
     resample_or_compress
+from dwi_ml.data.processing.volume.compact_dtypes import (
+    COMPACT_DTYPES, compact_volume_data)
 from nested_lookup import nested_lookup
 import nibabel as nib
 import numpy as np
@@ -217,7 +220,9 @@ class HDF5Creator:
         Reads the groups config json file and finds:
         - List of groups. Their type should be one of 'volume' or 'streamlines'
         - For volume groups: 'standardization' value should be provided and one
-          of 'all', 'independent', 'per_file' or 'none'.
+          of 'all', 'independent', 'per_file' or 'none'. Optional 'dtype'
+          value should be one of 'float32' (default), 'float16', 'bfloat16'
+          or 'int16'.
 
         Returns the list of volume groups and streamline groups.
         """
@@ -253,6 +258,13 @@ class HDF5Creator:
                         "example."
                         .format(group, std_choices,
                                 self.groups_config[group]['standardization']))
+                if 'dtype' in self.groups_config[group] and \
+                        self.groups_config[group]['dtype'] not in \
+                        COMPACT_DTYPES:
+                    raise KeyError(
+                        "Group {}'s 'dtype' should be one of {}, but we got "
+                        "{}.".format(group, COMPACT_DTYPES,
+                                     self.groups_config[group]['dtype']))
                 volume_groups.append(group)
 
             # Streamline groups
@@ -371,6 +383,9 @@ class HDF5Creator:
         config file.
 
         If wished, all intermediate steps are saved on disk in the hdf5 folder.
+
+        Finally, a dataset index is added at the root (see
+        dwi_ml.data.hdf5.utils.write_dataset_index).
         """
         with h5py.File(self.out_hdf_filename, 'w') as hdf_handle:
             # Save configuration
@@ -399,6 +414,9 @@ class HDF5Creator:
                              .format(nb_processed, nb_subjs, subj_id))
                 self._create_one_subj(subj_id, hdf_handle)
 
+            # Summary of all subjects, read at loading time.
+            write_dataset_index(hdf_handle)
+
         logging.info("Saved dataset : {}".format(self.out_hdf_filename))
 
     def _create_one_subj(self, subj_id, hdf_handle):
@@ -422,9 +440,9 @@ class HDF5Creator:
         Create the hdf5 groups for all volume groups in the config_file for a
         given subject.
 
-        Saves the attrs 'data', 'affine', 'voxres' (voxel resolution) and
-        'nb_feature' (the size of last dimension) for each.
-        (+ 'type' = 'volume')
+        Saves the attrs 'data', 'affine', 'voxres' (voxel resolution),
+        'nb_feature' (the size of last dimension) and 'dtype' for each.
+        (+ 'type' = 'volume', + 'scale' and 'offset' for dtype int16)
         """
         ref_header = None
         for group in self.volume_groups:
@@ -439,9 +457,17 @@ class HDF5Creator:
                 if not is_header_compatible(ref_header, group_header):
                     raise ValueError("Some volume groups have incompatible "
                                      "headers for subj {}.".format(subj_id))
-            logging.debug('      *Done. Now creating dataset from group.')
+            dtype = self.groups_config[group].get('dtype', 'float32')
+            logging.debug('      *Done. Now creating dataset from group '
+                          '(dtype {}).'.format(dtype))
+            compact_data, scale, offset = compact_volume_data(group_data,
+                                                              dtype)
             hdf_group = subj_hdf_group.create_group(group)
-            hdf_group.create_dataset('data', data=group_data)
+            hdf_group.create_dataset('data', data=compact_data)
+            hdf_group.attrs['dtype'] = dtype
+            if scale is not None:
+                hdf_group.attrs['scale'] = scale
+                hdf_group.attrs['offset'] = offset
             logging.debug('      *Done.')
 
             # Saving data information.
@@ -639,8 +665,11 @@ class HDF5Creator:
             # Accessing private Dipy values, but necessary.
             # We need to deconstruct the streamlines into arrays with
             # types recognizable by the hdf5.
-            streamlines_group.create_dataset('data',
-                                             data=sft.streamlines._data)
+            # Streamlines are saved in vox space, corner origin, as float32:
+            # the batch loader can then send them directly to tensors.
+            streamlines_group.create_dataset(
+                'data', data=np.asarray(sft.streamlines._data,
+                                        dtype=np.float32))
             streamlines_group.create_dataset('offsets',
                                              data=sft.streamlines._offsets)
             streamlines_group.create_dataset('lengths',
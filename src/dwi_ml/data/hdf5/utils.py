@@ -1,9 +1,23 @@
 # -*- coding: utf-8 -*-
+import logging
 from argparse import ArgumentParser
 from typing import List
 
+import h5py
+import numpy as np
+from dipy.io.stateful_tractogram import Origin, Space
+
+from dwi_ml.data.dataset.checks_for_groups import prepare_groups_info
+from dwi_ml.data.dataset.streamline_containers import \
+    load_streamlines_attributes_from_hdf
+from dwi_ml.data.processing.streamlines.data_augmentation import \
+    resample_streamlines_flat
 from dwi_ml.io_utils import add_resample_or_compress_arg
 
+# Root-level hdf5 group summarizing the dataset. See write_dataset_index.
+INDEX_GROUP = 'dataset_index'
+SET_NAMES = ['training', 'validation', 'testing']
+
 
 def format_nb_blocs_connectivity(connectivity_nb_blocs) -> List:
     """
@@ -83,3 +97,148 @@ def add_hdf5_creation_args(p: ArgumentParser):
 def add_streamline_processing_args(p: ArgumentParser):
     g = p.add_argument_group('Streamlines processing options')
     add_resample_or_compress_arg(g)
+
+
+def _euclidean_lengths_flat(data, lengths, affine):
+    """Length of each streamline, in mm, from the flat data in voxel space."""
+    segments = np.dot(np.diff(data, axis=0), np.asarray(affine)[:3, :3].T)
+    segment_lengths = np.sqrt(np.sum(segments ** 2, axis=-1))
+    ends = np.cumsum(lengths) - 1
+    segment_lengths[ends[:-1]] = 0.  # Between two streamlines.
+    cumulated = np.concatenate(([0.], np.cumsum(segment_lengths)))
+    return cumulated[ends] - cumulated[ends - lengths + 1]
+
+
+def add_resampled_streamline_group(subj_hdf_group: h5py.Group, group: str,
+                                   new_group: str, step_size: float):
+    """
+    Adds a copy of a streamline group, resampled to a new step size, to a
+    subject in the hdf5. Training a model with this step_size on the new
+    group avoids resampling the streamlines at every batch.
+
+    The new group has the same attributes, dps and connectivity matrix, with
+    updated 'data', 'offsets', 'lengths' and 'euclidean_lengths' (used by the
+    batch sampler to compute the batch heaviness), and the attribute
+    'step_size'.
+
+    Params
+    ------
+    subj_hdf_group: h5py.Group
+        The subject's hdf5 group, opened in 'a' mode.
+    group: str
+        The streamline group to resample.
+    new_group: str
+        Name of the new streamline group.
+    step_size: float
+        The step size, in mm.
+    """
+    old = subj_hdf_group[group]
+    if old.attrs['type'] != 'streamlines':
+        raise ValueError("Group {} is not a streamline group.".format(group))
+    (affine, _, _, _), space, origin = \
+        load_streamlines_attributes_from_hdf(old)
+    if space != Space.VOX or origin != Origin.TRACKVIS:
+        raise ValueError("Expecting streamlines in voxel space, corner "
+                         "origin, as saved by dwiml_create_hdf5_dataset.")
+    if new_group in subj_hdf_group:
+        raise ValueError("Group {} already exists.".format(new_group))
+
+    data, lengths = resample_streamlines_flat(
+        np.asarray(old['data']), np.asarray(old['lengths']),
+        step_size_mm=step_size, affine=affine)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    logging.debug("    Resampled {} streamlines: {} points (was {})."
+                  .format(len(lengths), len(data), len(old['data'])))
+
+    new = subj_hdf_group.create_group(new_group)
+    for key, value in old.attrs.items():
+        new.attrs[key] = value
+    new.attrs['step_size'] = step_size
+    for key in ['connectivity_matrix', 'connectivity_label_volume']:
+        if key in old:
+            old.copy(key, new)
+    if 'data_per_streamline' in old:
+        old.copy('data_per_streamline', new)
+
+    new.create_dataset('data', data=data)
+    new.create_dataset('offsets', data=offsets.astype(old['offsets'].dtype))
+    new.create_dataset('lengths', data=lengths.astype(old['lengths'].dtype))
+    new.create_dataset('euclidean_lengths',
+                       data=_euclidean_lengths_flat(data, lengths, affine))
+
+
+def get_subjects_in_hdf(hdf_handle: h5py.File) -> List[str]:
+    """All subjects in the hdf5 (i.e. all root groups but the index)."""
+    return [key for key in hdf_handle.keys() if key != INDEX_GROUP]
+
+
+def write_dataset_index(hdf_handle: h5py.File):
+    """
+    Writes (or rewrites) the dataset index: a root-level hdf5 group containing
+    the groups information (volume groups, nb_features, streamline groups,
+    step sizes) and, for each set (training, validation, testing), the sorted
+    list of subjects and, for each streamline group, the number of streamlines
+    per subject and the concatenated lengths and euclidean lengths.
+
+    The MultiSubjectDataset reads it with a few I/O calls instead of walking
+    through all subjects. It must be rewritten whenever subjects or groups are
+    added to the hdf5.
+
+    Params
+    ------
+    hdf_handle: h5py.File
+        The hdf5 file, opened in 'w' or 'a' mode.
+    """
+    if INDEX_GROUP in hdf_handle:
+        del hdf_handle[INDEX_GROUP]
+
+    subjs_per_set = [sorted(hdf_handle.attrs[set_name + '_subjs'])
+                     for set_name in SET_NAMES]
+    all_subjs = [subj for subjs in subjs_per_set for subj in subjs]
+    if len(all_subjs) == 0:
+        logging.warning("No subject in the hdf5. Index not written.")
+        return
+
+    # Groups information: as in the MultiSubjectDataset, the first subject
+    # is the reference. Others are verified.
+    group_info = prepare_groups_info(all_subjs[0], hdf_handle)
+    (volume_groups, nb_features, streamline_groups,
+     contains_connectivity) = group_info
+    step_size = hdf_handle.attrs['step_size']
+    if isinstance(step_size, str):
+        # 'Not defined by user'
+        step_size = np.nan
+    first_subj = hdf_handle[all_subjs[0]]
+    step_sizes = [first_subj[group].attrs.get('step_size', step_size)
+                  for group in streamline_groups]
+
+    index = hdf_handle.create_group(INDEX_GROUP)
+    index.attrs['volume_groups'] = volume_groups
+    index.attrs['nb_features'] = np.asarray(nb_features, dtype=int)
+    index.attrs['streamline_groups'] = streamline_groups
+    index.attrs['contains_connectivity'] = contains_connectivity
+    index.attrs['step_sizes'] = np.asarray(step_sizes, dtype=float)
+
+    for set_name, subjs in zip(SET_NAMES, subjs_per_set):
+        for subj in subjs:
+            prepare_groups_info(subj, hdf_handle, group_info)
+        set_index = index.create_group(set_name)
+        set_index.attrs['subjs'] = subjs
+        for group in streamline_groups:
+            lengths = [np.asarray(hdf_handle[subj][group]['lengths'])
+                       for subj in subjs]
+            lengths_mm = [
+                np.asarray(hdf_handle[subj][group]['euclidean_lengths'])
+                for subj in subjs]
+            group_index = set_index.create_group(group)
+            group_index.create_dataset(
+                'nb_streamlines', data=np.asarray([len(s) for s in lengths],
+                                                  dtype=int))
+            group_index.create_dataset(
+                'lengths', data=np.concatenate(lengths) if len(subjs) > 0
+                else np.zeros(0, dtype=int))
+            group_index.create_dataset(
+                'lengths_mm', data=np.concatenate(lengths_mm)
+                if len(subjs) > 0 else np.zeros(0))
+    logging.info("Wrote the dataset index for {} subjects."
+                 .format(len(all_subjs)))
@@ -172,3 +172,201 @@ def reverse_streamlines(sft: StatefulTractogram,
         data_per_streamline=sft.data_per_streamline)
 
     return new_sft
+
+
+# ----------------
+# Versions working directly on flat arrays of points, as stored in the hdf5
+# (equivalent to ArraySequence._data and ._lengths), without creating
+# StatefulTractograms. Used by the batch loader. With the same rng state,
+# results are the same as with the SFT versions above.
+# ----------------
+def _get_starts(lengths: np.ndarray):
+    """Index of the first point of each streamline in the flat data."""
+    return np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(int)
+
+
+def split_streamlines_flat(data: np.ndarray, lengths: np.ndarray,
+                           rng: np.random.RandomState,
+                           split_ids: np.ndarray = None,
+                           min_nb_points: int = 12):
+    """
+    Same as split_streamlines, but on flat data. Streamlines that are split
+    keep their points: cutting them only changes the lengths. As in
+    split_streamlines, chosen streamlines that are too short to be cut are
+    removed.
+
+    Params
+    ------
+    data: np.ndarray of shape (nb_points, 3)
+        The points of all streamlines, concatenated.
+    lengths: np.ndarray
+        The number of points of each streamline.
+    rng: np.random.RandomState
+        Random number generator.
+    split_ids: np.ndarray, optional
+        List of streamlines to split. If not provided, all streamlines are
+        split.
+    min_nb_points: int
+        Only cut streamlines with more than min_nb_points.
+
+    Returns
+    -------
+    new_data: np.ndarray
+        The points of the remaining streamlines.
+    new_lengths: np.ndarray
+        The lengths of the segments.
+    """
+    lengths = np.asarray(lengths, dtype=int)
+    min_final_nb_points = int(np.floor(min_nb_points / 2))
+
+    chosen = np.zeros(len(lengths), dtype=bool)
+    if split_ids is None:
+        chosen[:] = True
+    else:
+        chosen[np.asarray(split_ids, dtype=int)] = True
+    to_split = chosen & (lengths > min_nb_points)
+    to_remove = chosen & ~to_split
+
+    # Drawing the cut indices in the same order as split_streamlines.
+    cut_idx = rng.randint(min_final_nb_points,
+                          lengths[to_split] - min_final_nb_points)
+
+    # Streamlines that are split become two streamlines.
+    new_lengths = np.repeat(lengths, to_split + 1)
+    first_segments = np.cumsum(to_split + 1)[to_split] - 2
+    new_lengths[first_segments] = cut_idx
+    new_lengths[first_segments + 1] = lengths[to_split] - cut_idx
+
+    if np.any(to_remove):
+        removed_segments = np.repeat(to_remove, to_split + 1)
+        data = data[~np.repeat(to_remove, lengths)]
+        new_lengths = new_lengths[~removed_segments]
+
+    return data, new_lengths
+
+
+def reverse_streamlines_flat(data: np.ndarray, lengths: np.ndarray,
+                             reverse_ids: np.ndarray = None):
+    """
+    Same as reverse_streamlines, but on flat data.
+
+    Params
+    ------
+    data: np.ndarray of shape (nb_points, 3)
+        The points of all streamlines, concatenated.
+    lengths: np.ndarray
+        The number of points of each streamline.
+    reverse_ids: np.ndarray, optional
+        List of streamlines to reverse. If not provided, all streamlines are
+        reversed.
+
+    Returns
+    -------
+    new_data: np.ndarray
+        The points, with chosen streamlines reversed. Lengths are unchanged.
+    """
+    lengths = np.asarray(lengths, dtype=int)
+    to_reverse = np.zeros(len(lengths), dtype=bool)
+    if reverse_ids is None:
+        to_reverse[:] = True
+    else:
+        to_reverse[np.asarray(reverse_ids, dtype=int)] = True
+
+    # For reversed streamlines, point p comes from point (length - 1 - p).
+    starts = _get_starts(lengths)
+    idx = np.arange(np.sum(lengths))
+    position = idx - np.repeat(starts, lengths)
+    reversed_position = np.repeat(lengths, lengths) - 1 - position
+    position = np.where(np.repeat(to_reverse, lengths), reversed_position,
+                        position)
+    return data[np.repeat(starts, lengths) + position]
+
+
+def resample_streamlines_flat(data: np.ndarray, lengths: np.ndarray,
+                              step_size_mm: float = None,
+                              nb_points: int = None,
+                              affine: np.ndarray = None):
+    """
+    Same as resample_or_compress (without compression), but on flat data,
+    vectorized over all streamlines: new points are interpolated linearly
+    along the cumulative arc length of each streamline.
+
+    Params
+    ------
+    data: np.ndarray of shape (nb_points, 3)
+        The points of all streamlines, concatenated, in voxel space.
+    lengths: np.ndarray
+        The number of points of each streamline.
+    step_size_mm: float
+        Step size, in mm. Arc lengths are computed in mm with the affine, as
+        in scilpy's resample_streamlines_step_size. The number of points is
+        ceil(length / step_size), with a minimum of 2.
+    nb_points: int
+        Number of points per streamline. Arc lengths are computed in voxel
+        space, as in scilpy's resample_streamlines_num_points used on a SFT in
+        voxel space.
+    affine: np.ndarray
+        The vox2rasmm affine. Required with step_size_mm.
+
+    Returns
+    -------
+    new_data: np.ndarray
+    new_lengths: np.ndarray
+    """
+    if (step_size_mm is None) == (nb_points is None):
+        raise ValueError("Choose either step_size_mm or nb_points.")
+
+    lengths = np.asarray(lengths, dtype=int)
+    data = np.asarray(data, dtype=np.float64)
+    nb_streamlines = len(lengths)
+    starts = _get_starts(lengths)
+    streamline_of_point = np.repeat(np.arange(nb_streamlines), lengths)
+
+    # Length of each segment. The segment joining the last point of a
+    # streamline and the first point of the next one is set to 0.
+    segments = np.diff(data, axis=0)
+    if step_size_mm is not None:
+        if affine is None:
+            raise ValueError("The affine is required to resample with a "
+                             "step size in mm.")
+        segments = np.dot(segments, np.asarray(affine)[:3, :3].T)
+    segment_lengths = np.sqrt(np.sum(segments ** 2, axis=-1))
+    segment_lengths[starts[1:] - 1] = 0.
+
+    # Cumulative arc length of each point, restarting at 0 for each
+    # streamline.
+    arc = np.concatenate(([0.], np.cumsum(segment_lengths)))
+    arc -= np.repeat(arc[starts], lengths)
+    total_lengths = arc[starts + lengths - 1]
+
+    if step_size_mm is not None:
+        new_lengths = np.ceil(total_lengths / step_size_mm).astype(int)
+        new_lengths[new_lengths == 1] = 2
+    else:
+        new_lengths = np.full(nb_streamlines, nb_points, dtype=int)
+
+    # Arc length of each new point.
+    new_starts = _get_starts(new_lengths)
+    new_streamline = np.repeat(np.arange(nb_streamlines), new_lengths)
+    new_position = np.arange(np.sum(new_lengths)) - new_starts[new_streamline]
+    nb_intervals = np.maximum(new_lengths - 1, 1)[new_streamline]
+    new_arc = new_position / nb_intervals * total_lengths[new_streamline]
+
+    # Finding the segment containing each new point: searching on the arc
+    # length shifted by the streamline index, which is increasing over the
+    # whole flat array since each arc is < its total length.
+    max_arc = np.max(total_lengths) + 1. if nb_streamlines > 0 else 1.
+    global_arc = arc + streamline_of_point * max_arc
+    new_global_arc = new_arc + new_streamline * max_arc
+    segment = np.searchsorted(global_arc, new_global_arc, side='right') - 1
+    last_segment = (starts + np.maximum(lengths - 2, 0))[new_streamline]
+    segment = np.clip(segment, starts[new_streamline], last_segment)
+
+    # Linear interpolation inside each segment.
+    seg_length = arc[segment + 1] - arc[segment]
+    ratio = np.divide(new_arc - arc[segment], seg_length,
+                      out=np.zeros_like(new_arc), where=seg_length > 0)
+    ratio = np.clip(ratio, 0., 1.)[:, None]
+    new_data = data[segment] + ratio * (data[segment + 1] - data[segment])
+
+    return new_data.astype(np.float32), new_lengths
@@ -4,12 +4,6 @@ from typing import List
 
 import numpy as np
 import torch
-from matplotlib import pyplot as plt
-from matplotlib.colors import LogNorm
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from scilpy.tractanalysis.connectivity_segmentation import \
-    extract_longest_segments_from_profile as segmenting_func
-from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
 
 # We could try using nan instead of zeros for non-existing previous dirs...
 DEFAULT_UNEXISTING_VAL = torch.zeros((1, 3), dtype=torch.float32)
@@ -348,6 +342,12 @@ def compute_triu_connectivity_from_labels(streamlines, data_labels,
     end_labels = []
 
     if use_scilpy:
+        # Slow imports (sklearn): only imported when needed.
+        from scilpy.tractanalysis.connectivity_segmentation import \
+            extract_longest_segments_from_profile as segmenting_func
+        from scilpy.tractograms.uncompress import \
+            streamlines_to_voxel_coordinates
+
         indices, points_to_idx = streamlines_to_voxel_coordinates(
             streamlines, return_mapping=True)
 
@@ -429,7 +429,67 @@ def compute_triu_connectivity_from_blocs(streamlines, volume_size, nb_blocs):
     return matrix, start_block, end_block
 
 
+def compute_triu_connections_from_blocs(streamlines, volume_size, nb_blocs):
+    """
+    Same as compute_triu_connectivity_from_blocs, but instead of the dense
+    (mmm x mmm) matrix, returns, for each streamline, its row and column in
+    the upper triangular matrix. Useful to compare with a sparse matrix.
+
+    Returns
+    -------
+    rows, cols: np.ndarray
+        Each of length nb_streamlines.
+    """
+    start_block, end_block = _compute_origin_finish_blocs(
+        streamlines, volume_size, np.asarray(nb_blocs))
+    return (np.minimum(start_block, end_block),
+            np.maximum(start_block, end_block))
+
+
+def compute_triu_connections_from_labels(streamlines, data_labels,
+                                         real_labels=None):
+    """
+    Same as compute_triu_connectivity_from_labels (with use_scilpy=False),
+    but instead of the dense (nb_labels x nb_labels) matrix, returns, for
+    each streamline, its row and column in the upper triangular matrix.
+
+    Parameters
+    ----------
+    streamlines: list of np arrays or list of tensors.
+        Streamlines, in vox space, corner origin.
+    data_labels: np.ndarray
+        The loaded nifti image.
+    real_labels: np.ndarray
+        The sorted unique values of data_labels. Computed if not given.
+
+    Returns
+    -------
+    rows, cols: np.ndarray
+        Each of length nb_streamlines.
+    """
+    if real_labels is None:
+        real_labels = np.unique(data_labels)
+    if isinstance(streamlines[0], torch.Tensor):
+        starts = torch.vstack([s[0, :] for s in streamlines]).cpu().numpy()
+        ends = torch.vstack([s[-1, :] for s in streamlines]).cpu().numpy()
+    else:
+        starts = np.vstack([s[0] for s in streamlines])
+        ends = np.vstack([s[-1] for s in streamlines])
+
+    # Vox space, corner origin: the floor is the voxel index.
+    starts = data_labels[tuple(np.floor(starts).astype(int).T)]
+    ends = data_labels[tuple(np.floor(ends).astype(int).T)]
+    starts = np.searchsorted(real_labels, starts)
+    ends = np.searchsorted(real_labels, ends)
+    return np.minimum(starts, ends), np.maximum(starts, ends)
+
+
 def prepare_figure_connectivity(matrix):
+    # Slow imports: this module is also used by the models.
+    from matplotlib import pyplot as plt
+    from matplotlib.colors import LogNorm
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
     matrix = np.copy(matrix)
 
     fig, axs = plt.subplots(2, 2)
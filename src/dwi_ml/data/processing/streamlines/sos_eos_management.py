@@ -17,7 +17,7 @@ from typing import List
 import torch
 from torch.nn.functional import one_hot, pad
 
-from dwi_ml.data.spheres import TorchSphere
+from dwi_ml.data.spheres import SPHERE_CHUNK_SIZE, TorchSphere
 
 
 def convert_dirs_to_class(batch_dirs: List[torch.Tensor],
@@ -57,64 +57,104 @@ def convert_dirs_to_class(batch_dirs: List[torch.Tensor],
         eos_class = nb_class + nb_other_classes + 1
         nb_other_classes += 1
 
+    if smooth_labels and not to_one_hot:
+        raise ValueError("With smooth label, we must convert to one-hot "
+                         "vectors.")
+
+    if len(batch_dirs) == 0:
+        return []
+
+    # Working on all points of the batch at once. Computing the output rows
+    # of each point (with SOS / EOS rows inserted) first, to fill the final
+    # tensor directly.
+    lengths = [len(s) for s in batch_dirs]
+    flat_dirs = torch.cat(batch_dirs, dim=0)
+    device = flat_dirs.device
+    rows = None
+    if add_sos or add_eos:
+        rows, lengths, sos_rows, eos_rows = _get_rows_with_sos_eos(
+            lengths, add_sos, add_eos, device)
+
     if smooth_labels:
         # See https://github.com/itaybenou/DeepTract/, in utils.train_utils.py
+        # Labels smooth is of shape nb_points x nb_class. Computed by chunks
+        # of points: the (nb_points, nb_class) intermediate matrices of a
+        # whole batch do not fit in the CPU cache.
+        flat_idx = torch.zeros((sum(lengths), nb_class + nb_other_classes),
+                               dtype=torch.float32, device=device)
+        for start in range(0, len(flat_dirs), SPHERE_CHUNK_SIZE):
+            chunk = slice(start, start + SPHERE_CHUNK_SIZE)
+            labels = _smooth_labels(flat_dirs[chunk], sphere.vertices)
+            if rows is None:
+                flat_idx[chunk, :nb_class] = labels
+            else:
+                flat_idx[rows[chunk], :nb_class] = labels
 
-        if not to_one_hot:
-            raise ValueError("With smooth label, we must convert to one-hot "
-                             "vectors.")
-        batch_idx = []
-        for s in batch_dirs:
-            # toDo. See if we can skip loop.
-            lens = torch.linalg.norm(s, dim=-1)
-            dots = torch.matmul(s, sphere.vertices.T)  # Cosine similarity
-
-            # Fixing numerical instabilities
-            one = torch.as_tensor(1, dtype=torch.float32, device=s.device)
-            tmp = torch.maximum(
-                torch.minimum(torch.div(dots, lens[:, None]), one), -one)
-            angle = torch.arccos(tmp)
-
-            # Labels smooth is of shape nb_points x nb_class.
-            labels_smooth = torch.exp(-1 * angle / 0.1)
-
-            if add_sos or add_eos:
-                # Adding n points and n classes, n = 1 or 2.
-                labels_smooth = pad(labels_smooth,
-                                    (0, nb_other_classes, add_sos, add_eos))
-                if add_sos:
-                    labels_smooth[0, sos_class - 1] = 1.0
-                if add_eos:
-                    labels_smooth[-1, eos_class - 1] = 1.0
-
-            # To make as probabilities:
-            labels_smooth /= torch.sum(labels_smooth, dim=1, keepdim=True)
-            batch_idx.append(labels_smooth)
-    else:
-        batch_idx = [sphere.find_closest(s) for s in batch_dirs]
-
-        device = batch_dirs[0].device
         if add_sos:
-            sos_class = torch.as_tensor(sos_class - 1, device=device)
+            flat_idx[sos_rows, sos_class - 1] = 1.0
         if add_eos:
-            eos_class = torch.as_tensor(eos_class - 1, device=device)
+            flat_idx[eos_rows, eos_class - 1] = 1.0
 
-        if add_sos and add_eos:
-            batch_idx = [torch.hstack((sos_class, s, eos_class)) for s in batch_idx]
-        elif add_sos:
-            batch_idx = [torch.hstack((sos_class, s)) for s in batch_idx]
-        elif add_eos:
-            batch_idx = [torch.hstack((s, eos_class)) for s in batch_idx]
+        # To make as probabilities:
+        flat_idx /= torch.sum(flat_idx, dim=1, keepdim=True)
+    else:
+        flat_idx = sphere.find_closest(flat_dirs)
+
+        if rows is not None:
+            idx_with_tokens = torch.zeros(sum(lengths), dtype=torch.long,
+                                          device=device)
+            idx_with_tokens[rows] = flat_idx.to(torch.long)
+            if add_sos:
+                idx_with_tokens[sos_rows] = sos_class - 1
+            if add_eos:
+                idx_with_tokens[eos_rows] = eos_class - 1
+            flat_idx = idx_with_tokens
 
         if to_one_hot:
-            batch_idx = [one_hot(s.to(dtype=torch.long),
-                                 num_classes=nb_class + nb_other_classes
-                                 ).to(dtype=torch.float)
-                         for s in batch_idx]
+            flat_idx = one_hot(flat_idx.to(dtype=torch.long),
+                               num_classes=nb_class + nb_other_classes
+                               ).to(dtype=torch.float)
 
+    batch_idx = list(flat_idx.split(lengths))
     return batch_idx
 
 
+def _smooth_labels(dirs: torch.Tensor, vertices: torch.Tensor):
+    lens = torch.linalg.norm(dirs, dim=-1)
+    labels = torch.matmul(dirs, vertices.T)  # Cosine similarity
+
+    # Fixing numerical instabilities. Then, labels = exp(-angle / 0.1).
+    labels.div_(lens[:, None]).clamp_(-1., 1.)
+    return labels.arccos_().mul_(-1 / 0.1).exp_()
+
+
+def _get_rows_with_sos_eos(lengths: List[int], add_sos: bool, add_eos: bool,
+                           device):
+    """
+    Computes the rows of each point once a row is inserted at the beginning
+    (SOS) and/or at the end (EOS) of each streamline, in the flattened data.
+
+    Returns
+    -------
+    rows: Tensor
+        The new row of each initial point.
+    new_lengths: List[int]
+    sos_rows, eos_rows: Tensor
+        The index of the new rows.
+    """
+    nb_new = int(add_sos) + int(add_eos)
+    lengths_t = torch.as_tensor(lengths, device=device)
+    new_lengths_t = lengths_t + nb_new
+    new_ends = torch.cumsum(new_lengths_t, dim=0)
+    new_starts = new_ends - new_lengths_t
+
+    shift = torch.repeat_interleave(
+        torch.arange(len(lengths), device=device) * nb_new, lengths_t)
+    rows = torch.arange(sum(lengths), device=device) + shift + int(add_sos)
+
+    return rows, new_lengths_t.tolist(), new_starts, new_ends - 1
+
+
 def add_label_as_last_dim(batch_dirs: List[torch.Tensor],
                           add_sos=False, add_eos=False):
     """
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage of volume groups in the hdf5.
+
+Volumes can be stored in the hdf5 with a smaller dtype than float32 to reduce
+disk I/O and the memory footprint of the volume cache. Data is kept in this
+compact dtype in memory and is only upcast to float32 at interpolation time.
+
+Possible dtypes:
+    - 'float32': Default. Same as before.
+    - 'float16': Half precision. Values must be in [-65504, 65504]. Relative
+      error < 5e-4.
+    - 'bfloat16': Same range as float32 but only 8 bits of mantissa. Relative
+      error < 4e-3. H5py does not support bfloat16: bits are stored as int16
+      and viewed as bfloat16 when loading.
+    - 'int16': Linear quantization, one scale and offset per feature (last
+      dimension), stored in the group's attributes. Absolute error is at most
+      scale / 2, i.e. (max - min) / 131068 per feature.
+"""
+import logging
+
+import h5py
+import numpy as np
+import torch
+
+COMPACT_DTYPES = ['float32', 'float16', 'bfloat16', 'int16']
+
+# Largest value representable in float16.
+_FLOAT16_MAX = np.finfo(np.float16).max
+_INT16_MAX = np.iinfo(np.int16).max
+
+
+def compact_volume_data(data: np.ndarray, dtype: str = 'float32'):
+    """
+    Converts the data to the chosen dtype, for storage in the hdf5.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        The 4D volume (last dimension = features).
+    dtype: str
+        One of COMPACT_DTYPES.
+
+    Returns
+    -------
+    data: np.ndarray
+        The data to save in the hdf5.
+    scale: np.ndarray or None
+        With int16: the scale for each feature. Else, None.
+    offset: np.ndarray or None
+        With int16: the offset for each feature. Else, None.
+    """
+    if dtype not in COMPACT_DTYPES:
+        raise ValueError("Volume dtype should be one of {}, but got {}."
+                         .format(COMPACT_DTYPES, dtype))
+
+    data = np.asarray(data, dtype=np.float32)
+    if dtype == 'float32':
+        return data, None, None
+
+    if dtype == 'float16':
+        if np.max(np.abs(data)) > _FLOAT16_MAX:
+            raise ValueError(
+                "Data contains values bigger than {} in absolute value. It "
+                "cannot be stored as float16. Standardize it or use bfloat16 "
+                "or int16.".format(_FLOAT16_MAX))
+        return data.astype(np.float16), None, None
+
+    if dtype == 'bfloat16':
+        # Rounding is done by torch. Storing the bits as int16.
+        data = torch.from_numpy(data).to(torch.bfloat16).view(torch.int16)
+        return data.numpy(), None, None
+
+    # int16: one scale and offset per feature.
+    nb_features = data.shape[-1]
+    flat = data.reshape((-1, nb_features))
+    mins = np.min(flat, axis=0)
+    maxs = np.max(flat, axis=0)
+    offset = (maxs + mins) / 2.
+    scale = (maxs - mins) / (2. * _INT16_MAX)
+    scale[scale == 0] = 1.  # Constant features
+    data = np.round((data - offset) / scale)
+    data = np.clip(data, -_INT16_MAX, _INT16_MAX).astype(np.int16)
+    return data, scale.astype(np.float32), offset.astype(np.float32)
+
+
+def _get_volume_dtype(hdf_group: h5py.Group):
+    # Older hdf5 files did not save the dtype: always float32.
+    if 'dtype' in hdf_group.attrs:
+        return str(hdf_group.attrs['dtype'])
+    return 'float32'
+
+
+def load_compact_volume_as_tensor(hdf_group: h5py.Group, device=None):
+    """
+    Loads a volume group's data, keeping it in its compact dtype.
+
+    Returns
+    -------
+    data: torch.Tensor
+        Of dtype float32, float16, bfloat16 or int16.
+    scaling: Tuple[torch.Tensor, torch.Tensor] or None
+        With int16 data: the (scale, offset) per feature, to apply after
+        interpolation. Else, None.
+    """
+    dtype = _get_volume_dtype(hdf_group)
+    logging.debug("Loading volume data with dtype {}".format(dtype))
+
+    if dtype == 'float32':
+        data = torch.as_tensor(np.array(hdf_group['data'], dtype=np.float32),
+                               device=device)
+        return data, None
+    elif dtype == 'float16':
+        data = torch.as_tensor(np.array(hdf_group['data'], dtype=np.float16),
+                               device=device)
+        return data, None
+    elif dtype == 'bfloat16':
+        data = torch.as_tensor(np.array(hdf_group['data'], dtype=np.int16),
+                               device=device)
+        return data.view(torch.bfloat16), None
+    elif dtype == 'int16':
+        data = torch.as_tensor(np.array(hdf_group['data'], dtype=np.int16),
+                               device=device)
+        scale = torch.as_tensor(np.array(hdf_group.attrs['scale']),
+                                dtype=torch.float, device=device)
+        offset = torch.as_tensor(np.array(hdf_group.attrs['offset']),
+                                 dtype=torch.float, device=device)
+        return data, (scale, offset)
+    else:
+        raise ValueError("Volume dtype not recognized in the hdf5: {}"
+                         .format(dtype))
+
+
+def load_volume_as_float32(hdf_group: h5py.Group) -> np.ndarray:
+    """
+    Loads a volume group's data and converts it back to a float32 np.array.
+    Useful for volumes that are not interpolated by our models (ex: masks).
+    """
+    data, scaling = load_compact_volume_as_tensor(hdf_group)
+    data = data.to(torch.float)
+    if scaling is not None:
+        data = dequantize_interpolated_data(data, scaling)
+    return data.numpy()
+
+
+def dequantize_interpolated_data(data: torch.Tensor, scaling):
+    """
+    Applies the int16 scaling after interpolation. Trilinear interpolation is
+    linear and its weights sum to 1, so scaling after interpolation gives the
+    same result as scaling the volume first.
+
+    Parameters
+    ----------
+    data: torch.Tensor
+        Interpolated data, of shape (..., nb_features).
+    scaling: Tuple[torch.Tensor, torch.Tensor] or None
+        The (scale, offset) per feature.
+    """
+    if scaling is None:
+        return data
+    scale, offset = scaling
+    return data * scale.to(data.device) + offset.to(data.device)
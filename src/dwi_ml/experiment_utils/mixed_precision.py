@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Mixed precision (torch.autocast) for training, tracking and testing.
+
+Precision choices:
+    - 'float32': Default. No autocast.
+    - 'bfloat16': Autocast to bfloat16. Same range as float32: no gradient
+      scaling necessary. Supported on CPU and on recent GPUs.
+    - 'float16': Autocast to float16, on GPU only. Gradients are scaled
+      during training (torch's GradScaler) to avoid underflow.
+
+Under autocast, torch chooses the precision of each operation (ex, matrix
+multiplications in low precision, reductions and softmax in float32). Our own
+numerically sensitive functions (log-probabilities of the Gaussian and
+Fisher-von-Mises distributions, trilinear interpolation weights, final
+tracking directions) are decorated with keep_float32 to always run in
+float32.
+"""
+import contextlib
+import functools
+
+import torch
+
+PRECISION_CHOICES = ['float32', 'bfloat16', 'float16']
+
+_DTYPES = {'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+
+def check_precision(precision: str, device: torch.device = None):
+    if precision not in PRECISION_CHOICES:
+        raise ValueError("Precision should be one of {}, but got {}."
+                         .format(PRECISION_CHOICES, precision))
+    if precision == 'float16' and device is not None and \
+            device.type != 'cuda':
+        raise ValueError("Precision float16 is only supported on GPU. Use "
+                         "bfloat16 on CPU.")
+
+
+def get_autocast_context(precision: str, device: torch.device):
+    """
+    Returns the context manager under which to run the model (forward pass
+    and loss; not the backward pass).
+    """
+    if precision == 'float32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=_DTYPES[precision])
+
+
+def get_grad_scaler(precision: str, device: torch.device):
+    """
+    Gradient scaler. Only enabled with float16. Else, its methods do nothing
+    (scale returns the loss as is, step calls optimizer.step).
+    """
+    return torch.amp.GradScaler(device.type,
+                                enabled=(precision == 'float16'))
+
+
+def _autocast_device_types():
+    return [d for d in ['cpu', 'cuda'] if torch.is_autocast_enabled(d)]
+
+
+def to_float32(x):
+    """Casts tensors (possibly in lists or tuples) to float32."""
+    if isinstance(x, torch.Tensor) and x.is_floating_point():
+        return x.float()
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_float32(xx) for xx in x)
+    return x
+
+
+def keep_float32(cast_inputs: bool = True):
+    """
+    Decorator: runs the function with autocast disabled.
+
+    Parameters
+    ----------
+    cast_inputs: bool
+        If True, floating point tensors received as arguments (possibly in
+        lists or tuples) are cast to float32. Use False for functions that
+        manage their inputs' dtypes (ex, interpolation of compact volumes).
+    """
+    def decorator(fct):
+        @functools.wraps(fct)
+        def wrapper(*args, **kwargs):
+            device_types = _autocast_device_types()
+            if len(device_types) == 0:
+                return fct(*args, **kwargs)
+            if cast_inputs:
+                args = to_float32(args)
+                kwargs = {k: to_float32(v) for k, v in kwargs.items()}
+            with contextlib.ExitStack() as stack:
+                for device_type in device_types:
+                    stack.enter_context(
+                        torch.autocast(device_type, enabled=False))
+                return fct(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -32,7 +32,8 @@ def add_arg_existing_experiment_path(p: ArgumentParser):
 
 
 def add_memory_args(p: ArgumentParser, add_lazy_options=False,
-                    add_multiprocessing_option=True, add_rng=False):
+                    add_multiprocessing_option=True, add_rng=False,
+                    add_dataloader_options=False):
     g = p.add_argument_group("Memory usage")
 
     # Multi-processing / GPU
@@ -52,6 +53,28 @@ def add_memory_args(p: ArgumentParser, add_lazy_options=False,
         p.add_argument('--use_gpu', action='store_true',
                        help="If set, use GPU for processing.")
 
+    # Torch DataLoader's workers (with --processes)
+    if add_dataloader_options:
+        g.add_argument(
+            '--persistent_workers', action='store_true',
+            help="With --processes: keep the data loading workers alive "
+                 "between epochs (each \nworker opens its hdf5 file once). "
+                 "Handles and volume cache are then \nalso kept between "
+                 "epochs in the main process.")
+        g.add_argument(
+            '--prefetch_factor', type=int, metavar='n',
+            help="With --processes: number of batches loaded in advance by "
+                 "each worker. \n[torch's default: 2]")
+
+    # Mixed precision. See dwi_ml.experiment_utils.mixed_precision.
+    g.add_argument(
+        '--precision', choices=['float32', 'bfloat16', 'float16'],
+        default='float32',
+        help="Precision of the model's computations. With bfloat16 or "
+             "float16, uses \nmixed precision (torch.autocast): faster and "
+             "lighter, but less precise. \nfloat16 requires a GPU. "
+             "[%(default)s]")
+
     # RNG
     if add_rng:
         g.add_argument('--rng', type=int, default=1234,
@@ -3,7 +3,6 @@ import logging
 from math import ceil
 from typing import Tuple, List, Union, Optional
 
-import dipy.data
 import numpy as np
 import torch
 from torch import Tensor
@@ -601,8 +600,10 @@ class AbstractSphereClassificationDG(AbstractDirectionGetterModel):
 
         # Classes
         self.sphere_name = sphere
+        # Slow import, only needed by these models.
+        import dipy.data
         sphere = dipy.data.get_sphere(name=sphere)
-        self.torch_sphere = TorchSphere(sphere)
+        self.torch_sphere = TorchSphere(sphere, lookup_grid_size=32)
         self.output_size = sphere.vertices.shape[0]   # nb_classes
 
         # EOS
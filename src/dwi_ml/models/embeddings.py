@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+import itertools
 from typing import Tuple, List
 
 import numpy as np
 import torch
 from torch import Tensor
 
+from dwi_ml.data.processing.volume.interpolation import \
+    interpolate_volume_in_neighborhood
+
 """
 Hint: To use on packed sequences:
 
@@ -174,6 +178,107 @@ class CNNEmbedding(EmbeddingAbstract):
 
         return x
 
+    def compute_volume_features(self, volume: Tensor,
+                                neighborhood_radius: int,
+                                neighborhood_resolution: float):
+        """
+        Runs the CNN once on the whole volume rather than on each point's
+        neighborhood. Features can then be interpolated at any coordinate with
+        interpolate_volume_features. Used in inference (validation, tracking):
+        neighborhoods of neighboring points overlap almost entirely, so most
+        convolutions in forward() are redundant.
+
+        The neighborhood must be a grid with an integer resolution (in
+        voxels): a grid of resolution d corresponds to a convolution of
+        dilation d on the volume.
+
+        Exactness: trilinear interpolation is linear, so interpolating the
+        convolution of the volume is the same as convolving the interpolated
+        neighborhood. The last layer's activation is applied after
+        interpolation. Thus:
+            - With one CNN layer, results are the same as forward() (up to
+              float precision), except for neighborhoods going further than
+              one voxel outside the volume.
+            - With more layers, activations of the intermediate layers are
+              computed on the voxel grid rather than at the neighborhood's
+              points. Results are exact only for coordinates on the voxel
+              grid; elsewhere, they are an approximation.
+
+        Parameters
+        ----------
+        volume: Tensor
+            The 4D volume, of shape (X, Y, Z, nb_features_in), in float.
+        neighborhood_radius: int
+            The radius of the grid neighborhood.
+        neighborhood_resolution: float
+            The resolution of the grid neighborhood, in voxels. Must be an
+            integer value.
+
+        Returns
+        -------
+        features: Tensor
+            The last layer's outputs, before activation, of shape
+            (X', Y', Z', nb_filters[-1]).
+        origin: int
+            features[i, j, k] corresponds to the output for a neighborhood
+            starting at volume coordinate (i, j, k) + origin.
+        dilation: int
+            The spacing of the features (the neighborhood resolution).
+        """
+        dilation = int(round(neighborhood_resolution))
+        if dilation < 1 or abs(neighborhood_resolution - dilation) > 1e-6:
+            raise ValueError(
+                "Computing CNN features on the whole volume requires an "
+                "integer neighborhood resolution, but got {}."
+                .format(neighborhood_resolution))
+
+        # Replicating borders, as our trilinear interpolation does with
+        # coordinates outside the volume. Padding enough so that features
+        # exist for the whole neighborhood of any point in the volume.
+        pad = neighborhood_radius * dilation + 2
+        x = torch.permute(volume, (3, 0, 1, 2))[None, ...]
+        x = torch.nn.functional.pad(x, [pad] * 6, mode='replicate')
+
+        # The first layer's output at index i is the output for a
+        # neighborhood starting at i - pad + radius * dilation.
+        origin = neighborhood_radius * dilation - pad
+        for i, cnn_layer in enumerate(self.cnn_layers):
+            x = torch.nn.functional.conv3d(
+                x, cnn_layer.weight, cnn_layer.bias, dilation=dilation)
+            if i < len(self.cnn_layers) - 1:
+                x = self.activation_layer(x)
+
+        features = torch.permute(x[0], (1, 2, 3, 0))
+        return features, origin, dilation
+
+    def interpolate_volume_features(self, features: Tensor, origin: int,
+                                    dilation: int, coords_vox_corner: Tensor):
+        """
+        Interpolates the features computed by compute_volume_features at
+        given coordinates. Returns the same output as forward() (see
+        compute_volume_features for exactness).
+
+        Parameters
+        ----------
+        features, origin, dilation:
+            Outputs of compute_volume_features.
+        coords_vox_corner: Tensor
+            The coordinates, of shape (M, 3), in voxel space, corner origin.
+
+        Returns
+        -------
+        x: Tensor of shape (M, X2*Y2*Z2*C2)
+        """
+        # Output positions are ordered as in forward: (X2, Y2, Z2, C2).
+        out_positions = itertools.product(*[range(n) for n in
+                                            self.out_image_shape])
+        vectors = torch.as_tensor(
+            np.asarray(list(out_positions)) * dilation - origin,
+            dtype=torch.float, device=coords_vox_corner.device)
+        x, _ = interpolate_volume_in_neighborhood(features, coords_vox_corner,
+                                                  vectors)
+        return self.activation_layer(x)
+
 
 keys_to_embeddings = {'no_embedding': NoEmbedding,
                       'nn_embedding': NNEmbedding,
@@ -10,13 +10,18 @@ import numpy as np
 import torch
 from torch import Tensor
 
+from dwi_ml.cache.cache_manager import SingleThreadCacheManager
 from dwi_ml.data.dataset.multi_subject_containers import MultisubjectSubset
+from dwi_ml.data.processing.volume.compact_dtypes import \
+    dequantize_interpolated_data
 from dwi_ml.data.processing.volume.interpolation import \
     interpolate_volume_in_neighborhood
 from dwi_ml.data.processing.space.neighborhood import \
-    prepare_neighborhood_vectors
+    prepare_neighborhood_vectors, unflatten_neighborhood
+from dwi_ml.experiment_utils.mixed_precision import keep_float32
 from dwi_ml.experiment_utils.prints import format_dict_to_str
-from dwi_ml.io_utils import add_resample_or_compress_arg
+from dwi_ml.io_utils import (add_resample_or_compress_arg,
+                             verify_which_model_in_path)
 from dwi_ml.models.direction_getter_models import keys_to_direction_getters
 from dwi_ml.models.embeddings import (keys_to_embeddings, NNEmbedding,
                                       NoEmbedding)
@@ -24,6 +29,42 @@ from dwi_ml.models.utils.direction_getters import add_direction_getter_args
 
 logger = logging.getLogger('model_logger')
 
+# Saved in a model's directory by export_inference_artifact. If present,
+# load_model_from_params_and_state uses it.
+INFERENCE_ARTIFACT_NAME = 'model_for_inference.pt'
+
+
+def _prepare_inference_artifact(model_type: str, params: dict, model_state):
+    # Weights on CPU, contiguous: they can be memory-mapped when loading.
+    return {'model_type': model_type, 'params': params,
+            'state_dict': {k: v.detach().cpu().contiguous()
+                           for k, v in model_state.items()}}
+
+
+def export_inference_artifact(model_dir: str, filename: str = None):
+    """
+    Writes a self-contained file for inference (model type, parameters and
+    weights) from a saved model directory (see
+    MainModelAbstract.save_params_and_state), without instantiating the
+    model.
+
+    Parameters
+    ----------
+    model_dir: str
+        Path to the saved model (ex, experiment_path/best_model).
+    filename: str
+        Output file. Default: model_dir/model_for_inference.pt, which is then
+        used by load_model_from_params_and_state.
+    """
+    filename = filename or os.path.join(model_dir, INFERENCE_ARTIFACT_NAME)
+    model_type = verify_which_model_in_path(model_dir)
+    with open(os.path.join(model_dir, "parameters.json"), 'r') as json_file:
+        params = json.load(json_file)
+    model_state = MainModelAbstract._load_state(model_dir)
+    torch.save(_prepare_inference_artifact(model_type, params, model_state),
+               filename)
+    return filename
+
 
 class MainModelAbstract(torch.nn.Module):
     """
@@ -163,6 +204,43 @@ class MainModelAbstract(torch.nn.Module):
         if to_remove:
             shutil.rmtree(to_remove)
 
+    def save_inference_artifact(self, filename):
+        """
+        Saves a self-contained file for inference: the model's type, its
+        parameters and its weights (on CPU). See
+        load_model_from_inference_artifact.
+        """
+        torch.save(_prepare_inference_artifact(
+            self.__class__.__name__, self.params_for_checkpoint,
+            self.state_dict()), filename)
+
+    @classmethod
+    def load_model_from_inference_artifact(cls, filename,
+                                           log_level=logging.WARNING):
+        """
+        Loads a model saved with save_inference_artifact (or
+        export_inference_artifact). Weights are memory-mapped and used as is
+        by the model (not copied). Intended for inference: the model is set
+        to eval state, on CPU.
+        """
+        artifact = torch.load(filename, map_location='cpu', mmap=True,
+                              weights_only=True)
+        if artifact['model_type'] != cls.__name__:
+            raise ValueError("File {} contains a {}, not a {}."
+                             .format(filename, artifact['model_type'],
+                                     cls.__name__))
+
+        logger.setLevel(log_level)
+        logger.debug("Loading model from inference artifact {}"
+                     .format(filename))
+        params = cls._format_loaded_params(artifact['params'])
+        params.update(log_level=log_level)
+        model = cls(**params)
+        model.load_state_dict(artifact['state_dict'], assign=True)
+        model.eval()
+
+        return model
+
     @classmethod
     def load_model_from_params_and_state(cls, model_dir,
                                          log_level=logging.WARNING):
@@ -174,7 +252,13 @@ class MainModelAbstract(torch.nn.Module):
             or from the best model folder. Must contain files
             - parameters.json
             - model_state.pkl
+            If it contains a model_for_inference.pt (see
+            export_inference_artifact), it is used instead.
         """
+        artifact = os.path.join(model_dir, INFERENCE_ARTIFACT_NAME)
+        if os.path.isfile(artifact):
+            return cls.load_model_from_inference_artifact(artifact, log_level)
+
         params = cls._load_params(model_dir)
 
         logger.setLevel(log_level)
@@ -199,12 +283,19 @@ class MainModelAbstract(torch.nn.Module):
         with open(params_filename, 'r') as json_file:
             params = json.load(json_file)
 
+        return cls._format_loaded_params(params)
+
+    @classmethod
+    def _format_loaded_params(cls, params):
+        """Override to update params saved by older versions."""
         return params
 
     @classmethod
     def _load_state(cls, model_dir):
         model_state_file = os.path.join(model_dir, "model_state.pkl")
-        model_state = torch.load(model_state_file)
+        # Memory-mapped: weights are read once, when copied to the model.
+        model_state = torch.load(model_state_file, map_location='cpu',
+                                 mmap=True, weights_only=True)
 
         return model_state
 
@@ -489,6 +580,7 @@ class MainModelOneInput(MainModelAbstract):
         # it wasn't there yet.
         data_tensor = subset.get_volume_verify_cache(
             subj_idx, input_group_idx, device=self.device)
+        volume_scaling = subset.get_volume_scaling(subj_idx, input_group_idx)
 
         # Prepare the volume data
         # Coord_torch contain the coords after interpolation, possibly clipped
@@ -497,10 +589,11 @@ class MainModelOneInput(MainModelAbstract):
             # Adding neighborhood.
             subj_x_data, coords_torch = interpolate_volume_in_neighborhood(
                 data_tensor, flat_subj_x_coords, self.neighborhood_vectors,
-                clear_cache=clear_cache)
+                clear_cache=clear_cache, volume_scaling=volume_scaling)
         else:
             subj_x_data, coords_torch = interpolate_volume_in_neighborhood(
-                data_tensor, flat_subj_x_coords, None, clear_cache=clear_cache)
+                data_tensor, flat_subj_x_coords, None, clear_cache=clear_cache,
+                volume_scaling=volume_scaling)
 
         # Split the flattened signal back to streamlines
         lengths = [len(s) for s in streamlines]
@@ -575,6 +668,11 @@ class ModelOneInputWithEmbedding(MainModelOneInput):
         else:
             self.instantiate_nn_embedding()
 
+        # Runtime option, not saved with the model's parameters. See
+        # uses_cnn_volume_features. Features are cached for one subject.
+        self.cnn_volume_features = False
+        self._cnn_features_cache = SingleThreadCacheManager(1)
+
     def instantiate_cnn_embedding(self):
         input_embedding_cls = keys_to_embeddings[self.input_embedding_key]
 
@@ -618,6 +716,80 @@ class ModelOneInputWithEmbedding(MainModelOneInput):
         self.computed_input_embedded_size = \
             self.input_embedding_layer.out_flattened_size
 
+    @property
+    def uses_cnn_volume_features(self):
+        """
+        With CNN embedding and option cnn_volume_features, outside of
+        training (validation, tracking), the CNN is run once on each subject's
+        whole volume, and prepare_batch_one_input returns the embedded inputs,
+        interpolated at each point. See CNNEmbedding.compute_volume_features
+        for when this is exact. During training, gradients require the usual
+        per-point CNN.
+        """
+        return (self.cnn_volume_features and
+                self.input_embedding_key == 'cnn_embedding' and
+                self.context is not None and self.context != 'training')
+
+    def train(self, mode: bool = True):
+        # Cached CNN features depend on the weights.
+        self._cnn_features_cache.empty_cache()
+        return super().train(mode)
+
+    def set_cnn_features_cache_size(self, nb_subjects: int):
+        """
+        Number of subjects for which CNN volume features are kept in memory
+        (ex, when tracking many subjects together). Default: 1.
+        """
+        self._cnn_features_cache = SingleThreadCacheManager(nb_subjects)
+
+    def prepare_batch_one_input(self, streamlines, subset: MultisubjectSubset,
+                                subj_idx, input_group_idx, prepare_mask=False,
+                                clear_cache=True):
+        if prepare_mask or not self.uses_cnn_volume_features:
+            return super().prepare_batch_one_input(
+                streamlines, subset, subj_idx, input_group_idx, prepare_mask,
+                clear_cache)
+
+        # Same key as in the volume cache.
+        key = '{}.{}.{}'.format(subset.set_name, subj_idx, input_group_idx)
+        if key not in self._cnn_features_cache:
+            logging.debug("Computing CNN features on the whole volume for "
+                          "subject {}".format(subj_idx))
+            data_tensor = subset.get_volume_verify_cache(
+                subj_idx, input_group_idx, device=self.device)
+            volume_scaling = subset.get_volume_scaling(subj_idx,
+                                                       input_group_idx)
+            volume = dequantize_interpolated_data(data_tensor.float(),
+                                                  volume_scaling)
+            with torch.no_grad():
+                self._cnn_features_cache[key] = \
+                    self.input_embedding_layer.compute_volume_features(
+                        volume, self.neighborhood_radius,
+                        self.neighborhood_resolution)
+        features, origin, dilation = self._cnn_features_cache[key]
+
+        flat_subj_x_coords = torch.cat(streamlines, dim=0)
+        subj_x_data = self.input_embedding_layer.interpolate_volume_features(
+            features, origin, dilation, flat_subj_x_coords)
+
+        lengths = [len(s) for s in streamlines]
+        return list(subj_x_data.split(lengths))
+
+    def embed_inputs(self, inputs: Tensor):
+        """
+        Runs the input embedding layer on flattened inputs of shape
+        (nb_points, nb_features * nb_neighbors).
+        """
+        if self.input_embedding_key == 'cnn_embedding':
+            if self.uses_cnn_volume_features:
+                # Already embedded in prepare_batch_one_input.
+                return inputs
+            # We need to reshape flattened inputs into a neighborhood.
+            inputs = unflatten_neighborhood(
+                inputs, self.neighborhood_vectors, self.neighborhood_type,
+                self.neighborhood_radius, self.neighborhood_resolution)
+        return self.input_embedding_layer(inputs)
+
     def instantiate_nn_embedding(self):
         # NN embedding or identity embedding:
 
@@ -757,6 +929,7 @@ class ModelWithDirectionGetter(MainModelAbstract):
         })
         return p
 
+    @keep_float32()
     def get_tracking_directions(self, model_outputs: Tensor, algo: str,
                                 eos_stopping_thresh: Union[float, str]):
         """
@@ -9,7 +9,25 @@ import math
 import torch
 
 
+def sinusoidal_encoding(positions: torch.Tensor, d_model: int):
+    """
+    Sinusoidal encoding of the given positions, such as described in the
+    paper Attention is all you need. Output shape: [len(positions), d_model].
+    """
+    position = positions.unsqueeze(1).float()  # shape: nb_positions x 1.
+    div_term = torch.exp(torch.arange(0, d_model, 2, device=positions.device) *
+                         (-math.log(10000.0) / d_model))  # len: d_model / 2
+    encoding = torch.zeros(len(positions), d_model, device=positions.device)
+    encoding[:, 0::2] = torch.sin(position * div_term)
+    encoding[:, 1::2] = torch.cos(position * div_term)
+    return encoding
+
+
 class AbstractPositionalEncoding(torch.nn.Module):
+    # If True, nothing is added to the data. Positions are rather encoded as
+    # a bias in the attention. See get_attention_bias.
+    relative = False
+
     def __init__(self, d_model: int, dropout_rate: float, max_len: int = 2048):
         """
         Positional incoding for the Transformer model.
@@ -51,12 +69,7 @@ class SinusoidalPositionalEncoding(AbstractPositionalEncoding):
                                  "but we got {}".format(d_model)
 
         # Compute the sinusoidal embedding parameter
-        position = torch.arange(max_len).unsqueeze(1)  # shape: max_len x 1.
-        div_term = torch.exp(torch.arange(0, d_model, 2) *
-                             (-math.log(10000.0) / d_model))  # len: d_model / 2
-        pos_emb = torch.zeros(1, max_len, d_model)
-        pos_emb[0, :, 0::2] = torch.sin(position * div_term)
-        pos_emb[0, :, 1::2] = torch.cos(position * div_term)
+        pos_emb = sinusoidal_encoding(torch.arange(max_len), d_model)[None]
 
         # pos_emb is a parameter, but not learned. We don't want the optimizer
         # to update this. We could do self.pos_emb = pos_emb.
@@ -78,16 +91,62 @@ class SinusoidalPositionalEncoding(AbstractPositionalEncoding):
 
 class RelationalSinusoidalPosEncoding(AbstractPositionalEncoding):
     """
-    Creates the vector for positional embedding that can be added to the data
-    embedding as first layer of a transformer. Such as described in the music
-    paper [ref] to replace the sinusoidal version.
-
-    [ref]
+    Relative positional encoding: nothing is added to the data embedding.
+    Instead, a bias depending on the distance between the query and the key
+    is added to the attention scores. Such as described in the music paper
+    [ref], this makes the model invariant to translations in the sequence:
+    the output at a point only depends on the previous points, not on their
+    absolute position. Sequences longer than max_len can thus be processed,
+    and, with an attention window, sequences can be cropped to their last
+    points during tracking.
+
+    Here, to keep attention heads independent of their dimension, the bias
+    is one scalar per head and per distance (such as in T5 [ref2]). It is
+    a learned linear combination of the sinusoidal encoding of the distance,
+    so that it is defined for any distance.
+
+    [ref] Huang et al., 2018. Music Transformer.
+          https://arxiv.org/abs/1809.04281
+    [ref2] Raffel et al., 2020. Exploring the limits of transfer learning
+           with a unified text-to-text transformer.
     """
-    def __init__(self, d_model, dropout_rate, max_len):
+    relative = True
+
+    def __init__(self, d_model, dropout_rate, max_len, nheads: int = 1,
+                 nb_distance_features: int = 32):
+        """
+        nheads: int
+            Number of attention heads. One bias per head.
+        nb_distance_features: int
+            Size of the sinusoidal encoding of the distances. Independent of
+            d_model: the bias is a scalar.
+        """
         super().__init__(d_model, dropout_rate, max_len)
-        # toDo
-        raise NotImplementedError
+        self.nheads = nheads
+        self.nb_distance_features = nb_distance_features
+
+        # From the sinusoidal encoding of the distance to one bias per head.
+        self.bias_layer = torch.nn.Linear(nb_distance_features, nheads)
+
+    def forward(self, x) -> torch.Tensor:
+        # Positions are managed in the attention. See get_attention_bias.
+        return x
+
+    def get_attention_bias(self, seq_len: int, device=None):
+        """
+        Returns
+        -------
+        bias: Tensor
+            Shape [nheads, seq_len, seq_len]. At [h, i, j], the bias of head
+            h for query i and key j, depending on the distance i - j.
+            Future positions (j > i) get the bias of distance 0; they are
+            expected to be masked.
+        """
+        distances = torch.arange(seq_len, device=device)
+        bias = self.bias_layer(
+            sinusoidal_encoding(distances, self.nb_distance_features))
+        relative_pos = distances[:, None] - distances[None, :]
+        return bias[relative_pos.clamp(min=0)].permute(2, 0, 1)
 
 
 keys_to_positional_encodings = {
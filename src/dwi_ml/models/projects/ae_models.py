@@ -125,8 +125,10 @@ class ModelAE(MainModelAbstract):
         return x
 
     def encode(self, x):
-        # x: list of tensors
-        x = torch.stack(x)
+        # x: list of tensors (all of the same length: nb_points), or already
+        # stacked.
+        if not isinstance(x, torch.Tensor):
+            x = torch.stack(x)
         x = torch.swapaxes(x, 1, 2)
 
         h1 = F.relu(self.encod_conv1(x))
@@ -166,7 +168,8 @@ class ModelAE(MainModelAbstract):
 
     def compute_loss(self, model_outputs, targets, average_results=True):
 
-        targets = torch.stack(targets)
+        if not isinstance(targets, torch.Tensor):
+            targets = torch.stack(targets)
         targets = torch.swapaxes(targets, 1, 2)
         reconstruction_loss = torch.nn.MSELoss(reduction="sum")
         mse = reconstruction_loss(model_outputs, targets)
@@ -6,7 +6,6 @@ import numpy as np
 import torch
 from torch.nn.utils.rnn import invert_permutation, PackedSequence, pack_sequence
 
-from dwi_ml.data.processing.space.neighborhood import unflatten_neighborhood
 from dwi_ml.data.processing.streamlines.post_processing import \
     compute_directions, normalize_directions, compute_n_previous_dirs
 from dwi_ml.data.processing.streamlines.sos_eos_management import \
@@ -66,6 +65,27 @@ def faster_unpack_sequence(packed_sequence: PackedSequence):
     return batch
 
 
+def pack_same_length_sequences(sequences: List[torch.Tensor]):
+    """
+    Same as torch's pack_sequence, for sequences that all have the same
+    length (ex: models using nb_points). No sorting or padding: packed data is
+    simply the sequences stacked on the time dimension.
+    """
+    nb_points = len(sequences[0])
+    data = torch.stack(sequences, dim=1).reshape(-1, *sequences[0].shape[1:])
+    batch_sizes = torch.full((nb_points,), len(sequences), dtype=torch.int64)
+    return PackedSequence(data, batch_sizes)
+
+
+def unpack_same_length_sequences(data: torch.Tensor, nb_sequences: int):
+    """
+    Inverse of pack_same_length_sequences, on the packed data. Returns a list
+    of views; nothing is copied.
+    """
+    data = data.view(-1, nb_sequences, *data.shape[1:])
+    return list(data.transpose(0, 1).unbind(0))
+
+
 class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
                        ModelWithNeighborhood, ModelOneInputWithEmbedding):
     """
@@ -268,16 +288,32 @@ class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
         # Right now input is always flattened (interpolation is implemented
         # that way). For CNN, we will rearrange it ourselves.
         # Verifying the first input
-        assert x[0].shape[-1] == self.input_size, \
-            "Not the expected input size! Should be {} (i.e. {} features for " \
-            "each of the {} neighbors), but got {} (input shape {})." \
-            .format(self.input_size, self.nb_features, self.nb_neighbors,
-                    x[0].shape[-1], x[0].shape)
+        if self.uses_cnn_volume_features:
+            # Already embedded in prepare_batch_one_input.
+            cnn_output_size = self.input_embedding_layer.out_flattened_size
+            assert x[0].shape[-1] == cnn_output_size, \
+                "Not the expected input size! Should be {} (i.e. the CNN " \
+                "volume features), but got {} (input shape {})." \
+                .format(cnn_output_size, x[0].shape[-1], x[0].shape)
+        else:
+            assert x[0].shape[-1] == self.input_size, \
+                "Not the expected input size! Should be {} (i.e. {} " \
+                "features for each of the {} neighbors), but got {} (input " \
+                "shape {})." \
+                .format(self.input_size, self.nb_features, self.nb_neighbors,
+                        x[0].shape[-1], x[0].shape)
+
+        # When all streamlines have the same length (ex: with nb_points, or
+        # during forward tracking), using a dense path: no sorting, and
+        # packing / unpacking are simple reshapes.
+        nb_streamlines = len(x)
+        same_length = all(len(s) == len(x[0]) for s in x)
+        pack = pack_same_length_sequences if same_length else pack_sequence
 
         # Making sure we can use default 'enforce_sorted=True' with packed
         # sequences.
         unsorted_indices = None
-        if not self.context == 'tracking':
+        if not self.context == 'tracking' and not same_length:
             # Ordering streamlines per length.
             lengths = torch.as_tensor([len(s) for s in x])
             _, sorted_indices = torch.sort(lengths, descending=True)
@@ -300,7 +336,7 @@ class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
             if self.nb_previous_dirs > 0:
                 n_prev_dirs = compute_n_previous_dirs(
                     dirs, self.nb_previous_dirs, point_idx=point_idx)
-                n_prev_dirs = pack_sequence(n_prev_dirs)
+                n_prev_dirs = pack(n_prev_dirs)
                 # Shape: (nb_points - 1) per streamline x (3 per prev dir)
                 n_prev_dirs = self.prev_dirs_embedding(n_prev_dirs.data)
                 n_prev_dirs = self.embedding_dropout(n_prev_dirs)
@@ -310,7 +346,7 @@ class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
                 copy_prev_dir = self.copy_prev_dir(dirs)
 
         # ==== 2. Inputs embedding ====
-        x = pack_sequence(x)
+        x = pack(x)
         batch_sizes = x.batch_sizes
 
         # Avoiding unpacking and packing back if not needed.
@@ -320,14 +356,7 @@ class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
             x = x.data
 
             # Embedding. Shape of inputs: nb_pts_total * embedded_size
-            if self.input_embedding_key == 'cnn_embedding':
-                # We need to reshape flattened inputs into a neighborhood.
-                # Batch has been prepared in self.prepare_batch_one_input.
-                x = unflatten_neighborhood(
-                    x, self.neighborhood_vectors, self.neighborhood_type,
-                    self.neighborhood_radius, self.neighborhood_resolution)
-
-            x = self.input_embedding_layer(x)
+            x = self.embed_inputs(x)
             x = self.embedding_dropout(x)
 
             # ==== 3. Concat with previous dirs ====
@@ -365,13 +394,10 @@ class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
             if 'gaussian' in self.dg_key or 'fisher' in self.dg_key:
                 # Separating mean, sigmas (gaussian) or mean, kappa (fisher)
                 x, x2 = x
-
-                x2 = PackedSequence(x2, batch_sizes)
-                x2 = faster_unpack_sequence(x2)
-                x2 = [x2[i] for i in unsorted_indices]
-            x = PackedSequence(x, batch_sizes)
-            x = faster_unpack_sequence(x)
-            x = [x[i] for i in unsorted_indices]
+                x2 = self._unpack(x2, batch_sizes, unsorted_indices,
+                                  nb_streamlines, same_length)
+            x = self._unpack(x, batch_sizes, unsorted_indices,
+                             nb_streamlines, same_length)
 
             if 'gaussian' in self.dg_key or 'fisher' in self.dg_key:
                 x = (x, x2)
@@ -379,7 +405,7 @@ class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
         if return_hidden:
             # Return the hidden states too. Necessary for the generative
             # (tracking) part, done step by step.
-            if not self.context == 'tracking':
+            if unsorted_indices is not None:
                 # (ex: when preparing backward tracking.
                 #  Must also re-sort hidden states.)
                 if self.rnn_model.rnn_torch_key == 'lstm':
@@ -397,6 +423,15 @@ class Learn2TrackModel(ModelWithPreviousDirections, ModelWithDirectionGetter,
         else:
             return x
 
+    @staticmethod
+    def _unpack(x, batch_sizes, unsorted_indices, nb_streamlines,
+                same_length):
+        if same_length:
+            return unpack_same_length_sequences(x, nb_streamlines)
+        x = PackedSequence(x, batch_sizes)
+        x = faster_unpack_sequence(x)
+        return [x[i] for i in unsorted_indices]
+
     def copy_prev_dir(self, dirs):
         if 'regression' in self.dg_key:
             # Regression: The latest previous dir will be used as skip
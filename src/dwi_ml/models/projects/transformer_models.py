@@ -2,10 +2,9 @@
 import logging
 from typing import Union, List, Optional
 
-from dipy.data import get_sphere
 import numpy as np
 import torch
-from torch.nn import Dropout, Transformer
+from torch.nn import Dropout
 from torch.nn.functional import pad
 
 from dwi_ml.data.processing.streamlines.sos_eos_management import \
@@ -138,7 +137,8 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
                  neighborhood_radius: Optional[int] = None,
                  neighborhood_resolution: Optional[float] = None,
                  log_level=logging.root.level,
-                 nb_points: Optional[int] = None):
+                 nb_points: Optional[int] = None,
+                 attention_window: Optional[int] = None):
         """
         Note about embedding size:
             In the original model + SrcOnly model: defines d_model.
@@ -154,7 +154,8 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
             encoding. During the forward call, batches are only padded to the
             longest sequence in the batch. However, positional encoding only
             makes sence if not streamlines are longer than that value (this is
-            verified).
+            verified). With the relational positional encoding, longer
+            sequences are accepted.
         positional_encoding_key: str,
             Chosen class for the input's positional embedding. Choices:
             keys_to_positional_embeddings.keys(). Default: 'sinusoidal'.
@@ -179,6 +180,13 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
             layer with the norm.
         n_layers_e: int
             All ours models have at least an encoder.
+        attention_window: int
+            If set, each point only attends to the attention_window last
+            points (itself included), in every attention layer. With the
+            relational positional encoding, during tracking, streamlines are
+            then cropped to the points that can influence the output at the
+            last point (see tracking_context_len). Default: None (attending
+            to all previous points).
         """
 
         # Important. Super must be called first to verify input embedded size
@@ -202,6 +210,7 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
 
         self.max_len = max_len
         self.positional_encoding_key = positional_encoding_key
+        self.attention_window = attention_window
         self.nheads = nheads
         self.n_layers_e = n_layers_e  # All our models have an encoder
         self.dropout_rate = dropout_rate
@@ -223,6 +232,10 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
             raise ValueError("Positional encoding choice not understood: {}"
                              .format(self.positional_encoding_key))
 
+        if attention_window is not None and attention_window < 1:
+            raise ValueError("The attention window must be at least 1, but "
+                             "got {}".format(attention_window))
+
         # ----------- Instantiations
         # This dropout is only used in the embedding; torch's transformer
         # prepares its own dropout elsewhere, and direction getter too.
@@ -235,8 +248,17 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
 
         # 2. positional encoding layer
         cls_p = keys_to_positional_encodings[self.positional_encoding_key]
-        self.position_encoding_layer = cls_p(self.d_model, dropout_rate,
-                                             max_len)
+        if cls_p.relative:
+            # One attention bias per head.
+            self.position_encoding_layer = cls_p(
+                self.d_model, dropout_rate, max_len, nheads=nheads)
+        else:
+            self.position_encoding_layer = cls_p(self.d_model, dropout_rate,
+                                                 max_len)
+
+        # Future masks: one (max_len, max_len) mask per device. Masks for
+        # shorter lengths are views of it. See _generate_future_mask.
+        self._future_masks = {}
 
         # 3. target embedding layer: See child class with Target
 
@@ -266,6 +288,7 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
             'input_embedding_key': self.input_embedding_key,
             'input_embedded_size': self.input_embedded_size,
             'max_len': self.max_len,
+            'attention_window': self.attention_window,
             'n_layers_e': self.n_layers_e,
             'positional_encoding_key': self.positional_encoding_key,
             'dropout_rate': self.dropout_rate,
@@ -278,8 +301,8 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
         return p
 
     @classmethod
-    def _load_params(cls, model_dir):
-        params = super()._load_params(model_dir)
+    def _format_loaded_params(cls, params):
+        params = super()._format_loaded_params(params)
 
         # d_model now a property method.
         if 'd_model' in params:
@@ -290,6 +313,33 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
 
         return params
 
+    @property
+    def nb_attention_layers(self):
+        """Number of successive attention layers. See tracking_context_len."""
+        return self.n_layers_e
+
+    @property
+    def tracking_context_len(self):
+        """
+        With an attention window, each attention layer only looks
+        attention_window - 1 points further in the past. The output at the
+        last point thus only depends on the tracking_context_len last points.
+        With a relative positional encoding, absolute positions do not
+        matter: during tracking, the other points can be ignored.
+        None if all points are necessary.
+        """
+        if self.attention_window is None or \
+                not self.position_encoding_layer.relative:
+            return None
+        return self.nb_attention_layers * (self.attention_window - 1) + 1
+
+    @property
+    def _mask_is_causal(self):
+        # With a window or a position bias, the mask is not simply the causal
+        # mask: scaled_dot_product_attention's causal kernel can't be used.
+        return (self.attention_window is None and
+                not self.position_encoding_layer.relative)
+
     def set_context(self, context):
         # Training, validation: Used by trainer. Nothing special.
         # Tracking: Used by tracker. Returns only the last point.
@@ -304,19 +354,30 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
     def _generate_future_mask(self, sz):
         """DO NOT USE FLOAT, their code had a bug (see issue #92554. Fixed in
         latest GitHub branch. Waiting for release.) Using boolean masks.
-        """
-        mask = Transformer.generate_square_subsequent_mask(sz, self.device)
-        return mask < 0
 
-    def _generate_padding_mask(self, unpadded_lengths, batch_max_len):
-        nb_streamlines = len(unpadded_lengths)
+        The mask of size sz is the top-left corner of the mask of size
+        max_len. Computed once per device; returns a view. Masks must not be
+        modified in-place.
 
-        mask_padding = torch.full((nb_streamlines, batch_max_len),
-                                  fill_value=False, device=self.device)
-        for i in range(nb_streamlines):
-            mask_padding[i, unpadded_lengths[i]:] = True
+        With an attention window, points further than the window are also
+        masked.
+        """
+        key = str(self.device)
+        if key not in self._future_masks or len(self._future_masks[key]) < sz:
+            # sz > max_len is possible with relative positional encoding.
+            positions = torch.arange(max(sz, self.max_len), device=self.device)
+            distances = positions[:, None] - positions[None, :]
+            mask = distances < 0
+            if self.attention_window is not None:
+                mask |= distances >= self.attention_window
+            self._future_masks[key] = mask
+        return self._future_masks[key][:sz, :sz]
 
-        return mask_padding
+    def _generate_padding_mask(self, unpadded_lengths, batch_max_len):
+        # True at positions >= the streamline's length.
+        lengths = torch.as_tensor(unpadded_lengths, device=self.device)
+        positions = torch.arange(batch_max_len, device=self.device)
+        return positions[None, :] >= lengths[:, None]
 
     def _prepare_masks(self, unpadded_lengths, use_padding, batch_max_len):
         """
@@ -343,13 +404,24 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
             = [[False, True,  True],
                [False, False, True],
                [False, False, False]]
+            With relational positional encoding: float mask of shape
+            [nheads, batch_max_len, batch_max_len], containing the attention
+            bias, and -inf at masked positions.
         mask_padding: Tensor
             Shape [nb_streamlines, batch_max_len]. Masks positions that do not
             exist in the sequence.
         """
         mask_future = self._generate_future_mask(batch_max_len)
-
-        if use_padding:
+        if self.position_encoding_layer.relative:
+            bias = self.position_encoding_layer.get_attention_bias(
+                batch_max_len, self.device)
+            mask_future = bias.masked_fill(mask_future, -torch.inf)
+
+        # With a window, padded points, at the end, could have all their keys
+        # masked, leading to NaN. But the padding mask is not necessary:
+        # because of the future mask, real points never attend to padded
+        # points.
+        if use_padding and self.attention_window is None:
             mask_padding = self._generate_padding_mask(unpadded_lengths,
                                                        batch_max_len)
         else:
@@ -408,10 +480,22 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
         # verifying if any length exceeds the max allowed).
         input_lengths = np.asarray([len(i) for i in inputs])
 
-        if np.any(input_lengths > self.max_len):
+        if not self.position_encoding_layer.relative and \
+                np.any(input_lengths > self.max_len):
             raise ValueError("Some streamlines were longer than accepted max "
                              "length for sequences ({})".format(self.max_len))
 
+        # Compute targets (= directions) for the decoder.
+        data, constant_output = self._prepare_data(inputs, input_streamlines)
+        nb_streamlines = len(inputs)
+
+        # During tracking, only the last points can influence the output.
+        context_len = self.tracking_context_len
+        if self.context == 'tracking' and context_len is not None and \
+                np.any(input_lengths > context_len):
+            data = self._crop_data(data, context_len)
+            input_lengths = np.minimum(input_lengths, context_len)
+
         # ----------- Padding params
         use_padding = not np.all(input_lengths == input_lengths[0])
         batch_max_len = np.max(input_lengths)
@@ -421,9 +505,6 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
         # ----------- Prepare masks
         masks = self._prepare_masks(input_lengths, use_padding, batch_max_len)
 
-        # Compute targets (= directions) for the decoder.
-        nb_streamlines = len(inputs)
-
         # ----------- Ok. Start processing
         # Note. Tried calling torch.cuda.empty_cache() before.
         # Not really recommended, and does not seem to help much.
@@ -433,7 +514,6 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
         # 1. Embedding + position encoding.
         # Run embedding on padded data. Necessary to make the model
         # adapt for the positional encoding.
-        data, constant_output = self._prepare_data(inputs, input_streamlines)
         data = self._run_embeddings(data, use_padding, batch_max_len)
         data = self._run_position_encoding(data)
 
@@ -459,11 +539,11 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
                 # Not all the same length (ex, backward tracking)
                 # Taking output at the last coordinate = len(input) - 1
                 # (-1 for python indexing)
-                outputs = [outputs[i, input_lengths[i] - 1, :]
-                           for i in range(nb_streamlines)]
-
-                # Stacking for the direction getter.
-                outputs = torch.vstack(outputs)
+                last_points = torch.as_tensor(input_lengths - 1,
+                                              device=outputs.device)
+                outputs = outputs[torch.arange(nb_streamlines,
+                                               device=outputs.device),
+                                  last_points, :]
 
             else:
                 # All the same length (ex, during forward tracking)
@@ -482,11 +562,15 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
             # i.e. one output per coordinate. It's the trainer's job to remove
             # the last coordinate if we don't need it (if no EOS).
             # Ignoring results at padded points.
-            outputs = [outputs[i, 0:input_lengths[i], :]
-                       for i in range(nb_streamlines)]
+            if use_padding:
+                outputs = [outputs[i, 0:input_lengths[i], :]
+                           for i in range(nb_streamlines)]
 
-            # Stacking for the direction getter.
-            outputs = torch.vstack(outputs)
+                # Stacking for the direction getter.
+                outputs = torch.vstack(outputs)
+            else:
+                # All the same length (ex, with nb_points): nothing to unpad.
+                outputs = outputs.reshape(-1, outputs.shape[-1])
 
             if constant_output is not None:  # ex, start_from_copy_prev:
                 constant_output = torch.vstack(constant_output)
@@ -519,6 +603,10 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
     def _prepare_data(self, inputs, input_streamlines):
         raise NotImplementedError
 
+    def _crop_data(self, data, nb_points):
+        """Keeps only the nb_points last points of each streamline."""
+        raise NotImplementedError
+
     def _run_embeddings(self, data, use_padding, batch_max_len):
         raise NotImplementedError
 
@@ -536,8 +624,14 @@ class AbstractTransformerModel(ModelWithNeighborhood, ModelWithDirectionGetter,
         #      will be masked in attention anyway)
 
         # Inputs
-        inputs = pad_and_stack_batch(inputs, use_padding, batch_max_len)
-        inputs = self.input_embedding_layer(inputs)
+        if self.input_embedding_key == 'cnn_embedding':
+            # The CNN works on flattened inputs (one neighborhood per point).
+            lengths = [len(i) for i in inputs]
+            inputs = list(self.embed_inputs(torch.cat(inputs)).split(lengths))
+            inputs = pad_and_stack_batch(inputs, use_padding, batch_max_len)
+        else:
+            inputs = pad_and_stack_batch(inputs, use_padding, batch_max_len)
+            inputs = self.input_embedding_layer(inputs)
         return inputs
 
     def merge_batches_outputs(self, all_outputs, new_batch, device=None):
@@ -600,8 +694,8 @@ class TransformerSrcOnlyModel(AbstractTransformerModel):
         return p
 
     @classmethod
-    def _load_params(cls, model_dir):
-        params = super()._load_params(model_dir)
+    def _format_loaded_params(cls, params):
+        params = super()._format_loaded_params(params)
 
         return params
 
@@ -610,6 +704,9 @@ class TransformerSrcOnlyModel(AbstractTransformerModel):
         # No constant value to be added to output.
         return inputs, None
 
+    def _crop_data(self, inputs, nb_points):
+        return [i[-nb_points:] for i in inputs]
+
     def _run_embeddings(self, inputs, use_padding, batch_max_len):
         return self._run_input_embedding(inputs, use_padding, batch_max_len)
 
@@ -624,7 +721,7 @@ class TransformerSrcOnlyModel(AbstractTransformerModel):
         # mask_future, mask_padding = masks
         outputs, sa_weights = self.modified_torch_transformer(
             src=inputs, mask=masks[0], src_key_padding_mask=masks[1],
-            is_causal=True, return_weights=return_weights)
+            is_causal=self._mask_is_causal, return_weights=return_weights)
 
         return outputs, (sa_weights,)
 
@@ -657,8 +754,10 @@ class AbstractTransformerModelWithTarget(AbstractTransformerModel):
             self.token_sphere = None
             self.target_features = 4
         else:
+            # Slow import, only needed with this SOS token.
+            from dipy.data import get_sphere
             dipy_sphere = get_sphere(name=sos_token_type)
-            self.token_sphere = TorchSphere(dipy_sphere)
+            self.token_sphere = TorchSphere(dipy_sphere, lookup_grid_size=32)
             # nb classes = nb_vertices + SOS
             self.target_features = len(self.token_sphere.vertices) + 1
 
@@ -728,6 +827,11 @@ class AbstractTransformerModelWithTarget(AbstractTransformerModel):
 
         return (inputs, targets), copy_prev_dir
 
+    def _crop_data(self, data, nb_points):
+        # inputs, targets = data
+        return ([i[-nb_points:] for i in data[0]],
+                [t[-nb_points:] for t in data[1]])
+
     def _run_embeddings(self, data, use_padding, batch_max_len):
         raise NotImplementedError
 
@@ -894,6 +998,12 @@ class OriginalTransformerModel(AbstractTransformerModelWithTarget):
         p['n_layers_d'] = self.n_layers_d
         return p
 
+    @property
+    def nb_attention_layers(self):
+        # Output depends on targets through the decoder, and on inputs
+        # through the encoder then the decoder.
+        return self.n_layers_e + self.n_layers_d
+
     def _run_embeddings(self, data, use_padding, batch_max_len):
         # input, targets = data
         inputs = self._run_input_embedding(data[0], use_padding, batch_max_len)
@@ -928,8 +1038,10 @@ class OriginalTransformerModel(AbstractTransformerModelWithTarget):
                 src=data[0], tgt=data[1],
                 src_mask=masks[0], tgt_mask=masks[0], memory_mask=masks[0],
                 src_key_padding_mask=masks[1], tgt_key_padding_mask=masks[1],
-                memory_key_padding_mask=masks[1], src_is_causal=True,
-                tgt_is_causal=True, memory_is_causal=True,
+                memory_key_padding_mask=masks[1],
+                src_is_causal=self._mask_is_causal,
+                tgt_is_causal=self._mask_is_causal,
+                memory_is_causal=self._mask_is_causal,
                 return_weights=return_weights)
         return outputs, (sa_weights_encoder, sa_weights_decoder, mha_weights)
 
@@ -1010,7 +1122,7 @@ class TransformerSrcAndTgtModel(AbstractTransformerModelWithTarget):
         # mask_future, mask_padding = masks
         outputs, sa_weights = self.modified_torch_transformer(
             src=concat_s_t, mask=masks[0], src_key_padding_mask=masks[1],
-            is_causal=True, return_weights=return_weights)
+            is_causal=self._mask_is_causal, return_weights=return_weights)
 
         return outputs, (sa_weights,)
 
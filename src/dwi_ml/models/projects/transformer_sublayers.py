@@ -4,6 +4,13 @@ Child classes of Torch Transformers. Changes are:
 - EncoderLayer: Idem
 - DecoderLayer: Idem
 
+When attention weights are not required (i.e. outside of the 'visu_weights'
+context), attention is computed directly with
+torch.nn.functional.scaled_dot_product_attention. Torch's MultiheadAttention
+also uses it when need_weights=False, but it first merges the key padding
+mask with the attention mask into a (batch, heads, L, L) float mask, and it
+does not use the causal kernels when there is padding. Here, masks stay
+boolean and are broadcast over heads.
 """
 import logging
 from typing import Optional
@@ -16,6 +23,10 @@ from torch.nn import (TransformerDecoderLayer, TransformerEncoderLayer,
 
 logger = logging.getLogger('model_logger')
 
+# Set to False to always use torch's MultiheadAttention forward (ex, to
+# compare results).
+USE_SDPA = True
+
 
 def do_not_share_linear_weights(attn: MultiheadAttention, d_model):
     """
@@ -44,6 +55,118 @@ def do_not_share_linear_weights(attn: MultiheadAttention, d_model):
     attn._reset_parameters()
 
 
+def _to_sdpa_mask(mask: Optional[Tensor]):
+    """
+    MultiheadAttention masks: True (or -inf) = not allowed to attend.
+    scaled_dot_product_attention masks: True (or 0) = allowed to attend.
+    Float masks are additive in both cases.
+    """
+    if mask is None or mask.dtype != torch.bool:
+        return mask
+    return ~mask
+
+
+def _merge_sdpa_masks(attn_mask: Optional[Tensor],
+                      key_padding_mask: Optional[Tensor],
+                      batch_size: int, nb_heads: int):
+    """
+    Merges masks for scaled_dot_product_attention, broadcasting over heads
+    and batch rather than expanding them.
+    """
+    attn_mask = _to_sdpa_mask(attn_mask)
+    if attn_mask is not None and attn_mask.dim() == 3:
+        # Shape (batch * heads, L, S), as accepted by MultiheadAttention, or
+        # (heads, L, S), the same for all streamlines (ex, relative position
+        # bias).
+        if attn_mask.shape[0] == nb_heads:
+            batch_size = 1
+        attn_mask = attn_mask.view(batch_size, nb_heads,
+                                   *attn_mask.shape[1:])
+
+    key_padding_mask = _to_sdpa_mask(key_padding_mask)
+    if key_padding_mask is None:
+        return attn_mask
+    key_padding_mask = key_padding_mask[:, None, None, :]
+    if attn_mask is None:
+        return key_padding_mask
+
+    if attn_mask.dtype == torch.bool and key_padding_mask.dtype == torch.bool:
+        return attn_mask & key_padding_mask
+
+    # At least one float (additive) mask.
+    def _to_float(m):
+        if m.dtype != torch.bool:
+            return m
+        return torch.zeros(m.shape, device=m.device).masked_fill(
+            ~m, -torch.inf)
+    return _to_float(attn_mask) + _to_float(key_padding_mask)
+
+
+def sdpa_attention(attn: MultiheadAttention, query: Tensor, key: Tensor,
+                   value: Tensor, attn_mask: Optional[Tensor],
+                   key_padding_mask: Optional[Tensor], is_causal: bool):
+    """
+    Same as attn(query, key, value, ..., need_weights=False)[0], for a
+    batch_first MultiheadAttention, using scaled_dot_product_attention.
+
+    As in MultiheadAttention, is_causal is a hint that attn_mask is the
+    causal mask. Without padding, the mask is then not used at all.
+    """
+    batch_size, len_q, d_model = query.shape
+    len_k = key.shape[1]
+    nb_heads = attn.num_heads
+    head_dim = d_model // nb_heads
+
+    if attn._qkv_same_embed_dim:
+        w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+    else:
+        w_q, w_k, w_v = (attn.q_proj_weight, attn.k_proj_weight,
+                         attn.v_proj_weight)
+    if attn.in_proj_bias is not None:
+        b_q, b_k, b_v = attn.in_proj_bias.chunk(3)
+    else:
+        b_q = b_k = b_v = None
+
+    # Shapes: (batch, heads, L, head_dim)
+    q = F.linear(query, w_q, b_q).view(
+        batch_size, len_q, nb_heads, head_dim).transpose(1, 2)
+    k = F.linear(key, w_k, b_k).view(
+        batch_size, len_k, nb_heads, head_dim).transpose(1, 2)
+    v = F.linear(value, w_v, b_v).view(
+        batch_size, len_k, nb_heads, head_dim).transpose(1, 2)
+
+    if is_causal and key_padding_mask is None:
+        mask = None
+    else:
+        mask = _merge_sdpa_masks(attn_mask, key_padding_mask, batch_size,
+                                 nb_heads)
+        is_causal = False
+
+    dropout_p = attn.dropout if attn.training else 0.
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                       dropout_p=dropout_p,
+                                       is_causal=is_causal)
+    x = x.transpose(1, 2).reshape(batch_size, len_q, d_model)
+    return attn.out_proj(x)
+
+
+def _mask_for_mha(attn: MultiheadAttention, attn_mask: Optional[Tensor],
+                  batch_size: int):
+    """
+    MultiheadAttention does not accept masks of shape (heads, L, S). Expanding
+    them to (batch * heads, L, S).
+    """
+    if (attn_mask is not None and attn_mask.dim() == 3 and
+            attn_mask.shape[0] != batch_size * attn.num_heads):
+        attn_mask = attn_mask.repeat(batch_size, 1, 1)
+    return attn_mask
+
+
+def _can_use_sdpa(attn: MultiheadAttention, return_weights: bool):
+    return (USE_SDPA and not return_weights and attn.batch_first and
+            attn.bias_k is None and not attn.add_zero_attn)
+
+
 class ModifiedTransformerEncoderLayer(TransformerEncoderLayer):
     def __init__(self, d_model, nhead, **kw):
         super().__init__(d_model, nhead, **kw)
@@ -190,9 +313,15 @@ class ModifiedTransformerEncoderLayer(TransformerEncoderLayer):
                   is_causal: bool = False,
                   # New args:
                   return_weights=False, average_heads=False):
+        if _can_use_sdpa(self.self_attn, return_weights):
+            x = sdpa_attention(self.self_attn, x, x, x, attn_mask,
+                               key_padding_mask, is_causal)
+            return self.dropout1(x), None
+
         x, weights = self.self_attn(
             x, x, x,
-            attn_mask=attn_mask, key_padding_mask=key_padding_mask,
+            attn_mask=_mask_for_mha(self.self_attn, attn_mask, len(x)),
+            key_padding_mask=key_padding_mask,
             is_causal=is_causal,
             # Modified args:
             need_weights=return_weights, average_attn_weights=average_heads)
@@ -270,9 +399,15 @@ class ModifiedTransformerDecoderLayer(TransformerDecoderLayer):
         """
         Copy-pasted from torch. Now returns weights.
         """
+        if _can_use_sdpa(self.self_attn, return_weights):
+            x = sdpa_attention(self.self_attn, x, x, x, attn_mask,
+                               key_padding_mask, is_causal)
+            return self.dropout1(x), None
+
         x, weights = self.self_attn(
             x, x, x,
-            attn_mask=attn_mask, key_padding_mask=key_padding_mask,
+            attn_mask=_mask_for_mha(self.self_attn, attn_mask, len(x)),
+            key_padding_mask=key_padding_mask,
             is_causal=is_causal,
             # Modified args:
             need_weights=return_weights, average_attn_weights=average_heads)
@@ -289,9 +424,15 @@ class ModifiedTransformerDecoderLayer(TransformerDecoderLayer):
         """
         Copy-pasted from torch. Can now use need_weight = True.
         """
+        if _can_use_sdpa(self.multihead_attn, return_weights):
+            x = sdpa_attention(self.multihead_attn, x, mem, mem, attn_mask,
+                               key_padding_mask, is_causal)
+            return self.dropout2(x), None
+
         x = self.multihead_attn(
             x, mem, mem,
-            attn_mask=attn_mask, key_padding_mask=key_padding_mask,
+            attn_mask=_mask_for_mha(self.multihead_attn, attn_mask, len(x)),
+            key_padding_mask=key_padding_mask,
             is_causal=is_causal,
             # Modified args:
             need_weights=return_weights, average_attn_weights=average_heads)
@@ -34,7 +34,10 @@ def add_transformers_model_args(p):
         '--position_encoding', default='sinusoidal', metavar='key',
         choices=keys_to_positional_encodings.keys(),
         help="Type of positional embedding to use. One of 'sinusoidal' "
-             "(default)\n or 'relational'. ")
+             "(default)\n or 'relational'. With 'relational', a bias "
+             "depending on the distance \nbetween points is added in the "
+             "attention instead, and streamlines can be \nlonger than "
+             "max_len.")
 
     gt = p.add_argument_group("Embedding of the target (Y)\n"
                               "(FOR MODELS TTO and TTST)")
@@ -75,6 +78,13 @@ def add_transformers_model_args(p):
              "timepoints).\nPlease beware that this value influences strongly "
              "the executing time and heaviness.\nAlso used with sinusoidal "
              "position embedding. [%(default)s]")
+    gtt.add_argument(
+        '--attention_window', type=int, metavar='n',
+        help="If set, each point only attends to the n last points (itself "
+             "included), \nin every attention layer. With the 'relational' "
+             "position encoding, \ntracking then only processes the last "
+             "points of the streamlines, \nwhatever their length. Default: "
+             "attending to all previous points.")
     gtt.add_argument(
         '--nheads', type=int, default=8, metavar='n',
         help="Number of heads per layer. Could be different for each layer \n"
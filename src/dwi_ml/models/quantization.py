@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Int8 quantization of models for inference on CPU (ex, tracking).
+
+Quantization choices:
+    - 'dynamic': Weights of Linear, LSTM and GRU layers (in the embeddings,
+      the recurrent layers, the transformer's feed-forward layers and the
+      direction getters) are stored in int8. Activations are quantized on the
+      fly, at each call. No calibration needed.
+    - 'static_embedding': Same, but the input embedding (NN embedding only)
+      is quantized statically: the scale of its inputs is calibrated once,
+      on inputs from the data (ex, at the seeds), rather than computed at
+      each call.
+
+Other layers (layer normalization, attention's projections, CNN embedding)
+stay in float32. Quantized layers only run on CPU.
+"""
+import logging
+
+import torch
+from torch import Tensor
+from torch.ao.quantization import (DeQuantStub, QuantStub, convert,
+                                   get_default_qconfig, prepare,
+                                   quantize_dynamic)
+
+from dwi_ml.models.embeddings import NNEmbedding
+
+QUANTIZATION_CHOICES = ['dynamic', 'static_embedding']
+
+DYNAMIC_QUANTIZED_LAYERS = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}
+
+logger = logging.getLogger('model_logger')
+
+
+def check_quantization(quantization: str, device: torch.device = None,
+                       precision: str = 'float32'):
+    if quantization is None:
+        return
+    if quantization not in QUANTIZATION_CHOICES:
+        raise ValueError("Quantization should be one of {}, but got {}."
+                         .format(QUANTIZATION_CHOICES, quantization))
+    if device is not None and device.type != 'cpu':
+        raise ValueError("Quantized models only run on CPU.")
+    if precision != 'float32':
+        raise ValueError("Quantized models cannot be used with precision {}. "
+                         "Use float32.".format(precision))
+
+
+class StaticQuantizedLayer(torch.nn.Module):
+    """
+    Wraps a layer to be statically quantized: inputs are quantized (with the
+    scale found during calibration) and outputs are dequantized, so that the
+    rest of the model still sees float tensors.
+    """
+    def __init__(self, layer: torch.nn.Module):
+        super().__init__()
+        self.quant = QuantStub()
+        self.layer = layer
+        self.dequant = DeQuantStub()
+
+    def forward(self, x: Tensor):
+        return self.dequant(self.layer(self.quant(x)))
+
+
+def quantize_embedding_static(embedding: NNEmbedding,
+                              calibration_inputs: Tensor):
+    """
+    Statically quantizes the linear layer of a NN embedding, in place.
+
+    Parameters
+    ----------
+    embedding: NNEmbedding
+    calibration_inputs: Tensor
+        Inputs of shape (nb_points, nb_features_in), representative of the
+        data (ex, inputs at the seeds). Used to choose the inputs' and
+        outputs' quantization scales.
+    """
+    if not isinstance(embedding, NNEmbedding):
+        raise ValueError("Static quantization is only implemented for the NN "
+                         "embedding, but got {}."
+                         .format(type(embedding).__name__))
+
+    wrapper = StaticQuantizedLayer(embedding.linear)
+    wrapper.qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    wrapper.eval()
+    prepare(wrapper, inplace=True)
+    with torch.no_grad():
+        wrapper(calibration_inputs.float().cpu())
+    convert(wrapper, inplace=True)
+    embedding.linear = wrapper
+
+
+def quantize_model(model: torch.nn.Module, quantization: str,
+                   calibration_inputs: Tensor = None):
+    """
+    Quantizes the model in place, for inference on CPU. The model should be
+    in eval mode.
+
+    Parameters
+    ----------
+    model: MainModelAbstract
+        Ex: a Learn2track or Transformer model.
+    quantization: str
+        One of QUANTIZATION_CHOICES.
+    calibration_inputs: Tensor
+        Required with 'static_embedding'. Inputs of the input embedding
+        layer, of shape (nb_points, nb_features_in). See
+        quantize_embedding_static.
+
+    Returns
+    -------
+    model: the quantized model.
+    """
+    check_quantization(quantization)
+    if quantization == 'static_embedding':
+        if calibration_inputs is None:
+            raise ValueError("Static quantization of the embedding requires "
+                             "calibration inputs.")
+        quantize_embedding_static(model.input_embedding_layer,
+                                  calibration_inputs)
+
+    # Already quantized layers (ex, the static embedding) are not nn.Linear
+    # anymore: they are skipped.
+    model = quantize_dynamic(model, DYNAMIC_QUANTIZED_LAYERS,
+                             dtype=torch.qint8, inplace=True)
+    logger.info("Model quantized to int8 ({}).".format(quantization))
+    return model
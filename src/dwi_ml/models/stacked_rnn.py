@@ -81,6 +81,10 @@ class StackedRNN(torch.nn.Module):
         self.use_layer_normalization = use_layer_normalization
         self.dropout = dropout
 
+        # Activation checkpointing: not a parameter of the model; can be set
+        # by the trainer. See self.forward.
+        self.activation_checkpointing = False
+
         self.rnn_layers = []
         self.layer_norm_layers = []
         if self.dropout and self.dropout != 0:
@@ -192,6 +196,11 @@ class StackedRNN(torch.nn.Module):
         # layers
         outputs = []
 
+        # With activation checkpointing, layers' intermediate activations are
+        # not saved for the backward pass, but computed again.
+        use_checkpoint = (self.activation_checkpointing and self.training
+                          and torch.is_grad_enabled())
+
         # Running forward on each layer:
         # linear --> layer norm --> dropout --> skip connection
         last_output = inputs
@@ -204,34 +213,17 @@ class StackedRNN(torch.nn.Module):
                 # only the .data was kept from Dropout and Relu
                 last_output = PackedSequence(last_output, inputs.batch_sizes)
 
-            # ** RNN **
-            # Either as 3D tensor or as packedSequence
-            last_output, new_state_i = self.rnn_layers[i](
-                last_output, hidden_states[i])
+            if use_checkpoint:
+                # Slow import, only needed for training.
+                from torch.utils.checkpoint import checkpoint
+                last_output, new_state_i = checkpoint(
+                    self._forward_layer, i, last_output, hidden_states[i],
+                    use_reentrant=False)
+            else:
+                last_output, new_state_i = self._forward_layer(
+                    i, last_output, hidden_states[i])
             out_hidden_states.append(new_state_i)
 
-            # ** Other sub-layers **
-            # Forward functions for layer_norm, dropout and skip take tensors
-            # Does not matter if order of datapoints is not kept, applied on
-            # each data point separately
-            last_output = last_output.data
-
-            # Apply layer normalization
-            if self.use_layer_normalization:
-                last_output = self.layer_norm_layers[i](last_output)
-
-            if i < len(self.rnn_layers) - 1:
-                # Apply dropout except on last layer
-                if self.dropout > 0:
-                    last_output = self.dropout_module(last_output)
-                    logger.debug('   Output size after dropout: {}'
-                                 .format(last_output.shape))
-
-                # Apply ReLu activation except on last layer
-                last_output = self.relu_sublayer(last_output)
-                logger.debug('   Output size after reLu: {}'
-                             .format(last_output.shape))
-
             # Saving layer's last_output and states for later
             if self.use_skip_connection:
                 # Keeping memory for the last layer's concatenation of all
@@ -263,3 +255,38 @@ class StackedRNN(torch.nn.Module):
                     'Final skip connection: concatenating all outputs but NOT '
                     'input. Final shape is {}'.format(last_output.shape))
         return last_output, out_hidden_states
+
+    def _forward_layer(self, i, last_output: PackedSequence, hidden_state):
+        """
+        Runs layer i: RNN --> layer norm --> dropout --> relu.
+        Returns the output tensor (the .data of the packed sequence) and the
+        new hidden state.
+        """
+        # ** RNN **
+        # Either as 3D tensor or as packedSequence
+        last_output, new_state_i = self.rnn_layers[i](last_output,
+                                                      hidden_state)
+
+        # ** Other sub-layers **
+        # Forward functions for layer_norm, dropout and skip take tensors
+        # Does not matter if order of datapoints is not kept, applied on
+        # each data point separately
+        last_output = last_output.data
+
+        # Apply layer normalization
+        if self.use_layer_normalization:
+            last_output = self.layer_norm_layers[i](last_output)
+
+        if i < len(self.rnn_layers) - 1:
+            # Apply dropout except on last layer
+            if self.dropout > 0:
+                last_output = self.dropout_module(last_output)
+                logger.debug('   Output size after dropout: {}'
+                             .format(last_output.shape))
+
+            # Apply ReLu activation except on last layer
+            last_output = self.relu_sublayer(last_output)
+            logger.debug('   Output size after reLu: {}'
+                         .format(last_output.shape))
+
+        return last_output, new_state_i
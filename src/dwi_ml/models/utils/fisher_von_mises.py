@@ -3,6 +3,8 @@
 import numpy as np
 import torch
 
+from dwi_ml.experiment_utils.mixed_precision import keep_float32
+
 """
 The complete formulas and explanations are available in our doc:
 https://dwi-ml.readthedocs.io/en/latest/formulas.html
@@ -30,6 +32,7 @@ def fisher_von_mises_log_prob_vector(mus, kappa, targets, eps=1e-5):
     return log_prob
 
 
+@keep_float32()
 def fisher_von_mises_log_prob(mus, kappa, targets, eps=1e-5):
     """
     Fisher von Mises loss for a batch.
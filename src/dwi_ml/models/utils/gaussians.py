@@ -2,6 +2,8 @@
 
 import numpy as np
 
+from dwi_ml.experiment_utils.mixed_precision import keep_float32
+
 """
 The complete formulas and explanations are available in our doc:
 https://dwi-ml.readthedocs.io/en/latest/formulas.html
@@ -9,6 +11,7 @@ https://dwi-ml.readthedocs.io/en/latest/formulas.html
 d = 3
 
 
+@keep_float32()
 def independent_gaussian_log_prob(targets, mus, sigmas):
     """
     This function computes the log likelihood for **individual** multivariate
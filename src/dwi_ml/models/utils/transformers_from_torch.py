@@ -6,6 +6,9 @@ Child classes of Torch Transformers. Changes are:
   to decide if we want to share the linear weights for Q, K, V.
 - Encoder: Idem
 - Decoder: Idem
+- Encoder and decoder: Added an option for activation checkpointing (layers'
+  activations are computed again during the backward pass instead of being
+  kept in memory). Set activation_checkpointing = True to use it.
 
 """
 import logging
@@ -23,6 +26,19 @@ from dwi_ml.models.projects.transformer_sublayers import \
 logger = logging.getLogger('model_logger')
 
 
+def _use_checkpoint(module, return_weights):
+    # Only useful when gradients will be computed. Weights are only returned
+    # for visualisation, not during training.
+    return (module.activation_checkpointing and module.training and
+            torch.is_grad_enabled() and not return_weights)
+
+
+def checkpoint(*args, **kw):
+    # torch.utils.checkpoint is slow to import, and only needed for training.
+    from torch.utils.checkpoint import checkpoint as torch_checkpoint
+    return torch_checkpoint(*args, **kw)
+
+
 class ModifiedTransformerEncoder(TransformerEncoder):
     def __init__(self, encoder_layer, *args, **kw):
         if not isinstance(encoder_layer, ModifiedTransformerEncoderLayer):
@@ -30,6 +46,7 @@ class ModifiedTransformerEncoder(TransformerEncoder):
                              .format(ModifiedTransformerEncoderLayer.__name__,
                                      type(encoder_layer)))
         super().__init__(encoder_layer, *args, **kw)
+        self.activation_checkpointing = False
 
     def forward(self, src: Tensor, mask: Optional[Tensor] = None,
                 src_key_padding_mask: Optional[Tensor] = None,
@@ -117,8 +134,15 @@ class ModifiedTransformerEncoder(TransformerEncoder):
         is_causal = _detect_is_causal_mask(mask, is_causal, seq_len)
 
         # THIS IS THE MODIFIED PART
+        use_checkpoint = _use_checkpoint(self, return_weights)
         sa_weights = [None] * len(self.layers)
         for mod, i in zip(self.layers, range(len(self.layers))):
+            if use_checkpoint:
+                output, sa_weights[i] = checkpoint(
+                    mod, output, src_mask=mask, is_causal=is_causal,
+                    src_key_padding_mask=src_key_padding_mask_for_layers,
+                    use_reentrant=False)
+                continue
             output, sa_weights[i] = mod(
                 output, src_mask=mask, is_causal=is_causal,
                 src_key_padding_mask=src_key_padding_mask_for_layers,
@@ -143,6 +167,7 @@ class ModifiedTransformerDecoder(TransformerDecoder):
                              .format(ModifiedTransformerEncoderLayer.__name__,
                                      type(decoder_layer)))
         super().__init__(decoder_layer, *args, **kw)
+        self.activation_checkpointing = False
 
     def forward(self, tgt: Tensor, memory: Tensor,
                 tgt_mask: Optional[Tensor] = None,
@@ -162,9 +187,19 @@ class ModifiedTransformerDecoder(TransformerDecoder):
         tgt_is_causal = _detect_is_causal_mask(tgt_mask, tgt_is_causal, seq_len)
 
         # THIS IS THE MODIFIED PART
+        use_checkpoint = _use_checkpoint(self, return_weights)
         mha_weights = [None] * len(self.layers)
         sa_weights = [None] * len(self.layers)
         for mod, i in zip(self.layers, range(len(self.layers))):
+            if use_checkpoint:
+                output, mha_weights[i], sa_weights[i] = checkpoint(
+                    mod, output, memory, tgt_mask=tgt_mask,
+                    memory_mask=memory_mask,
+                    tgt_key_padding_mask=tgt_key_padding_mask,
+                    memory_key_padding_mask=memory_key_padding_mask,
+                    tgt_is_causal=tgt_is_causal,
+                    memory_is_causal=memory_is_causal, use_reentrant=False)
+                continue
             output, mha_weights[i], sa_weights[i] = \
                 mod(output, memory, tgt_mask=tgt_mask, memory_mask=memory_mask,
                     tgt_key_padding_mask=tgt_key_padding_mask,
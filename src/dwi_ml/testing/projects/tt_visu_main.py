@@ -20,9 +20,6 @@ from scilpy.io.utils import assert_inputs_exist, assert_outputs_exist
 
 from dwi_ml.io_utils import verify_which_model_in_path
 from dwi_ml.models.projects.transformer_models import find_transformer_class
-from dwi_ml.testing.projects.tt_visu_bertviz import (
-    encoder_decoder_show_head_view, encoder_decoder_show_model_view,
-    encoder_show_model_view, encoder_show_head_view)
 from dwi_ml.testing.projects.tt_visu_colored_sft import (
     color_sft_duplicate_lines, color_sft_x_y_projections)
 from dwi_ml.testing.projects.tt_visu_matrix import show_model_view_as_imshow
@@ -142,7 +139,8 @@ def _run_transformer_get_weights(parser, args, sub_logger_level, device):
     tester = TesterOneInput(
         model=model, hdf5_file=args.hdf5_file, subj_id=args.subj_id,
         subset_name=args.subset, volume_group=args.input_group,
-        batch_size=args.batch_size, device=device)
+        batch_size=args.batch_size, device=device,
+        precision=args.precision)
 
     # 5. Run the transformer.
     logging.debug("Running the model to get the weights...")
@@ -270,6 +268,11 @@ def _visu_encoder_decoder(
                     args.group_with_max)
 
         if args.bertviz or args.bertviz_locally:
+            # Slow import, only needed here.
+            from dwi_ml.testing.projects.tt_visu_bertviz import (
+                encoder_decoder_show_head_view,
+                encoder_decoder_show_model_view, encoder_show_model_view,
+                encoder_show_head_view)
             print(
                 "\n\n-------------- Preparing the attention through bertviz "
                 "for one streamline --------------")
@@ -7,6 +7,8 @@ from tqdm import tqdm
 
 from dwi_ml.data.processing.streamlines.data_augmentation import \
     resample_or_compress
+from dwi_ml.experiment_utils.mixed_precision import (
+    check_precision, get_autocast_context, to_float32)
 from dwi_ml.models.main_models import (MainModelOneInput,
                                        ModelWithDirectionGetter)
 from dwi_ml.testing.utils import prepare_dataset_one_subj
@@ -44,7 +46,8 @@ class TesterWithDirectionGetter:
     """
     def __init__(self, model: ModelWithDirectionGetter,
                  subj_id, hdf5_file, subset_name,
-                 batch_size: int = None, device: torch.device = None):
+                 batch_size: int = None, device: torch.device = None,
+                 precision: str = 'float32'):
         """
         Parameters
         ----------
@@ -54,8 +57,15 @@ class TesterWithDirectionGetter:
         subset_name: str
         batch_size: int
         device: torch.Device
+        precision: str
+            'float32' (default), 'bfloat16' or 'float16' (GPU only). With
+            bfloat16 or float16, the forward pass runs under torch.autocast.
+            Outputs are converted back to float32 and the loss is computed in
+            float32.
         """
+        check_precision(precision, device or torch.device('cpu'))
         self.device = device
+        self.precision = precision
         self.model = model
         self.model.eval()  # Removes dropout.
         self.model.move_to(device)
@@ -151,7 +161,10 @@ class TesterWithDirectionGetter:
                 inputs = self._prepare_inputs(streamlines_f)
 
                 # 2. Run forward
-                batch_out = self.model(inputs, streamlines_f)
+                with get_autocast_context(self.precision,
+                                          self.device or torch.device('cpu')):
+                    batch_out = self.model(inputs, streamlines_f)
+                batch_out = to_float32(batch_out)
                 outputs = self.model.merge_batches_outputs(outputs, batch_out,
                                                            device='cpu')
 
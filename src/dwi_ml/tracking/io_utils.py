@@ -11,8 +11,11 @@ import numpy as np
 
 from scilpy.tracking.seed import SeedGenerator
 
+from dwi_ml.data.processing.volume.compact_dtypes import \
+    load_volume_as_float32
 from dwi_ml.experiment_utils.timer import Timer
 from dwi_ml.io_utils import add_arg_existing_experiment_path, add_memory_args
+from dwi_ml.models.quantization import QUANTIZATION_CHOICES
 from dwi_ml.testing.utils import add_args_testing_subj_hdf5
 from dwi_ml.tracking.tracking_mask import TrackingMask
 from dwi_ml.tracking.tracker import DWIMLAbstractTracker
@@ -21,13 +24,33 @@ ALWAYS_VOX_SPACE = Space.VOX
 ALWAYS_CORNER = Origin('corner')
 
 
-def add_tracking_options(p: ArgumentParser):
+def add_tracking_options(p: ArgumentParser, multiple_subjects=False):
     add_arg_existing_experiment_path(p)
-    add_args_testing_subj_hdf5(p, optional_hdf5=True,
-                               ask_input_group=True)
+    if multiple_subjects:
+        g = p.add_argument_group("Inputs options")
+        g.add_argument('--hdf5_file', metavar='file',
+                       help="Path to the hdf5 file. If not given, will use "
+                            "the file from the experiment's \nparameters. "
+                            "(in parameters_latest.json)")
+        p.add_argument('input_group',
+                       help="Model's input's volume group in the hdf5.")
+        p.add_argument('out_dir',
+                       help="Output directory. One tractogram per subject "
+                            "is saved, named \n<subj_id>.<out_format>.")
+        g.add_argument('--subj_ids', nargs='+', metavar='id',
+                       help="Subjects to track. Default: all subjects of "
+                            "the subset.")
+        g.add_argument('--subset', default='testing',
+                       choices=['training', 'validation', 'testing'],
+                       help="Subset containing the subjects. [%(default)s]")
+        g.add_argument('--out_format', default='trk', choices=['trk', 'tck'],
+                       help="Tractograms' format. [%(default)s]")
+    else:
+        add_args_testing_subj_hdf5(p, optional_hdf5=True,
+                                   ask_input_group=True)
 
-    p.add_argument('out_tractogram',
-                   help='Tractogram output file (must be .trk or .tck).')
+        p.add_argument('out_tractogram',
+                       help='Tractogram output file (must be .trk or .tck).')
     p.add_argument('seeding_mask_group',
                    help="Seeding mask's volume group in the hdf5.")
 
@@ -35,6 +58,13 @@ def add_tracking_options(p: ArgumentParser):
     track_g.add_argument('--algo', choices=['det', 'prob'], default='det',
                          help="Tracking algorithm (det or prob). Must be "
                               "implemented in the chosen model. \n[det]")
+    track_g.add_argument('--samples_per_seed', type=int, default=1,
+                         metavar='k',
+                         help="With --algo prob: number of streamlines "
+                              "tracked from each seed. The first \nstep "
+                              "(inputs and model at the seed) is computed "
+                              "once for the k \nstreamlines. Use with k "
+                              "times fewer seeds (ex, --npv). [%(default)s]")
     track_g.add_argument('--step_size', type=float,
                          help='Step size in mm. Default: using the step size '
                               'saved in the model parameters.')
@@ -104,23 +134,45 @@ def add_tracking_options(p: ArgumentParser):
                      help='Track n streamlines at the same time. Intended for '
                           'GPU usage. Default = 1 \n(no simultaneous '
                           'tracking).')
+    m_g.add_argument('--spatial_sorting', type=int, default=0, metavar='n',
+                     help="With --simultaneous_tracking: propagate lines in "
+                          "a spatially coherent \norder, for faster "
+                          "interpolation. Seeds are sorted along a Z-order "
+                          "\ncurve, and remaining lines are sorted again "
+                          "every n steps. Outputs \nare still in the seeds' "
+                          "order. Default: 0 (no sorting).")
+    m_g.add_argument('--cnn_volume_features', action='store_true',
+                     help="For models with a CNN input embedding: run the "
+                          "CNN once on the whole \ninput volume, and "
+                          "interpolate the features rather than running \n"
+                          "the CNN on each point's neighborhood. Exact with "
+                          "one CNN layer; \napproximate with more. See "
+                          "CNNEmbedding.compute_volume_features.")
+    m_g.add_argument('--quantize', choices=QUANTIZATION_CHOICES,
+                     help="If set, the model is quantized to int8 for "
+                          "faster inference on CPU (not with \n--use_gpu). "
+                          "'dynamic': Linear, LSTM and GRU layers. "
+                          "'static_embedding': \nsame, but the NN input "
+                          "embedding is calibrated on inputs at the seeds. "
+                          "\nSee dwi_ml.models.quantization.")
 
     return track_g
 
 
-def prepare_seed_generator(parser, args, hdf_handle):
+def prepare_seed_generator(parser, args, hdf_handle, subj_id=None):
     """
     Prepares a SeedGenerator from scilpy's library. Returns also some header
-    information to allow verifications.
+    information to allow verifications. subj_id: default: args.subj_id.
     """
-    if args.subj_id not in hdf_handle:
+    subj_id = subj_id or args.subj_id
+    if subj_id not in hdf_handle:
         raise ValueError("Subject {} not found in the HDF5 file."
-                         .format(args.subj_id))
-    if args.seeding_mask_group not in hdf_handle[args.subj_id]:
+                         .format(subj_id))
+    if args.seeding_mask_group not in hdf_handle[subj_id]:
         raise ValueError("Seeding mask {} not found the subject's HDF group."
                          .format(args.seeding_mask_group))
-    seeding_group = hdf_handle[args.subj_id][args.seeding_mask_group]
-    seed_data = np.array(seeding_group['data'], dtype=np.float32)
+    seeding_group = hdf_handle[subj_id][args.seeding_mask_group]
+    seed_data = load_volume_as_float32(seeding_group)
     seed_res = np.array(seeding_group.attrs['voxres'], dtype=np.float32)
     affine = np.array(seeding_group.attrs['affine'], dtype=np.float32)
     ref = nib.Nifti1Image(seed_data, affine)
@@ -129,8 +181,9 @@ def prepare_seed_generator(parser, args, hdf_handle):
                                    origin=ALWAYS_CORNER)
 
     if len(seed_generator.seeds_vox_corner) == 0:
-        parser.error('Seed mask "{}" does not have any voxel with value > 0.'
-                     .format(args.in_seed))
+        parser.error('Seed mask "{}" does not have any voxel with value > 0 '
+                     'for subject {}.'.format(args.seeding_mask_group,
+                                              subj_id))
 
     if args.npv:
         # Note. Not really nb seed per voxel, just in average.
@@ -151,6 +204,11 @@ def prepare_tracking_mask(hdf_handle, tracking_mask_group, subj_id,
     """
     Prepare the tracking mask as a DataVolume from scilpy's library. Returns
     also some header information to allow verifications.
+
+    With nearest interpolation, the mask is binarized (see
+    TrackingMask.binarize). With trilinear interpolation, it is kept in
+    float64. Safe distances are computed to skip the mask's verification far
+    from its border (see TrackingMask.compute_safe_distances).
     """
     if subj_id not in hdf_handle:
         raise KeyError("Subject {} not found in {}. Possible subjects are: {}"
@@ -159,12 +217,17 @@ def prepare_tracking_mask(hdf_handle, tracking_mask_group, subj_id,
         raise KeyError("HDF group '{}' not found for subject {} in hdf file {}"
                        .format(tracking_mask_group, subj_id, hdf_handle))
     tm_group = hdf_handle[subj_id][tracking_mask_group]
-    mask_data = np.array(tm_group['data'], dtype=np.float64).squeeze()
+    mask_data = load_volume_as_float32(tm_group).squeeze()
+    if mask_interp != 'nearest':
+        mask_data = mask_data.astype(np.float64)
     # mask_res = np.array(tm_group.attrs['voxres'], dtype=np.float32)
     affine = np.array(tm_group.attrs['affine'], dtype=np.float32)
     ref = nib.Nifti1Image(mask_data, affine)
 
     mask = TrackingMask(mask_data.shape, mask_data, mask_interp)
+    if mask_interp == 'nearest':
+        mask.binarize()
+    mask.compute_safe_distances()
 
     return mask, ref
 
@@ -183,6 +246,16 @@ def track_and_save(tracker: DWIMLAbstractTracker, args, ref):
         logging.debug("Tracked {} streamlines (out of {} seeds). Now saving..."
                       .format(len(streamlines), tracker.nbr_seeds))
 
+    save_tractogram_and_seeds(streamlines, seeds, ref, args.out_tractogram,
+                              args.save_seeds)
+
+
+def save_tractogram_and_seeds(streamlines, seeds, ref, out_tractogram,
+                              save_seeds):
+    """
+    Saves the tracked streamlines (vox space, corner origin), with their seeds
+    as data_per_streamline if save_seeds.
+    """
     if len(streamlines) == 0:
         logging.warning("No streamlines created! Not saving tractogram!")
         return
@@ -190,7 +263,7 @@ def track_and_save(tracker: DWIMLAbstractTracker, args, ref):
     # save seeds if args.save_seeds is given
     # Seeds must be saved in voxel space (ok!), but origin: center, if we want
     # to use scripts such as scil_compute_seed_density_map.
-    if args.save_seeds:
+    if save_seeds:
         print("Saving seeds in data_per_streamline.")
         seeds = [np.asarray(seed) - 0.5 for seed in seeds]  # to_center
         data_per_streamline = {'seeds': seeds}
@@ -202,8 +275,8 @@ def track_and_save(tracker: DWIMLAbstractTracker, args, ref):
     set_sft_logger_level('WARNING')
 
     logging.info("Saving resulting tractogram to {}"
-                 .format(args.out_tractogram))
+                 .format(out_tractogram))
     sft = StatefulTractogram(streamlines, ref, space=ALWAYS_VOX_SPACE,
                              origin=ALWAYS_CORNER,
                              data_per_streamline=data_per_streamline)
-    save_tractogram(sft, args.out_tractogram, bbox_valid_check=False)
+    save_tractogram(sft, out_tractogram, bbox_valid_check=False)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import nibabel as nib
+from scilpy.tracking.seed import SeedGenerator
+
+from dwi_ml.data.dataset.mri_data_containers import MRIData
+from dwi_ml.tracking.tracker import DWIMLAbstractTracker
+from dwi_ml.tracking.tracking_mask import TrackingMask
+
+logger = logging.getLogger('tracker_logger')
+
+
+class SubjectTrackingData:
+    """
+    Everything needed to track one subject, loaded in advance (see
+    track_multiple_subjects).
+    """
+    def __init__(self, subj_id: str, seed_generator: SeedGenerator,
+                 nbr_seeds: int, mask: TrackingMask, ref: nib.Nifti1Image,
+                 volumes: Dict[str, MRIData] = None):
+        """
+        Parameters
+        ----------
+        subj_id: str
+        seed_generator: SeedGenerator
+        nbr_seeds: int
+        mask: TrackingMask
+        ref: nib.Nifti1Image
+            Reference used to save the tractogram.
+        volumes: Dict[str, MRIData]
+            Input volumes (non-lazy), per volume group. They are added to the
+            dataset's cache before tracking the subject.
+        """
+        self.subj_id = subj_id
+        self.seed_generator = seed_generator
+        self.nbr_seeds = nbr_seeds
+        self.mask = mask
+        self.ref = ref
+        self.volumes = volumes or {}
+
+
+def track_multiple_subjects(tracker: DWIMLAbstractTracker,
+                            subj_ids: List[str], load_subject: Callable,
+                            nb_subjects_together: int = 1,
+                            first_subj_data: SubjectTrackingData = None):
+    """
+    Tracks many subjects with the same tracker, i.e. loading the model only
+    once.
+
+    Subjects are tracked by groups of nb_subjects_together. Lines of all
+    subjects in a group are propagated together, by batches of
+    tracker.simultaneous_tracking lines (see tracker.track_subjects). While a
+    group is tracked (and its results used by the caller), the data of the
+    next group is loaded in a background thread.
+
+    Parameters
+    ----------
+    tracker: DWIMLAbstractTracker
+        The tracker. Its dataset must contain all subjects. Its cache size
+        should be at least nb_subjects_together.
+    subj_ids: List[str]
+        The subjects to track.
+    load_subject: Callable
+        subj_data = load_subject(subj_id), with subj_data a
+        SubjectTrackingData. Called from the background thread: if it reads
+        the hdf5, it should use its own handle.
+    nb_subjects_together: int
+        Number of subjects tracked together.
+    first_subj_data: SubjectTrackingData
+        If given, the data of subj_ids[0], already loaded (ex, to create the
+        tracker). It is not loaded again.
+
+    Yields
+    ------
+    subj_data: SubjectTrackingData
+    lines: List
+        The subject's streamlines, in voxel space, corner origin.
+    seeds: List
+        The subject's seeds.
+    """
+    if tracker.dataset.is_lazy and \
+            tracker.dataset.cache_size < nb_subjects_together:
+        logger.warning("Cache size ({}) is smaller than the number of "
+                       "subjects tracked together ({}): volumes will be "
+                       "reloaded during tracking."
+                       .format(tracker.dataset.cache_size,
+                               nb_subjects_together))
+
+    all_subj_ids = tracker.dataset.subjs_data_list.subject_ids
+    groups = [subj_ids[i:i + nb_subjects_together]
+              for i in range(0, len(subj_ids), nb_subjects_together)]
+
+    def _load_subject(subj_id):
+        if first_subj_data is not None and \
+                subj_id == first_subj_data.subj_id:
+            return first_subj_data
+        return load_subject(subj_id)
+
+    def _load_group(group):
+        return [_load_subject(subj_id) for subj_id in group]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_group = executor.submit(_load_group, groups[0])
+        for g in range(len(groups)):
+            group_data = next_group.result()
+            if g + 1 < len(groups):
+                next_group = executor.submit(_load_group, groups[g + 1])
+
+            logger.info("Tracking subject(s) {} ({} / {})".format(
+                groups[g], g * nb_subjects_together + len(groups[g]),
+                len(subj_ids)))
+            subj_idxs = []
+            for subj_data in group_data:
+                subj_idx = all_subj_ids.index(subj_data.subj_id)
+                subj_idxs.append(subj_idx)
+                for group_name, volume in subj_data.volumes.items():
+                    tracker.dataset.add_volume_to_cache(
+                        subj_idx,
+                        tracker.dataset.volume_groups.index(group_name),
+                        volume, tracker.device)
+
+            tracker.set_subjects(
+                subj_idxs, [d.mask for d in group_data],
+                [d.seed_generator for d in group_data],
+                [d.nbr_seeds for d in group_data])
+            lines_per_subj, seeds_per_subj = tracker.track_subjects()
+
+            for subj_data, lines, seeds in zip(group_data, lines_per_subj,
+                                               seeds_per_subj):
+                yield subj_data, lines, seeds
@@ -54,14 +54,13 @@ class RecurrentTracker(DWIMLTrackerOneInput):
         # We don't re-run the last point (i.e. the seed) because the first
         # propagation step after backward = at that point.
         tmp_lines = [s[:-1, :] for s in lines]
-        all_inputs = self.model.prepare_batch_one_input(
-            tmp_lines, self.dataset, self.subj_idx, self.volume_group)
+        all_inputs = self._prepare_batch_one_input(tmp_lines)
 
         # all_inputs is a List of
         # nb_streamlines x tensor[nb_points, nb_features]
 
         # No hidden state given = running model on all points.
-        with self.grad_context:
+        with self.grad_context, self._autocast():
             _, self.hidden_recurrent_states = self.model(
                 all_inputs, tmp_lines, return_hidden=True, point_idx=None)
 
@@ -72,7 +71,7 @@ class RecurrentTracker(DWIMLTrackerOneInput):
 
     def _call_model_forward(self, inputs, lines):
         # For RNN, we need to send the hidden state too.
-        with self.grad_context:
+        with self.grad_context, self._autocast():
             model_outputs, self.hidden_recurrent_states = self.model(
                 inputs, lines, self.hidden_recurrent_states,
                 return_hidden=True, point_idx=-1)
@@ -91,3 +90,7 @@ class RecurrentTracker(DWIMLTrackerOneInput):
         # Hidden states: list[states] (One value per layer).
         self.hidden_recurrent_states = self.model.take_lines_in_hidden_state(
             self.hidden_recurrent_states, can_continue)
+
+    def take_lines_in_memory(self, lines_idx: np.ndarray):
+        self.hidden_recurrent_states = self.model.take_lines_in_hidden_state(
+            self.hidden_recurrent_states, lines_idx)
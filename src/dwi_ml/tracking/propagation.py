@@ -7,6 +7,7 @@ import torch
 from torch import Tensor
 
 from dwi_ml.tracking.tracking_mask import TrackingMask
+from dwi_ml.tracking.utils import morton_order
 
 logger = logging.getLogger('tracker_logger')
 
@@ -16,7 +17,9 @@ def propagate_multiple_lines(
         get_next_dirs: Callable, theta: float, step_size: float,
         verify_opposite_direction: bool = False,
         mask: TrackingMask = None, max_nbr_pts: int = None,
-        append_last_point: bool = True, normalize_directions: bool = True):
+        append_last_point: bool = True, normalize_directions: bool = True,
+        lines_subj_idx: Tensor = None, sort_every: int = 0,
+        reorder_memory: Callable = None):
     """
     Propagates initialized streamlines.
 
@@ -40,6 +43,23 @@ def propagate_multiple_lines(
     max_nbr_pts: int
     append_last_point: bool
     normalize_directions: bool
+    lines_subj_idx: Tensor
+        With a stacked mask (see TrackingMask.stack): the index of each line's
+        subject in the mask. Lines of all subjects are then propagated
+        together.
+    sort_every: int
+        If > 0, every sort_every steps, the remaining lines are reordered by
+        their current position (see morton_order), so that consecutive lines
+        interpolate the volumes at nearby positions. Final lines are always
+        returned in their initial order.
+    reorder_memory: Callable
+        Required with sort_every. A function with format:
+        None = reorder_memory(order: np.ndarray)
+        To reorder your internal states like the lines.
+
+    If the mask has safe distances (see TrackingMask.compute_safe_distances),
+    lines are only verified in the mask when they could have reached its
+    border since their last verification.
     """
     nb_streamlines = len(lines)
 
@@ -47,6 +67,11 @@ def propagate_multiple_lines(
     invalid_direction_counts = np.zeros(nb_streamlines)
     continuing_lines_rawidx = np.arange(nb_streamlines)
 
+    # Distance each line can still travel without verifying the mask.
+    safe_distances = None
+    if mask is not None and mask.safe_distances is not None:
+        safe_distances = np.zeros(nb_streamlines)
+
     # Will get the final lines when they are done.
     final_lines = [None] * nb_streamlines  # type: List[Tensor]
 
@@ -63,6 +88,7 @@ def propagate_multiple_lines(
             previous_dir /= torch.linalg.norm(previous_dir, dim=-1)[:, None]
 
     # Track
+    nb_steps = 0
     while not all_lines_completed:
         n_new_pos, previous_dir, invalid_dirs = \
             _take_one_step_or_go_straight(
@@ -74,10 +100,18 @@ def propagate_multiple_lines(
             logger.debug("{} streamlines with invalid directions "
                          "(ex, EOS, angle).".format(sum(invalid_dirs)))
 
+        if safe_distances is not None:
+            if normalize_directions:
+                safe_distances -= step_size
+            else:
+                safe_distances -= step_size * torch.linalg.norm(
+                    previous_dir, dim=-1).cpu().numpy()
+
         # For other streamlines: verifying but appending only if option is
         # chosen.
         break_with_appending = _verify_stopping_criteria(
-            n_new_pos, lines, mask, max_nbr_pts)
+            n_new_pos, lines, mask, max_nbr_pts, lines_subj_idx,
+            safe_distances)
 
         if append_last_point:
             # Appending last point only to streamlines with valid dir (i.e.
@@ -111,9 +145,33 @@ def propagate_multiple_lines(
             previous_dir = previous_dir[can_continue, :]
             continuing_lines_rawidx = continuing_lines_rawidx[can_continue]
             invalid_direction_counts = invalid_direction_counts[can_continue]
+            if safe_distances is not None:
+                safe_distances = safe_distances[can_continue]
+            if lines_subj_idx is not None:
+                lines_subj_idx = lines_subj_idx[torch.as_tensor(
+                    can_continue, device=lines_subj_idx.device)]
         else:
             all_lines_completed = True
 
+        nb_steps += 1
+        if sort_every > 0 and nb_steps % sort_every == 0 and \
+                not all_lines_completed:
+            order = morton_order(
+                torch.vstack([s[-1, :] for s in lines]).cpu().numpy(),
+                None if lines_subj_idx is None else
+                lines_subj_idx.cpu().numpy())
+            lines = [lines[i] for i in order]
+            previous_dir = previous_dir[torch.as_tensor(
+                order, device=previous_dir.device)]
+            continuing_lines_rawidx = continuing_lines_rawidx[order]
+            invalid_direction_counts = invalid_direction_counts[order]
+            if safe_distances is not None:
+                safe_distances = safe_distances[order]
+            if lines_subj_idx is not None:
+                lines_subj_idx = lines_subj_idx[torch.as_tensor(
+                    order, device=lines_subj_idx.device)]
+            reorder_memory(order)
+
     assert not np.any([line is None for line in final_lines])
 
     return final_lines
@@ -169,10 +227,17 @@ def _take_one_step_or_go_straight(
     return n_new_pos, next_dirs, invalid_dirs
 
 
-def _verify_stopping_criteria(n_last_pos, lines, mask=None, max_nbr_pts=None):
+def _verify_stopping_criteria(n_last_pos, lines, mask=None, max_nbr_pts=None,
+                              lines_subj_idx=None, safe_distances=None):
     """
     mask can be None, or if you want to check bounds, you can set an empty mask
-    (with mask.data = None).
+    (with mask.data = None). With a stacked mask, lines_subj_idx is the index
+    of each line's subject.
+
+    safe_distances: np.ndarray
+        If given, the distance each line can still travel in the mask. Lines
+        with a positive distance are known to be in the mask. Others are
+        verified, and their distance is updated in place.
     """
     # Checking NaN values.
     # I.e. invalid direction AND could not just copy previous because it also
@@ -190,7 +255,8 @@ def _verify_stopping_criteria(n_last_pos, lines, mask=None, max_nbr_pts=None):
 
     # Checking if out of bound using seeding mask
     if mask is not None:
-        out_of_mask = ~mask.is_vox_corner_in_bound(n_last_pos).cpu().numpy()
+        out_of_mask = ~mask.is_vox_corner_in_bound(
+            n_last_pos, lines_subj_idx).cpu().numpy()
         if sum(out_of_mask) > 0:
             logger.debug("{} streamlines stopping out of bounds."
                          .format(sum(out_of_mask)))
@@ -201,8 +267,19 @@ def _verify_stopping_criteria(n_last_pos, lines, mask=None, max_nbr_pts=None):
             # Avoid interpolation for points that we already know can't
             # continue.
             still_on = ~stopping
-
-            out_of_mask = ~mask.is_vox_corner_in_mask(n_last_pos[still_on]).cpu().numpy()
+            if safe_distances is not None:
+                still_on = np.logical_and(still_on, safe_distances <= 0)
+                if not np.any(still_on):
+                    return stopping
+            still_on_subj_idx = None if lines_subj_idx is None else \
+                lines_subj_idx[torch.as_tensor(still_on,
+                                               device=lines_subj_idx.device)]
+
+            out_of_mask = ~mask.is_vox_corner_in_mask(
+                n_last_pos[still_on], still_on_subj_idx).cpu().numpy()
+            if safe_distances is not None:
+                safe_distances[still_on] = mask.get_safe_distances(
+                    n_last_pos[still_on], still_on_subj_idx).cpu().numpy()
             if sum(out_of_mask) > 0:
                 logger.debug("{} streamlines stopping out of mask."
                              .format(sum(out_of_mask)))
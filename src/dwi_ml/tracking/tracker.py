@@ -10,22 +10,29 @@ from typing import List
 from dipy.tracking.streamlinespeed import compress_streamlines
 import numpy as np
 import torch
-from dwi_ml.tracking.utils import prepare_step_size_vox
+from dwi_ml.tracking.utils import morton_order, prepare_step_size_vox
 from torch import Tensor
 from tqdm.contrib.logging import tqdm_logging_redirect
 
 from scilpy.tracking.seed import SeedGenerator
 
 from dwi_ml.data.dataset.multi_subject_containers import MultisubjectSubset
+from dwi_ml.experiment_utils.mixed_precision import (check_precision,
+                                                     get_autocast_context)
 from dwi_ml.models.direction_getter_models import \
     AbstractRegressionDG
 from dwi_ml.models.main_models import ModelWithDirectionGetter, \
     MainModelOneInput
+from dwi_ml.models.quantization import check_quantization, quantize_model
 from dwi_ml.tracking.propagation import propagate_multiple_lines
 from dwi_ml.tracking.tracking_mask import TrackingMask
 
 logger = logging.getLogger('tracker_logger')
 
+# Number of seeds at which inputs are prepared to calibrate the static
+# quantization of the input embedding.
+NB_CALIBRATION_SEEDS = 1000
+
 
 class DWIMLAbstractTracker:
     """
@@ -47,15 +54,16 @@ class DWIMLAbstractTracker:
                  rng_seed=1234, track_forward_only=False,
                  simultaneous_tracking: int = 1, use_gpu: bool = False,
                  append_last_point=True, eos_stopping_thresh=None,
-                 log_level=logging.WARNING):
+                 precision: str = 'float32',
+                 quantization: str = None, samples_per_seed: int = 1,
+                 spatial_sorting: int = 0, log_level=logging.WARNING):
         """
         Parameters
         ----------
         dataset: MultisubjectSubset
             Loaded testing set. Must be lazy to allow multiprocessing.
-            Multi-subject tracking not implemented; it should contain only
-            one subject.
-        subj_idx: int, subject used for tracking.
+        subj_idx: int, subject used for tracking. To track other subjects
+            with the same tracker, see set_subjects.
         model: ModelWithDirectionGetter, your torch model.
         mask: TrackingMask.
             Can contain no data, but requires its parameter dim to verify if
@@ -89,6 +97,27 @@ class DWIMLAbstractTracker:
         eos_stopping_thresh: float or 'max'
             Threshold for the EOS value to trigger a stopping criteria (if
             your model supports EOS). Default: 0.5
+        precision: str
+            'float32' (default), 'bfloat16' or 'float16' (GPU only). With
+            bfloat16 or float16, the model runs under torch.autocast. Next
+            directions are always computed in float32.
+        quantization: str
+            None (default), 'dynamic' or 'static_embedding'. If set, the
+            model is quantized to int8 (CPU only). See
+            dwi_ml.models.quantization. Applied by the child classes, once
+            inputs can be prepared (see quantize_model).
+        samples_per_seed: int
+            Number of streamlines (branches) tracked from each seed, with
+            algo 'prob'. The first step, at the seed, is computed once and
+            shared by the branches (inputs, model's memory and output); then
+            each branch samples its own directions. Default: 1.
+        spatial_sorting: int
+            If > 0, lines are propagated in a spatially coherent order, for
+            faster interpolation of the volumes with simultaneous tracking:
+            each chunk of seeds is sorted along a Z-order curve (see
+            morton_order), and the remaining lines are sorted again every
+            spatial_sorting steps. Streamlines are still returned in the
+            seeds' order. Default: 0 (no sorting).
         """
         self.mask = mask
         self.seed_generator = seed_generator
@@ -104,6 +133,13 @@ class DWIMLAbstractTracker:
         self.dataset = dataset
         self.subj_idx = subj_idx
         self.model = model
+
+        # Subjects tracked together (see set_subjects), and, during their
+        # tracking, the index (in subj_idxs) of each current line's subject.
+        self.subj_idxs = [subj_idx]
+        self.seed_generators = [seed_generator]
+        self.nbrs_seeds = [nbr_seeds]
+        self.lines_subj_idx = None  # type: np.ndarray
         self.append_last_point = append_last_point
         self.eos_stopping_thresh = eos_stopping_thresh
 
@@ -148,29 +184,28 @@ class DWIMLAbstractTracker:
                 "but you are now tracking with {}mm step size!"
                 .format(model.step_size, step_size_mm))
 
-        step_size_vox, normalize_directions = prepare_step_size_vox(
-            step_size_mm, seed_generator.voxres)
-
-        self.step_size = step_size_vox
+        self.step_size_mm = step_size_mm
         self.max_nbr_pts = int(max_len_mm / step_size_mm)
         self.min_nbr_pts = max(int(min_len_mm / step_size_mm), 1)
-        self.normalize_directions = normalize_directions
+        self._set_step_size_vox(seed_generator.voxres)
 
         self.algo = algo
         if algo not in ['det', 'prob']:
             raise ValueError("Tracker's algo should be 'det' or 'prob'.")
+        if samples_per_seed < 1:
+            raise ValueError("samples_per_seed should be at least 1, but got "
+                             "{}.".format(samples_per_seed))
+        if samples_per_seed > 1 and algo != 'prob':
+            raise ValueError("Many samples per seed are only useful with "
+                             "algo 'prob': with 'det', they would all be "
+                             "the same.")
+        self.samples_per_seed = samples_per_seed
+        self.spatial_sorting = spatial_sorting
+        # True only during the first step of the forward propagation, when
+        # lines contain samples_per_seed copies of each seed.
+        self.branching_at_seed = False
 
         self.theta = theta
-        if not normalize_directions and step_size_vox != 1:
-            logger.warning("Tracker not normalizing directions obtained as "
-                           "output from the model. Using a step size other "
-                           "than 1 does not really make sense. You probably "
-                           "want to advance of exactly 1 * output.")
-
-        # If output is already normalized, no need to do it again.
-        if 'regression' in self.model.direction_getter.key and \
-                self.model.direction_getter.normalize_outputs == 1:
-            self.normalize_directions = False
 
         # Contrary to super: normalize direction is optional
         self.verify_opposite_direction = verify_opposite_direction
@@ -188,6 +223,7 @@ class DWIMLAbstractTracker:
             self.min_nbr_pts = 1
 
         # Either GPU or multi-processes
+        self.requested_nbr_processes = nbr_processes
         self.nbr_processes = self._set_nbr_processes(nbr_processes)
         if nbr_processes > 2:
             if not dataset.is_lazy:
@@ -198,6 +234,7 @@ class DWIMLAbstractTracker:
 
         self.simultaneous_tracking = simultaneous_tracking
         self.use_gpu = use_gpu
+        self.precision = precision
         if use_gpu:
             if torch.cuda.is_available():
                 logger.info("We will be using GPU!")
@@ -207,6 +244,9 @@ class DWIMLAbstractTracker:
                                  "available!")
         else:
             device = torch.device('cpu')
+        check_precision(precision, device)
+        check_quantization(quantization, device, precision)
+        self.quantization = quantization
         self.move_to(device)
 
         logger.setLevel(log_level)
@@ -216,6 +256,81 @@ class DWIMLAbstractTracker:
         self.model.move_to(device)
         self.mask.move_to(device)
 
+    def quantize_model(self, calibration_inputs: Tensor = None):
+        """
+        Quantizes the model to int8, with self.quantization. See
+        dwi_ml.models.quantization.quantize_model.
+        """
+        logger.info("Quantizing the model ({}).".format(self.quantization))
+        self.model = quantize_model(self.model, self.quantization,
+                                    calibration_inputs)
+
+    def _set_step_size_vox(self, voxres):
+        """
+        Step size in voxel space (we track in voxel space): depends on the
+        subject's resolution.
+        """
+        step_size_vox, normalize_directions = prepare_step_size_vox(
+            self.step_size_mm, voxres)
+        self.step_size = step_size_vox
+        self.normalize_directions = normalize_directions
+
+        if not normalize_directions and step_size_vox != 1:
+            logger.warning("Tracker not normalizing directions obtained as "
+                           "output from the model. Using a step size other "
+                           "than 1 does not really make sense. You probably "
+                           "want to advance of exactly 1 * output.")
+
+        # If output is already normalized, no need to do it again.
+        if 'regression' in self.model.direction_getter.key and \
+                self.model.direction_getter.normalize_outputs == 1:
+            self.normalize_directions = False
+
+    def set_subjects(self, subj_idxs: List[int], masks: List[TrackingMask],
+                     seed_generators: List[SeedGenerator],
+                     nbrs_seeds: List[int]):
+        """
+        Binds the tracker to other subject(s) of the dataset, ex to track a
+        whole cohort without reloading the model. With more than one subject,
+        use track_subjects: their lines are propagated together. Their masks
+        are then stacked (see TrackingMask.stack) and they must have the same
+        resolution.
+
+        Parameters
+        ----------
+        subj_idxs: List[int]
+            Subjects' indices in the dataset.
+        masks: List[TrackingMask]
+            One tracking mask per subject.
+        seed_generators: List[SeedGenerator]
+            One seed generator per subject.
+        nbrs_seeds: List[int]
+            Number of seeds for each subject.
+        """
+        voxres = seed_generators[0].voxres
+        if len(subj_idxs) > 1:
+            if not all(np.allclose(g.voxres, voxres)
+                       for g in seed_generators):
+                raise ValueError("Subjects tracked together must have the "
+                                 "same resolution.")
+            mask = TrackingMask.stack(masks)
+        else:
+            mask = masks[0]
+
+        self.subj_idxs = subj_idxs
+        self.subj_idx = subj_idxs[0]
+        self.seed_generators = seed_generators
+        self.seed_generator = seed_generators[0]
+        self.nbrs_seeds = nbrs_seeds
+        self.nbr_seeds = sum(nbrs_seeds)
+        self.nbr_processes = self._set_nbr_processes(
+            self.requested_nbr_processes)
+        self.lines_subj_idx = None
+
+        self.mask = mask
+        self.mask.move_to(self.device)
+        self._set_step_size_vox(voxres)
+
     def _set_nbr_processes(self, nbr_processes):
         """
         Copied from scilpy's tracker.
@@ -272,6 +387,58 @@ class DWIMLAbstractTracker:
 
             return lines, seeds
 
+    def track_subjects(self):
+        """
+        Tracks all subjects given to set_subjects. With many subjects, their
+        seeds are all generated first, and lines of all subjects are
+        propagated together, by batches of simultaneous_tracking lines.
+
+        Returns
+        -------
+        lines_per_subj: List[List]
+            The streamlines of each subject.
+        seeds_per_subj: List[List]
+            The seeds of each subject.
+        """
+        if len(self.subj_idxs) == 1:
+            lines, seeds = self.track()
+            return [lines], [seeds]
+
+        # Same seeds as when tracking each subject alone.
+        all_seeds = []
+        seeds_subj = []
+        for i, (seed_generator, nbr_seeds) in enumerate(
+                zip(self.seed_generators, self.nbrs_seeds)):
+            random_generator, indices = seed_generator.init_generator(
+                self.rng_seed, self.skip)
+            all_seeds.extend(seed_generator.get_next_n_pos(
+                random_generator, indices, which_seed_start=0, n=nbr_seeds))
+            seeds_subj.extend([i] * nbr_seeds)
+        seeds_subj = np.asarray(seeds_subj)
+
+        lines_per_subj = [[] for _ in self.subj_idxs]
+        seeds_per_subj = [[] for _ in self.subj_idxs]
+        nb_seeds_per_batch = self._nb_seeds_per_batch()
+        with tqdm_logging_redirect(total=self.nbr_seeds, ncols=100) as pbar:
+            for start in range(0, self.nbr_seeds, nb_seeds_per_batch):
+                end = min(start + nb_seeds_per_batch, self.nbr_seeds)
+                self.lines_subj_idx = seeds_subj[start:end]
+
+                tmp_lines, tmp_seeds = \
+                    self._get_multiple_lines_both_directions(
+                        all_seeds[start:end])
+                pbar.update(end - start)
+
+                # lines_subj_idx now follows the clean lines.
+                for line, seed, i in zip(tmp_lines, tmp_seeds,
+                                         self.lines_subj_idx):
+                    lines_per_subj[i].append(line.tolist())
+                    seeds_per_subj[i].append(seed.tolist())
+
+        self.lines_subj_idx = None
+
+        return lines_per_subj, seeds_per_subj
+
     def reset_data(self):
         if self.dataset.is_lazy:
             # Empty cache
@@ -363,10 +530,11 @@ class DWIMLAbstractTracker:
             seed = self.seed_generator.get_next_pos(
                 random_generator, indices, first_seed_of_chunk + s)
 
-            # Forward and backward tracking
-            line = self._get_multiple_lines_both_directions([seed])[0][0]
+            # Forward and backward tracking. With samples_per_seed > 1, many
+            # lines.
+            lines, _ = self._get_multiple_lines_both_directions([seed])
 
-            if line is not None:
+            for line in lines:
                 streamline = np.array(line, dtype='float32')
 
                 if self.compression_th and self.compression_th > 0:
@@ -397,7 +565,7 @@ class DWIMLAbstractTracker:
         seeds = []
         with tqdm_logging_redirect(total=self.nbr_seeds, ncols=100) as pbar:
             while seed_count < self.nbr_seeds:
-                nb_next_seeds = self.simultaneous_tracking
+                nb_next_seeds = self._nb_seeds_per_batch()
                 if seed_count + nb_next_seeds > self.nbr_seeds:
                     nb_next_seeds = self.nbr_seeds - seed_count
 
@@ -415,18 +583,44 @@ class DWIMLAbstractTracker:
 
         return lines, seeds
 
+    def _nb_seeds_per_batch(self):
+        """
+        Number of seeds propagated together: simultaneous_tracking lines,
+        including all samples of each seed.
+        """
+        return max(1, self.simultaneous_tracking // self.samples_per_seed)
+
     def _get_multiple_lines_both_directions(self, seeds: List[np.ndarray]):
         """
         Returns
         -------
         clean_lines: List[np.ndarray]
-            The generated streamline for each seeding_pos.
+            The generated streamlines. With samples_per_seed > 1, many
+            streamlines per seeding_pos.
+        clean_seeds: List[np.ndarray]
+            The seed of each streamline.
         """
         torch.cuda.empty_cache()
 
+        # Seeds' initial indices: lines are returned in the seeds' order.
+        seeds_idx = np.arange(len(seeds))
+        if self.spatial_sorting > 0:
+            seeds_idx = morton_order(np.asarray(seeds), self.lines_subj_idx)
+            seeds = [seeds[i] for i in seeds_idx]
+            if self.lines_subj_idx is not None:
+                self.lines_subj_idx = self.lines_subj_idx[seeds_idx]
+
         # List of list. Sending to Tensors.
         seeds = [torch.as_tensor(s, device=self.device, dtype=torch.float)
                  for s in seeds]
+        if self.samples_per_seed > 1:
+            # Copies of each seed, one per branch. See get_next_dirs.
+            seeds = [s for s in seeds for _ in range(self.samples_per_seed)]
+            seeds_idx = np.repeat(seeds_idx, self.samples_per_seed)
+            if self.lines_subj_idx is not None:
+                self.lines_subj_idx = np.repeat(self.lines_subj_idx,
+                                                self.samples_per_seed)
+            self.branching_at_seed = True
         lines = [s.clone()[None, :] for s in seeds]
 
         logger.debug("Starting forward")
@@ -438,6 +632,7 @@ class DWIMLAbstractTracker:
             lines, rej_idx = self.prepare_backward(lines)
             if rej_idx is not None and len(rej_idx) > 0:
                 seeds = [s for i, s in enumerate(seeds) if i not in rej_idx]
+                seeds_idx = np.delete(seeds_idx, rej_idx)
             lines = self._propagate_multiple_lines(lines)
 
         # Clean streamlines
@@ -446,17 +641,49 @@ class DWIMLAbstractTracker:
         good_lengths, = np.where(self.min_nbr_pts <= lengths)
         clean_lines = [lines[i] for i in good_lengths]
         clean_seeds = [seeds[i] for i in good_lengths]
+        if self.lines_subj_idx is not None:
+            self.lines_subj_idx = self.lines_subj_idx[good_lengths]
+
+        if self.spatial_sorting > 0:
+            # Back to the seeds' order (branches of a seed stay in order).
+            order = np.argsort(seeds_idx[good_lengths], kind='stable')
+            clean_lines = [clean_lines[i] for i in order]
+            clean_seeds = [clean_seeds[i] for i in order]
+            if self.lines_subj_idx is not None:
+                self.lines_subj_idx = self.lines_subj_idx[order]
 
         return clean_lines, clean_seeds
 
     def _propagate_multiple_lines(self, lines: List[Tensor]):
+        lines_subj_idx = self.lines_subj_idx
+        mask_subj_idx = None if lines_subj_idx is None else \
+            torch.as_tensor(lines_subj_idx, device=self.device)
         with torch.no_grad():
-            return propagate_multiple_lines(
-                lines, self.update_memory_after_removing_lines,
+            lines = propagate_multiple_lines(
+                lines, self._update_memory_and_lines_subj,
                 self.get_next_dirs, self.theta, self.step_size,
                 self.verify_opposite_direction, self.mask, self.max_nbr_pts,
                 append_last_point=self.append_last_point,
-                normalize_directions=self.normalize_directions)
+                normalize_directions=self.normalize_directions,
+                lines_subj_idx=mask_subj_idx,
+                sort_every=self.spatial_sorting,
+                reorder_memory=self._reorder_memory_and_lines_subj)
+
+        # Final lines are returned in their initial order.
+        self.lines_subj_idx = lines_subj_idx
+        return lines
+
+    def _update_memory_and_lines_subj(self, can_continue: np.ndarray,
+                                      new_stopping_lines_raw_idx: List):
+        if self.lines_subj_idx is not None:
+            self.lines_subj_idx = self.lines_subj_idx[can_continue]
+        self.update_memory_after_removing_lines(can_continue,
+                                                new_stopping_lines_raw_idx)
+
+    def _reorder_memory_and_lines_subj(self, order: np.ndarray):
+        if self.lines_subj_idx is not None:
+            self.lines_subj_idx = self.lines_subj_idx[order]
+        self.take_lines_in_memory(order)
 
     def get_next_dirs(self, lines: List[Tensor], n_last_pos: List[Tensor]):
         """
@@ -467,6 +694,9 @@ class DWIMLAbstractTracker:
             next_dirs = a Tensor of shape [nb_streamlines, 3].
         n_last_pos: List[Tensor]
         """
+        if self.branching_at_seed:
+            return self._get_next_dirs_at_branching_seeds(lines, n_last_pos)
+
         inputs = self._prepare_inputs_at_pos(n_last_pos)
 
         model_outputs = self._call_model_forward(inputs, lines)
@@ -476,6 +706,28 @@ class DWIMLAbstractTracker:
 
         return next_dirs
 
+    def _get_next_dirs_at_branching_seeds(self, lines: List[Tensor],
+                                          n_last_pos: List[Tensor]):
+        """
+        First step with samples_per_seed = k > 1: lines contain k consecutive
+        copies of each seed. Inputs and model outputs are computed once per
+        seed, then the model's memory and outputs are repeated for each
+        branch, and each branch samples its own direction.
+        """
+        self.branching_at_seed = False
+        k = self.samples_per_seed
+        first_branches = np.arange(0, len(lines), k)
+
+        inputs = self._prepare_inputs_at_pos(n_last_pos[::k], first_branches)
+        model_outputs = self._call_model_forward(inputs, lines[::k])
+        self.take_lines_in_memory(np.repeat(np.arange(len(inputs)), k))
+        model_outputs = _repeat_outputs(model_outputs, k)
+
+        next_dirs = self.model.get_tracking_directions(
+            model_outputs, self.algo, self.eos_stopping_thresh)
+
+        return next_dirs
+
     def prepare_forward(self, seeding_pos: List[Tensor]):
         """
         Prepare information necessary at the first point of the streamline
@@ -490,11 +742,18 @@ class DWIMLAbstractTracker:
         # starting information. Override if your model is different.
         pass
 
-    def _prepare_inputs_at_pos(self, last_pos):
+    def _prepare_inputs_at_pos(self, last_pos, lines_idx=None):
+        """
+        lines_idx: if last_pos is not given for all current lines, the
+        index of their lines (needed to find their subject).
+        """
         raise NotImplementedError
 
+    def _autocast(self):
+        return get_autocast_context(self.precision, self.device)
+
     def _call_model_forward(self, inputs, lines):
-        with self.grad_context:
+        with self.grad_context, self._autocast():
             model_outputs = self.model(inputs, lines)
         return model_outputs
 
@@ -513,6 +772,20 @@ class DWIMLAbstractTracker:
         """
         pass
 
+    def take_lines_in_memory(self, lines_idx: np.ndarray):
+        """
+        In case your model keeps a memory of the current lines: keeps the
+        memory of lines lines_idx, in that order. Lines can be repeated. Used
+        to give each branch the memory of its seed (see samples_per_seed) and
+        when lines are reordered (see spatial_sorting).
+
+        Params
+        ------
+        lines_idx: np.ndarray
+            Indices of the current lines.
+        """
+        pass
+
     def prepare_backward(self, lines: List[Tensor]):
         """
         Preparing backward.
@@ -540,6 +813,8 @@ class DWIMLAbstractTracker:
 
         if rej_idx is not None and len(rej_idx) > 0:
             lines = [s for i, s in enumerate(lines) if i not in rej_idx]
+            if self.lines_subj_idx is not None:
+                self.lines_subj_idx = np.delete(self.lines_subj_idx, rej_idx)
 
         if len(lines) > 0:
             logger.debug("   Starting backward propagation for the remaining "
@@ -610,7 +885,8 @@ class DWIMLTrackerFromWholeStreamline(DWIMLAbstractTracker):
 
                 # Inputs: not reverted. Lines: reverted. Last input = line[0]
                 last_inputs = self._prepare_inputs_at_pos(
-                    [lines[i][0, :]for i in idx_missing_one])
+                    [lines[i][0, :] for i in idx_missing_one],
+                    idx_missing_one)
 
                 self.input_memory_for_backward = [
                     torch.vstack([self.input_memory_for_backward[i],
@@ -643,6 +919,9 @@ class DWIMLTrackerFromWholeStreamline(DWIMLAbstractTracker):
             self.input_memory = [self.input_memory[i] for i in
                                  range(len(can_continue)) if can_continue[i]]
 
+    def take_lines_in_memory(self, lines_idx: np.ndarray):
+        self.input_memory = [self.input_memory[i] for i in lines_idx]
+
     def _call_model_forward(self, inputs, lines):
 
         # Adding the current input to the input memory
@@ -695,7 +974,29 @@ class DWIMLTrackerOneInput(DWIMLAbstractTracker):
                            "not keep cache size to zero. Data would be "
                            "loaded again at each propagation step!")
 
-    def _prepare_inputs_at_pos(self, n_pos):
+        if self.quantization is not None:
+            calibration_inputs = None
+            if self.quantization == 'static_embedding':
+                calibration_inputs = self._prepare_calibration_inputs()
+            self.quantize_model(calibration_inputs)
+
+    def _prepare_calibration_inputs(self):
+        """
+        Inputs (before embedding) at the first seeds, to calibrate the static
+        quantization of the input embedding.
+        """
+        random_generator, indices = self.seed_generator.init_generator(
+            self.rng_seed, self.skip)
+        seeds = self.seed_generator.get_next_n_pos(
+            random_generator, indices, which_seed_start=0,
+            n=min(self.nbr_seeds, NB_CALIBRATION_SEEDS))
+        seeds = [torch.as_tensor(s, device=self.device, dtype=torch.float)
+                 for s in seeds]
+        with self.grad_context:
+            inputs = self._prepare_inputs_at_pos(seeds)
+        return torch.cat(inputs, dim=0)
+
+    def _prepare_inputs_at_pos(self, n_pos, lines_idx=None):
         """
         Prepare inputs at current position: get the volume and interpolate at
         current coordinate (possibly get the neighborhood coordinates too).
@@ -704,10 +1005,44 @@ class DWIMLTrackerOneInput(DWIMLAbstractTracker):
         ------
         n_pos: List[Tensor(1, 3)]
             List of n "streamlines" composed of one point.
+        lines_idx: np.ndarray
+            If n_pos is not given for all current lines: their indices.
         """
         n_pos = [pos[None, :] for pos in n_pos]
-        return self.model.prepare_batch_one_input(
-            n_pos, self.dataset, self.subj_idx, self.volume_group)
+        return self._prepare_batch_one_input(n_pos, lines_idx)
+
+    def _prepare_batch_one_input(self, lines, lines_idx=None):
+        """
+        Calls the model's prepare_batch_one_input. When many subjects are
+        tracked together, each line's input comes from its own subject.
+        """
+        if self.lines_subj_idx is None:
+            return self.model.prepare_batch_one_input(
+                lines, self.dataset, self.subj_idx, self.volume_group)
+
+        lines_subj_idx = self.lines_subj_idx
+        if lines_idx is not None:
+            lines_subj_idx = lines_subj_idx[lines_idx]
+        inputs = [None] * len(lines)
+        for i in np.unique(lines_subj_idx):
+            idx, = np.where(lines_subj_idx == i)
+            subj_inputs = self.model.prepare_batch_one_input(
+                [lines[j] for j in idx], self.dataset, self.subj_idxs[i],
+                self.volume_group)
+            for j, subj_input in zip(idx, subj_inputs):
+                inputs[j] = subj_input
+        return inputs
+
+
+def _repeat_outputs(model_outputs, nb_repeats: int):
+    """
+    Repeats each line's model outputs (a tensor or tuple of tensors, one row
+    per line) nb_repeats times, consecutively.
+    """
+    if isinstance(model_outputs, (tuple, list)):
+        return type(model_outputs)(_repeat_outputs(o, nb_repeats)
+                                   for o in model_outputs)
+    return torch.repeat_interleave(model_outputs, nb_repeats, dim=0)
 
 
 def where_first(array):
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+from typing import List
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
 import torch
 
 from dwi_ml.data.processing.volume.interpolation import \
@@ -6,8 +10,16 @@ from dwi_ml.data.processing.volume.interpolation import \
 
 eps = 1e-6
 
+# Safe distances are stored in voxels, as uint8.
+MAX_SAFE_DISTANCE = 255
+
 
 class TrackingMask:
+    """
+    Tracking mask of one subject or, when created with TrackingMask.stack, of
+    a batch of subjects. In the latter case, methods must receive subj_idx,
+    the index of the subject (in the stack) of each coordinate.
+    """
     def __init__(self, dim, data=None, interp: str = 'nearest'):
         # Required dim to check if out of bounds, even with no tracking mask
         self.higher_bound = torch.as_tensor(dim[0:3])
@@ -19,20 +31,109 @@ class TrackingMask:
             self.data = torch.as_tensor(data)
         else:
             self.data = None
+        self.safe_distances = None
 
         if interp is not None:
             assert interp in ['nearest', 'trilinear']
 
+    @classmethod
+    def stack(cls, masks: List['TrackingMask']):
+        """
+        Stacks the masks of many subjects. Data (if any) is padded to the
+        largest dimensions: shape [nb_subjects, x, y, z]. Each subject keeps
+        its own bounds. Only nearest interpolation is supported.
+        """
+        has_data = [m.data is not None for m in masks]
+        assert all(has_data) or not any(has_data), \
+            "Either all masks or none of them must have data."
+        mask = cls.__new__(cls)
+        mask.interp = masks[0].interp
+        mask.lower_bound = masks[0].lower_bound
+        mask.higher_bound = torch.vstack([m.higher_bound for m in masks])
+        if any(has_data):
+            assert all(m.interp == 'nearest' for m in masks), \
+                "Stacked masks only support nearest interpolation."
+            dim = torch.max(mask.higher_bound, dim=0)[0].tolist()
+            mask.data = torch.zeros([len(masks)] + dim,
+                                    dtype=masks[0].data.dtype,
+                                    device=masks[0].data.device)
+            for i, m in enumerate(masks):
+                x, y, z = m.data.shape[0:3]
+                mask.data[i, :x, :y, :z] = m.data
+        else:
+            mask.data = None
+
+        mask.safe_distances = None
+        if all(m.safe_distances is not None for m in masks):
+            # Padding: distance 0, i.e. always verified.
+            mask.safe_distances = torch.zeros(
+                mask.data.shape, dtype=torch.uint8,
+                device=masks[0].safe_distances.device)
+            for i, m in enumerate(masks):
+                x, y, z = m.safe_distances.shape
+                mask.safe_distances[i, :x, :y, :z] = m.safe_distances
+        return mask
+
     def move_to(self, device):
         self.higher_bound = self.higher_bound.to(device)
         self.lower_bound = self.lower_bound.to(device)
         if self.data is not None:
             self.data = self.data.to(device)
+        if self.safe_distances is not None:
+            self.safe_distances = self.safe_distances.to(device)
+
+    def binarize(self):
+        """
+        With nearest interpolation, a point is in the mask if its voxel's
+        value is >= 0.5: the mask can be kept as a bool tensor (1 byte per
+        voxel) with the same results.
+        """
+        assert self.interp == 'nearest', \
+            "Only masks with nearest interpolation can be binarized."
+        if self.data is not None:
+            self.data = torch.greater_equal(self.data, 0.5)
 
-    def is_vox_corner_in_bound(self, xyz: torch.Tensor):
+    def compute_safe_distances(self):
+        """
+        Computes, for each voxel, a distance r (in voxels, floored, as uint8)
+        such that any point in this voxel, moved by less than r, is still in
+        the mask.
+
+        From the Euclidean distance d between the voxel and the closest voxel
+        out of the mask (or out of bounds), we remove the distance between a
+        point and the voxels used to interpolate at that point (< sqrt(3)
+        from the point, for both interpolations), once at the start and once
+        at the end: r = d - 2 * sqrt(3). With trilinear interpolation, voxels
+        are considered in the mask if their value is > 0.5 (all 8 corners in
+        the mask: the interpolated value is in the mask, too).
+        """
+        if self.data is None:
+            return
+        data = self.data.cpu().numpy()
+        if self.interp == 'nearest':
+            inside = data >= 0.5
+        else:
+            inside = data >= 0.5 + eps
+
+        # Padding with zeros: out of bounds counts as out of the mask.
+        inside = np.pad(inside, 1)
+        d = distance_transform_edt(inside)[1:-1, 1:-1, 1:-1]
+        r = np.clip(np.floor(d - 2 * np.sqrt(3)), 0, MAX_SAFE_DISTANCE)
+        self.safe_distances = torch.as_tensor(r.astype(np.uint8),
+                                              device=self.data.device)
+
+    def _get_higher_bound(self, subj_idx: torch.Tensor = None):
+        if subj_idx is None:
+            return self.higher_bound
+        return self.higher_bound[subj_idx]
+
+    def is_vox_corner_in_bound(self, xyz: torch.Tensor,
+                               subj_idx: torch.Tensor = None):
         """
         xyz: Tensor
             Coordinates in voxel space, corner origin. Of shape [n, 3].
+        subj_idx: Tensor
+            For stacked masks: the subject of each coordinate. Of shape [n].
         """
         # Uses data_volume.is_coordinate_in_bound with space=VOX,
         # origin=Corner.
@@ -40,10 +141,12 @@ class TrackingMask:
 
         return ~torch.logical_or(
             torch.any(torch.less(xyz, self.lower_bound), dim=-1),
-            torch.any(torch.greater_equal(xyz, self.higher_bound), dim=-1))
+            torch.any(torch.greater_equal(xyz,
+                                          self._get_higher_bound(subj_idx)),
+                      dim=-1))
 
     def get_value_at_vox_corner_coordinate(
-        self, xyz, interpolation, clear_cache=True
+        self, xyz, interpolation, clear_cache=True, subj_idx=None
     ):
         """ Get the value at the voxel corner coordinate.
 
@@ -57,18 +160,41 @@ class TrackingMask:
             Whether to clear the cache after computing the interpolation.
             Can be useful to save memory but will slow down the function.
             Only used if interpolation is 'trilinear'.
+        subj_idx : torch.Tensor
+            For stacked masks: the subject of each coordinate. Of shape [n].
         """
+        if subj_idx is not None:
+            assert interpolation == 'nearest'
+            idx = torch.floor(xyz).to(dtype=torch.long)
+            return self.data[subj_idx, idx[:, 0], idx[:, 1], idx[:, 2]]
 
         if interpolation == 'nearest':
             return torch_nearest_neighbor_interpolation(self.data, xyz)
         else:
             return torch_trilinear_interpolation(self.data, xyz, clear_cache)
 
-    def is_vox_corner_in_mask(self, xyz):
+    def is_vox_corner_in_mask(self, xyz, subj_idx=None):
         # Clipping to bound.
         xyz = torch.maximum(xyz, self.lower_bound)
-        xyz = torch.minimum(xyz, self.higher_bound - eps)
+        xyz = torch.minimum(xyz, self._get_higher_bound(subj_idx) - eps)
 
         return torch.greater_equal(
-            self.get_value_at_vox_corner_coordinate(xyz, self.interp),
+            self.get_value_at_vox_corner_coordinate(xyz, self.interp,
+                                                    subj_idx=subj_idx),
             torch.as_tensor(0.5, device=xyz.device))
+
+    def get_safe_distances(self, xyz, subj_idx=None):
+        """
+        Returns the distance (see compute_safe_distances) that points at xyz
+        (in voxel space, corner origin, of shape [n, 3]) can travel while
+        staying in the mask, as a float tensor of shape [n].
+        """
+        xyz = torch.maximum(xyz, self.lower_bound)
+        xyz = torch.minimum(xyz, self._get_higher_bound(subj_idx) - eps)
+        idx = torch.floor(xyz).to(dtype=torch.long)
+        if subj_idx is not None:
+            r = self.safe_distances[subj_idx, idx[:, 0], idx[:, 1],
+                                    idx[:, 2]]
+        else:
+            r = self.safe_distances[idx[:, 0], idx[:, 1], idx[:, 2]]
+        return r.float()
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 import logging
 
+import numpy as np
+
+from dwi_ml.data.processing.streamlines.post_processing import \
+    compute_triu_connectivity_from_blocs
+
 
 def prepare_step_size_vox(step_size, res):
     if step_size:
@@ -20,3 +25,129 @@ def prepare_step_size_vox(step_size, res):
 
     return step_size_vox_space, normalize_directions
 
+
+# Bits per dimension in Morton codes: coordinates up to 1023 voxels.
+MORTON_BITS = 10
+
+
+def _spread_bits(x):
+    """Inserts two zeros between each of the 10 bits of x."""
+    x = (x | (x << 16)) & 0x030000FF
+    x = (x | (x << 8)) & 0x0300F00F
+    x = (x | (x << 4)) & 0x030C30C3
+    x = (x | (x << 2)) & 0x09249249
+    return x
+
+
+def morton_order(coords, groups=None):
+    """
+    Order of the points along a Z-order (Morton) curve: consecutive points in
+    this order are close in space. Points in the same voxel keep their
+    initial order, so the result is deterministic.
+
+    Parameters
+    ----------
+    coords: np.ndarray
+        Coordinates of shape (N, 3), in voxel space, corner origin.
+    groups: np.ndarray
+        Optional, of shape (N,). Points are sorted by group first (ex, by
+        subject, when subjects are tracked together).
+
+    Returns
+    -------
+    order: np.ndarray
+        Indices of the points, sorted.
+    """
+    idx = np.clip(np.floor(coords), 0, 2 ** MORTON_BITS - 1).astype(np.int64)
+    codes = _spread_bits(idx[:, 0]) | (_spread_bits(idx[:, 1]) << 1) | \
+        (_spread_bits(idx[:, 2]) << 2)
+    if groups is None:
+        return np.argsort(codes, kind='stable')
+    return np.lexsort((codes, groups))
+
+
+def _directions_from_seed(line, seed):
+    """
+    Directions of the line's segments, going forward and backward from the
+    point closest to the seed.
+    """
+    i = np.argmin(np.linalg.norm(line - seed, axis=1))
+    dirs = np.diff(line, axis=0)
+    forward = dirs[i:]
+    backward = -dirs[:i][::-1]
+    return forward, backward
+
+
+def _angles(dirs_a, dirs_b):
+    n = min(len(dirs_a), len(dirs_b))
+    a = dirs_a[:n] / np.linalg.norm(dirs_a[:n], axis=1, keepdims=True)
+    b = dirs_b[:n] / np.linalg.norm(dirs_b[:n], axis=1, keepdims=True)
+    return np.degrees(np.arccos(np.clip(np.sum(a * b, axis=1), -1, 1)))
+
+
+def compare_tractograms(ref_lines, ref_seeds, lines, seeds, volume_size,
+                        nb_blocs):
+    """
+    Compares a tractogram to a reference tractogram tracked from the same
+    seeds (ex, tracked with a quantized model vs float32). Streamlines are
+    matched by seed.
+
+    Parameters
+    ----------
+    ref_lines, lines: List[np.ndarray]
+        Streamlines, in voxel space, corner origin. Preferably not
+        compressed: directions are compared step by step.
+    ref_seeds, seeds: List[np.ndarray]
+        The seed of each streamline, in voxel space, corner origin.
+    volume_size: list
+        The 3D dimension of the reference volume.
+    nb_blocs: list
+        Number of blocs in each dimension for the connectivity (see
+        compute_triu_connectivity_from_blocs).
+
+    Returns
+    -------
+    results: dict
+        - 'nb_matched': number of streamlines found in both tractograms.
+        - 'angular_error': mean angle (degrees) between the matched
+          streamlines' directions, step by step from the seed, in both
+          directions, up to the shortest one's length.
+        - 'same_connection': fraction of matched streamlines connecting the
+          same blocs.
+        - 'connectivity_difference': sum of absolute differences between the
+          connectivity matrices, divided by their total number of
+          streamlines (0 = same matrices, 1 = no common connection).
+    """
+    ref_lines = [np.asarray(line) for line in ref_lines]
+    lines = [np.asarray(line) for line in lines]
+    ref_matrix, ref_start, ref_end = compute_triu_connectivity_from_blocs(
+        ref_lines, volume_size, nb_blocs)
+    matrix, start, end = compute_triu_connectivity_from_blocs(
+        lines, volume_size, nb_blocs)
+
+    ref_idx = {tuple(np.round(seed, 4)): i for i, seed in enumerate(ref_seeds)}
+    angles = []
+    nb_matched = 0
+    nb_same_connection = 0
+    for i, seed in enumerate(seeds):
+        j = ref_idx.get(tuple(np.round(seed, 4)))
+        if j is None:
+            continue
+        nb_matched += 1
+        if {start[i], end[i]} == {ref_start[j], ref_end[j]}:
+            nb_same_connection += 1
+        for dirs, ref_dirs in zip(_directions_from_seed(lines[i], seed),
+                                  _directions_from_seed(ref_lines[j], seed)):
+            angles.append(_angles(dirs, ref_dirs))
+
+    angles = np.concatenate(angles) if len(angles) > 0 else np.asarray([])
+    total = ref_matrix.sum() + matrix.sum()
+    return {
+        'nb_matched': nb_matched,
+        'angular_error': float(np.mean(angles)) if len(angles) else np.nan,
+        'same_connection': nb_same_connection / nb_matched
+        if nb_matched else np.nan,
+        'connectivity_difference':
+            float(np.abs(ref_matrix - matrix).sum() / total)
+            if total else np.nan,
+    }
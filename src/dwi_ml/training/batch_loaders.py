@@ -51,7 +51,8 @@ import torch
 from dwi_ml.data.dataset.multi_subject_containers import (
     MultiSubjectDataset, MultisubjectSubset)
 from dwi_ml.data.processing.streamlines.data_augmentation import (
-    reverse_streamlines, split_streamlines, resample_or_compress)
+    reverse_streamlines, reverse_streamlines_flat, split_streamlines,
+    split_streamlines_flat, resample_or_compress, resample_streamlines_flat)
 from dwi_ml.data.processing.utils import add_noise_to_tensor
 from dwi_ml.models.main_models import MainModelOneInput, \
     ModelWithNeighborhood, MainModelAbstract
@@ -189,19 +190,96 @@ class DWIMLStreamlinesBatchLoader:
             self.context = context
         self.dataset.context = context
 
-    def _data_augmentation_sft(self, sft):
-        if self.model.step_size is not None and \
-                self.context_subset.step_size == self.model.step_size:
+    def worker_init_fn(self, worker_id: int):
+        """
+        To be used as the DataLoader's worker_init_fn. Runs once at the start
+        of each worker process (once for the whole training with persistent
+        workers):
+
+        - The worker opens its own hdf handle (lazy data), kept alive as long
+          as the worker.
+        - Data augmentation's random generator: workers are copies of the
+          main process; without re-seeding, all workers would use the same
+          random numbers. Torch gives a different seed to each worker,
+          derived from the main process's torch seed (reproducible).
+        """
+        if self.context_subset is not None:
+            self.context_subset.open_worker_handle()
+        self.np_rng = np.random.RandomState(torch.initial_seed() % 2 ** 32)
+
+    def _needs_resampling(self):
+        """
+        True if the model's step_size / compress_lines / nb_points differ from
+        the preprocessing done when creating the hdf5.
+        """
+        if self.model.step_size is None and \
+                not self.model.compress_lines and \
+                self.model.nb_points is None:
+            return False
+        elif self.model.step_size is not None and \
+                self.context_subset.streamline_step_sizes[
+                    self.streamline_group_idx] == self.model.step_size:
             logger.debug("Step size is the same as when creating "
                          "the hdf5 dataset. Not resampling again.")
-        elif self.model.compress_lines is not None and \
+            return False
+        elif self.model.compress_lines and \
                 self.context_subset.compress == self.model.compress_lines:
             logger.debug("Compression rate is the same as when creating "
                          "the hdf5 dataset. Not compressing again.")
-        elif self.model.nb_points is not None and self.model.nb_points == self.context_subset.nb_points:
-            logging.debug("Number of points per streamline is the same"
-                          " as when creating the hdf5. Not resampling again.")
-        else:
+            return False
+        elif self.model.nb_points is not None and \
+                self.context_subset.nb_points == self.model.nb_points:
+            logger.debug("Number of points per streamline is the same"
+                         " as when creating the hdf5. Not resampling again.")
+            return False
+        return True
+
+    def _use_fast_path(self, subj_sft_data):
+        """
+        Streamlines can be processed directly from the hdf5's flat arrays,
+        without creating a StatefulTractogram, if they are stored in voxel
+        space, corner origin (default in dwiml_create_hdf5_dataset). Only
+        compression still requires the SFT.
+        """
+        return (subj_sft_data.is_vox_corner and
+                not (self._needs_resampling() and
+                     self.model.compress_lines))
+
+    def _data_augmentation_flat(self, data, lengths, affine):
+        """
+        Same as _data_augmentation_sft, on the flat data (see
+        data_augmentation.py). Uses the same random draws; with the same
+        rng state, results are the same.
+        """
+        if self._needs_resampling():
+            logger.debug("Resample streamlines using: \n" +
+                         "- step_size: {}\n".format(self.model.step_size) +
+                         "- nb_points: {}".format(self.model.nb_points))
+            data, lengths = resample_streamlines_flat(
+                data, lengths, self.model.step_size, self.model.nb_points,
+                affine)
+
+        if self.split_ratio and self.split_ratio > 0:
+            logger.debug("            Splitting: {}".format(self.split_ratio))
+            all_ids = np.arange(len(lengths))
+            n_to_split = int(np.floor(len(lengths) * self.split_ratio))
+            split_ids = self.np_rng.choice(all_ids, size=n_to_split,
+                                           replace=False)
+            data, lengths = split_streamlines_flat(data, lengths, self.np_rng,
+                                                   split_ids)
+
+        if self.reverse_ratio and self.reverse_ratio > 0:
+            logger.debug("            Reversing: {}"
+                         .format(self.reverse_ratio))
+            ids = np.arange(len(lengths))
+            self.np_rng.shuffle(ids)
+            reverse_ids = ids[:int(len(ids) * self.reverse_ratio)]
+            data = reverse_streamlines_flat(data, lengths, reverse_ids)
+
+        return data, lengths
+
+    def _data_augmentation_sft(self, sft):
+        if self._needs_resampling():
             logger.debug("Resample streamlines using: \n" +
                          "- step_size: {}\n".format(self.model.step_size) +
                          "- compress_lines: {}".format(self.model.compress_lines) +
@@ -305,25 +383,36 @@ class DWIMLStreamlinesBatchLoader:
                 self.context_subset.subjs_data_list.get_subj_with_handle(subj)
             subj_sft_data = subj_data.sft_data_list[self.streamline_group_idx]
 
-            # Get streamlines as sft
-            logger.debug("            Loading sampled streamlines...")
-            sft = subj_sft_data.as_sft(s_ids)
-            sft = self._data_augmentation_sft(sft)
+            if self._use_fast_path(subj_sft_data):
+                # Streamlines are already in voxel space, corner origin.
+                logger.debug("            Loading sampled streamlines "
+                             "(fast path, no SFT)...")
+                data, lengths = subj_sft_data.get_flat_streamlines(s_ids)
+                data, lengths = self._data_augmentation_flat(
+                    data, lengths, subj_sft_data.space_attributes[0])
+                subj_streamlines = torch.as_tensor(data).split(
+                    lengths.tolist())
+            else:
+                # Get streamlines as sft
+                logger.debug("            Loading sampled streamlines...")
+                sft = subj_sft_data.as_sft(s_ids)
+                sft = self._data_augmentation_sft(sft)
+
+                # What we want is the streamline coordinates, to eventually
+                # get the underlying input(s). Sending to vox and to corner to
+                # be able to use our trilinear interpolation
+                sft.to_vox()
+                sft.to_corner()
+                subj_streamlines = [torch.as_tensor(s)
+                                    for s in sft.streamlines]
 
             # Remember the indices of this subject's (augmented) streamlines
             ids_start = len(batch_streamlines)
-            ids_end = ids_start + len(sft)
+            ids_end = ids_start + len(subj_streamlines)
             final_s_ids_per_subj[subj] = slice(ids_start, ids_end)
 
             # Add all (augmented) streamlines to the batch
-            # What we want is the streamline coordinates, to eventually get
-            # the underlying input(s). Sending to vox and to corner to
-            # be able to use our trilinear interpolation
-            sft.to_vox()
-            sft.to_corner()
-            batch_streamlines.extend(sft.streamlines)
-
-        batch_streamlines = [torch.as_tensor(s) for s in batch_streamlines]
+            batch_streamlines.extend(subj_streamlines)
 
         return batch_streamlines, final_s_ids_per_subj
 
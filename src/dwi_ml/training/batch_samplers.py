@@ -13,6 +13,10 @@ Defines how to sample the streamlines available in the MultiSubjectData.
     reduce the number of time we need to load new data by using the same
     subjects for a given number of "cycles".
 
+    - With lazy data, the cache_affinity option samples batches from a
+    working set of subjects fitting in the volume cache, rotated one subject
+    at a time.
+
 USAGE:
 Can be used in a torch DataLoader. For instance:
         # Initialize dataset
@@ -43,7 +47,8 @@ class DWIMLBatchIDSampler(Sampler):
                  batch_size_validation: Union[int, None],
                  batch_size_units: str, nb_streamlines_per_chunk: int = None,
                  rng: int = None, nb_subjects_per_batch: int = None,
-                 cycles: int = None, log_level=logger.root.level):
+                 cycles: int = None, cache_affinity: bool = False,
+                 log_level=logger.root.level):
         """
         Parameters
         ----------
@@ -78,6 +83,23 @@ class DWIMLBatchIDSampler(Sampler):
             Used if `nb_subjects_per_batch` is given. Number of batches
             re-using the same subjects (and thus the same volumes) before
             sampling new ones. Default: None.
+            With cache_affinity: number of batches between two rotations of
+            the working set. Default: None (subjects leave the working set
+            only once all their streamlines have been used).
+        cache_affinity: bool
+            For lazy data, with a volume cache. Batches are sampled from a
+            working set of subjects whose volumes fit in the cache (cache_size
+            subjects; assuming one input volume per subject). Subjects whose
+            streamlines have all been used are replaced by a new subject,
+            chosen randomly, weighted by its number of remaining streamlines
+            (as in the usual sampling). Each volume is thus loaded only once
+            per epoch. If `cycles` is set, every `cycles` batches, the subject
+            that has been in the working set for the longest time is also
+            replaced: useful if epochs are
+            limited to a maximum number of batches, to visit more subjects.
+            Each batch contains nb_subjects_per_batch subjects from the
+            working set (or all of them). With non-lazy data, this option has
+            no effect. Default: False.
         """
         super().__init__(None)  # This does nothing but python likes it.
 
@@ -110,7 +132,7 @@ class DWIMLBatchIDSampler(Sampler):
                              .format(batch_size_units))
 
         # Checking that n_volumes was given if cycles was given
-        if cycles and nb_subjects_per_batch is None:
+        if cycles and nb_subjects_per_batch is None and not cache_affinity:
             raise ValueError("If `cycles` is defined, "
                              "`nb_subjects_per_batch` should be defined. Got: "
                              "nb_subjects_per_batch={}, cycles={}"
@@ -121,6 +143,7 @@ class DWIMLBatchIDSampler(Sampler):
         self.streamline_group_name = streamline_group_name
         self.nb_subjects_per_batch = nb_subjects_per_batch
         self.cycles = cycles
+        self.cache_affinity = cache_affinity
         self.batch_size_training = batch_size_training
         self.batch_size_validation = batch_size_validation
         self.batch_size_units = batch_size_units
@@ -160,6 +183,7 @@ class DWIMLBatchIDSampler(Sampler):
             'rng': self.rng,
             'nb_subjects_per_batch': self.nb_subjects_per_batch,
             'cycles': self.cycles,
+            'cache_affinity': self.cache_affinity,
         }
         return params
 
@@ -243,6 +267,14 @@ class DWIMLBatchIDSampler(Sampler):
                           "out of {} possible streamlines"
                           .format(sum(global_unused_streamlines)))
 
+        if self.cache_affinity:
+            if self.context_subset.is_lazy and self.context_subset.cache_size:
+                yield from self._iter_with_cache_affinity(
+                    ids_per_subjs, global_unused_streamlines)
+                return
+            self.logger.debug("Cache affinity is only used with lazy data "
+                              "and a volume cache. Ignored.")
+
         # This will continue "yielding" batches until it encounters a break.
         # (i.e. when all streamlines have been used)
         while True:
@@ -340,6 +372,73 @@ class DWIMLBatchIDSampler(Sampler):
             # Finished cycle. Will choose new subjs if the number of iterations
             # is not reached for this __iter__ call.
 
+    def _iter_with_cache_affinity(self, ids_per_subjs,
+                                  global_unused_streamlines):
+        """
+        Streamline sampling from a working set of subjects fitting in the
+        volume cache. See the cache_affinity option.
+        """
+        working_set_size = self.context_subset.cache_size
+        rotation_period = self.cycles or np.inf
+        working_set = []  # Ordered from oldest to newest.
+        nb_batches_since_rotation = 0
+        while True:
+            remaining = np.array(
+                [np.sum(global_unused_streamlines[subj_id_slice])
+                 for _, subj_id_slice in ids_per_subjs.items()])
+            if np.sum(remaining) == 0:
+                self.logger.debug("No streamlines remain for this epoch, "
+                                  "stopping.")
+                break
+
+            # Updating the working set.
+            working_set = [s for s in working_set if remaining[s] > 0]
+            candidates = [s for s in range(len(remaining))
+                          if remaining[s] > 0 and s not in working_set]
+            if (nb_batches_since_rotation >= rotation_period and
+                    len(working_set) == working_set_size and
+                    len(candidates) > 0):
+                working_set.pop(0)
+                nb_batches_since_rotation = 0
+            while len(working_set) < working_set_size and len(candidates) > 0:
+                weights = remaining[candidates] / np.sum(remaining[candidates])
+                new_subj = self.np_rng.choice(candidates, p=weights)
+                working_set.append(new_subj)
+                candidates.remove(new_subj)
+
+            # Choosing this batch's subjects.
+            if self.nb_subjects_per_batch and \
+                    self.nb_subjects_per_batch < len(working_set):
+                weights = remaining[working_set] / np.sum(
+                    remaining[working_set])
+                sampled_subjs = self.np_rng.choice(
+                    working_set, size=self.nb_subjects_per_batch,
+                    replace=False, p=weights)
+            else:
+                sampled_subjs = working_set
+            self.logger.debug('    Working set: {}. Sampled subjects: {}'
+                              .format(working_set, sampled_subjs))
+
+            max_batch_size_per_subj = int(
+                self.context_batch_size / len(sampled_subjs))
+            if self.batch_size_units == 'nb_streamlines':
+                chunk_size = max_batch_size_per_subj
+            else:
+                chunk_size = (self.nb_streamlines_per_chunk or
+                              DEFAULT_CHUNK_SIZE)
+
+            batch_ids_per_subj = []
+            for subj in sampled_subjs:
+                sampled_ids, global_unused_streamlines = \
+                    self._sample_streamlines_for_subj(
+                        subj, ids_per_subjs, global_unused_streamlines,
+                        max_batch_size_per_subj, chunk_size)
+                if len(sampled_ids) > 0:
+                    batch_ids_per_subj.append((subj, sampled_ids))
+
+            nb_batches_since_rotation += 1
+            yield batch_ids_per_subj
+
     def _sample_streamlines_for_subj(self, subj, ids_per_subjs,
                                      global_unused_streamlines,
                                      max_batch_size_per_subj, chunk_size):
@@ -2,12 +2,10 @@
 import logging
 from typing import List
 
-import h5py
 import numpy as np
 import torch
 
 from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
-from dwi_ml.tracking.io_utils import prepare_tracking_mask
 from dwi_ml.tracking.propagation import propagate_multiple_lines
 from dwi_ml.training.trainers_withGV import \
     DWIMLTrainerForTrackingOneInput
@@ -31,30 +29,30 @@ class Learn2TrackTrainer(DWIMLTrainerForTrackingOneInput):
         theta = 2 * np.pi  # theta = 360 degrees
         max_nbr_pts = int(200 / self.model.step_size)
 
-        # These methods will be used during the loop on subjects
+        # All subjects are propagated together, with a stacked tracking mask.
+        batch_subjs = list(ids_per_subj.keys())
+        tracking_mask, lines_subj_nb = self.prepare_batch_tracking_mask(
+            lines, ids_per_subj)
+
+        # These methods will be used during the propagation
         def update_memory_after_removing_lines(can_continue: np.ndarray, _):
-            nonlocal subjs_hidden_states
-            nonlocal subj_batch_nb
-            subjs_hidden_states[subj_batch_nb] = (
-                self.model.take_lines_in_hidden_state(
-                    subjs_hidden_states[subj_batch_nb], can_continue))
+            nonlocal hidden_states
+            nonlocal lines_subj_nb
+            hidden_states = self.model.take_lines_in_hidden_state(
+                hidden_states, can_continue)
+            lines_subj_nb = lines_subj_nb[can_continue]
 
         def get_dirs_at_last_pos(_lines: List[torch.Tensor], n_last_pos):
-            # Get dirs for current subject: run model
-            nonlocal subjs_hidden_states
-            nonlocal subj_idx
-            nonlocal subj_batch_nb
+            # Get dirs for all remaining lines: run model
+            nonlocal hidden_states
 
             n_last_pos = [pos[None, :] for pos in n_last_pos]
-            # Amongst the current batch of streamlines (n_pos), the ones
-            # belonging to current subject are: all of them!
-            subj_dict = {subj_idx: slice(0, len(n_last_pos))}
-            subj_inputs = self.batch_loader.load_batch_inputs(
-                n_last_pos, subj_dict)
+            inputs = self.batch_loader.load_batch_inputs(
+                n_last_pos,
+                self.get_remaining_ids_per_subj(batch_subjs, lines_subj_nb))
 
-            model_outputs, subjs_hidden_states[subj_batch_nb] = self.model(
-                subj_inputs, _lines,
-                hidden_recurrent_states=subjs_hidden_states[subj_batch_nb],
+            model_outputs, hidden_states = self.model(
+                inputs, _lines, hidden_recurrent_states=hidden_states,
                 return_hidden=True, point_idx=-1)
 
             next_dirs = self.model.get_tracking_directions(
@@ -63,46 +61,20 @@ class Learn2TrackTrainer(DWIMLTrainerForTrackingOneInput):
 
         # Running the beginning of the streamlines to get the hidden states
         # (using one less point. The next will be done during propagation).
-        # Here, subjs_hidden_states will be a list of hidden_states per subj.
         if self.tracking_phase_nb_segments_init > 0:
             tmp_lines = [line[:-1, :] for line in lines]
             inputs = self.batch_loader.load_batch_inputs(
                 tmp_lines, ids_per_subj)
-            _, whole_hidden_states = self.model(inputs, tmp_lines,
-                                                return_hidden=True)
-
-            subjs_hidden_states = [
-                self.model.take_lines_in_hidden_state(whole_hidden_states,
-                                                      subj_slice)
-                for subj, subj_slice in ids_per_subj.items()]
-            del tmp_lines, inputs, whole_hidden_states
+            _, hidden_states = self.model(inputs, tmp_lines,
+                                          return_hidden=True)
+            del tmp_lines, inputs
         else:
-            subjs_hidden_states = None
-
-        # Running the propagation separately for each subject
-        # (because they all need their own tracking mask)
-        final_lines = []
-        subj_batch_nb = -1
-        for subj_idx, subj_line_idx_slice in ids_per_subj.items():
-            subj_batch_nb += 1   # Will be used as non-local in methods above
-
-            # Load the subject's tracking mask
-            with h5py.File(self.batch_loader.dataset.hdf5_file, 'r'
-                           ) as hdf_handle:
-                subj_id = self.batch_loader.context_subset.subjects[subj_idx]
-                logging.debug("Loading subj {} ({})'s tracking mask."
-                              .format(subj_idx, subj_id))
-                tracking_mask, _ = prepare_tracking_mask(
-                    hdf_handle, self.tracking_mask_group, subj_id=subj_id,
-                    mask_interp='nearest')
-                tracking_mask.move_to(self.device)
-
-            # Propagates all lines for this subject
-            final_lines.extend(propagate_multiple_lines(
-                lines[subj_line_idx_slice], update_memory_after_removing_lines,
-                get_next_dirs=get_dirs_at_last_pos, theta=theta,
-                step_size=self.model.step_size, verify_opposite_direction=False,
-                mask=tracking_mask, max_nbr_pts=max_nbr_pts,
-                append_last_point=False, normalize_directions=True))
-
-        return final_lines
+            hidden_states = None
+
+        return propagate_multiple_lines(
+            lines, update_memory_after_removing_lines,
+            get_next_dirs=get_dirs_at_last_pos, theta=theta,
+            step_size=self.model.step_size, verify_opposite_direction=False,
+            mask=tracking_mask, max_nbr_pts=max_nbr_pts,
+            append_last_point=False, normalize_directions=True,
+            lines_subj_idx=torch.as_tensor(lines_subj_nb, device=self.device))
@@ -15,8 +15,11 @@ from tqdm import tqdm
 from dwi_ml.experiment_utils.memory import (
     log_gpu_per_tensor, log_currently_allocated, log_gpu_general_info, BYTES_IN_GB,
     torch_reset_peaks_memory, log_max_allocated)
+from dwi_ml.experiment_utils.mixed_precision import (
+    check_precision, get_autocast_context, get_grad_scaler)
 from dwi_ml.experiment_utils.tqdm_logging import tqdm_logging_redirect
 from dwi_ml.models.main_models import (MainModelAbstract,
+                                       ModelOneInputWithEmbedding,
                                        ModelWithDirectionGetter)
 from dwi_ml.training.batch_loaders import (
     DWIMLStreamlinesBatchLoader, DWIMLBatchLoaderOneInput)
@@ -25,6 +28,7 @@ from dwi_ml.training.utils.gradient_norm import compute_gradient_norm
 from dwi_ml.training.utils.monitoring import (
     BestEpochMonitor, IterTimer, BatchHistoryMonitor, TimeMonitor,
     EarlyStoppingError)
+from dwi_ml.training.utils.validation_cache import ValidationInputsCache
 
 logger = logging.getLogger('train_logger')
 # If the remaining time is less than one epoch + X seconds, we will quit
@@ -58,7 +62,11 @@ class DWIMLAbstractTrainer:
                  max_batches_per_epoch_validation: Union[int, None] = 1000,
                  patience: int = None, patience_delta: float = 1e-6,
                  nb_cpu_processes: int = 0, use_gpu: bool = False,
-                 clip_grad: float = None,
+                 persistent_workers: bool = False,
+                 prefetch_factor: int = None,
+                 clip_grad: float = None, precision: str = 'float32',
+                 grad_accumulation_steps: int = 1,
+                 activation_checkpointing: bool = False,
                  comet_workspace: str = None, comet_project: str = None,
                  from_checkpoint: bool = False, log_level=logging.root.level):
         """
@@ -108,12 +116,38 @@ class DWIMLAbstractTrainer:
         nb_cpu_processes: int
             Number of parallel CPU workers. Use 0 to avoid parallel threads.
             Default : 0.
+        persistent_workers: bool
+            With nb_cpu_processes > 0: if true, the DataLoaders' workers are
+            started once and kept alive for the whole training (one set of
+            workers for training, one for validation), instead of being
+            started again at every epoch. Each worker opens its hdf handle
+            once. In the main process, handles and the volume cache are
+            then also kept between epochs. Default: False.
+        prefetch_factor: int
+            With nb_cpu_processes > 0: number of batches loaded in advance by
+            each worker. Default: None (torch's default, 2).
         use_gpu: bool
             If true, use GPU device when possible instead of CPU.
             Default = False
         clip_grad : float
             The value to which to clip gradients after the backward pass.
             There is no good value here. Default: 1000.
+        precision: str
+            One of 'float32' (default), 'bfloat16' or 'float16' (GPU only).
+            With bfloat16 or float16, the forward pass and loss run under
+            torch.autocast (mixed precision). With float16, gradients are
+            scaled (torch's GradScaler). See
+            dwi_ml.experiment_utils.mixed_precision.
+        grad_accumulation_steps: int
+            Number of batches on which to accumulate gradients before updating
+            the parameters. The effective batch size is n times bigger, for
+            the memory cost of a single batch. Loss and gradient norms are
+            logged as usual (gradient norms: once per update). Default: 1.
+        activation_checkpointing: bool
+            If true, activations inside the recurrent layers (StackedRNN) or
+            the transformer's encoder / decoder layers are not kept in memory
+            during training; they are computed again during the backward pass.
+            Saves memory for ~30% more computation time. Default: False.
         comet_workspace: str
             Your comet workspace. See our docs/Getting Started for more
             information on comet and its API key. Default= None (comet.ml will
@@ -144,6 +178,9 @@ class DWIMLAbstractTrainer:
         self.space = 'vox'
         self.origin = 'corner'
         self.clip_grad = clip_grad
+        self.precision = precision
+        self.grad_accumulation_steps = grad_accumulation_steps
+        self.activation_checkpointing = activation_checkpointing
 
         # Learning rate:
         if learning_rates is None:
@@ -167,6 +204,14 @@ class DWIMLAbstractTrainer:
         if nb_cpu_processes == 1:
             nb_cpu_processes = 0
         self.nb_cpu_processes = nb_cpu_processes
+        if nb_cpu_processes == 0 and (persistent_workers or prefetch_factor):
+            logger.warning("Options persistent_workers and prefetch_factor "
+                           "are only used with parallel CPU workers. "
+                           "Ignored.")
+            persistent_workers = False
+            prefetch_factor = None
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
 
         # ----------------------
         # Instantiated classes given by the user
@@ -215,6 +260,9 @@ class DWIMLAbstractTrainer:
         if optimizer not in ['SGD', 'Adam', 'RAdam']:
             raise ValueError("Optimizer choice {} not recognized."
                              .format(optimizer))
+        if grad_accumulation_steps < 1:
+            raise ValueError("grad_accumulation_steps should be at least 1, "
+                             "but got {}.".format(grad_accumulation_steps))
 
         # ----------------
         # Create DataLoaders from the BatchSamplers
@@ -225,13 +273,24 @@ class DWIMLAbstractTrainer:
         #     dataloader output is on GPU, ready to be fed to the model.
         #     Otherwise, dataloader output is kept on CPU, and the main thread
         #     sends volumes and coords on GPU for interpolation.
+        #   * With parallel workers: each worker opens its own hdf handle
+        #     (worker_init_fn). With persistent workers, the batch loader's
+        #     context is fixed in each DataLoader's workers when they start
+        #     (in the first epoch): it is always the same for a given
+        #     DataLoader.
         logger.debug("- Instantiating dataloaders...")
+        workers_kw = {}
+        if self.nb_cpu_processes > 0:
+            workers_kw = {
+                'worker_init_fn': self.batch_loader.worker_init_fn,
+                'persistent_workers': self.persistent_workers,
+                'prefetch_factor': self.prefetch_factor}
         self.train_dataloader = DataLoader(
             dataset=self.batch_sampler.dataset.training_set,
             batch_sampler=self.batch_sampler,
             num_workers=self.nb_cpu_processes,
             collate_fn=self.batch_loader.load_batch_streamlines,
-            pin_memory=self.use_gpu)
+            pin_memory=self.use_gpu, **workers_kw)
         self.valid_dataloader = None
         if self.use_validation:
             self.valid_dataloader = DataLoader(
@@ -239,7 +298,9 @@ class DWIMLAbstractTrainer:
                 batch_sampler=self.batch_sampler,
                 num_workers=self.nb_cpu_processes,
                 collate_fn=self.batch_loader.load_batch_streamlines,
-                pin_memory=self.use_gpu)
+                pin_memory=self.use_gpu, **workers_kw)
+        # With persistent workers: contexts for which workers are running.
+        self._started_workers = set()
 
         # ----------------------
         # Evolving values. They will need to be updated if initialized from
@@ -262,6 +323,9 @@ class DWIMLAbstractTrainer:
         # overwrites the model. Must be done before launching the optimizer
         # (it needs to use the cuda tensors if using the GPU.)
         self.model.move_to(device=self.device)
+        check_precision(precision, self.device)
+        if activation_checkpointing:
+            self._set_activation_checkpointing()
 
         # B. Current epoch
         self.current_epoch = 0
@@ -272,6 +336,10 @@ class DWIMLAbstractTrainer:
         self.nb_batches_train = None
         self.nb_batches_valid = None
 
+        # Number of batches whose gradients are accumulated but not yet used
+        # to update the parameters.
+        self.nb_accumulated_batches = 0
+
         # D. Monitors
         # grad_norm = The total norm (sqrt(sum(params**2))) of parameters
         # before gradient clipping, if any.
@@ -310,6 +378,9 @@ class DWIMLAbstractTrainer:
         self.comet_exp = None
         self.comet_key = None
 
+        # Optional cache of validation batches (see DWIMLTrainerOneInput).
+        self.validation_cache = None  # type: ValidationInputsCache
+
         # ----------------------
         # F. Launching optimizer!
         # ----------------------
@@ -333,6 +404,10 @@ class DWIMLAbstractTrainer:
         self.optimizer = cls(self.model.parameters(),
                              weight_decay=weight_decay)
 
+        # With float16: scaling the loss to avoid underflow in gradients.
+        # Disabled (does nothing) otherwise.
+        self.grad_scaler = get_grad_scaler(precision, self.device)
+
     @property
     def params_for_checkpoint(self):
         """
@@ -352,8 +427,13 @@ class DWIMLAbstractTrainer:
             'max_batches_per_epoch_training': self.max_batches_per_epochs_train,
             'max_batches_per_epoch_validation': self.max_batches_per_epochs_valid,
             'nb_cpu_processes': self.nb_cpu_processes,
+            'persistent_workers': self.persistent_workers,
+            'prefetch_factor': self.prefetch_factor,
             'use_gpu': self.use_gpu,
             'clip_grad': self.clip_grad,
+            'precision': self.precision,
+            'grad_accumulation_steps': self.grad_accumulation_steps,
+            'activation_checkpointing': self.activation_checkpointing,
             'comet_workspace': self.comet_workspace,
             'comet_project': self.comet_project,
             'optimizer': self.optimizer_key,
@@ -436,6 +516,7 @@ class DWIMLAbstractTrainer:
             'comet_key': self.comet_key,
             # Optimizer
             'optimizer_state': self.optimizer.state_dict(),
+            'grad_scaler_state': self.grad_scaler.state_dict(),
         }
 
         # Monitors
@@ -535,6 +616,10 @@ class DWIMLAbstractTrainer:
 
         # E. Optimizer
         self.optimizer.load_state_dict(current_states['optimizer_state'])
+        # (Empty if the scaler was disabled. Older checkpoints: no state.)
+        if current_states.get('grad_scaler_state'):
+            self.grad_scaler.load_state_dict(
+                current_states['grad_scaler_state'])
 
         # F. Monitors
         for monitor in self.monitors:
@@ -779,21 +864,77 @@ class DWIMLAbstractTrainer:
     def _save_log_locally(self, array: np.ndarray, fname: str):
         np.save(os.path.join(self.log_dir, fname), array)
 
-    def _clear_handles(self):
+    def _clear_handles(self, drop_cache=True):
         """
         Trying to improve the handles management.
         Todo. Improve again. CPU multiprocessing fails because of handles
          management.
+
+        With persistent workers, this is only done before the workers start
+        (first epoch): afterwards, workers use their own handle, and the main
+        process keeps its handles and its volume cache.
         """
+        context = self.batch_sampler.context
+        if self.persistent_workers and context in self._started_workers:
+            return
+        if self.persistent_workers:
+            self._started_workers.add(context)
+
         # Make sure there are no existing HDF handles if using parallel workers
         if (self.nb_cpu_processes > 0 and
                 self.batch_sampler.context_subset.is_lazy):
             self.batch_sampler.context_subset.close_all_handles()
-            self.batch_sampler.context_subset.volume_cache_manager = None
+            if drop_cache:
+                self.batch_sampler.context_subset.volume_cache_manager = None
+
+    def _autocast(self):
+        return get_autocast_context(self.precision, self.device)
 
-    def back_propagation(self, loss):
+    def _set_activation_checkpointing(self):
+        """
+        Sets activation_checkpointing = True on all the model's sub-modules
+        supporting it (see StackedRNN and our transformer encoders /
+        decoders).
+        """
+        nb = 0
+        for module in self.model.modules():
+            if hasattr(module, 'activation_checkpointing'):
+                module.activation_checkpointing = True
+                nb += 1
+        if nb == 0:
+            logger.warning("Activation checkpointing is not supported by "
+                           "this model. Ignoring.")
+
+    def back_propagation(self, loss, update_now: bool = True):
+        """
+        Computes the gradients. Parameters are updated only if update_now
+        (with grad_accumulation_steps > 1, gradients of previous batches are
+        accumulated).
+
+        Returns the gradient norms (before and after fix_parameters) if
+        parameters were updated, else (None, None).
+        """
         logger.debug('*** Computing back propagation')
-        loss.backward()
+        # Gradients are summed over batches: averaging.
+        loss = loss / self.grad_accumulation_steps
+        self.grad_scaler.scale(loss).backward()
+        self.nb_accumulated_batches += 1
+
+        if not update_now:
+            return None, None
+        return self._update_parameters()
+
+    def _update_parameters(self):
+        # Gradients must be unscaled before clipping them.
+        self.grad_scaler.unscale_(self.optimizer)
+
+        # Last step of an epoch can have accumulated fewer batches.
+        if self.nb_accumulated_batches < self.grad_accumulation_steps:
+            factor = self.grad_accumulation_steps / self.nb_accumulated_batches
+            for p in self.model.parameters():
+                if p.grad is not None:
+                    p.grad.mul_(factor)
+        self.nb_accumulated_batches = 0
 
         # Any other steps. Ex: clip gradients. Not implemented here.
         # See Learn2track's Trainer for an example.
@@ -803,10 +944,9 @@ class DWIMLAbstractTrainer:
         grad_norm = compute_gradient_norm(self.model.parameters())
 
         # Update parameters
-        # Future work: We could update only every n steps.
-        #  Effective batch size is n time bigger.
-        #  See here https://towardsdatascience.com/optimize-pytorch-performance-for-speed-and-memory-efficiency-2022-84f453916ea6
-        self.optimizer.step()
+        # (With float16: skipped if gradients contain inf or NaN).
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
 
         # Reset parameter gradients to zero or to None before the next
         # forward pass
@@ -826,6 +966,7 @@ class DWIMLAbstractTrainer:
         self.batch_loader.set_context('training')
         self.batch_sampler.set_context('training')
         self.model.set_context('training')
+        self.batch_sampler.context_subset.reset_cache_stats()
 
         self._clear_handles()
         self.model.train()
@@ -853,23 +994,29 @@ class DWIMLAbstractTrainer:
                 # Enable gradients for backpropagation. Uses torch's module
                 # train(), which "turns on" the training mode.
                 torch_reset_peaks_memory()
-                with grad_context():
+                with grad_context(), self._autocast():
                     mean_loss = self.train_one_batch(data)
                 log_max_allocated(
                     logger_debug=logger,
                     context="During training (forward + compute loss)")
 
                 # ------------ Back propagation ---------
+                # With gradient accumulation: updating every n batches, and
+                # at the end of the epoch.
+                update_now = ((batch_id + 1) % self.grad_accumulation_steps
+                              == 0 or batch_id == self.nb_batches_train - 1)
                 torch_reset_peaks_memory()
                 unclipped_grad_norm, grad_norm = self.back_propagation(
-                    mean_loss)
+                    mean_loss, update_now)
                 log_max_allocated(
                     logger_debug=logger,
                     context="During training (backpropagation)")
 
                 # ------- Saving info
-                self.unclipped_grad_norm_monitor.update(unclipped_grad_norm)
-                self.grad_norm_monitor.update(grad_norm)
+                if update_now:
+                    self.unclipped_grad_norm_monitor.update(
+                        unclipped_grad_norm)
+                    self.grad_norm_monitor.update(grad_norm)
 
                 # Break if maximum number of batches has been reached
                 if batch_id == self.nb_batches_train - 1:
@@ -890,6 +1037,14 @@ class DWIMLAbstractTrainer:
             # running validation
             del train_iterator
 
+        # If the dataloader finished earlier than expected: using the
+        # remaining accumulated gradients. Checkpoints are saved at the end of
+        # the epoch: no gradient is ever left behind.
+        if self.nb_accumulated_batches > 0:
+            unclipped_grad_norm, grad_norm = self._update_parameters()
+            self.unclipped_grad_norm_monitor.update(unclipped_grad_norm)
+            self.grad_norm_monitor.update(grad_norm)
+
         # Saving epoch's information
         for monitor in self.training_monitors:
             monitor.end_epoch()
@@ -913,20 +1068,33 @@ class DWIMLAbstractTrainer:
         self.batch_sampler.set_context('validation')
         self.model.set_context('validation')
         self.model.eval()
+        self.batch_sampler.context_subset.reset_cache_stats()
 
         # Make sure there are no existing HDF handles if using parallel workers
-        if (self.nb_cpu_processes > 0 and
-                self.batch_sampler.context_subset.is_lazy):
-            self.batch_sampler.context_subset.close_all_handles()
+        self._clear_handles(drop_cache=False)
+
+        # With the validation cache: once filled, looping on the cached
+        # batches rather than sampling new ones.
+        use_cache = self.validation_cache is not None
+        if use_cache:
+            self.validation_cache.start_epoch()
+        if use_cache and self.validation_cache.is_complete:
+            batches = self.validation_cache
+        else:
+            batches = self.valid_dataloader
 
         # Validate all batches
-        with tqdm_logging_redirect(self.valid_dataloader, ncols=100,
+        with tqdm_logging_redirect(batches, ncols=100,
                                    total=self.nb_batches_valid,
                                    loggers=[logging.root],
                                    tqdm_class=tqdm) as pbar:
             valid_iterator = enumerate(pbar)
             for batch_id, data in valid_iterator:
                 logger.debug("\n\nStart of validation batch: ")
+                if use_cache:
+                    if not self.validation_cache.is_complete:
+                        self.validation_cache.add_batch(data)
+                    self.validation_cache.current_batch_id = batch_id
                 log_currently_allocated(
                     logger_debug=logger,
                     context="At the beginning of a validation batch")
@@ -934,7 +1102,7 @@ class DWIMLAbstractTrainer:
 
                 # ------ Forward pass + loss -------
                 torch_reset_peaks_memory()
-                with torch.no_grad():
+                with torch.no_grad(), self._autocast():
                     self.validate_one_batch(data, epoch)
                 log_max_allocated(
                     logger_debug=logger,
@@ -961,6 +1129,9 @@ class DWIMLAbstractTrainer:
             # running training again
             del valid_iterator
 
+        if use_cache:
+            self.validation_cache.end_epoch()
+
         # Save info
         for monitor in self.validation_monitors:
             monitor.end_epoch()
@@ -1010,6 +1181,14 @@ class DWIMLAbstractTrainer:
                         .format(monitor.name, value))
             logs.append((value, monitor.name))
 
+        # Lazy data: volume cache hit rate (see the batch sampler's
+        # cache_affinity option).
+        hit_rate = self.batch_sampler.context_subset.cache_hit_rate
+        if hit_rate is not None:
+            logger.info("   Volume cache hit rate for this epoch: {:.1f}%"
+                        .format(100 * hit_rate))
+            logs.append((hit_rate, 'volume_cache_hit_rate'))
+
         if self.comet_exp:
             # Comet context: will add train_(loss) or valid_(loss) to the
             # monitors name in comet.
@@ -1051,6 +1230,16 @@ class DWIMLAbstractTrainer:
             json_file.write(json.dumps(best_losses, indent=4,
                                        separators=(',', ': ')))
 
+    def _streamlines_to_device(self, streamlines: List[torch.Tensor]):
+        """
+        Sends the batch's streamlines to the device in a single transfer
+        rather than one by one. Returns views of the transferred data.
+        """
+        lengths = [len(s) for s in streamlines]
+        flat = torch.cat(streamlines).to(self.device, non_blocking=True,
+                                         dtype=torch.float)
+        return list(flat.split(lengths))
+
     def run_one_batch(self, data):
         """
         Runs a batch of data through the model (calling its forward method)
@@ -1072,8 +1261,7 @@ class DWIMLAbstractTrainer:
 
         # Dataloader always works on CPU. Sending to right device.
         # (model is already moved).
-        targets = [s.to(self.device, non_blocking=True, dtype=torch.float)
-                   for s in targets]
+        targets = self._streamlines_to_device(targets)
 
         # Uses the model's method, with the batch_loader's data.
         # Possibly skipping the last point if not useful.
@@ -1119,7 +1307,12 @@ class DWIMLAbstractTrainer:
             unclipped_grad_norm = compute_gradient_norm(
                 self.model.parameters())
         if torch.isnan(unclipped_grad_norm):
-            raise ValueError("Exploding gradients. Experiment failed.")
+            if self.grad_scaler.is_enabled():
+                # The scale was too big. GradScaler will skip this step and
+                # decrease the scale.
+                logger.debug("Gradients are not finite. Skipping step.")
+            else:
+                raise ValueError("Exploding gradients. Experiment failed.")
 
         return unclipped_grad_norm.cpu().numpy()
 
@@ -1175,6 +1368,51 @@ class DWIMLAbstractTrainer:
 class DWIMLTrainerOneInput(DWIMLAbstractTrainer):
     batch_loader: DWIMLBatchLoaderOneInput
 
+    def __init__(self, validation_cache_size: float = None,
+                 validation_cache_dir: str = None,
+                 cnn_volume_features: bool = False, *args, **kw):
+        """
+        Parameters
+        ----------
+        validation_cache_size: float
+            If set, validation batches are fixed after the first epoch, and
+            their interpolated inputs are cached, up to this size (in GB).
+            Validation epochs then become (mostly) pure forward passes. See
+            ValidationInputsCache. Default: None (no cache).
+        validation_cache_dir: str
+            If set, the validation inputs are saved as memory-mapped files in
+            this directory rather than in RAM. Prefer a local disk.
+        cnn_volume_features: bool
+            For models with a CNN embedding: during validation, run the CNN
+            once on each subject's volume and interpolate the features. See
+            ModelOneInputWithEmbedding.uses_cnn_volume_features.
+        """
+        super().__init__(*args, **kw)
+
+        self.cnn_volume_features = cnn_volume_features
+        if cnn_volume_features:
+            if not (isinstance(self.model, ModelOneInputWithEmbedding) and
+                    self.model.input_embedding_key == 'cnn_embedding'):
+                raise ValueError("Option cnn_volume_features can only be used "
+                                 "with a CNN input embedding.")
+            self.model.cnn_volume_features = True
+
+        self.validation_cache_size = validation_cache_size
+        self.validation_cache_dir = validation_cache_dir
+        if validation_cache_size and self.use_validation:
+            self.validation_cache = ValidationInputsCache(
+                validation_cache_size, validation_cache_dir)
+
+    @property
+    def params_for_checkpoint(self):
+        p = super().params_for_checkpoint
+        p.update({
+            'validation_cache_size': self.validation_cache_size,
+            'validation_cache_dir': self.validation_cache_dir,
+            'cnn_volume_features': self.cnn_volume_features,
+        })
+        return p
+
     def run_one_batch(self, data):
         """
         Run a batch of data through the model (calling its forward method)
@@ -1204,8 +1442,7 @@ class DWIMLTrainerOneInput(DWIMLAbstractTrainer):
 
         # Dataloader always works on CPU. Sending to right device.
         # (model is already moved).
-        targets = [s.to(self.device, non_blocking=True, dtype=torch.float)
-                   for s in targets]
+        targets = self._streamlines_to_device(targets)
 
         # Getting the inputs points from the volumes.
         # Uses the model's method, with the batch_loader's data.
@@ -1219,8 +1456,19 @@ class DWIMLTrainerOneInput(DWIMLAbstractTrainer):
 
         # Batch inputs is already the right length. Models don't need to
         # discard the last point if no EOS. Avoid interpolation for no reason.
-        batch_inputs = self.batch_loader.load_batch_inputs(
-            streamlines_f, ids_per_subj)
+        # During validation, inputs may be in the cache.
+        batch_inputs = None
+        use_cache = (self.validation_cache is not None and
+                     self.batch_loader.context == 'validation')
+        if use_cache:
+            batch_inputs = self.validation_cache.get_inputs(
+                self.validation_cache.current_batch_id, self.device)
+        if batch_inputs is None:
+            batch_inputs = self.batch_loader.load_batch_inputs(
+                streamlines_f, ids_per_subj)
+            if use_cache:
+                self.validation_cache.add_inputs(
+                    self.validation_cache.current_batch_id, batch_inputs)
 
         logger.debug('*** Computing forward propagation')
         # todo Possibly add noise to inputs here. Not ready
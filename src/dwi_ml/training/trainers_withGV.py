@@ -21,19 +21,18 @@ are:
 import logging
 from typing import List
 
-import h5py
 import numpy as np
 import torch
 from torch.nn import PairwiseDistance
 
 from dwi_ml.data.processing.streamlines.post_processing import \
-    compute_triu_connectivity_from_blocs, compute_triu_connectivity_from_labels
+    compute_triu_connections_from_blocs, compute_triu_connections_from_labels
 from dwi_ml.experiment_utils.memory import BYTES_IN_GB
 from dwi_ml.models.main_models import ModelWithDirectionGetter
 from dwi_ml.tracking.propagation import propagate_multiple_lines
-from dwi_ml.tracking.io_utils import prepare_tracking_mask
 from dwi_ml.training.batch_loaders import DWIMLBatchLoaderOneInput
 from dwi_ml.training.trainers import DWIMLTrainerOneInput
+from dwi_ml.training.utils.gv_resource_cache import GVResourceCache
 from dwi_ml.training.utils.monitoring import BatchHistoryMonitor
 
 logger = logging.getLogger('train_logger')
@@ -46,7 +45,8 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
     def __init__(self, add_a_tracking_validation_phase: bool = False,
                  tracking_phase_frequency: int = 1,
                  tracking_phase_nb_segments_init: int = 5,
-                 tracking_phase_mask_group: str = None, *args, **kw):
+                 tracking_phase_mask_group: str = None,
+                 tracking_phase_cache_size: int = 10, *args, **kw):
         """
         Parameters
         ----------
@@ -68,6 +68,10 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
             metrics. Adding 0 : only the seed point is kept.
         tracking_phase_mask_group: str
             Name of the volume group to use as tracking mask.
+        tracking_phase_cache_size: int
+            Number of validation subjects for which the tracking mask and
+            reference connectivity matrix are kept in memory (masks on the
+            device) between batches and epochs. Default: 10.
         """
         super().__init__(*args, **kw)
 
@@ -78,6 +82,9 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
                              "validation phase cannot be negative.")
         self.tracking_phase_nb_segments_init = tracking_phase_nb_segments_init
         self.tracking_mask_group = tracking_phase_mask_group
+        self.tracking_phase_cache_size = tracking_phase_cache_size
+        self.gv_resources = GVResourceCache(tracking_phase_cache_size,
+                                            self.device)
 
         self.compute_connectivity = self.batch_loader.data_contains_connectivity
 
@@ -113,6 +120,7 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
             'tracking_phase_frequency': self.tracking_phase_frequency,
             'tracking_phase_nb_segments_init': self.tracking_phase_nb_segments_init,
             'tracking_phase_mask_group': self.tracking_mask_group,
+            'tracking_phase_cache_size': self.tracking_phase_cache_size,
         })
 
         return p
@@ -219,46 +227,34 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
         compares with expected values for the subject.
         """
         if self.compute_connectivity:
-            # toDo. See if it's too much to keep them all in memory. Could be
-            #  done in the loop for each subject.
-            (connectivity_matrices, volume_sizes,
-             connectivity_nb_blocs, connectivity_labels) = \
-                self.batch_loader.load_batch_connectivity_matrices(
-                    ids_per_subj)
-
+            subset = self.batch_loader.context_subset
             score = 0.0
-            for i, subj in enumerate(ids_per_subj.keys()):
-                real_matrix = connectivity_matrices[i]
-                volume_size = volume_sizes[i]
-                nb_blocs = connectivity_nb_blocs[i]
-                labels = connectivity_labels[i]
-                _lines = lines[ids_per_subj[subj]]
-
-                # Move to cpu, numpy now.
-                _lines = [line.cpu().numpy() for line in _lines]
-
-                # Reference matrices are saved as binary in create_hdf5,
-                # but still. Ensuring.
-                real_matrix = real_matrix > 0
-
-                # But our matrix here won't be!
+            for subj, line_ids in ids_per_subj.items():
+                real_matrix, volume_size, nb_blocs, labels, real_labels = \
+                    self.gv_resources.get_connectivity(
+                        subset, subj, self.batch_loader.streamline_group_idx)
+                _lines = lines[line_ids]
+
+                # Our matrix here is never built: we only need, for each
+                # line, its position in the (triangular) matrix.
                 if nb_blocs is not None:
-                    batch_matrix, _, _ = compute_triu_connectivity_from_blocs(
+                    matrix_size = np.prod(nb_blocs)
+                    rows, cols = compute_triu_connections_from_blocs(
                         _lines, volume_size, nb_blocs)
                 else:
                     # Note: scilpy usage not ready! Simple endpoints position
                     # Note: uses streamlines in vox space, corner origin
-                    batch_matrix, _, _, _ =\
-                        compute_triu_connectivity_from_labels(
-                            _lines, labels, use_scilpy=False)
+                    matrix_size = len(real_labels)
+                    rows, cols = compute_triu_connections_from_labels(
+                        _lines, labels, real_labels)
 
-                if batch_matrix.shape[0] != real_matrix.shape[0]:
+                if matrix_size != real_matrix.shape[0]:
                     raise ValueError(
                         "You do not seem to be using the same labels ({} "
                         "labels) for the connectivity matrix as what used to "
                         "compute the reference connectivity matrices in the "
                         "hdf5 (nb rows: {})."
-                        .format(batch_matrix[0].shape, real_matrix.shape[0]))
+                        .format(matrix_size, real_matrix.shape[0]))
 
                 # Where our batch has a 0: not important, maybe it was simply
                 # not in this batch.
@@ -267,9 +263,10 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
                 # Else, score should be high (1).  = 1 - 0 = 1 - real
                 # If two streamlines have the same connection, score is
                 # either 0 or 2 for that voxel.  ==> nb * (1 - real).
-                where_one = np.where(batch_matrix > 0)
-                score += np.sum(batch_matrix[where_one] *
-                                (1.0 - real_matrix[where_one]))
+                # Summing over lines: the number of lines not ending in a
+                # real connection.
+                real = np.asarray(real_matrix[rows, cols]).ravel()
+                score += np.sum(~real)
 
             # Average for batch
             score = score / len(lines)
@@ -277,21 +274,66 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
             score = None
         return score
 
+    def prepare_batch_tracking_mask(self, lines: List[torch.Tensor],
+                                    ids_per_subj):
+        """
+        Stacks the tracking masks of the batch's subjects (see
+        TrackingMask.stack), to propagate all lines together. Stacked masks
+        are kept in the GV resource cache.
+
+        Returns
+        -------
+        mask: TrackingMask
+            The stacked mask.
+        lines_subj_nb: np.ndarray
+            For each line, the index of its subject in the mask, i.e. in
+            ids_per_subj.keys(). Lines are expected to be grouped by subject,
+            in the same order.
+        """
+        subset = self.batch_loader.context_subset
+        mask = self.gv_resources.get_stacked_tracking_mask(
+            subset, list(ids_per_subj.keys()), self.tracking_mask_group)
+        nb_lines_per_subj = [len(lines[line_idx])
+                             for line_idx in ids_per_subj.values()]
+        lines_subj_nb = np.repeat(np.arange(len(ids_per_subj)),
+                                  nb_lines_per_subj)
+        return mask, lines_subj_nb
+
+    @staticmethod
+    def get_remaining_ids_per_subj(batch_subjs: List[int],
+                                   lines_subj_nb: np.ndarray):
+        """
+        During propagation, lines are removed from the batch. Returns the new
+        ids_per_subj of the remaining lines, given the index (in batch_subjs)
+        of each line's subject.
+        """
+        counts = np.bincount(lines_subj_nb, minlength=len(batch_subjs))
+        ends = np.cumsum(counts)
+        return {subj: slice(end - count, end) for subj, count, end
+                in zip(batch_subjs, counts, ends) if count > 0}
+
     def propagate_multiple_lines(self, lines: List[torch.Tensor],
                                  ids_per_subj):
         """
-        Tractography propagation of 'lines'.
+        Tractography propagation of 'lines'. Lines of all subjects are
+        propagated together, with a stacked tracking mask.
         """
         assert self.model.step_size is not None, \
             "We can't propagate compressed streamlines."
 
-        def update_memory_after_removing_lines(_, __):
-            pass
+        batch_subjs = list(ids_per_subj.keys())
+        tracking_mask, lines_subj_nb = self.prepare_batch_tracking_mask(
+            lines, ids_per_subj)
+
+        def update_memory_after_removing_lines(can_continue: np.ndarray, _):
+            nonlocal lines_subj_nb
+            lines_subj_nb = lines_subj_nb[can_continue]
 
         def get_dirs_at_last_pos(_lines: List[torch.Tensor], n_last_pos):
             n_last_pos = [pos[None, :] for pos in n_last_pos]
             batch_inputs = self.batch_loader.load_batch_inputs(
-                n_last_pos, ids_per_subj)
+                n_last_pos,
+                self.get_remaining_ids_per_subj(batch_subjs, lines_subj_nb))
 
             model_outputs = self.model(batch_inputs, n_last_pos)
 
@@ -302,29 +344,11 @@ class DWIMLTrainerForTrackingOneInput(DWIMLTrainerOneInput):
         theta = 2 * np.pi  # theta = 360 degrees
         max_nbr_pts = int(200 / self.model.step_size)
 
-        # Looping on subjects because current implementation requires a single
-        # tracking mask. But all the rest (get_dirs_at_last_pos, particularly)
-        # work on multiple subjects because the batch loader loads input
-        # according to subject id. Could refactor "propagate_multiple_line" to
-        # accept multiple masks or manage it differently.
-        final_lines = []
-        for subj_idx, line_idx in ids_per_subj.items():
-            with h5py.File(self.batch_loader.dataset.hdf5_file, 'r'
-                           ) as hdf_handle:
-                subj_id = self.batch_loader.context_subset.subjects[subj_idx]
-                logging.debug("Loading subj {} ({})'s tracking mask."
-                              .format(subj_idx, subj_id))
-                tracking_mask, _ = prepare_tracking_mask(
-                    hdf_handle, self.tracking_mask_group, subj_id=subj_id,
-                    mask_interp='nearest')
-                tracking_mask.move_to(self.device)
-
-            final_lines.extend(propagate_multiple_lines(
-                lines[line_idx], update_memory_after_removing_lines,
-                get_dirs_at_last_pos, theta=theta,
-                step_size=self.model.step_size,
-                verify_opposite_direction=False,
-                mask=tracking_mask, max_nbr_pts=max_nbr_pts,
-                append_last_point=False, normalize_directions=True))
-
-        return final_lines
+        return propagate_multiple_lines(
+            lines, update_memory_after_removing_lines,
+            get_dirs_at_last_pos, theta=theta,
+            step_size=self.model.step_size,
+            verify_opposite_direction=False,
+            mask=tracking_mask, max_nbr_pts=max_nbr_pts,
+            append_last_point=False, normalize_directions=True,
+            lines_subj_idx=torch.as_tensor(lines_subj_nb, device=self.device))
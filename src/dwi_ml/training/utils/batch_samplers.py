@@ -18,6 +18,13 @@ def add_args_batch_sampler(p: argparse.ArgumentParser):
     g_batch_size.add_argument(
         '--batch_size_validation', type=int, default=100, metavar='s',
         help="Idem; batch size during validation.")
+    g_batch_size.add_argument(
+        '--auto_batch_size', type=float, metavar='GB',
+        help="If set, the training batch size is chosen automatically before "
+             "training: the \nlargest size (in batch_size_units) for which "
+             "a training step on the longest \nstreamlines fits in this "
+             "memory budget. The search starts from \n"
+             "batch_size_training.")
     g_batch_size.add_argument(
         '--batch_size_units', type=str, metavar='u', default='nb_streamlines',
         choices={'nb_streamlines', 'length_mm'},
@@ -40,7 +47,15 @@ def add_args_batch_sampler(p: argparse.ArgumentParser):
         '--cycles', type=int, metavar='c',
         help="Relevant only if nb_subject_per_batch is set. Number of cycles "
              "before changing \nto new subjects (and thus loading new "
-             "volumes).")
+             "volumes). With --cache_affinity: number \nof batches before "
+             "replacing a subject of the working set (default: when \nit "
+             "has no streamlines left).")
+    g_batch_size.add_argument(
+        '--cache_affinity', action='store_true',
+        help="With lazy data: sample batches from a working set of "
+             "cache_size subjects \n(whose volumes stay in the cache), "
+             "replacing a subject once all its \nstreamlines are used. The "
+             "volume cache hit rate is logged at each epoch.")
 
 
 def prepare_batch_sampler(dataset, args, sub_loggers_level):
@@ -52,7 +67,7 @@ def prepare_batch_sampler(dataset, args, sub_loggers_level):
             batch_size_units=args.batch_size_units,
             nb_streamlines_per_chunk=args.nb_streamlines_per_chunk,
             nb_subjects_per_batch=args.nb_subjects_per_batch,
-            cycles=args.cycles,
+            cycles=args.cycles, cache_affinity=args.cache_affinity,
             rng=args.rng, log_level=sub_loggers_level)
 
     return batch_sampler
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Automatic choice of the training batch size, given a memory budget.
+
+Before training, we run one forward + backward pass on worst-case batches
+(the longest streamlines of the training set, with the model's complete
+input, including the neighborhood) of increasing sizes, and keep the largest
+size that fits in the budget.
+
+Memory used by a training step:
+    - On GPU: torch's peak allocated memory (model, optimizer states,
+      activations and temporary tensors).
+    - On CPU: torch does not track its allocations. We measure the tensors
+      saved for the backward pass (i.e. the activations, which grow with the
+      batch size), and add the model's parameters, their gradients and the
+      optimizer's states. Temporary tensors are not counted: keep a margin.
+"""
+import logging
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from dwi_ml.experiment_utils.memory import BYTES_IN_GB
+
+logger = logging.getLogger('train_logger')
+
+# Maximum number of forward / backward passes during the search.
+MAX_NB_TRIALS = 12
+# Stopping when the interval between a batch size that fits and one that
+# does not fit is smaller than this ratio.
+TOLERANCE = 0.05
+
+
+def get_worst_case_batch(subset, streamline_group_idx: int, batch_size: int,
+                         batch_size_units: str) -> List[Tuple[int, list]]:
+    """
+    Chooses the longest streamlines of the subset, up to batch_size.
+
+    Returns
+    -------
+    batch_ids_per_subj: list[(int, list)]
+        Same format as the output of the batch sampler: for each subject, the
+        list of relative streamline ids.
+    """
+    lengths = subset.streamline_lengths_mm[streamline_group_idx]
+    order = np.argsort(lengths)[::-1]
+    if batch_size_units == 'nb_streamlines':
+        chosen = order[:batch_size]
+    else:
+        cumulative_sum = np.cumsum(lengths[order])
+        chosen = order[:max(1, np.count_nonzero(cumulative_sum <= batch_size))]
+
+    batch_ids_per_subj = []
+    ids_per_subj = subset.streamline_ids_per_subj[streamline_group_idx]
+    for subj, subj_slice in ids_per_subj.items():
+        subj_ids = chosen[(chosen >= subj_slice.start) &
+                          (chosen < subj_slice.stop)]
+        if len(subj_ids) > 0:
+            batch_ids_per_subj.append(
+                (subj, list(np.sort(subj_ids) - subj_slice.start)))
+    return batch_ids_per_subj
+
+
+def _optimizer_states_size(trainer):
+    params_size = sum(p.numel() * p.element_size()
+                      for p in trainer.model.parameters() if p.requires_grad)
+    # Adam and RAdam: two states per parameter. SGD (no momentum): none.
+    nb_states = 0 if trainer.optimizer_key == 'SGD' else 2
+    return params_size, params_size * (1 + nb_states)
+
+
+def measure_training_step_memory(trainer, batch_ids_per_subj) -> int:
+    """
+    Runs the forward pass and the backward pass on the given batch (without
+    updating the parameters). Returns the memory used, in bytes, or None if
+    the GPU ran out of memory.
+    """
+    data = trainer.batch_loader.load_batch_streamlines(batch_ids_per_subj)
+    use_cuda = trainer.device.type == 'cuda'
+
+    saved_size = [0]
+
+    def _pack(t):
+        saved_size[0] += t.numel() * t.element_size()
+        return t
+
+    try:
+        if use_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        with torch.enable_grad(), trainer._autocast(), \
+                torch.autograd.graph.saved_tensors_hooks(_pack, lambda t: t):
+            loss, _ = trainer.run_one_batch(data)
+        trainer.grad_scaler.scale(loss).backward()
+        del loss
+        if use_cuda:
+            # Optimizer states are allocated at the first step.
+            _, states_size = _optimizer_states_size(trainer)
+            size = torch.cuda.max_memory_allocated() + states_size
+        else:
+            params_size, states_size = _optimizer_states_size(trainer)
+            size = saved_size[0] + params_size + states_size
+    except torch.cuda.OutOfMemoryError:
+        size = None
+    finally:
+        trainer.model.zero_grad(set_to_none=True)
+        if use_cuda:
+            torch.cuda.empty_cache()
+    return size
+
+
+def tune_batch_size(trainer, memory_budget_gb: float) -> int:
+    """
+    Finds the largest training batch size (in the batch sampler's units)
+    fitting in the memory budget, and sets it in the batch sampler. It is
+    then saved with the batch sampler's parameters in the checkpoints:
+    resumed experiments use the same value.
+
+    The search starts from the current batch size, doubles (or halves) it
+    until the limit is crossed, then bisects.
+
+    Parameters
+    ----------
+    trainer: DWIMLAbstractTrainer
+        Instantiated trainer (with its model, batch sampler and loader).
+    memory_budget_gb: float
+        Maximal memory for one training step, in GB.
+
+    Returns
+    -------
+    batch_size: int
+        The chosen batch size.
+    """
+    budget = memory_budget_gb * BYTES_IN_GB
+    sampler = trainer.batch_sampler
+    group = sampler.streamline_group_idx
+    subset = sampler.dataset.training_set
+    if sampler.batch_size_units == 'nb_streamlines':
+        max_size = int(subset.total_nb_streamlines[group])
+    else:
+        max_size = int(np.ceil(np.sum(subset.streamline_lengths_mm[group])))
+
+    trainer.batch_loader.set_context('training')
+    sampler.set_context('training')
+    trainer.model.set_context('training')
+    trainer.model.train()
+
+    memory_per_size = {}
+
+    def _fits(size):
+        batch = get_worst_case_batch(subset, group, size,
+                                     sampler.batch_size_units)
+        memory = measure_training_step_memory(trainer, batch)
+        memory_per_size[size] = memory
+        logger.info("Batch size tuning: batch size {} ({}): {}"
+                    .format(size, sampler.batch_size_units,
+                            'out of memory' if memory is None else
+                            '{:.3f} GB'.format(memory / BYTES_IN_GB)))
+        return memory is not None and memory <= budget
+
+    # Finding an interval [fits, does not fit].
+    size = min(max(1, sampler.batch_size_training), max_size)
+    if _fits(size):
+        low, high = size, None
+        while high is None and low < max_size and \
+                len(memory_per_size) < MAX_NB_TRIALS:
+            size = min(2 * low, max_size)
+            if _fits(size):
+                low = size
+            else:
+                high = size
+    else:
+        low, high = None, size
+        while low is None and high > 1 and \
+                len(memory_per_size) < MAX_NB_TRIALS:
+            size = high // 2
+            if _fits(size):
+                low = size
+            else:
+                high = size
+        if low is None:
+            raise ValueError("Batch size tuning: even the smallest batch "
+                             "does not fit in {} GB.".format(memory_budget_gb))
+
+    # Bisection.
+    while high is not None and high - low > max(1, TOLERANCE * low) and \
+            len(memory_per_size) < MAX_NB_TRIALS:
+        size = (low + high) // 2
+        if _fits(size):
+            low = size
+        else:
+            high = size
+
+    logger.info("Batch size tuning: using a training batch size of {} ({}), "
+                "for an estimated {:.3f} GB per training step (budget: {} "
+                "GB)".format(low, sampler.batch_size_units,
+                             memory_per_size[low] / BYTES_IN_GB,
+                             memory_budget_gb))
+    sampler.batch_size_training = low
+    sampler.context_batch_size = low
+    return low
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Per-subject resources of the generation-validation (GV) phase: tracking masks
+and reference connectivity matrices. They are loaded from the hdf5 the first
+time a subject is seen in a validation batch, and kept for the next batches
+and epochs.
+"""
+import logging
+from typing import List
+
+import h5py
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from dwi_ml.cache.cache_manager import SingleThreadCacheManager
+from dwi_ml.data.dataset.multi_subject_containers import MultisubjectSubset
+from dwi_ml.tracking.io_utils import prepare_tracking_mask
+from dwi_ml.tracking.tracking_mask import TrackingMask
+
+logger = logging.getLogger('train_logger')
+
+
+class GVResourceCache:
+    """
+    Keeps, for at most max_nb_subjects subjects (least recently used first
+    removed):
+        - Their tracking mask, as a bool tensor on the device.
+        - The masks of the last group of subjects seen together in a batch,
+          stacked (see TrackingMask.stack). Only the last stack is kept:
+          random batches rarely repeat a group of subjects, and each stack
+          is a padded copy of the subjects' masks.
+        - Their reference connectivity matrix, as a sparse binary matrix, with
+          the information required to compute the batch's connections.
+
+    The cache is emptied when the subset changes (ex, the dataset is
+    reloaded).
+    """
+    def __init__(self, max_nb_subjects: int, device):
+        """
+        Parameters
+        ----------
+        max_nb_subjects: int
+            Maximal number of subjects for which resources are kept.
+        device: torch.device
+            Device on which masks are kept.
+        """
+        if max_nb_subjects < 1:
+            raise ValueError("The GV resource cache must be able to contain "
+                             "at least one subject, got {}."
+                             .format(max_nb_subjects))
+        self.max_nb_subjects = max_nb_subjects
+        self.device = device
+        self.masks = SingleThreadCacheManager(max_nb_subjects)
+        self.stacked_masks = SingleThreadCacheManager(1)
+        self.connectivity = SingleThreadCacheManager(max_nb_subjects)
+        self._subset = None
+
+    def _verify_subset(self, subset: MultisubjectSubset):
+        if subset is not self._subset:
+            if self._subset is not None:
+                logger.debug("Subset changed: emptying the GV resources.")
+            self.masks.empty_cache()
+            self.stacked_masks.empty_cache()
+            self.connectivity.empty_cache()
+            self._subset = subset
+
+    def get_tracking_mask(self, subset: MultisubjectSubset, subj_idx: int,
+                          mask_group: str) -> TrackingMask:
+        self._verify_subset(subset)
+        if subj_idx in self.masks:
+            return self.masks[subj_idx]
+
+        subj_id = subset.subjects[subj_idx]
+        logger.debug("Loading subj {} ({})'s tracking mask."
+                     .format(subj_idx, subj_id))
+        with h5py.File(subset.hdf5_file, 'r') as hdf_handle:
+            mask, _ = prepare_tracking_mask(hdf_handle, mask_group,
+                                            subj_id=subj_id,
+                                            mask_interp='nearest')
+        mask.move_to(self.device)
+        self.masks[subj_idx] = mask
+        return mask
+
+    def get_stacked_tracking_mask(self, subset: MultisubjectSubset,
+                                  subj_idxs: List[int],
+                                  mask_group: str) -> TrackingMask:
+        """
+        Returns the stacked tracking masks of subjects subj_idxs, in that
+        order. Stacking allocates and copies a padded mask: it is not done
+        again if the group is the same as in the last call.
+        """
+        self._verify_subset(subset)
+        key = tuple(subj_idxs)
+        if key in self.stacked_masks:
+            return self.stacked_masks[key]
+
+        mask = TrackingMask.stack([
+            self.get_tracking_mask(subset, subj_idx, mask_group)
+            for subj_idx in subj_idxs])
+        self.stacked_masks[key] = mask
+        return mask
+
+    def get_connectivity(self, subset: MultisubjectSubset, subj_idx: int,
+                         streamline_group_idx: int):
+        """
+        Returns
+        -------
+        matrix: scipy.sparse.csr_matrix
+            The binary reference connectivity matrix.
+        volume_size: np.ndarray
+            The reference volume's shape (for connectivity from blocs).
+        nb_blocs: list or None
+            The number of blocs (for connectivity from blocs).
+        labels: np.ndarray or None
+            The labels volume (for connectivity from labels).
+        real_labels: np.ndarray or None
+            The sorted unique labels.
+        """
+        self._verify_subset(subset)
+        if subj_idx in self.connectivity:
+            return self.connectivity[subj_idx]
+
+        subj_data = subset.subjs_data_list.get_subj_with_handle(subj_idx)
+        sft_data = subj_data.sft_data_list[streamline_group_idx]
+        matrix, volume_size, nb_blocs, labels = \
+            sft_data.get_connectivity_matrix_and_info()
+
+        # Reference matrices are saved as binary in create_hdf5, but still.
+        # Ensuring.
+        matrix = csr_matrix(np.asarray(matrix) > 0)
+        real_labels = np.unique(labels) if labels is not None else None
+        resources = (matrix, volume_size, nb_blocs, labels, real_labels)
+        self.connectivity[subj_idx] = resources
+        return resources
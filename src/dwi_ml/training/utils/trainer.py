@@ -9,7 +9,8 @@ logger = logging.getLogger('train_logger')
 
 
 def add_training_args(p: argparse.ArgumentParser,
-                      add_a_tracking_validation_phase=False):
+                      add_a_tracking_validation_phase=False,
+                      add_validation_cache=False):
     training_group = p.add_argument_group("Training")
     training_group.add_argument(
         '--learning_rate', metavar='r', nargs='+',
@@ -50,6 +51,16 @@ def add_training_args(p: argparse.ArgumentParser,
         '--clip_grad', type=float, default=None,
         help="Value to which the gradient norms to avoid exploding gradients."
              "\nDefault = None (not clipping).")
+    training_group.add_argument(
+        '--grad_accumulation_steps', type=int, default=1, metavar='n',
+        help="Accumulate gradients over n batches before updating the "
+             "parameters. The \neffective batch size is n times bigger, for "
+             "the memory cost of one batch. [1]")
+    training_group.add_argument(
+        '--activation_checkpointing', action='store_true',
+        help="Do not keep the activations of the recurrent / transformer "
+             "layers in memory; \ncompute them again during the backward "
+             "pass. Saves memory, but is slower.")
 
     if add_a_tracking_validation_phase:
         training_group.add_argument(
@@ -69,6 +80,29 @@ def add_training_args(p: argparse.ArgumentParser,
             help="Number of segments copied from the 'real' validation "
                  "streamlines before starting \npropagation during GV phases "
                  "[1].")
+        training_group.add_argument(
+            '--tracking_phase_cache_size', type=int, default=10, metavar='n',
+            help="Number of validation subjects for which the tracking mask "
+                 "and reference \nconnectivity matrix are kept in memory "
+                 "during GV phases [10].")
+
+    if add_validation_cache:
+        training_group.add_argument(
+            '--validation_cache_size', type=float, metavar='GB',
+            help="If set, validation batches are fixed after the first epoch "
+                 "and their \ninterpolated inputs are cached (up to this "
+                 "size, in GB) for the next epochs.")
+        training_group.add_argument(
+            '--validation_cache_dir', metavar='dir',
+            help="With --validation_cache_size: save the cached inputs as "
+                 "memory-mapped \nfiles in this directory (ex: a local disk) "
+                 "rather than in RAM.")
+        training_group.add_argument(
+            '--cnn_volume_features', action='store_true',
+            help="For models with a CNN input embedding: during validation, "
+                 "run the CNN once \non each subject's volume and "
+                 "interpolate the features. Exact with one CNN \nlayer; "
+                 "approximate with more.")
 
     comet_g = p.add_argument_group("Comet")
     comet_g.add_argument(
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import tempfile
+from typing import List
+
+import numpy as np
+import torch
+
+logger = logging.getLogger('train_logger')
+
+
+class ValidationInputsCache:
+    """
+    Cross-epoch cache of the validation batches and of their interpolated
+    inputs.
+
+    During validation, there is no noise. If we also use the same batches at
+    every epoch, the interpolated inputs do not change from one epoch to the
+    next. The first validation epoch fills the cache: it remembers every
+    batch (streamlines, after data augmentation, and their subject ids), and
+    their interpolated inputs as long as the size budget allows it. Following
+    epochs loop on the cached batches instead of sampling new ones. Cached
+    inputs are then used directly; only batches that did not fit in the
+    budget are interpolated again.
+
+    Inputs are kept in RAM or, if a directory is given, in memory-mapped
+    files in that directory (preferably on a fast local disk).
+    """
+    def __init__(self, max_size_gb: float, cache_dir: str = None):
+        """
+        Parameters
+        ----------
+        max_size_gb: float
+            Maximal size of the cached inputs, in GB. Streamlines are always
+            kept (they are small compared to the inputs, which include the
+            neighborhood).
+        cache_dir: str
+            If given, inputs are saved in memory-mapped files in a temporary
+            sub-directory of cache_dir instead of being kept in RAM.
+        """
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.cache_dir = cache_dir
+
+        self._tmp_dir = None
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                raise NotADirectoryError(
+                    "Validation cache directory does not exist: {}"
+                    .format(cache_dir))
+            self._tmp_dir = tempfile.TemporaryDirectory(
+                dir=cache_dir, prefix='dwiml_validation_cache_')
+
+        self.is_complete = False
+        self.current_size = 0
+        self._batches = []  # type: List[tuple]
+        self._inputs = []  # List of (flat inputs, lengths) or None.
+
+        # Set by the trainer before each batch.
+        self.current_batch_id = None
+
+        # Statistics for the current epoch.
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def start_epoch(self):
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def end_epoch(self):
+        if len(self._batches) > 0:
+            self.is_complete = True
+        logger.info("Validation inputs cache: {} batches, {} with cached "
+                    "inputs ({:.2f} GB). Hits this epoch: {}. Misses: {}."
+                    .format(len(self._batches),
+                            sum(i is not None for i in self._inputs),
+                            self.current_size / 1024 ** 3,
+                            self.nb_hits, self.nb_misses))
+
+    def add_batch(self, data):
+        """
+        Remembers a batch (output of the batch loader). Returns its id in the
+        cache.
+        """
+        targets, ids_per_subj = data
+        targets = [s.cpu() for s in targets]
+        self._batches.append((targets, dict(ids_per_subj)))
+        self._inputs.append(None)
+        return len(self._batches) - 1
+
+    def get_inputs(self, batch_id: int, device):
+        """
+        Returns the cached inputs for this batch (list of tensors, one per
+        streamline), or None.
+        """
+        if self._inputs[batch_id] is None:
+            self.nb_misses += 1
+            return None
+
+        self.nb_hits += 1
+        flat_inputs, lengths = self._inputs[batch_id]
+        flat_inputs = torch.from_numpy(np.asarray(flat_inputs)).to(device)
+        return list(flat_inputs.split(lengths))
+
+    def add_inputs(self, batch_id: int, batch_inputs: List[torch.Tensor]):
+        """
+        Saves the inputs of this batch, if the budget allows it.
+        """
+        lengths = [len(x) for x in batch_inputs]
+        flat_inputs = torch.cat(batch_inputs, dim=0).cpu().numpy()
+        size = flat_inputs.nbytes
+        if self.current_size + size > self.max_size:
+            return
+
+        if self._tmp_dir is not None:
+            filename = os.path.join(self._tmp_dir.name,
+                                    'batch_{}.dat'.format(batch_id))
+            cached = np.memmap(filename, dtype=flat_inputs.dtype, mode='w+',
+                               shape=flat_inputs.shape)
+            cached[:] = flat_inputs
+            cached.flush()
+            flat_inputs = cached
+
+        self._inputs[batch_id] = (flat_inputs, lengths)
+        self.current_size += size
+
+    def clear(self):
+        self._batches = []
+        self._inputs = []
+        self.current_size = 0
+        self.is_complete = False
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = tempfile.TemporaryDirectory(
+                dir=self.cache_dir, prefix='dwiml_validation_cache_')
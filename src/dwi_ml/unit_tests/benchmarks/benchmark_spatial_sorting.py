@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the trilinear interpolation of a volume at many points,
+in random order vs sorted along a Z-order curve (see the trackers' option
+spatial_sorting). Not run by pytest. Usage:
+    python benchmark_spatial_sorting.py [device]
+"""
+import sys
+import time
+
+import numpy as np
+import torch
+
+from dwi_ml.data.processing.volume.interpolation import \
+    torch_trilinear_interpolation
+from dwi_ml.tracking.utils import morton_order
+
+VOLUME_SHAPE = (128, 128, 128)
+NB_FEATURES = [1, 28]
+NB_POINTS = [10000, 100000]
+
+
+def _timeit(func, nb_repeats=10):
+    func()  # Warm-up
+    start = time.time()
+    for _ in range(nb_repeats):
+        func()
+    return (time.time() - start) / nb_repeats
+
+
+def main():
+    device = torch.device(sys.argv[1] if len(sys.argv) > 1 else 'cpu')
+    rng = np.random.RandomState(0)
+    for nb_features in NB_FEATURES:
+        volume = torch.rand(*VOLUME_SHAPE, nb_features, device=device)
+        for nb_points in NB_POINTS:
+            coords = rng.uniform(0, VOLUME_SHAPE[0] - 1, size=(nb_points, 3))
+            t_sort = _timeit(lambda: morton_order(coords))
+            sorted_coords = coords[morton_order(coords)]
+
+            times = []
+            for c in [coords, sorted_coords]:
+                c = torch.as_tensor(c, dtype=torch.float, device=device)
+                times.append(_timeit(lambda: torch_trilinear_interpolation(
+                    volume, c, clear_cache=False)))
+            print("{} features, {} points: random order {:.1f} M points/s, "
+                  "Z-order {:.1f} M points/s (sorting: {:.1f} ms)"
+                  .format(nb_features, nb_points,
+                          nb_points / times[0] / 1e6,
+                          nb_points / times[1] / 1e6, t_sort * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the transformer's masks during tracking, with thousands
+of simultaneous lines. Not run by pytest. Usage:
+    python benchmark_transformer_masks.py [device]
+"""
+import sys
+import time
+
+import numpy as np
+import torch
+
+from dwi_ml.models.projects.transformer_models import TransformerSrcOnlyModel
+
+NB_LINES = [1000, 5000]
+LENGTHS = [1, 32]
+MAX_LEN = 256
+NB_FEATURES = 32
+
+
+def _timeit(func, nb_repeats=20):
+    func()  # Warm-up
+    start = time.time()
+    for _ in range(nb_repeats):
+        func()
+    return (time.time() - start) / nb_repeats * 1000
+
+
+def main():
+    device = torch.device(sys.argv[1] if len(sys.argv) > 1 else 'cpu')
+    model = TransformerSrcOnlyModel(
+        experiment_name='benchmark', step_size=0.5, compress_lines=None,
+        nb_features=NB_FEATURES, max_len=MAX_LEN, log_level='WARNING',
+        input_embedded_size=64, positional_encoding_key='sinusoidal',
+        input_embedding_key='nn_embedding', ffnn_hidden_size=None, nheads=4,
+        dropout_rate=0., activation='relu', norm_first=False, n_layers_e=2,
+        dg_key='cosine-regression', dg_args=None, neighborhood_type=None,
+        neighborhood_radius=None, nb_cnn_filters=None, kernel_size=None)
+    model.move_to(device)
+    model.set_context('tracking')
+    model.eval()
+
+    rng = np.random.RandomState(0)
+    for nb_lines in NB_LINES:
+        # Forward tracking: all lines have the same length. Backward
+        # tracking: various lengths (padding).
+        for current_len in LENGTHS:
+            same = np.full(nb_lines, current_len)
+            various = rng.randint(1, current_len + 1, nb_lines)
+            t_future = _timeit(lambda: model._generate_future_mask(
+                current_len))
+            t_padding = _timeit(lambda: model._generate_padding_mask(
+                various, current_len))
+            print("{} lines, length {}: future mask {:.3f} ms, padding mask "
+                  "{:.3f} ms".format(nb_lines, current_len, t_future,
+                                     t_padding))
+
+            for name, lengths in [('forward', same), ('backward', various)]:
+                inputs = [torch.rand(n, NB_FEATURES, device=device)
+                          for n in lengths]
+                with torch.no_grad():
+                    t_step = _timeit(lambda: model(inputs), nb_repeats=3)
+                print("    One tracking step ({} tracking): {:.1f} ms"
+                      .format(name, t_step))
+
+
+if __name__ == '__main__':
+    main()
@@ -125,6 +125,14 @@ def _verify_sft_data(sft_data, group_number):
         list_4.data_per_streamline[dps_key_2][0:4],
         expected_mock_2d_dps[0:4])
 
+    # Accessing the flat data directly, without SFT: same streamlines.
+    # (Streamlines are stored in vox space, corner origin.)
+    assert sft_data.is_vox_corner
+    data, lengths = sft_data.get_flat_streamlines([3, 0, 2])
+    list_3 = sft_data.as_sft([3, 0, 2])
+    assert np.array_equal(lengths, list_3.streamlines._lengths)
+    assert np.allclose(data, list_3.streamlines.get_data())
+
 
 def _non_lazy_version(hdf5_filename):
     logging.debug("-------------- NON-LAZY version -----------------")
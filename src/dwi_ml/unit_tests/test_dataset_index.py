@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import h5py
+import numpy as np
+
+from dwi_ml.data.dataset.multi_subject_containers import MultiSubjectDataset
+from dwi_ml.data.dataset.single_subject_containers import LazySubjectData
+from dwi_ml.data.hdf5.utils import INDEX_GROUP, write_dataset_index
+
+rng = np.random.RandomState(0)
+nb_streamlines = {'subj1': 4, 'subj2': 6, 'subj3': 3}
+
+
+def _create_hdf5(hdf5_file):
+    with h5py.File(hdf5_file, 'w') as hdf_handle:
+        # Unsorted on purpose: the dataset sorts subjects.
+        hdf_handle.attrs['training_subjs'] = ['subj2', 'subj1']
+        hdf_handle.attrs['validation_subjs'] = ['subj3']
+        hdf_handle.attrs['testing_subjs'] = []
+        hdf_handle.attrs['step_size'] = 0.5
+        hdf_handle.attrs['compress'] = 'Not defined by user'
+        for subj, n in nb_streamlines.items():
+            volume = hdf_handle.create_group(subj + '/input')
+            volume.create_dataset('data', data=np.zeros((3, 3, 3, 2)))
+            volume.attrs['type'] = 'volume'
+            volume.attrs['nb_features'] = 2
+            volume.attrs['voxres'] = [1., 1., 1.]
+            volume.attrs['affine'] = np.eye(4)
+
+            lengths = rng.randint(2, 10, n)
+            group = hdf_handle.create_group(subj + '/streamlines')
+            group.attrs['type'] = 'streamlines'
+            group.attrs['space'] = 'vox'
+            group.attrs['origin'] = 'trackvis'
+            group.attrs['affine'] = np.eye(4)
+            group.attrs['dimensions'] = [3, 3, 3]
+            group.attrs['voxel_sizes'] = [1., 1., 1.]
+            group.attrs['voxel_order'] = 'RAS'
+            group.create_dataset('data', data=rng.rand(sum(lengths), 3))
+            group.create_dataset('offsets', data=np.concatenate(
+                ([0], np.cumsum(lengths)[:-1])))
+            group.create_dataset('lengths', data=lengths)
+            group.create_dataset('euclidean_lengths', data=rng.rand(n) * 10)
+
+
+def _load(hdf5_file, lazy, subj_id=None):
+    dataset = MultiSubjectDataset(hdf5_file, lazy=lazy, cache_size=1)
+    dataset.load_data(load_validation=subj_id is None,
+                      load_testing=subj_id is None, subj_id=subj_id)
+    return dataset
+
+
+def _assert_same_subset(subset, ref_subset):
+    assert subset.subjects == ref_subset.subjects
+    assert subset.total_nb_streamlines == ref_subset.total_nb_streamlines
+    assert subset.total_nb_points == ref_subset.total_nb_points
+    assert subset.streamline_ids_per_subj == \
+        ref_subset.streamline_ids_per_subj
+    for group in range(len(ref_subset.streamline_groups)):
+        assert np.array_equal(subset.streamline_lengths[group],
+                              ref_subset.streamline_lengths[group])
+        assert np.array_equal(subset.streamline_lengths_mm[group],
+                              ref_subset.streamline_lengths_mm[group])
+
+
+def test_dataset_index():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = os.path.join(tmp_dir, 'test.hdf5')
+        _create_hdf5(hdf5_file)
+
+        # Without index: walking through all subjects.
+        ref = {lazy: _load(hdf5_file, lazy) for lazy in [False, True]}
+        ref_subj = _load(hdf5_file, True, subj_id='subj2')
+        assert ref[True].training_set.total_nb_streamlines == [10]
+
+        with h5py.File(hdf5_file, 'a') as hdf_handle:
+            write_dataset_index(hdf_handle)
+            assert INDEX_GROUP in hdf_handle
+
+        for lazy in [False, True]:
+            dataset = _load(hdf5_file, lazy)
+            assert dataset.volume_groups == ['input']
+            assert dataset.nb_features == [2]
+            assert dataset.streamline_groups == ['streamlines']
+            assert dataset.training_set.streamline_step_sizes == [0.5]
+            _assert_same_subset(dataset.training_set,
+                                ref[lazy].training_set)
+            _assert_same_subset(dataset.validation_set,
+                                ref[lazy].validation_set)
+            assert dataset.testing_set.nb_subjects == 0
+        _assert_same_subset(_load(hdf5_file, True, 'subj2').training_set,
+                            ref_subj.training_set)
+
+        # Lazy: subjects' containers are created on first access.
+        subjs_list = dataset.training_set.subjs_data_list
+        assert len(subjs_list.created_subjects()) == 0
+        subj = subjs_list.get_subj_with_handle(1)
+        assert isinstance(subj, LazySubjectData)
+        assert subj.subject_id == 'subj2'
+        assert len(subj.sft_data_list[0]) == nb_streamlines['subj2']
+        assert len(subjs_list.created_subjects()) == 1
+        dataset.training_set.close_all_handles()
+
+
+if __name__ == '__main__':
+    test_dataset_index()
@@ -5,6 +5,10 @@ import logging
 import numpy as np
 import torch
 
+from dwi_ml.data.processing.space.neighborhood import \
+    prepare_neighborhood_vectors, unflatten_neighborhood
+from dwi_ml.data.processing.volume.interpolation import \
+    interpolate_volume_in_neighborhood
 from dwi_ml.models.embeddings import keys_to_embeddings
 
 
@@ -102,5 +106,57 @@ def test_embeddings():
     assert np.array_equal(output.shape, [BATCH_SIZE, model.out_flattened_size])
 
 
+def _cnn_volume_features_error(nb_layers, coords):
+    radius, resolution = 2, 2.
+    nb_features = 3
+    image_shape = np.asarray([2 * radius + 1] * 3)
+    volume = torch.rand([12, 12, 12, nb_features])
+    neighb_vect = prepare_neighborhood_vectors('grid', radius, resolution)
+
+    cls = keys_to_embeddings['cnn_embedding']
+    model = cls(nb_features_in=nb_features, nb_filters=[4] * nb_layers,
+                kernel_sizes=[3] * nb_layers, image_shape=image_shape)
+
+    # Usual per-point CNN
+    x, _ = interpolate_volume_in_neighborhood(volume, coords, neighb_vect)
+    x = unflatten_neighborhood(x, neighb_vect, 'grid', radius, resolution)
+    expected = model(x)
+
+    # CNN on the whole volume
+    features, origin, dilation = model.compute_volume_features(
+        volume, radius, resolution)
+    output = model.interpolate_volume_features(features, origin, dilation,
+                                               coords)
+    assert output.shape == expected.shape
+    return torch.max(torch.abs(output - expected))
+
+
+def test_cnn_volume_features():
+    torch.manual_seed(0)
+    any_coords = torch.rand([50, 3]) * 12
+    grid_coords = torch.randint(0, 12, [50, 3]).float()
+
+    # One layer: exact everywhere, including near the borders.
+    assert _cnn_volume_features_error(1, any_coords) < 1e-5
+
+    # Two layers: exact on the voxel grid only.
+    assert _cnn_volume_features_error(2, grid_coords) < 1e-5
+    error = _cnn_volume_features_error(2, any_coords)
+    logging.debug("Error with two layers, off the voxel grid: {}"
+                  .format(error))
+    assert error < 0.5
+
+    # Non-integer resolutions are not supported.
+    cls = keys_to_embeddings['cnn_embedding']
+    model = cls(nb_features_in=3, nb_filters=[4], kernel_sizes=[3],
+                image_shape=np.asarray([5, 5, 5]))
+    try:
+        model.compute_volume_features(torch.rand([5, 5, 5, 3]), 2, 0.5)
+        raise AssertionError("Expected an error with resolution 0.5")
+    except ValueError:
+        pass
+
+
 if __name__ == '__main__':
     test_embeddings()
+    test_cnn_volume_features()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import pytest
+import torch
+
+from dwi_ml.models.main_models import (INFERENCE_ARTIFACT_NAME,
+                                       export_inference_artifact)
+from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
+from dwi_ml.models.projects.transformer_models import TransformerSrcOnlyModel
+from dwi_ml.unit_tests.utils.data_and_models_for_tests import \
+    create_test_batch_2lines_4features
+
+batch_x, _, batch_s, _ = create_test_batch_2lines_4features()
+
+
+def _prepare_model():
+    torch.manual_seed(0)
+    model = TransformerSrcOnlyModel(
+        experiment_name='test', step_size=0.5, compress_lines=None,
+        nb_features=4, max_len=5, input_embedded_size=4,
+        positional_encoding_key='sinusoidal',
+        input_embedding_key='nn_embedding', ffnn_hidden_size=None, nheads=1,
+        dropout_rate=0., activation='relu', norm_first=False, n_layers_e=1,
+        dg_key='cosine-regression', dg_args=None, nb_cnn_filters=None,
+        kernel_size=None)
+    model.set_context('visu')
+    model.eval()
+    return model
+
+
+def test_inference_artifact():
+    model = _prepare_model()
+    expected = model(batch_x, batch_s)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = os.path.join(tmp_dir, 'best_model')
+        model.save_params_and_state(model_dir)
+
+        # Exported in the model dir: used by the usual loading.
+        export_inference_artifact(model_dir)
+        assert os.path.isfile(os.path.join(model_dir,
+                                           INFERENCE_ARTIFACT_NAME))
+        loaded = TransformerSrcOnlyModel.load_model_from_params_and_state(
+            model_dir)
+        loaded.set_context('visu')
+        for a, b in zip(loaded(batch_x, batch_s), expected):
+            assert torch.allclose(a, b)
+
+        # Saved from the model itself, to any file.
+        filename = os.path.join(tmp_dir, 'model.pt')
+        model.save_inference_artifact(filename)
+        loaded = TransformerSrcOnlyModel.load_model_from_inference_artifact(
+            filename)
+        loaded.set_context('visu')
+        for a, b in zip(loaded(batch_x, batch_s), expected):
+            assert torch.allclose(a, b)
+
+        with pytest.raises(ValueError):
+            Learn2TrackModel.load_model_from_inference_artifact(filename)
+
+
+if __name__ == '__main__':
+    test_inference_artifact()
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 import logging
 
+import numpy as np
+import torch
 from torch.nn.utils.rnn import pack_sequence
 
+from dwi_ml.data.processing.volume.interpolation import \
+    interpolate_volume_in_neighborhood
 from dwi_ml.experiment_utils.prints import format_dict_to_str
 from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
 from dwi_ml.models.stacked_rnn import StackedRNN, ADD_SKIP_TO_OUTPUT
 from dwi_ml.unit_tests.utils.data_and_models_for_tests import create_test_batch_2lines_4features
 
-batch_x, _, batch_s, _ = create_test_batch_2lines_4features()
+batch_x, batch_x_same_lengths, batch_s, batch_s_same_lengths = \
+    create_test_batch_2lines_4features()
 
 
 def test_stacked_rnn():
@@ -33,6 +38,24 @@ def test_stacked_rnn():
         assert output.shape[1] == 6  # 3 + 3 with skip connections
 
 
+def test_stacked_rnn_activation_checkpointing():
+    batch_x_packed = pack_sequence(batch_x, enforce_sorted=False)
+    model = StackedRNN('lstm', input_size=4, layer_sizes=[3, 3],
+                       use_skip_connection=True,
+                       use_layer_normalization=True, dropout=0.4)
+
+    grads = []
+    for activation_checkpointing in [False, True]:
+        model.activation_checkpointing = activation_checkpointing
+        model.zero_grad()
+        torch.manual_seed(0)
+        output, _ = model(batch_x_packed)
+        output.sum().backward()
+        grads.append([p.grad.clone() for p in model.parameters()])
+    for g, g_checkpoint in zip(*grads):
+        assert torch.allclose(g, g_checkpoint, atol=1e-6)
+
+
 def test_learn2track():
     model = Learn2TrackModel('test', step_size=0.5, compress_lines=False,
                              nb_features=4, rnn_layer_sizes=[3, 3],
@@ -55,7 +78,14 @@ def test_learn2track():
 
     # Testing forward. No previous dirs
     model.set_context('training')
-    model(batch_x, batch_s)
+    output = model(batch_x, batch_s)
+
+    # Same lengths (ex, with nb_points): dense path, without sorting or
+    # packing. The RNN is causal: should give the same outputs on the first
+    # points.
+    output_same_lengths = model(batch_x_same_lengths, batch_s_same_lengths)
+    for o, o_same in zip(output, output_same_lengths):
+        assert torch.allclose(o[0:2], o_same, atol=1e-6)
 
 
 def test_learn2track_cnn():
@@ -87,6 +117,54 @@ def test_learn2track_cnn():
     model(batch_x, batch_s)
 
 
+def test_learn2track_cnn_volume_features():
+    torch.manual_seed(0)
+    model = Learn2TrackModel('test', step_size=0.5, compress_lines=False,
+                             nb_features=4, rnn_layer_sizes=[3, 3],
+                             nb_previous_dirs=0, prev_dirs_embedded_size=None,
+                             prev_dirs_embedding_key=None,
+                             normalize_prev_dirs=True,
+                             input_embedding_key='cnn_embedding',
+                             nb_cnn_filters=[4], kernel_size=[3],
+                             input_embedded_size=None,
+                             rnn_key='lstm', use_skip_connection=True,
+                             use_layer_normalization=True, dropout=0.,
+                             start_from_copy_prev=False,
+                             dg_key='cosine-regression', dg_args=None,
+                             neighborhood_type='grid', neighborhood_radius=1,
+                             neighborhood_resolution=1)
+    model.set_context('visu')
+    model.eval()
+
+    volume = torch.rand([10, 10, 10, 4])
+    lines = [torch.as_tensor(np.random.RandomState(i).uniform(2, 8, (n, 3)),
+                             dtype=torch.float) for i, n in enumerate([3, 2])]
+    lengths = [len(s) for s in lines]
+    coords = torch.cat(lines)
+
+    # Usual inputs: the neighborhood at each point.
+    x, _ = interpolate_volume_in_neighborhood(volume, coords,
+                                              model.neighborhood_vectors)
+    with torch.no_grad():
+        expected = model(list(x.split(lengths)), lines)
+
+    # With CNN volume features: inputs are already embedded (as returned by
+    # prepare_batch_one_input).
+    model.cnn_volume_features = True
+    features, origin, dilation = \
+        model.input_embedding_layer.compute_volume_features(
+            volume, model.neighborhood_radius, model.neighborhood_resolution)
+    x = model.input_embedding_layer.interpolate_volume_features(
+        features, origin, dilation, coords)
+    assert x.shape[-1] == model.input_embedding_layer.out_flattened_size
+    with torch.no_grad():
+        outputs = model(list(x.split(lengths)), lines)
+
+    # One CNN layer: exact.
+    for o, o_expected in zip(outputs, expected):
+        assert torch.allclose(o, o_expected, atol=1e-5)
+
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(level='DEBUG')
 
@@ -94,6 +172,7 @@ if __name__ == '__main__':
     print("Stacked RNN")
     print("---------------------------------------")
     test_stacked_rnn()
+    test_stacked_rnn_activation_checkpointing()
 
     print("\n---------------------------------------")
     print("Model Learn2track")
@@ -104,3 +183,4 @@ if __name__ == '__main__':
     print("Model Learn2track with CNN input embedding")
     print("---------------------------------------")
     test_learn2track_cnn()
+    test_learn2track_cnn_volume_features()
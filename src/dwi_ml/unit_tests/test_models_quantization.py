@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import copy
+
+import numpy as np
+import pytest
+import torch
+from torch.ao.nn.quantized.dynamic import LSTM as DynamicQuantizedLSTM
+
+from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
+from dwi_ml.models.projects.transformer_models import TransformerSrcOnlyModel
+from dwi_ml.models.quantization import (StaticQuantizedLayer,
+                                        check_quantization, quantize_model)
+from dwi_ml.tracking.propagation import propagate_multiple_lines
+from dwi_ml.tracking.tracking_mask import TrackingMask
+from dwi_ml.tracking.utils import compare_tractograms
+from dwi_ml.unit_tests.utils.data_and_models_for_tests import \
+    create_test_batch_2lines_4features
+
+batch_x, _, batch_s, _ = create_test_batch_2lines_4features()
+
+
+def _prepare_learn2track():
+    torch.manual_seed(0)
+    return Learn2TrackModel(
+        'test', step_size=0.5, compress_lines=False, nb_features=4,
+        rnn_layer_sizes=[16, 16], nb_previous_dirs=0,
+        prev_dirs_embedded_size=None, prev_dirs_embedding_key=None,
+        normalize_prev_dirs=True, input_embedding_key='nn_embedding',
+        input_embedded_size=8, kernel_size=None, nb_cnn_filters=None,
+        rnn_key='lstm', use_skip_connection=True,
+        use_layer_normalization=True, dropout=0., start_from_copy_prev=False,
+        dg_key='cosine-regression', dg_args=None, neighborhood_type=None,
+        neighborhood_radius=None)
+
+
+def _prepare_transformer():
+    torch.manual_seed(0)
+    return TransformerSrcOnlyModel(
+        experiment_name='test', step_size=0.5, compress_lines=None,
+        nb_features=4, max_len=50, input_embedded_size=16,
+        positional_encoding_key='sinusoidal',
+        input_embedding_key='nn_embedding', ffnn_hidden_size=None, nheads=2,
+        dropout_rate=0., activation='relu', norm_first=False, n_layers_e=2,
+        dg_key='cosine-regression', dg_args=None, nb_cnn_filters=None,
+        kernel_size=None)
+
+
+def _get_features(lines):
+    # A smooth 4-features "volume", computed directly at the coordinates.
+    return [torch.cat((torch.sin(line / 3.), torch.ones(len(line), 1)),
+                      dim=1) for line in lines]
+
+
+def test_check_quantization():
+    check_quantization(None, torch.device('cuda'))
+    check_quantization('dynamic', torch.device('cpu'))
+    with pytest.raises(ValueError):
+        check_quantization('int4')
+    with pytest.raises(ValueError):
+        check_quantization('dynamic', torch.device('cuda'))
+    with pytest.raises(ValueError):
+        check_quantization('dynamic', precision='bfloat16')
+
+
+def test_quantize_model():
+    for prepare_model in [_prepare_learn2track, _prepare_transformer]:
+        model = prepare_model()
+        model.set_context('visu')
+        model.eval()
+        with torch.no_grad():
+            expected = model(batch_x, batch_s)
+        if isinstance(expected, tuple):
+            expected = expected[0]
+
+        for quantization in ['dynamic', 'static_embedding']:
+            quantized = quantize_model(
+                copy.deepcopy(model), quantization,
+                calibration_inputs=torch.cat(batch_x))
+            assert not any(type(m) is torch.nn.Linear
+                           for m in quantized.modules())
+            if quantization == 'static_embedding':
+                assert isinstance(quantized.input_embedding_layer.linear,
+                                  StaticQuantizedLayer)
+            if isinstance(model, Learn2TrackModel):
+                assert isinstance(quantized.rnn_model.rnn_0,
+                                  DynamicQuantizedLSTM)
+
+            with torch.no_grad():
+                outputs = quantized(batch_x, batch_s)
+            if isinstance(outputs, tuple):
+                outputs = outputs[0]
+            for a, b in zip(outputs, expected):
+                cos = torch.nn.functional.cosine_similarity(a, b, dim=-1)
+                assert torch.all(cos > 0.99)
+
+    with pytest.raises(ValueError):
+        quantize_model(_prepare_transformer(), 'static_embedding')
+
+
+def _track(model, seeds, mask):
+    def update_memory(_, __):
+        pass
+
+    def get_next_dirs(lines, _n_last_pos):
+        outputs = model(_get_features(lines), lines)
+        return model.get_tracking_directions(outputs, 'det', None)
+
+    lines = [torch.as_tensor(s, dtype=torch.float)[None, :] for s in seeds]
+    with torch.no_grad():
+        lines = propagate_multiple_lines(
+            lines, update_memory, get_next_dirs, theta=np.pi / 2,
+            step_size=0.5, mask=mask, max_nbr_pts=40,
+            append_last_point=False, normalize_directions=True)
+    return [line.numpy() for line in lines]
+
+
+def test_quantized_tracking_regression():
+    # Tractograms tracked with the quantized model should be close to the
+    # float32 ones: small angular error, same connectivity.
+    model = _prepare_transformer()
+    model.set_context('tracking')
+    model.eval()
+
+    data = np.ones((10, 10, 10))
+    mask = TrackingMask(data.shape, data)
+    rng = np.random.RandomState(0)
+    seeds = list(rng.uniform(3, 7, size=(50, 3)))
+
+    ref_lines = _track(model, seeds, mask)
+    quantized = quantize_model(
+        copy.deepcopy(model), 'static_embedding',
+        calibration_inputs=torch.cat(_get_features(
+            [torch.as_tensor(np.asarray(seeds), dtype=torch.float)])))
+    lines = _track(quantized, seeds, mask)
+
+    results = compare_tractograms(ref_lines, seeds, lines, seeds,
+                                  data.shape, [3, 3, 3])
+    assert results['nb_matched'] == len(seeds)
+    assert results['angular_error'] < 3
+    assert results['same_connection'] >= 0.9
+    assert results['connectivity_difference'] <= 0.1
+
+
+if __name__ == '__main__':
+    test_check_quantization()
+    test_quantize_model()
+    test_quantized_tracking_regression()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import logging
 
-from torch import isnan, set_printoptions
+import torch
+from torch import allclose, isnan, set_printoptions
+from torch.nn import Transformer
 
+from dwi_ml.models.projects import transformer_sublayers
 from dwi_ml.models.projects.transformer_models import (
     OriginalTransformerModel, TransformerSrcAndTgtModel, TransformerSrcOnlyModel)
 from dwi_ml.unit_tests.utils.data_and_models_for_tests import create_test_batch_2lines_4features
@@ -13,9 +16,9 @@ total_nb_points_training = sum([len(s) for s in batch_s_various_lengths])
 nb_streamlines = len(batch_x_various_lengths)
 
 
-def _prepare_original_model():
+def _prepare_original_model(**kw):
     # Using defaults from script
-    model = OriginalTransformerModel(
+    params = dict(
         experiment_name='test', step_size=0.5, compress_lines=None,
         nb_features=4, input_embedded_size=4, max_len=5,
         log_level='DEBUG', positional_encoding_key='sinusoidal',
@@ -26,6 +29,8 @@ def _prepare_original_model():
         neighborhood_type=None, neighborhood_radius=None,
         nb_cnn_filters=None, kernel_size=None,
         start_from_copy_prev=False)
+    params.update(kw)
+    model = OriginalTransformerModel(**params)
     return model
 
 
@@ -51,8 +56,8 @@ def _prepare_ttst_model():
     return model
 
 
-def _prepare_tts_model():
-    model = TransformerSrcOnlyModel(
+def _prepare_tts_model(**kw):
+    params = dict(
         experiment_name='test',  step_size=0.5, compress_lines=None,
         nb_features=4, max_len=5, log_level='DEBUG',
         input_embedded_size=4,
@@ -61,6 +66,8 @@ def _prepare_tts_model():
         norm_first=False, n_layers_e=1, dg_key='cosine-regression',
         dg_args=None, neighborhood_type=None, neighborhood_radius=None,
         nb_cnn_filters=None, kernel_size=None)
+    params.update(kw)
+    model = TransformerSrcOnlyModel(**params)
     return model
 
 
@@ -132,6 +139,12 @@ def _run_tts_model(model):
     assert output[0].shape[1] == 3  # Here, regression, should output x, y, z
     assert not isnan(output[0][0, 0])
 
+    # Same lengths (ex, with nb_points): no padding. The model is causal:
+    # should give the same outputs on the first points.
+    output_same_lengths = model(batch_x_same_lengths, None)
+    for o, o_same in zip(output, output_same_lengths):
+        assert allclose(o[0:2], o_same, atol=1e-6)
+
     # Testing forward during visu context: will return weights
     model.set_context('visu_weights')
     _, weights = model(batch_x_various_lengths, None)
@@ -167,7 +180,111 @@ def test_models():
     _run_tts_model(model)
 
 
+def test_sdpa_attention():
+    # Outside of visu_weights, attention uses scaled_dot_product_attention.
+    # Should give the same results as torch's MultiheadAttention.
+    for model in [_prepare_original_model(), _prepare_ttst_model(),
+                  _prepare_tts_model()]:
+        model.set_context('training')
+        for batch_x, batch_s in [
+                (batch_x_various_lengths, batch_s_various_lengths),
+                (batch_x_same_lengths, batch_s_same_lengths)]:
+            transformer_sublayers.USE_SDPA = True
+            output = model(batch_x, batch_s)
+            transformer_sublayers.USE_SDPA = False
+            expected = model(batch_x, batch_s)
+            transformer_sublayers.USE_SDPA = True
+            for o, e in zip(output, expected):
+                assert allclose(o, e, atol=1e-5)
+
+
+def test_masks():
+    model = _prepare_tts_model()
+
+    # Future masks are views of the max_len mask.
+    for sz in [1, 3, model.max_len]:
+        expected = Transformer.generate_square_subsequent_mask(sz) < 0
+        assert torch.equal(model._generate_future_mask(sz), expected)
+    assert len(model._future_masks) == 1
+
+    lengths = [3, 1, 5]
+    expected = torch.full((3, 5), False)
+    for i, n in enumerate(lengths):
+        expected[i, n:] = True
+    assert torch.equal(model._generate_padding_mask(lengths, 5), expected)
+
+
+def test_attention_window():
+    # Relational encoding: streamlines can be longer than max_len (5).
+    # 2 heads, to test the per-head bias.
+    torch.manual_seed(0)
+    long_x = [torch.rand(12, 4), torch.rand(9, 4)]
+    long_s = [torch.rand(12, 3), torch.rand(9, 3)]
+    kw = dict(positional_encoding_key='relational', attention_window=3,
+              input_embedded_size=8, nheads=2, n_layers_e=2)
+    for model in [_prepare_tts_model(**kw),
+                  _prepare_original_model(**kw)]:
+        # TTS: 2 layers, context of 2 * (3 - 1) + 1 points. TTO: 3 layers.
+        assert model.tracking_context_len == \
+            model.nb_attention_layers * 2 + 1
+
+        model.set_context('training')
+        output = model(long_x, long_s)
+        assert not any(isnan(o).any() for o in output)
+
+        # Window: changing points far in the past does not change the output
+        # at the last point.
+        x_modified = [x.clone() for x in long_x]
+        for x in x_modified:
+            x[:-model.tracking_context_len] = 0.
+        output_modified = model(x_modified, long_s)
+        for o, o_modified in zip(output, output_modified):
+            assert allclose(o[-1], o_modified[-1], atol=1e-5)
+            assert not allclose(o[0], o_modified[0], atol=1e-5)
+
+        # Same as torch's MultiheadAttention (masks of shape [nheads, L, L])
+        transformer_sublayers.USE_SDPA = False
+        expected = model(long_x, long_s)
+        transformer_sublayers.USE_SDPA = True
+        for o, e in zip(output, expected):
+            assert allclose(o, e, atol=1e-5)
+
+        # Tracking: the streamlines are cropped. Same output at the last
+        # point.
+        model.set_context('tracking')
+        output_tracking = model(long_x, long_s)
+        for o, o_tracking in zip(output, output_tracking):
+            assert allclose(o[-1], o_tracking, atol=1e-5)
+
+
+def _grads_with_activation_checkpointing(model, activation_checkpointing):
+    torch.manual_seed(0)
+    for module in model.modules():
+        if hasattr(module, 'activation_checkpointing'):
+            module.activation_checkpointing = activation_checkpointing
+    model.zero_grad()
+    model.set_context('training')
+    output = model(batch_x_various_lengths, batch_s_various_lengths)
+    sum((o ** 2).sum() for o in output).backward()
+    return [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+
+def test_activation_checkpointing():
+    # With dropout: the random state must be the same when recomputing.
+    for model in [_prepare_tts_model(n_layers_e=2, dropout_rate=0.2),
+                  _prepare_original_model(dropout_rate=0.2)]:
+        expected = _grads_with_activation_checkpointing(model, False)
+        grads = _grads_with_activation_checkpointing(model, True)
+        assert len(grads) == len(expected)
+        for g, e in zip(grads, expected):
+            assert allclose(g, e, atol=1e-6)
+
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(level='DEBUG')
     set_printoptions(precision=3, sci_mode=False)
     test_models()
+    test_sdpa_attention()
+    test_masks()
+    test_attention_window()
+    test_activation_checkpointing()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import tempfile
+
+import h5py
+import numpy as np
+import torch
+
+from dwi_ml.data.dataset.mri_data_containers import LazyMRIData, MRIData
+from dwi_ml.data.processing.space.neighborhood import \
+    prepare_neighborhood_vectors
+from dwi_ml.data.processing.volume.compact_dtypes import compact_volume_data
+from dwi_ml.data.processing.volume.interpolation import \
+    interpolate_volume_in_neighborhood
+
+# Maximal relative error (compared to the maximal absolute value of each
+# feature) after interpolation.
+expected_max_errors = {'float32': 0.,
+                       'float16': 5e-4,
+                       'bfloat16': 4e-3,
+                       'int16': 2e-5}
+
+rng = np.random.RandomState(42)
+# Ex: 28 SH coefficients, not standardized.
+fake_data = rng.normal(0., 5., (10, 10, 10, 28)).astype(np.float32)
+fake_data[..., 0] += 1000.
+fake_coords = torch.as_tensor(rng.uniform(1., 8.5, (50, 3)),
+                              dtype=torch.float)
+
+
+def _save_and_load(data, dtype, hdf_filename, lazy):
+    compact_data, scale, offset = compact_volume_data(data, dtype)
+    with h5py.File(hdf_filename, 'w') as hdf_handle:
+        group = hdf_handle.create_group('input')
+        group.create_dataset('data', data=compact_data)
+        group.attrs['dtype'] = dtype
+        group.attrs['voxres'] = [1., 1., 1.]
+        group.attrs['affine'] = np.eye(4)
+        if scale is not None:
+            group.attrs['scale'] = scale
+            group.attrs['offset'] = offset
+
+    with h5py.File(hdf_filename, 'r') as hdf_handle:
+        if lazy:
+            mri_data = LazyMRIData.init_mri_data_from_hdf_info(
+                hdf_handle['input'])
+        else:
+            mri_data = MRIData.init_mri_data_from_hdf_info(
+                hdf_handle['input'])
+        volume = mri_data.get_data_as_tensor(torch.device('cpu'))
+        scaling = mri_data.scaling
+    return volume, scaling
+
+
+def test_compact_dtypes():
+    neighb_vec = prepare_neighborhood_vectors(
+        'axes', neighborhood_radius=1, neighborhood_resolution=0.5)
+
+    ref_volume = torch.as_tensor(fake_data)
+    ref_x, _ = interpolate_volume_in_neighborhood(ref_volume, fake_coords,
+                                                  neighb_vec)
+    max_abs = np.abs(fake_data).max(axis=(0, 1, 2))
+    max_abs = torch.as_tensor(np.tile(max_abs, len(neighb_vec)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf_filename = os.path.join(tmp_dir, 'test.hdf5')
+        for dtype, max_error in expected_max_errors.items():
+            for lazy in [False, True]:
+                volume, scaling = _save_and_load(fake_data, dtype,
+                                                 hdf_filename, lazy)
+
+                # Data is kept compact in memory.
+                expected_torch_dtype = {
+                    'float32': torch.float32, 'float16': torch.float16,
+                    'bfloat16': torch.bfloat16, 'int16': torch.int16}[dtype]
+                assert volume.dtype == expected_torch_dtype
+                assert (scaling is not None) == (dtype == 'int16')
+
+                # Upcast at interpolation time.
+                x, _ = interpolate_volume_in_neighborhood(
+                    volume, fake_coords, neighb_vec, volume_scaling=scaling)
+                assert x.dtype == torch.float32
+                assert x.shape == ref_x.shape
+
+                error = torch.max(torch.abs(x - ref_x) / max_abs)
+                logging.info("Volume dtype {} (lazy={}): max relative "
+                             "interpolation error {:.2e} ({} bytes per value)"
+                             .format(dtype, lazy, error,
+                                     volume.element_size()))
+                assert error <= max_error, \
+                    "Expected an error < {} for dtype {}, got {}".format(
+                        max_error, dtype, error)
+
+
+def test_float16_overflow():
+    try:
+        compact_volume_data(np.full((2, 2, 2, 1), 1e5), 'float16')
+        raise AssertionError("Expected an error with values > 65504.")
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(level='INFO')
+    test_compact_dtypes()
+    test_float16_overflow()
@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 
-from dwi_ml.data.processing.streamlines.post_processing import compute_triu_connectivity_from_blocs
+from dwi_ml.data.processing.streamlines.post_processing import (
+    compute_triu_connectivity_from_blocs,
+    compute_triu_connectivity_from_labels,
+    compute_triu_connections_from_blocs,
+    compute_triu_connections_from_labels)
 
 
 def test_connectivity():
@@ -23,5 +27,30 @@ def test_connectivity():
     assert np.array_equal(m, expected_m)
 
 
+def _dense_from_connections(rows, cols, size):
+    m = np.zeros((size, size), dtype=int)
+    np.add.at(m, (rows, cols), 1)
+    return m
+
+
+def test_connections():
+    # Same matrices as the dense versions, from the rows and columns.
+    rng = np.random.RandomState(0)
+    streamlines = [rng.uniform(0, 10, (rng.randint(2, 6), 3))
+                   for _ in range(50)]
+
+    m, _, _ = compute_triu_connectivity_from_blocs(streamlines, (10, 10, 10),
+                                                   (2, 3, 2))
+    rows, cols = compute_triu_connections_from_blocs(
+        streamlines, (10, 10, 10), (2, 3, 2))
+    assert np.array_equal(_dense_from_connections(rows, cols, 12), m)
+
+    labels = rng.choice([0, 3, 7, 12], size=(10, 10, 10))
+    m, _, _, _ = compute_triu_connectivity_from_labels(streamlines, labels)
+    rows, cols = compute_triu_connections_from_labels(streamlines, labels)
+    assert np.array_equal(_dense_from_connections(rows, cols, 4), m)
+
+
 if __name__ == '__main__':
     test_connectivity()
+    test_connections()
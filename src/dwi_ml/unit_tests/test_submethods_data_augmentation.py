@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import h5py
+import numpy as np
+from dipy.io.stateful_tractogram import StatefulTractogram, Space, Origin
+from dipy.tracking.utils import length
+from nibabel.streamlines import ArraySequence
+
+from dwi_ml.data.processing.streamlines.data_augmentation import (
+    resample_or_compress, resample_streamlines_flat, reverse_streamlines,
+    reverse_streamlines_flat, split_streamlines, split_streamlines_flat)
+from dwi_ml.data.hdf5.utils import add_resampled_streamline_group
+
+affine = np.diag([2., 2., 2., 1.])
+dimensions = (30, 30, 30)
+rng = np.random.RandomState(1234)
+lengths = rng.randint(2, 40, size=20)
+lengths[:3] = [2, 5, 12]  # Some streamlines too short to be split.
+data = np.concatenate([np.cumsum(rng.uniform(0.1, 0.6, (n, 3)), axis=0) + 2.
+                       for n in lengths]).astype(np.float32)
+
+
+def _get_sft():
+    streamlines = ArraySequence()
+    streamlines._data = data.copy()
+    streamlines._lengths = lengths.copy()
+    streamlines._offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return StatefulTractogram(streamlines, (affine, dimensions, [2., 2., 2.],
+                                            'RAS'),
+                              space=Space.VOX, origin=Origin.TRACKVIS)
+
+
+def _compare(sft, new_data, new_lengths):
+    assert np.array_equal(sft.streamlines._lengths, new_lengths)
+    assert np.allclose(sft.streamlines.get_data(), new_data, atol=1e-4)
+
+
+def test_split_flat():
+    split_ids = [0, 2, 3, 7, 12, 15]
+    sft = split_streamlines(_get_sft(), np.random.RandomState(3), split_ids)
+    new_data, new_lengths = split_streamlines_flat(
+        data, lengths, np.random.RandomState(3), split_ids)
+    # Chosen streamlines too short to be split are removed.
+    nb_split = np.sum(lengths[split_ids] > 12)
+    nb_removed = len(split_ids) - nb_split
+    assert len(new_lengths) == len(lengths) + nb_split - nb_removed
+    _compare(sft, new_data, new_lengths)
+
+
+def test_reverse_flat():
+    reverse_ids = [1, 4, 5, 19]
+    sft = reverse_streamlines(_get_sft(), reverse_ids)
+    new_data = reverse_streamlines_flat(data, lengths, reverse_ids)
+    _compare(sft, new_data, lengths)
+
+
+def test_resample_flat():
+    # Resampling with the step size is done in mm.
+    sft = resample_or_compress(_get_sft(), step_size_mm=0.8)
+    new_data, new_lengths = resample_streamlines_flat(
+        data, lengths, step_size_mm=0.8, affine=affine)
+    _compare(sft, new_data, new_lengths)
+
+    sft = resample_or_compress(_get_sft(), nb_points=15)
+    new_data, new_lengths = resample_streamlines_flat(
+        data, lengths, nb_points=15)
+    _compare(sft, new_data, new_lengths)
+
+
+def test_add_resampled_streamline_group():
+    sft = _get_sft()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = os.path.join(tmp_dir, 'test.hdf5')
+        with h5py.File(hdf5_file, 'w') as hdf_handle:
+            subj_group = hdf_handle.create_group('subj1')
+            group = subj_group.create_group('streamlines')
+            group.attrs['type'] = 'streamlines'
+            group.attrs['space'] = str(sft.space)
+            group.attrs['origin'] = str(sft.origin)
+            group.attrs['affine'] = affine
+            group.attrs['dimensions'] = dimensions
+            group.attrs['voxel_sizes'] = [2., 2., 2.]
+            group.attrs['voxel_order'] = 'RAS'
+            group.create_dataset('data', data=data)
+            group.create_dataset('offsets', data=sft.streamlines._offsets)
+            group.create_dataset('lengths', data=lengths)
+
+            add_resampled_streamline_group(hdf_handle['subj1'], 'streamlines',
+                                           'streamlines_resampled', 0.8)
+
+        with h5py.File(hdf5_file, 'r') as hdf_handle:
+            new_group = hdf_handle['subj1']['streamlines_resampled']
+            assert new_group.attrs['step_size'] == 0.8
+            new_data = np.asarray(new_group['data'])
+            new_lengths = np.asarray(new_group['lengths'])
+            euclidean_lengths = np.asarray(new_group['euclidean_lengths'])
+
+    sft = resample_or_compress(sft, step_size_mm=0.8)
+    _compare(sft, new_data, new_lengths)
+    sft.to_rasmm()
+    assert np.allclose(euclidean_lengths, list(length(sft.streamlines)),
+                       atol=1e-3)
+
+
+if __name__ == '__main__':
+    test_split_flat()
+    test_reverse_flat()
+    test_resample_flat()
+    test_add_resampled_streamline_group()
@@ -82,7 +82,49 @@ def test_classes(plot_sphere=False):
         plt.show()
 
 
+def test_classes_batch():
+    # Converting a batch at once must give the same result as converting
+    # each streamline.
+    torch_sphere = TorchSphere(get_sphere(name='repulsion100'))
+    torch.manual_seed(0)
+    batch_dirs = [torch.randn(n, 3) for n in [1, 5, 3]]
+    for smooth in [False, True]:
+        for add_sos in [False, True]:
+            for add_eos in [False, True]:
+                kw = dict(smooth_labels=smooth, add_sos=add_sos,
+                          add_eos=add_eos, to_one_hot=True)
+                result = convert_dirs_to_class(batch_dirs, torch_sphere, **kw)
+                for s, r in zip(batch_dirs, result):
+                    expected = convert_dirs_to_class([s], torch_sphere, **kw)
+                    assert torch.allclose(r, expected[0])
+                    assert len(r) == len(s) + add_sos + add_eos
+
+    # Empty batch.
+    assert convert_dirs_to_class([], torch_sphere, add_sos=True) == []
+
+
+def test_lookup_grid():
+    sphere = get_sphere(name='symmetric724')
+    dense_sphere = TorchSphere(sphere)
+    grid_sphere = TorchSphere(sphere, lookup_grid_size=16)
+
+    torch.manual_seed(0)
+    dirs = torch.randn(10000, 3)
+    dirs[0] = 0.
+    dirs[1] = torch.as_tensor([1., 1., 1.])
+    dirs[2] = torch.as_tensor([0., 0., -2.])
+    expected = dense_sphere.find_closest(dirs).long()
+    idx = grid_sphere.find_closest(dirs).long()
+
+    # Same vertex, or a tie.
+    vertices = dense_sphere.vertices
+    assert torch.allclose(torch.sum(dirs * vertices[idx], dim=-1),
+                          torch.sum(dirs * vertices[expected], dim=-1))
+
+
 if __name__ == '__main__':
     test_labels()
     test_zeros()
     test_classes(plot_sphere=True)
+    test_classes_batch()
+    test_lookup_grid()
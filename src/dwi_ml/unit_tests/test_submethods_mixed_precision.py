@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import torch
+
+from dwi_ml.data.processing.volume.interpolation import \
+    torch_trilinear_interpolation
+from dwi_ml.experiment_utils.mixed_precision import (
+    check_precision, get_autocast_context, get_grad_scaler)
+from dwi_ml.models.projects.transformer_models import TransformerSrcOnlyModel
+from dwi_ml.models.utils.fisher_von_mises import fisher_von_mises_log_prob
+from dwi_ml.models.utils.gaussians import independent_gaussian_log_prob
+
+cpu = torch.device('cpu')
+
+
+def test_sensitive_functions_in_float32():
+    torch.manual_seed(0)
+    mus = torch.nn.functional.normalize(torch.rand(10, 3), dim=-1)
+    targets = torch.nn.functional.normalize(torch.rand(10, 3), dim=-1)
+    kappa = torch.rand(10) * 50 + 1
+    sigmas = torch.rand(10, 3) + 0.1
+    volume = torch.rand(5, 5, 5, 8)
+    coords = torch.rand(20, 3) * 4
+
+    # Inputs coming from a layer under autocast are in bfloat16.
+    mus, sigmas = mus.bfloat16(), sigmas.bfloat16()
+
+    # Reference: same (rounded) inputs, in float32.
+    ref_fisher = fisher_von_mises_log_prob(mus.float(), kappa, targets)
+    ref_gauss = independent_gaussian_log_prob(targets, mus.float(),
+                                              sigmas.float())
+    ref_interp = torch_trilinear_interpolation(volume, coords)
+
+    with get_autocast_context('bfloat16', cpu):
+        fisher = fisher_von_mises_log_prob(mus, kappa, targets)
+        gauss = independent_gaussian_log_prob(targets, mus, sigmas)
+        interp = torch_trilinear_interpolation(volume, coords)
+
+    assert fisher.dtype == torch.float32
+    assert gauss.dtype == torch.float32
+    assert interp.dtype == torch.float32
+    assert torch.allclose(fisher, ref_fisher, atol=1e-6)
+    assert torch.allclose(gauss, ref_gauss, atol=1e-6)
+    assert torch.allclose(interp, ref_interp, atol=1e-6)
+
+
+def test_bfloat16_training_step():
+    torch.manual_seed(0)
+    model = TransformerSrcOnlyModel(
+        experiment_name='test', step_size=0.5, compress_lines=None,
+        nb_features=4, max_len=20, input_embedded_size=16,
+        positional_encoding_key='sinusoidal',
+        input_embedding_key='nn_embedding', ffnn_hidden_size=None, nheads=2,
+        dropout_rate=0., activation='relu', norm_first=False, n_layers_e=2,
+        dg_key='cosine-regression', dg_args=None, nb_cnn_filters=None,
+        kernel_size=None)
+    model.set_context('training')
+    lines = [torch.cumsum(torch.rand(n, 3), dim=0) for n in [15, 12, 10]]
+    inputs = [torch.rand(len(s) - 1, 4) for s in lines]
+
+    losses = {}
+    for precision in ['float32', 'bfloat16']:
+        model.zero_grad()
+        with get_autocast_context(precision, cpu):
+            outputs = model(inputs, [s[:-1] for s in lines])
+            loss, _ = model.compute_loss(outputs, lines)
+        scaler = get_grad_scaler(precision, cpu)
+        assert not scaler.is_enabled()
+        scaler.scale(loss).backward()
+        for p in model.parameters():
+            assert p.grad is None or torch.all(torch.isfinite(p.grad))
+        losses[precision] = loss.item()
+    logging.info("Loss in float32: {}. In bfloat16: {}".format(
+        losses['float32'], losses['bfloat16']))
+    assert abs(losses['float32'] - losses['bfloat16']) < \
+        0.05 * abs(losses['float32'])
+
+    # Tracking directions are always float32.
+    model.set_context('tracking')
+    with torch.no_grad(), get_autocast_context('bfloat16', cpu):
+        outputs = model(inputs, [s[:-1] for s in lines])
+        dirs = model.get_tracking_directions(outputs, 'det', None)
+    assert dirs.dtype == torch.float32
+
+
+def test_check_precision():
+    check_precision('bfloat16', cpu)
+    try:
+        check_precision('float16', cpu)
+        raise AssertionError("Expected an error with float16 on CPU.")
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(level='INFO')
+    test_sensitive_functions_in_float32()
+    test_bfloat16_training_step()
+    test_check_precision()
@@ -7,6 +7,9 @@ import numpy as np
 import torch
 from torch.nn.utils.rnn import pack_sequence, pad_packed_sequence
 
+from dwi_ml.models.projects.learn2track_model import (
+    pack_same_length_sequences, unpack_same_length_sequences)
+
 logging.getLogger().setLevel(level='INFO')
 
 
@@ -35,5 +38,20 @@ def test_packing_unpacking():
         assert torch.equal(result[s], streamlines[s])
 
 
+def test_packing_same_length():
+    streamlines = [torch.rand(4, 3) for _ in range(5)]
+
+    expected = pack_sequence(streamlines)
+    packed_sequence = pack_same_length_sequences(streamlines)
+    assert torch.equal(packed_sequence.data, expected.data)
+    assert torch.equal(packed_sequence.batch_sizes, expected.batch_sizes)
+
+    result = unpack_same_length_sequences(packed_sequence.data,
+                                          len(streamlines))
+    for s in range(len(streamlines)):
+        assert torch.equal(result[s], streamlines[s])
+
+
 if __name__ == '__main__':
     test_packing_unpacking()
+    test_packing_same_length()
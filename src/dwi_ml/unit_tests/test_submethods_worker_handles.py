@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import tempfile
+
+import h5py
+import numpy as np
+
+from dwi_ml.cache.cache_manager import SingleThreadCacheManager
+from dwi_ml.data.dataset.mri_data_containers import MRIData
+from dwi_ml.data.dataset.multi_subject_containers import MultisubjectSubset
+from dwi_ml.data.dataset.single_subject_containers import LazySubjectData
+from dwi_ml.data.dataset.subjectdata_list_containers import \
+    LazySubjectsDataList
+
+
+def _prepare_lazy_subset(hdf5_file):
+    subset = MultisubjectSubset('training', hdf5_file, lazy=True,
+                                cache_size=1)
+    subset.subjs_data_list = LazySubjectsDataList(hdf5_file, None)
+    subset.subjs_data_list.add_subject(
+        LazySubjectData(['input'], [1], ['streamlines'], 'subj1'))
+    subset.nb_subjects = 1
+    return subset
+
+
+def test_worker_handles():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = os.path.join(tmp_dir, 'test.hdf5')
+        with h5py.File(hdf5_file, 'w') as f:
+            f.create_dataset('subj1/input/data', data=np.zeros((2, 2, 2, 1)))
+            f['subj1/input'].attrs['voxres'] = [1., 1., 1.]
+            f['subj1/input'].attrs['affine'] = np.eye(4)
+
+        subset = _prepare_lazy_subset(hdf5_file)
+        subj = subset.subjs_data_list.get_subj_with_handle(0)
+        parent_handle = subj.hdf_handle
+        assert parent_handle.id.valid
+        subset.volume_cache_manager = SingleThreadCacheManager(1)
+
+        # Spawn: handles and cache are not pickled.
+        copied = pickle.loads(pickle.dumps(subset))
+        assert copied.subjs_data_list.hdf_handle is None
+        assert copied.subjs_data_list[0].hdf_handle is None
+        assert copied.volume_cache_manager is None
+
+        # Fork: the worker forgets the inherited handles and opens its own,
+        # without closing the parent's.
+        subset.open_worker_handle()
+        worker_handle = subset.subjs_data_list.hdf_handle
+        assert worker_handle is not parent_handle
+        assert parent_handle.id.valid
+        subj = subset.subjs_data_list.get_subj_with_handle(0)
+        assert subj.hdf_handle is worker_handle
+        assert 'input' in subj.hdf_handle['subj1']
+
+        worker_handle.close()
+        parent_handle.close()
+
+
+def test_volume_cache_stats():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = os.path.join(tmp_dir, 'test.hdf5')
+        with h5py.File(hdf5_file, 'w') as f:
+            f.create_dataset('subj1/input/data', data=np.ones((2, 2, 2, 1)))
+            f['subj1/input'].attrs['voxres'] = [1., 1., 1.]
+            f['subj1/input'].attrs['affine'] = np.eye(4)
+
+        subset = _prepare_lazy_subset(hdf5_file)
+        assert subset.cache_hit_rate is None
+        for _ in range(4):
+            volume = subset.get_volume_verify_cache(0, 0)
+            assert volume.shape == (2, 2, 2, 1)
+        assert subset.cache_misses == 1
+        assert subset.cache_hit_rate == 0.75
+        subset.close_all_handles()
+
+
+def test_add_volume_to_cache():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = os.path.join(tmp_dir, 'test.hdf5')
+        with h5py.File(hdf5_file, 'w') as f:
+            f.create_dataset('subj1/input/data', data=np.ones((2, 2, 2, 1)))
+            f['subj1/input'].attrs['voxres'] = [1., 1., 1.]
+            f['subj1/input'].attrs['affine'] = np.eye(4)
+
+            # Ex: volume prefetched with another handle.
+            volume = MRIData.init_mri_data_from_hdf_info(f['subj1/input'])
+
+        subset = _prepare_lazy_subset(hdf5_file)
+        assert subset.subjs_data_list.subject_ids == ['subj1']
+        subset.add_volume_to_cache(0, 0, volume)
+        subset.get_volume_verify_cache(0, 0)
+        assert subset.cache_hits == 1 and subset.cache_misses == 0
+        subset.close_all_handles()
+
+
+if __name__ == '__main__':
+    test_worker_handles()
+    test_volume_cache_stats()
+    test_add_volume_to_cache()
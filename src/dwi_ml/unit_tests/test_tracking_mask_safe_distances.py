@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import copy
+import os
+import tempfile
+
+import h5py
+import numpy as np
+import torch
+
+from dwi_ml.tracking.io_utils import prepare_tracking_mask
+from dwi_ml.tracking.propagation import propagate_multiple_lines
+from dwi_ml.tracking.tracking_mask import TrackingMask
+
+
+def _prepare_mask(interp):
+    # A ball of radius 12, with values in [0, 1] (smooth border).
+    x, y, z = np.meshgrid(*[np.arange(30)] * 3, indexing='ij')
+    dist = np.sqrt((x - 15) ** 2 + (y - 15) ** 2 + (z - 15) ** 2)
+    data = np.clip(12.5 - dist, 0, 1)
+    mask = TrackingMask(data.shape, data, interp)
+    if interp == 'nearest':
+        mask.binarize()
+    return mask
+
+
+def test_safe_distances():
+    rng = np.random.RandomState(0)
+    for interp in ['nearest', 'trilinear']:
+        mask = _prepare_mask(interp)
+        mask.compute_safe_distances()
+        assert mask.safe_distances.dtype == torch.uint8
+        assert mask.safe_distances.max() > 5
+
+        # Points moved by less than their safe distance stay in the mask.
+        xyz = torch.as_tensor(rng.uniform(0, 30, size=(5000, 3)),
+                              dtype=torch.float)
+        r = mask.get_safe_distances(xyz)
+        dirs = torch.as_tensor(rng.normal(size=(5000, 3)), dtype=torch.float)
+        dirs /= torch.linalg.norm(dirs, dim=-1)[:, None]
+        moved = xyz + 0.999 * r[:, None] * dirs
+        safe = r > 0
+        assert torch.all(mask.is_vox_corner_in_mask(xyz[safe]))
+        assert torch.all(mask.is_vox_corner_in_mask(moved[safe]))
+
+
+def _propagate(mask, seeds):
+    nb_verified = [0]
+    is_vox_corner_in_mask = mask.is_vox_corner_in_mask
+
+    def counting_is_vox_corner_in_mask(xyz, subj_idx=None):
+        nb_verified[0] += len(xyz)
+        return is_vox_corner_in_mask(xyz, subj_idx)
+    mask.is_vox_corner_in_mask = counting_is_vox_corner_in_mask
+
+    def update_memory(_, __):
+        pass
+
+    def get_next_dirs(lines, n_last_pos):
+        pos = torch.vstack(n_last_pos)
+        return torch.stack((torch.sin(pos[:, 1] / 4), torch.cos(pos[:, 0] / 4),
+                            0.3 * torch.ones(len(pos))), dim=1)
+
+    lines = [torch.as_tensor(s, dtype=torch.float)[None, :] for s in seeds]
+    lines = propagate_multiple_lines(
+        lines, update_memory, get_next_dirs, theta=np.pi / 2, step_size=0.5,
+        mask=mask, max_nbr_pts=200, append_last_point=False)
+    return lines, nb_verified[0]
+
+
+def test_propagation_with_safe_distances():
+    rng = np.random.RandomState(0)
+    seeds = list(rng.uniform(10, 20, size=(50, 3)))
+    for interp in ['nearest', 'trilinear']:
+        mask = _prepare_mask(interp)
+        fast_mask = copy.deepcopy(mask)
+        fast_mask.compute_safe_distances()
+
+        expected, nb_expected = _propagate(mask, seeds)
+        lines, nb_verified = _propagate(fast_mask, seeds)
+
+        # Same lines, with fewer verifications.
+        for line, expected_line in zip(lines, expected):
+            assert torch.equal(line, expected_line)
+        assert nb_verified < 0.8 * nb_expected
+
+
+def test_prepare_tracking_mask():
+    # A mask with values close to the 0.5 threshold.
+    data = _prepare_mask('trilinear').data.numpy()
+    data = np.clip(data, 0.499999, 0.500001)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = os.path.join(tmp_dir, 'test.hdf5')
+        with h5py.File(hdf5_file, 'w') as f:
+            f.create_dataset('subj1/mask/data', data=data)
+            f['subj1/mask'].attrs['affine'] = np.eye(4)
+
+        with h5py.File(hdf5_file, 'r') as f:
+            nearest, _ = prepare_tracking_mask(f, 'mask', 'subj1', 'nearest')
+            trilinear, _ = prepare_tracking_mask(f, 'mask', 'subj1',
+                                                 'trilinear')
+
+    # Nearest: bool. Trilinear: float64, as before the safe distances.
+    assert nearest.data.dtype == torch.bool
+    assert trilinear.data.dtype == torch.float64
+    assert nearest.safe_distances is not None
+    assert trilinear.safe_distances is not None
+
+    # Safe distances do not change the results near the threshold.
+    rng = np.random.RandomState(0)
+    xyz = torch.as_tensor(rng.uniform(0, 30, size=(5000, 3)),
+                          dtype=torch.float)
+    r = trilinear.get_safe_distances(xyz)
+    expected = TrackingMask(data.shape, data.astype(np.float64),
+                            'trilinear').is_vox_corner_in_mask(xyz)
+    assert torch.equal(trilinear.is_vox_corner_in_mask(xyz), expected)
+    assert torch.all(expected[r > 0])
+
+
+if __name__ == '__main__':
+    test_safe_distances()
+    test_propagation_with_safe_distances()
+    test_prepare_tracking_mask()
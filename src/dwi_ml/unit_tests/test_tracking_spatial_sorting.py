@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+from dwi_ml.tracking.propagation import propagate_multiple_lines
+from dwi_ml.tracking.tracking_mask import TrackingMask
+from dwi_ml.tracking.utils import morton_order
+
+
+def test_morton_order():
+    coords = np.asarray([[1.5, 0, 0], [0, 0, 0], [0, 1, 0], [1, 1, 0],
+                         [0, 0, 1], [0.2, 0.3, 0.1]])
+    # Same voxel: initial order is kept.
+    assert np.array_equal(morton_order(coords), [1, 5, 0, 2, 3, 4])
+
+    groups = np.asarray([1, 1, 0, 0, 0, 0])
+    assert np.array_equal(morton_order(coords, groups), [5, 2, 3, 4, 1, 0])
+
+
+def _propagate(seeds, sort_every):
+    data = np.ones((20, 20, 20))
+    mask = TrackingMask(data.shape, data)
+    lines = [torch.as_tensor(s, dtype=torch.float)[None, :] for s in seeds]
+
+    # A memory, to verify that it follows the lines: each line's seed.
+    memory = {'seeds': [line[0, :] for line in lines]}
+
+    def update_memory(can_continue, _):
+        memory['seeds'] = [s for s, c in zip(memory['seeds'], can_continue)
+                           if c]
+
+    def reorder_memory(order):
+        memory['seeds'] = [memory['seeds'][i] for i in order]
+
+    def get_next_dirs(lines, n_last_pos):
+        for line, seed in zip(lines, memory['seeds']):
+            assert torch.equal(line[0, :], seed)
+        pos = torch.vstack(n_last_pos)
+        return torch.stack((torch.sin(pos[:, 1] / 3), torch.cos(pos[:, 0] / 3),
+                            0.5 * torch.ones(len(pos))), dim=1)
+
+    return propagate_multiple_lines(
+        lines, update_memory, get_next_dirs, theta=np.pi / 2, step_size=0.5,
+        mask=mask, max_nbr_pts=50, sort_every=sort_every,
+        reorder_memory=reorder_memory)
+
+
+def test_propagation_with_sorting():
+    rng = np.random.RandomState(0)
+    seeds = list(rng.uniform(2, 18, size=(30, 3)))
+
+    expected = _propagate(seeds, sort_every=0)
+    lines = _propagate(seeds, sort_every=3)
+
+    # Same lines, in the seeds' order.
+    assert len(lines) == len(expected)
+    for line, expected_line in zip(lines, expected):
+        assert torch.allclose(line, expected_line)
+
+
+if __name__ == '__main__':
+    test_morton_order()
+    test_propagation_with_sorting()
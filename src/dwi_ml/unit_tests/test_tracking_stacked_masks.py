@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+from dwi_ml.tracking.propagation import propagate_multiple_lines
+from dwi_ml.tracking.tracking_mask import TrackingMask
+
+
+def _prepare_masks():
+    # Subject 0: 10 x 10 x 10 mask, with a hole at x = 6.
+    # Subject 1: 15 x 8 x 8 mask, full.
+    data0 = np.ones((10, 10, 10))
+    data0[6, :, :] = 0
+    data1 = np.ones((15, 8, 8))
+    masks = [TrackingMask(data0.shape, data0),
+             TrackingMask(data1.shape, data1)]
+    for mask in masks:
+        mask.binarize()
+    return masks
+
+
+def _propagate(lines, mask, lines_subj_idx=None):
+    def update_memory(_, __):
+        pass
+
+    def get_next_dirs(_lines, n_last_pos):
+        # Always going towards +x.
+        return torch.tensor([[1., 0., 0.]]).repeat(len(n_last_pos), 1)
+
+    return propagate_multiple_lines(
+        lines, update_memory, get_next_dirs, theta=np.pi / 2, step_size=1.,
+        mask=mask, max_nbr_pts=30, append_last_point=False,
+        lines_subj_idx=lines_subj_idx)
+
+
+def test_stacked_masks():
+    masks = _prepare_masks()
+    seeds = [[[0.5, 2.5, 2.5], [1.5, 2.5, 2.5]],
+             [[7.5, 2.5, 2.5], [8.5, 2.5, 2.5]],
+             [[0.5, 5.5, 5.5], [1.5, 5.5, 5.5]],
+             [[0.5, 2.5, 9.5], [1.5, 2.5, 9.5]]]
+    lines = [torch.tensor(s) for s in seeds]
+    lines_subj_idx = torch.tensor([0, 0, 1, 1])
+
+    stacked = TrackingMask.stack(masks)
+    assert stacked.data.shape == (2, 15, 10, 10)
+    assert stacked.data.dtype == torch.bool
+
+    # Same lines as when propagating each subject separately.
+    expected = _propagate(lines[0:2], masks[0]) + \
+        _propagate(lines[2:4], masks[1])
+    final_lines = _propagate(lines, stacked, lines_subj_idx)
+    for line, expected_line in zip(final_lines, expected):
+        assert torch.equal(line, expected_line)
+
+    # Subject 0: stops before the hole, or at its bound (x = 10).
+    # Subject 1: goes up to its bound (x = 15), but the last line starts out
+    # of subject 1's mask (z = 9.5 > 8), even if in subject 0's bounds.
+    assert [len(line) for line in final_lines] == [6, 3, 15, 2]
+
+
+if __name__ == '__main__':
+    test_stacked_masks()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import h5py
+import numpy as np
+import torch
+
+from dwi_ml.data.dataset.multi_subject_containers import MultisubjectSubset
+from dwi_ml.data.dataset.single_subject_containers import LazySubjectData
+from dwi_ml.data.dataset.subjectdata_list_containers import \
+    LazySubjectsDataList
+from dwi_ml.models.projects.learn2track_model import Learn2TrackModel
+from dwi_ml.models.projects.transformer_models import TransformerSrcOnlyModel
+from dwi_ml.tracking.multi_subject_tracking import (SubjectTrackingData,
+                                                    track_multiple_subjects)
+from dwi_ml.tracking.projects.learn2track_tracker import RecurrentTracker
+from dwi_ml.tracking.projects.transformer_tracker import TransformerTracker
+from dwi_ml.tracking.tracking_mask import TrackingMask
+
+# Three subjects of different sizes. Their masks have a hole, so that lines
+# stop at different steps.
+VOLUME_SHAPES = [(10, 10, 10), (12, 9, 10), (9, 11, 8)]
+NB_SEEDS = [10, 7, 5]
+
+
+class SeedGeneratorForTest:
+    """
+    Replaces scilpy's SeedGenerator: seeds are drawn once, uniformly in a
+    box (voxel space, corner origin), and returned by index (modulo the
+    number of seeds, as scilpy).
+    """
+    def __init__(self, nb_seeds, low, high, rng_seed=0):
+        self.voxres = np.ones(3)
+        self.seeds = list(np.random.RandomState(rng_seed).uniform(
+            low, high, size=(nb_seeds, 3)))
+
+    def init_generator(self, rng_seed, numbers_to_skip):
+        return None, None
+
+    def get_next_pos(self, random_generator, indices, which_seed):
+        return self.seeds[which_seed % len(self.seeds)]
+
+    def get_next_n_pos(self, random_generator, indices, which_seed_start, n):
+        return [self.get_next_pos(random_generator, indices, i)
+                for i in range(which_seed_start, which_seed_start + n)]
+
+
+def _prepare_learn2track():
+    torch.manual_seed(0)
+    return Learn2TrackModel(
+        'test', step_size=0.5, compress_lines=False, nb_features=4,
+        rnn_layer_sizes=[16, 16], nb_previous_dirs=1,
+        prev_dirs_embedded_size=4, prev_dirs_embedding_key='nn_embedding',
+        normalize_prev_dirs=True, input_embedding_key='nn_embedding',
+        input_embedded_size=8, kernel_size=None, nb_cnn_filters=None,
+        rnn_key='lstm', use_skip_connection=True,
+        use_layer_normalization=True, dropout=0., start_from_copy_prev=False,
+        dg_key='cosine-regression', dg_args=None, neighborhood_type=None,
+        neighborhood_radius=None)
+
+
+def _prepare_transformer():
+    torch.manual_seed(0)
+    return TransformerSrcOnlyModel(
+        experiment_name='test', step_size=0.5, compress_lines=None,
+        nb_features=4, max_len=100, input_embedded_size=16,
+        positional_encoding_key='sinusoidal',
+        input_embedding_key='nn_embedding', ffnn_hidden_size=None, nheads=2,
+        dropout_rate=0., activation='relu', norm_first=False, n_layers_e=2,
+        dg_key='cosine-regression', dg_args=None, nb_cnn_filters=None,
+        kernel_size=None)
+
+
+def _prepare_subset(hdf5_file):
+    rng = np.random.RandomState(0)
+    with h5py.File(hdf5_file, 'w') as f:
+        for i, shape in enumerate(VOLUME_SHAPES):
+            group = f.create_group('subj{}/input'.format(i))
+            group.create_dataset('data', data=rng.rand(*shape, 4))
+            group.attrs['voxres'] = [1., 1., 1.]
+            group.attrs['affine'] = np.eye(4)
+
+    subset = MultisubjectSubset('testing', hdf5_file, lazy=True,
+                                cache_size=len(VOLUME_SHAPES))
+    subset.volume_groups = ['input']
+    subset.subjs_data_list = LazySubjectsDataList(hdf5_file, None)
+    for i in range(len(VOLUME_SHAPES)):
+        subset.subjs_data_list.add_subject(LazySubjectData(
+            ['input'], [4], [], 'subj{}'.format(i)))
+    subset.nb_subjects = len(VOLUME_SHAPES)
+    return subset
+
+
+def _prepare_mask(subj_idx):
+    shape = VOLUME_SHAPES[subj_idx]
+    data = np.ones(shape)
+    data[:, :, shape[2] // 2 + 1] = 0
+    mask = TrackingMask(shape, data)
+    mask.binarize()
+    return mask
+
+
+def _prepare_seed_generator(subj_idx):
+    return SeedGeneratorForTest(NB_SEEDS[subj_idx], 2,
+                                np.asarray(VOLUME_SHAPES[subj_idx]) - 2,
+                                rng_seed=subj_idx)
+
+
+def _prepare_tracker(tracker_cls, model, subset, **kw):
+    return tracker_cls(
+        input_volume_group='input', dataset=subset, subj_idx=0, model=model,
+        mask=_prepare_mask(0), seed_generator=_prepare_seed_generator(0),
+        nbr_seeds=NB_SEEDS[0], min_len_mm=2, max_len_mm=20, step_size_mm=0.5,
+        theta=np.pi / 2, compression_th=None, **kw)
+
+
+def test_track_subjects():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        subset = _prepare_subset(os.path.join(tmp_dir, 'test.hdf5'))
+        for tracker_cls, model in [(RecurrentTracker, _prepare_learn2track()),
+                                   (TransformerTracker,
+                                    _prepare_transformer())]:
+            tracker = _prepare_tracker(tracker_cls, model, subset,
+                                       algo='det', simultaneous_tracking=8)
+
+            # Each subject alone.
+            expected = []
+            for i in range(len(VOLUME_SHAPES)):
+                tracker.set_subjects([i], [_prepare_mask(i)],
+                                     [_prepare_seed_generator(i)],
+                                     [NB_SEEDS[i]])
+                expected.append(tracker.track())
+
+            # All together: batches mix subjects. Same lines and seeds.
+            subj_idxs = list(range(len(VOLUME_SHAPES)))
+            tracker.set_subjects(
+                subj_idxs, [_prepare_mask(i) for i in subj_idxs],
+                [_prepare_seed_generator(i) for i in subj_idxs], NB_SEEDS)
+            lines_per_subj, seeds_per_subj = tracker.track_subjects()
+
+            # Some lines are rejected (too short).
+            assert sum(len(e[0]) for e in expected) < sum(NB_SEEDS)
+            for lines, seeds, (expected_lines, expected_seeds) in zip(
+                    lines_per_subj, seeds_per_subj, expected):
+                assert len(lines) == len(expected_lines) > 0
+                for line, expected_line in zip(lines, expected_lines):
+                    assert np.allclose(line, expected_line, atol=1e-5)
+                assert np.allclose(seeds, expected_seeds)
+
+
+def test_track_multiple_subjects():
+    loaded = []
+
+    def load_subject(subj_id):
+        loaded.append(subj_id)
+        i = int(subj_id[-1])
+        return SubjectTrackingData(subj_id, _prepare_seed_generator(i),
+                                   NB_SEEDS[i], _prepare_mask(i), ref=None)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        subset = _prepare_subset(os.path.join(tmp_dir, 'test.hdf5'))
+        tracker = _prepare_tracker(RecurrentTracker, _prepare_learn2track(),
+                                   subset, algo='det',
+                                   simultaneous_tracking=8)
+        subj_ids = ['subj{}'.format(i) for i in range(len(VOLUME_SHAPES))]
+
+        tracker.set_subjects([0, 1], [_prepare_mask(0), _prepare_mask(1)],
+                             [_prepare_seed_generator(0),
+                              _prepare_seed_generator(1)], NB_SEEDS[0:2])
+        expected = list(zip(*tracker.track_subjects()))
+
+        # The first subject, already loaded, is not loaded again.
+        first_subj_data = load_subject(subj_ids[0])
+        results = list(track_multiple_subjects(
+            tracker, subj_ids, load_subject, nb_subjects_together=2,
+            first_subj_data=first_subj_data))
+        assert loaded == subj_ids
+        assert results[0][0] is first_subj_data
+        assert [r[0].subj_id for r in results] == subj_ids
+        for (_, lines, seeds), (expected_lines, expected_seeds) in zip(
+                results, expected):
+            assert np.allclose(seeds, expected_seeds)
+            for line, expected_line in zip(lines, expected_lines):
+                assert np.allclose(line, expected_line, atol=1e-5)
+
+
+def test_samples_per_seed():
+    k = 3
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        subset = _prepare_subset(os.path.join(tmp_dir, 'test.hdf5'))
+        for tracker_cls, model in [(RecurrentTracker, _prepare_learn2track()),
+                                   (TransformerTracker,
+                                    _prepare_transformer())]:
+            # Deterministic "sampling": all samples of a seed are the same.
+            dg = model.direction_getter
+            dg._sample_tracking_direction_prob = dg._get_tracking_direction_det
+
+            for simultaneous_tracking in [1, 8]:
+                tracker = _prepare_tracker(
+                    tracker_cls, model, subset, algo='prob',
+                    simultaneous_tracking=simultaneous_tracking,
+                    save_seeds=True)
+                expected_lines, expected_seeds = tracker.track()
+
+                tracker = _prepare_tracker(
+                    tracker_cls, model, subset, algo='prob',
+                    simultaneous_tracking=simultaneous_tracking,
+                    save_seeds=True, samples_per_seed=k)
+                if simultaneous_tracking > 1:
+                    assert tracker._nb_seeds_per_batch() == 2
+                lines, seeds = tracker.track()
+
+                # k copies of each line, one after the other.
+                assert len(lines) == k * len(expected_lines)
+                for i, line in enumerate(lines):
+                    assert np.allclose(line, expected_lines[i // k],
+                                       atol=1e-5)
+                    assert np.allclose(seeds[i], expected_seeds[i // k])
+
+
+if __name__ == '__main__':
+    test_track_subjects()
+    test_track_multiple_subjects()
+    test_samples_per_seed()
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import logging
 import os
+import tempfile
 
+import h5py
 import numpy as np
 from dipy.io.stateful_tractogram import set_sft_logger_level
 from torch.utils.data.dataloader import DataLoader
 
 from dwi_ml.data.dataset.multi_subject_containers import MultiSubjectDataset
 from dwi_ml.models.main_models import MainModelOneInput
+from dwi_ml.training.batch_loaders import DWIMLStreamlinesBatchLoader
 from dwi_ml.unit_tests.utils.expected_values import TEST_EXPECTED_NB_STREAMLINES
 from dwi_ml.unit_tests.utils.data_and_models_for_tests import (
     create_test_batch_sampler, create_batch_loader, fetch_testing_data)
@@ -84,6 +87,74 @@ def test_batch_loader():
                                   split_ratio=0)
 
 
+def _create_vox_corner_hdf5(hdf5_file, lengths):
+    rng = np.random.RandomState(0)
+    data = rng.rand(sum(lengths), 3).astype(np.float32)
+    with h5py.File(hdf5_file, 'w') as hdf_handle:
+        hdf_handle.attrs['training_subjs'] = ['subj1']
+        hdf_handle.attrs['validation_subjs'] = []
+        hdf_handle.attrs['testing_subjs'] = []
+        hdf_handle.attrs['step_size'] = 0.5
+        hdf_handle.attrs['compress'] = 'Not defined by user'
+        volume = hdf_handle.create_group('subj1/input')
+        volume.create_dataset('data', data=np.zeros((3, 3, 3, 2)))
+        volume.attrs['type'] = 'volume'
+        volume.attrs['nb_features'] = 2
+        volume.attrs['voxres'] = [1., 1., 1.]
+        volume.attrs['affine'] = np.eye(4)
+
+        group = hdf_handle.create_group('subj1/streamlines')
+        group.attrs['type'] = 'streamlines'
+        group.attrs['space'] = 'vox'
+        group.attrs['origin'] = 'trackvis'
+        group.attrs['affine'] = np.eye(4)
+        group.attrs['dimensions'] = [3, 3, 3]
+        group.attrs['voxel_sizes'] = [1., 1., 1.]
+        group.attrs['voxel_order'] = 'RAS'
+        group.create_dataset('data', data=data)
+        group.create_dataset('offsets', data=np.concatenate(
+            ([0], np.cumsum(lengths)[:-1])))
+        group.create_dataset('lengths', data=lengths)
+        group.create_dataset('euclidean_lengths', data=np.ones(len(lengths)))
+    return data
+
+
+def test_batch_loader_fast_path():
+    lengths = np.asarray([4, 7, 2, 5])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hdf5_file = os.path.join(tmp_dir, 'test.hdf5')
+        data = _create_vox_corner_hdf5(hdf5_file, lengths)
+        dataset = MultiSubjectDataset(hdf5_file, lazy=False)
+        dataset.load_data(load_validation=False, load_testing=False)
+
+        # Default model: no resampling or compression.
+        model = MainModelOneInput(experiment_name='test')
+        batch_loader = DWIMLStreamlinesBatchLoader(
+            dataset, model, streamline_group_name='streamlines', rng=1234)
+        batch_loader.set_context('training')
+        subj_sft_data = dataset.training_set.subjs_data_list[0] \
+            .sft_data_list[0]
+        assert subj_sft_data.is_vox_corner
+        assert not batch_loader._needs_resampling()
+        assert batch_loader._use_fast_path(subj_sft_data)
+
+        streamlines, _ = batch_loader.load_batch_streamlines([(0, [3, 1])])
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        for s, s_id in zip(streamlines, [3, 1]):
+            assert np.allclose(s, data[offsets[s_id]:offsets[s_id + 1]])
+
+        # Resampling with a new step size: still on the flat arrays.
+        model = MainModelOneInput(experiment_name='test', step_size=0.2)
+        batch_loader.model = model
+        assert batch_loader._needs_resampling()
+        assert batch_loader._use_fast_path(subj_sft_data)
+
+        # Compressing requires the SFT.
+        model = MainModelOneInput(experiment_name='test', compress_lines=0.1)
+        batch_loader.model = model
+        assert not batch_loader._use_fast_path(subj_sft_data)
+
+
 def _load_directly_and_verify(batch_loader, batch_idx_tuples,
                               split_ratio=SPLIT_RATIO):
     expected_nb_streamlines = 0
@@ -158,3 +229,4 @@ if __name__ == '__main__':
     # typically produces a lot of outputs!
     set_sft_logger_level('WARNING')
     test_batch_loader()
+    test_batch_loader_fast_path()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+
+from dwi_ml.cache.cache_manager import SingleThreadCacheManager
+from dwi_ml.training.batch_samplers import DWIMLBatchIDSampler
+
+nb_subjects = 20
+nb_streamlines_per_subj = [50 + 10 * i for i in range(nb_subjects)]
+starts = np.cumsum([0] + nb_streamlines_per_subj)
+cache_size = 4
+
+
+def _fake_dataset():
+    subset = SimpleNamespace(
+        nb_subjects=nb_subjects, is_lazy=True, cache_size=cache_size,
+        total_nb_streamlines=[starts[-1]],
+        streamline_ids_per_subj=[{i: slice(starts[i], starts[i + 1])
+                                  for i in range(nb_subjects)}],
+        streamline_lengths_mm=[np.ones(starts[-1])])
+    return SimpleNamespace(streamline_groups=['streamlines'],
+                           training_set=subset, validation_set=subset,
+                           context=None)
+
+
+def _run_one_epoch(**kw):
+    sampler = DWIMLBatchIDSampler(
+        _fake_dataset(), 'streamlines', batch_size_training=40,
+        batch_size_validation=None, batch_size_units='nb_streamlines',
+        rng=1234, nb_subjects_per_batch=2, **kw)
+    sampler.set_context('training')
+
+    # Simulating the volume cache.
+    cache = SingleThreadCacheManager(cache_size)
+    nb_hits, nb_accesses = 0, 0
+    all_ids = []
+    for batch in sampler:
+        for subj, ids in batch:
+            nb_accesses += 1
+            if subj in cache:
+                nb_hits += 1
+                _ = cache[subj]
+            else:
+                cache[subj] = None
+            all_ids.extend(np.asarray(ids) + starts[subj])
+    return nb_hits / nb_accesses, all_ids
+
+
+def test_cache_affinity():
+    hit_rate_random, ids_random = _run_one_epoch(cycles=1)
+    hit_rate, ids = _run_one_epoch(cache_affinity=True)
+    hit_rate_rotating, ids_rotating = _run_one_epoch(cache_affinity=True,
+                                                     cycles=3)
+    logging.info("Cache hit rate: random sampling: {:.2f}. With cache "
+                 "affinity: {:.2f}. Rotating every 3 batches: {:.2f}"
+                 .format(hit_rate_random, hit_rate, hit_rate_rotating))
+
+    # All streamlines used exactly once in the epoch.
+    for epoch_ids in [ids_random, ids, ids_rotating]:
+        assert sorted(epoch_ids) == list(range(starts[-1]))
+    assert hit_rate > 0.75
+    assert hit_rate_rotating > 2 * hit_rate_random
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(level='INFO')
+    test_cache_affinity()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import contextlib
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from dwi_ml.experiment_utils.memory import BYTES_IN_GB
+from dwi_ml.experiment_utils.mixed_precision import get_grad_scaler
+from dwi_ml.models.projects.transformer_models import TransformerSrcOnlyModel
+from dwi_ml.training.utils.batch_size_tuner import (
+    get_worst_case_batch, measure_training_step_memory, tune_batch_size)
+
+# 2 subjects, 10 streamlines each.
+lengths_mm = np.concatenate([np.arange(10), np.arange(10) + 0.5]) * 2 + 5
+subset = SimpleNamespace(
+    streamline_lengths_mm=[lengths_mm],
+    streamline_ids_per_subj=[{0: slice(0, 10), 1: slice(10, 20)}],
+    total_nb_streamlines=[20])
+
+
+def _fake_trainer():
+    torch.manual_seed(0)
+    model = TransformerSrcOnlyModel(
+        experiment_name='test', step_size=0.5, compress_lines=None,
+        nb_features=4, max_len=30, input_embedded_size=16,
+        positional_encoding_key='sinusoidal',
+        input_embedding_key='nn_embedding', ffnn_hidden_size=None, nheads=2,
+        dropout_rate=0., activation='relu', norm_first=False, n_layers_e=2,
+        dg_key='cosine-regression', dg_args=None, nb_cnn_filters=None,
+        kernel_size=None)
+    model.set_context('training')
+
+    def _load_batch(batch_ids_per_subj):
+        # One point per mm.
+        return [torch.cumsum(torch.rand(int(lengths_mm[i + 10 * subj]), 3),
+                             dim=0)
+                for subj, ids in batch_ids_per_subj for i in ids]
+
+    def _run_one_batch(lines):
+        inputs = [torch.rand(len(s) - 1, 4) for s in lines]
+        outputs = model(inputs, [s[:-1] for s in lines])
+        return model.compute_loss(outputs, lines)
+
+    sampler = SimpleNamespace(
+        dataset=SimpleNamespace(training_set=subset), streamline_group_idx=0,
+        batch_size_training=4, batch_size_units='nb_streamlines',
+        set_context=lambda context: None)
+    return SimpleNamespace(
+        model=model, batch_sampler=sampler, device=torch.device('cpu'),
+        batch_loader=SimpleNamespace(load_batch_streamlines=_load_batch,
+                                     set_context=lambda context: None),
+        run_one_batch=_run_one_batch, _autocast=contextlib.nullcontext,
+        grad_scaler=get_grad_scaler('float32', torch.device('cpu')),
+        optimizer_key='Adam')
+
+
+def test_worst_case_batch():
+    # The 3 longest: last streamline of each subject, then subject 1's 9th.
+    batch = get_worst_case_batch(subset, 0, 3, 'nb_streamlines')
+    assert [(subj, list(ids)) for subj, ids in batch] == [(0, [9]),
+                                                          (1, [8, 9])]
+
+    # In mm: 24 + 23 < 50 < 24 + 23 + 22
+    batch = get_worst_case_batch(subset, 0, 50, 'length_mm')
+    assert [(subj, list(ids)) for subj, ids in batch] == [(0, [9]), (1, [9])]
+
+
+def test_tune_batch_size():
+    trainer = _fake_trainer()
+    memory = [measure_training_step_memory(
+        trainer, get_worst_case_batch(subset, 0, n, 'nb_streamlines'))
+        for n in [3, 6]]
+    assert memory[0] < memory[1]
+    assert all(p.grad is None for p in trainer.model.parameters())
+
+    # Budget between sizes 3 and 6: chosen batch size should be between them.
+    budget = (memory[0] + memory[1]) / 2 / BYTES_IN_GB
+    batch_size = tune_batch_size(trainer, budget)
+    assert 3 <= batch_size < 6
+    assert trainer.batch_sampler.batch_size_training == batch_size
+
+
+if __name__ == '__main__':
+    test_worst_case_batch()
+    test_tune_batch_size()
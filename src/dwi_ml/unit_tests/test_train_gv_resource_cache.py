@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+from dwi_ml.tracking.tracking_mask import TrackingMask
+from dwi_ml.training.utils.gv_resource_cache import GVResourceCache
+
+
+def test_stacked_tracking_masks():
+    cache = GVResourceCache(3, torch.device('cpu'))
+
+    # Pretending that the subjects' masks were already loaded.
+    subset = object()
+    cache._verify_subset(subset)
+    for subj_idx, shape in enumerate([(4, 4, 4), (5, 3, 3), (2, 2, 2)]):
+        mask = TrackingMask(shape, np.ones(shape))
+        mask.binarize()
+        cache.masks[subj_idx] = mask
+
+    # Stacked once for consecutive calls with the same group of subjects.
+    stacked = cache.get_stacked_tracking_mask(subset, [0, 1], 'mask')
+    assert stacked.data.shape == (2, 5, 4, 4)
+    assert cache.get_stacked_tracking_mask(subset, [0, 1], 'mask') is stacked
+    other = cache.get_stacked_tracking_mask(subset, [1, 0], 'mask')
+    assert other is not stacked
+    assert torch.equal(other.higher_bound[0], torch.as_tensor([5, 3, 3]))
+
+    # Only the last stack is kept.
+    assert (0, 1) not in cache.stacked_masks
+    assert cache.get_stacked_tracking_mask(subset, [0, 1], 'mask') \
+        is not stacked
+    assert (0, 1) in cache.stacked_masks
+
+    # Emptied with the other resources when the subset changes.
+    cache._verify_subset(object())
+    assert (0, 1) not in cache.stacked_masks
+
+
+if __name__ == '__main__':
+    test_stacked_tracking_masks()
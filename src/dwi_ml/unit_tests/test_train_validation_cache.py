@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import tempfile
+
+import torch
+
+from dwi_ml.training.utils.validation_cache import ValidationInputsCache
+
+
+def _fake_batch(nb_streamlines, seed):
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(3, 10, (nb_streamlines,), generator=generator)
+    streamlines = [torch.rand(n, 3, generator=generator) for n in lengths]
+    inputs = [torch.rand(n, 8, generator=generator) for n in lengths]
+    return (streamlines, {0: slice(0, nb_streamlines)}), inputs
+
+
+batches = [_fake_batch(4, seed) for seed in range(3)]
+
+
+def _run_cache(cache):
+    # First epoch: remembering batches and inputs.
+    cache.start_epoch()
+    for batch_id, (data, inputs) in enumerate(batches):
+        assert cache.add_batch(data) == batch_id
+        assert cache.get_inputs(batch_id, 'cpu') is None
+        cache.add_inputs(batch_id, inputs)
+    cache.end_epoch()
+    assert cache.is_complete
+    assert len(cache) == 3
+
+    # Second epoch: looping on the same batches.
+    cache.start_epoch()
+    for batch_id, data in enumerate(cache):
+        expected_data, expected_inputs = batches[batch_id]
+        for s, expected_s in zip(data[0], expected_data[0]):
+            assert torch.equal(s, expected_s)
+        inputs = cache.get_inputs(batch_id, 'cpu')
+        if inputs is not None:
+            for x, expected_x in zip(inputs, expected_inputs):
+                assert torch.equal(x, expected_x)
+    return cache.nb_hits, cache.nb_misses
+
+
+def test_validation_cache():
+    # Enough room for all batches.
+    assert _run_cache(ValidationInputsCache(1.)) == (3, 0)
+
+    # Room for only the first batch.
+    first_batch_size = sum(x.numel() * 4 for x in batches[0][1])
+    budget = (first_batch_size + 1) / 1024 ** 3
+    assert _run_cache(ValidationInputsCache(budget)) == (1, 2)
+
+    # Memory-mapped files.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        assert _run_cache(ValidationInputsCache(1., tmp_dir)) == (3, 0)
+
+
+if __name__ == '__main__':
+    test_validation_cache()